@@ -29,7 +29,9 @@ public class AuthzDBAdapter
     private static final String CREATE_NEW_FILE = "insert into objects (name, owner_id, data_key, object_type, parent_id, creation_time) values(?, ?, ?, ?, ?, datetime('now'))";
     private static final String SET_NEW_FILE_PERMS = "insert into object_acl (user_id, object_id, access_type_id) values(?, ?, ?)";
     private static final String UPDATE_FILE_INFO = "update objects set object_size=?, md5sum=?, creation_time=datetime('now') where id = ?";
-    private static final String GET_USER_USAGE = "SELECT SUM(object_size) FROM objects where owner_id = ? and object_type = ?";
+    private static final String GET_USER_USAGE = "SELECT used + reserved FROM object_usage where user_id = ? and object_type = ?";
+    private static final String SUM_USER_USAGE = "SELECT SUM(object_size) FROM objects where owner_id = ? and object_type = ?";
+    private static final String ADD_FILE_USAGE = "update object_usage set used = used + ? - (select COALESCE(object_size, 0) from objects where id = ?) where user_id = (select owner_id from objects where id = ?) and object_type = (select object_type from objects where id = ?)";
     private static final String GET_USER_QUOTA = "SELECT quota from object_quota where user_id = ? and object_type = ?";
     private static final String GET_FILE_SIZE = "SELECT object_size FROM objects WHERE id = ?";
     private static final String GET_FILE_OWNER = "SELECT owner_id FROM objects WHERE id = ?";
@@ -256,15 +258,23 @@ public class AuthzDBAdapter
             }
             long quota = rs.getLong(1);
 
+            // the usage cumulus keeps, a user it has not counted yet is
+            // added up
+            pstmt.close();
             pstmt = c.prepareStatement(GET_USER_USAGE);
             pstmt.setString(1, canUser);
             pstmt.setInt(2, objectType);
             rs = pstmt.executeQuery();
-            long totalUsage = 0;
-            if(rs.next())
+            if(!rs.next())
             {
-                totalUsage = rs.getLong(1);
+                pstmt.close();
+                pstmt = c.prepareStatement(SUM_USER_USAGE);
+                pstmt.setString(1, canUser);
+                pstmt.setInt(2, objectType);
+                rs = pstmt.executeQuery();
+                rs.next();
             }
+            long totalUsage = rs.getLong(1);
 
             if(totalUsage + fileSize > quota)
             {
@@ -804,6 +814,16 @@ public class AuthzDBAdapter
         try
         {
             c = getConnection();
+            // the owners usage changes with the size, both or neither
+            c.setAutoCommit(false);
+            pstmt = c.prepareStatement(ADD_FILE_USAGE);
+            pstmt.setLong(1, size);
+            pstmt.setInt(2, objectId);
+            pstmt.setInt(3, objectId);
+            pstmt.setInt(4, objectId);
+            pstmt.executeUpdate();
+            pstmt.close();
+
             pstmt = c.prepareStatement(UPDATE_FILE_INFO);
             pstmt.setLong(1, size);
             pstmt.setString(2, md5string);
@@ -812,12 +832,25 @@ public class AuthzDBAdapter
             int rc = pstmt.executeUpdate();
             if(rc != 1)
             {
+                c.rollback();
                 throw new AuthzDBException("did not insert the row properly");
             }
+            c.commit();
         }
         catch(SQLException e)
         {
             logger.error("an error occured looking up the file ", e);
+            try
+            {
+                if (c != null)
+                {
+                    c.rollback();
+                }
+            }
+            catch (SQLException sql)
+            {
+                logger.error("SQLException rolling back", sql);
+            }
             throw new AuthzDBException(e);
         }
         finally
@@ -830,6 +863,7 @@ public class AuthzDBAdapter
                 }
                 if (c != null)
                 {
+                    c.setAutoCommit(true);
                     returnConnection(c);
                 }
             }
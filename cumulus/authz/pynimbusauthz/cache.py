@@ -0,0 +1,119 @@
+import os
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+
+#  A bounded in process cache.  Entries are dropped least recently used
+#  first once max_size is reached and are never returned once they are
+#  older than ttl seconds.
+#
+#  Other processes (the admin command line tools) cannot reach into this
+#  cache, so they invalidate it by replacing stamp_file.  Every lookup
+#  stats the stamp and flushes everything if it changed since the last
+#  look.  That is a single local syscall, no db round trip.
+class TTLCache(object):
+
+    def __init__(self, max_size=1000, ttl=60, stamp_file=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stamp_file = stamp_file
+        self.stamp_sig = self._read_stamp()
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def set_stamp_file(self, stamp_file):
+        self.lock.acquire()
+        try:
+            self.stamp_file = stamp_file
+            self.stamp_sig = self._read_stamp()
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def _read_stamp(self):
+        if self.stamp_file == None:
+            return None
+        try:
+            st = os.stat(self.stamp_file)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    # must be called with the lock held
+    def _check_stamp(self):
+        sig = self._read_stamp()
+        if sig != self.stamp_sig:
+            self.stamp_sig = sig
+            self.entries.clear()
+
+    # return the cached value or None
+    def get(self, key):
+        if self.max_size < 1:
+            return None
+        self.lock.acquire()
+        try:
+            self._check_stamp()
+            ent = self.entries.pop(key, None)
+            if ent == None:
+                self.misses = self.misses + 1
+                return None
+            (tm, value) = ent
+            if time.time() - tm > self.ttl:
+                self.misses = self.misses + 1
+                return None
+            # put it back at the most recently used end
+            self.entries[key] = ent
+            self.hits = self.hits + 1
+            return value
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        if self.max_size < 1:
+            return
+        self.lock.acquire()
+        try:
+            self._check_stamp()
+            self.entries.pop(key, None)
+            while len(self.entries) >= self.max_size:
+                self.entries.popitem(last=False)
+            self.entries[key] = (time.time(), value)
+        finally:
+            self.lock.release()
+
+    # drop the given key, or everything if key is None.  this only affects
+    # this process, see touch() for the others
+    def invalidate(self, key=None):
+        self.lock.acquire()
+        try:
+            if key == None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+        finally:
+            self.lock.release()
+
+    # replace the stamp file so that every process sharing it flushes its
+    # cache on the next lookup.  a new file is renamed into place so the
+    # inode changes even if the clock granularity hides the mtime change
+    def touch(self):
+        if self.stamp_file == None:
+            return
+        d = os.path.dirname(os.path.abspath(self.stamp_file))
+        (osf, tmp_name) = tempfile.mkstemp(dir=d, prefix=".stamp")
+        try:
+            os.write(osf, "%d %f\n" % (os.getpid(), time.time()))
+            os.close(osf)
+            os.rename(tmp_name, self.stamp_file)
+        except:
+            try:
+                os.remove(tmp_name)
+            except OSError:
+                pass
+            raise
+
+    def get_size(self):
+        return len(self.entries)
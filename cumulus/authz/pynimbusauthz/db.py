@@ -2,6 +2,8 @@ import sqlite3
 import os
 import itertools
 import urlparse
+import threading
+import time
 import pynimbusauthz
 from pynimbusauthz.authz_exception import AuthzException
 
@@ -22,10 +24,147 @@ def make_test_database(db_str=":memory:"):
 
 
 
+#  what was added to the schema after it was first released.  acl.sql and
+#  acl.postgres.sql have all of it for a new database, upgrade_schema adds
+#  what is missing to one made before.  each entry is the name of the table
+#  or index with its sqlite and postgres ddl, they must match the files
+g_schema_additions = [
+    ("multipart_join",
+        """create table multipart_join(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            upload_id varchar(64) UNIQUE NOT NULL,
+            object_id INTEGER REFERENCES objects(id) NOT NULL,
+            name varchar(1024) NOT NULL,
+            owner_id char(36) REFERENCES users_canonical(id) NOT NULL,
+            creation_time DATETIME,
+            complete INTEGER DEFAULT 0)""",
+        """create table multipart_join(
+            id SERIAL PRIMARY KEY,
+            upload_id varchar(64) UNIQUE NOT NULL,
+            object_id INTEGER REFERENCES objects(id) ON DELETE CASCADE NOT NULL,
+            name varchar(1024) NOT NULL,
+            owner_id char(36) REFERENCES users_canonical(id) ON DELETE CASCADE NOT NULL,
+            creation_time TIMESTAMP,
+            complete INTEGER DEFAULT 0)"""),
+    ("multipart",
+        """create table multipart(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            data_key varchar(1024) UNIQUE NOT NULL,
+            order_num INTEGER NOT NULL,
+            mp_id INTEGER REFERENCES multipart_join(id) NOT NULL,
+            md5sum CHAR(32),
+            object_size INTEGER DEFAULT 0,
+            creation_time DATETIME,
+            UNIQUE(mp_id, order_num))""",
+        """create table multipart(
+            id SERIAL PRIMARY KEY,
+            data_key varchar(1024) UNIQUE NOT NULL,
+            order_num INTEGER NOT NULL,
+            mp_id INTEGER REFERENCES multipart_join(id) ON DELETE CASCADE NOT NULL,
+            md5sum CHAR(32),
+            object_size bigint DEFAULT 0,
+            creation_time TIMESTAMP,
+            UNIQUE(mp_id, order_num))"""),
+    ("objects_parent_name_idx",
+        "create index objects_parent_name_idx on objects(parent_id, name)",
+        "create index objects_parent_name_idx on objects(parent_id, name)"),
+    ("objects_owner_idx",
+        "create index objects_owner_idx on objects(owner_id, parent_id)",
+        "create index objects_owner_idx on objects(owner_id, parent_id)"),
+    ("object_acl_object_idx",
+        "create index object_acl_object_idx on object_acl(object_id, user_id)",
+        "create index object_acl_object_idx on object_acl(object_id, user_id)"),
+    ("object_usage",
+        """create table object_usage(
+            user_id char(36) REFERENCES users_canonical(id) NOT NULL,
+            object_type INTEGER REFERENCES object_types(id) NOT NULL,
+            used INTEGER DEFAULT 0 NOT NULL,
+            reserved INTEGER DEFAULT 0 NOT NULL,
+            PRIMARY KEY(user_id, object_type))""",
+        """create table object_usage(
+            user_id char(36) REFERENCES users_canonical(id) ON DELETE CASCADE NOT NULL,
+            object_type INTEGER REFERENCES object_types(id) NOT NULL,
+            used bigint DEFAULT 0 NOT NULL,
+            reserved bigint DEFAULT 0 NOT NULL,
+            PRIMARY KEY(user_id, object_type))"""),
+]
+
+#  columns added to tables that an older database may already have, the
+#  multipart tables of the sqlite ddl started out with only their keys.  a
+#  column added to a table that has rows cannot be NOT NULL without a
+#  default
+g_column_additions = [
+    ("multipart_join", "name", "varchar(1024) DEFAULT '' NOT NULL"),
+    ("multipart_join", "owner_id", "char(36) REFERENCES users_canonical(id)"),
+    ("multipart_join", "creation_time", "DATETIME"),
+    ("multipart", "md5sum", "CHAR(32)"),
+    ("multipart", "object_size", "INTEGER DEFAULT 0"),
+    ("multipart", "creation_time", "DATETIME"),
+]
+
+def _schema_has(db_obj, name):
+    if db_obj.replace_char == None:
+        s = "SELECT name FROM sqlite_master where name = ?"
+    else:
+        s = "SELECT relname FROM pg_class where relname = ?"
+    return db_obj._run_fetch_one(s, [name]) != None
+
+def _column_has(db_obj, table, column):
+    if db_obj.replace_char == None:
+        rows = db_obj._run_fetch_all("PRAGMA table_info(%s)" % (table), [])
+        return column in [r[1] for r in rows]
+    s = "SELECT column_name FROM information_schema.columns where table_name = ? and column_name = ?"
+    return db_obj._run_fetch_one(s, [table, column]) != None
+
+#  brings a database made by an older acl.sql up to date.  returns what was
+#  added, the caller commits.  it is safe to run any number of times
+def upgrade_schema(db_obj):
+    added = []
+    for (name, sqlite_ddl, pg_ddl) in g_schema_additions:
+        if _schema_has(db_obj, name):
+            continue
+        if db_obj.replace_char == None:
+            db_obj._run_no_fetch(sqlite_ddl, [])
+        else:
+            db_obj._run_no_fetch(pg_ddl, [])
+        added.append(name)
+    for (table, column, ddl) in g_column_additions:
+        if _column_has(db_obj, table, column):
+            continue
+        if db_obj.replace_char != None:
+            ddl = ddl.replace("DATETIME", "TIMESTAMP")
+        db_obj._run_no_fetch("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, ddl), [])
+        added.append("%s.%s" % (table, column))
+    # the md5 of a multipart upload does not fit the old char(32).  sqlite
+    # does not hold a value to the size of its column
+    if db_obj.replace_char != None:
+        s = """SELECT character_maximum_length FROM information_schema.columns
+            where table_name = 'objects' and column_name = 'md5sum'"""
+        row = db_obj._run_fetch_one(s, [])
+        if row != None and row[0] != None and int(row[0]) < 64:
+            db_obj._run_no_fetch("ALTER TABLE objects ALTER COLUMN md5sum TYPE varchar(64)", [])
+            added.append("objects.md5sum")
+    return added
+
+
 # a simple wrapper around readonly
+# when set it is called with the seconds each query or commit took
+g_query_timer = None
+
+def set_query_timer(timer):
+    global g_query_timer
+    g_query_timer = timer
+
+def _time_query(start):
+    if g_query_timer != None:
+        g_query_timer(time.time() - start)
+
 class DB(object):
-    def __init__(self, con_str=None, con=None):
+    def __init__(self, con_str=None, con=None, pool=None):
         self.replace_char = None
+        # if this handle came from a DBPool close() gives it back
+        self.pool = pool
+        self.last_used = time.time()
 
         if con_str != None:
             parts_a = con_str.split("://", 1)
@@ -38,7 +177,10 @@ class DB(object):
                 scheme = ""
             url = urlparse.urlparse("http://" + rest)
             if scheme == "sqlite" or scheme == '':
-                self.con = sqlite3.connect(url.path)
+                # a pooled handle may be borrowed by a different thread
+                # than the one that opened it.  the pool makes sure only
+                # one thread uses it at a time
+                self.con = sqlite3.connect(url.path, check_same_thread=(pool == None))
                 self.con.text_factory = str
             elif scheme == "psycopg2":
                 import psycopg2
@@ -55,42 +197,232 @@ class DB(object):
     def _run_no_fetch(self, s, data):
         if self.replace_char:
             s = s.replace('?', self.replace_char)
-        c = self.con.cursor()
-        c.execute(s, data)
-        c.close()
+        start = time.time()
+        try:
+            c = self.con.cursor()
+            c.execute(s, data)
+            n = c.rowcount
+            c.close()
+        finally:
+            _time_query(start)
+        return n
 
     def _run_fetch_iterator(self, s, data, convert_func, args=None):
         if self.replace_char:
             s = s.replace('?', self.replace_char)
-        c = self.con.cursor()
-        c.execute(s, data)
+        start = time.time()
+        try:
+            c = self.con.cursor()
+            c.execute(s, data)
+        finally:
+            _time_query(start)
         new_it = itertools.imap(lambda r: convert_func(self, r, args), c) 
         return new_it
 
     def _run_fetch_all(self, s, data):
         if self.replace_char:
             s = s.replace('?', self.replace_char)
-        c = self.con.cursor()
-        c.execute(s, data)
-        r = c.fetchall()
-        c.close()
+        start = time.time()
+        try:
+            c = self.con.cursor()
+            c.execute(s, data)
+            r = c.fetchall()
+            c.close()
+        finally:
+            _time_query(start)
         return r
 
 
     def _run_fetch_one(self, s, data):
         if self.replace_char:
             s = s.replace('?', self.replace_char)
-        c = self.con.cursor()
-        c.execute(s, data)
-        r = c.fetchone()
-        c.close()
+        start = time.time()
+        try:
+            c = self.con.cursor()
+            c.execute(s, data)
+            r = c.fetchone()
+            c.close()
+        finally:
+            _time_query(start)
         return r
         
     def commit(self):
-        self.con.commit()
+        start = time.time()
+        try:
+            self.con.commit()
+        finally:
+            _time_query(start)
 
     def rollback(self):
         self.con.rollback()
 
+    # cheap round trip to make sure the connection is still usable
+    def ping(self):
+        try:
+            self._run_fetch_one("SELECT 1", ())
+            self.con.rollback()
+            return True
+        except:
+            return False
+
+    def close(self):
+        if self.pool != None:
+            self.pool.release(self)
+        else:
+            self.con.close()
+
+
+#  A fixed size set of DB handles that are borrowed for a unit of work
+#  (a cumulus request for example) and then given back with close().
+#
+#  connection setup is the expensive part of talking to sqlite or postgres
+#  so handles are reused.  a thread is given back the handle it used last
+#  when it is free (thread affinity), handles that sat idle for longer than
+#  check_interval seconds are pinged before they are handed out.
+#
+#  size handles are kept open.  when they are all borrowed up to
+#  max_overflow more are opened and closed again when they are released.
+#  past that a caller waits at most timeout seconds for a handle.
+class DBPool(object):
+
+    def __init__(self, con_str, size=10, max_overflow=10, check_interval=60, timeout=30):
+        if size < 1:
+            raise AuthzException('DB_ERROR', "the pool size must be at least 1")
+        self.con_str = con_str
+        self.size = size
+        self.max_overflow = max_overflow
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.count = 0
+        self.free_list = []
+        self.borrowed = {}
+        self.cond = threading.Condition()
+        self.local = threading.local()
+
+    def _open(self):
+        return DB(con_str=self.con_str, pool=self)
+
+    # must be called with the condition held
+    def _take_free(self):
+        if len(self.free_list) == 0:
+            return None
+        last_db = getattr(self.local, 'db', None)
+        if last_db != None and last_db in self.free_list:
+            self.free_list.remove(last_db)
+            return last_db
+        # most recently released first, it is the most likely to be warm
+        return self.free_list.pop()
+
+    # give up the slot held by a handle that could not be opened or used
+    def _discard_slot(self):
+        self.cond.acquire()
+        try:
+            self.count = self.count - 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def _discard(self, db_obj):
+        try:
+            db_obj.con.close()
+        except:
+            pass
+        self._discard_slot()
+
+    def _check(self, db_obj):
+        if time.time() - db_obj.last_used < self.check_interval:
+            return db_obj
+        if db_obj.ping():
+            return db_obj
+        self._discard(db_obj)
+        return None
+
+    def get(self):
+        end_tm = time.time() + self.timeout
+        db_obj = None
+        while db_obj == None:
+            self.cond.acquire()
+            try:
+                while True:
+                    db_obj = self._take_free()
+                    if db_obj != None:
+                        break
+                    if self.count < self.size + self.max_overflow:
+                        self.count = self.count + 1
+                        break
+                    remaining = end_tm - time.time()
+                    if remaining <= 0:
+                        raise AuthzException('DB_ERROR', "no database connection was available after %d seconds" % (self.timeout))
+                    self.cond.wait(remaining)
+            finally:
+                self.cond.release()
+
+            if db_obj == None:
+                try:
+                    db_obj = self._open()
+                except:
+                    self._discard_slot()
+                    raise
+            else:
+                db_obj = self._check(db_obj)
+
+        self.cond.acquire()
+        try:
+            self.borrowed[id(db_obj)] = db_obj
+        finally:
+            self.cond.release()
+        self.local.db = db_obj
+        return db_obj
+
+    def release(self, db_obj):
+        self.cond.acquire()
+        try:
+            if id(db_obj) not in self.borrowed:
+                return
+            del self.borrowed[id(db_obj)]
+        finally:
+            self.cond.release()
+
+        # never hand out a handle with an open transaction.  un-committed
+        # work is dropped, just as it was when every request closed its
+        # own connection
+        try:
+            db_obj.rollback()
+        except:
+            self._discard(db_obj)
+            return
+        db_obj.last_used = time.time()
+
+        self.cond.acquire()
+        try:
+            if self.count > self.size:
+                # an overflow handle, do not keep it around
+                self.count = self.count - 1
+                self.cond.notify()
+                db_obj.con.close()
+                return
+            self.free_list.append(db_obj)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def get_free_count(self):
+        return len(self.free_list)
+
+    def get_open_count(self):
+        return self.count
+
+    # close every handle that is not currently borrowed
     def close(self):
-        self.con.close()
+        self.cond.acquire()
+        try:
+            free_list = self.free_list
+            self.free_list = []
+            self.count = self.count - len(free_list)
+        finally:
+            self.cond.release()
+        for db_obj in free_list:
+            try:
+                db_obj.con.close()
+            except:
+                pass
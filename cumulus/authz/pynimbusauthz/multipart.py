@@ -0,0 +1,186 @@
+import uuid
+from datetime import datetime
+import pynimbusauthz
+from pynimbusauthz.user import User
+from pynimbusauthz.objects import _parse_creation_time
+
+#
+#  a multipart upload in progress.  the key name will land in the bucket
+#  object_id once the upload is completed, until then each part is its own
+#  row in multipart pointing at its own data key
+class MultipartUpload(object):
+
+    def __init__(self, db_obj, row):
+        self.db_obj = db_obj
+        self.id = row[0]
+        self.upload_id = str(row[1])
+        self.object_id = row[2]
+        self.name = row[3]
+        # an upload from before owner_id was recorded has none
+        self.owner_id = row[4]
+        if self.owner_id != None:
+            self.owner_id = str(self.owner_id)
+        self.creation_time = _parse_creation_time(row[5])
+        self.complete = row[6]
+
+    def get_id(self):
+        return self.id
+
+    def get_upload_id(self):
+        return self.upload_id
+
+    def get_bucket_id(self):
+        return self.object_id
+
+    def get_name(self):
+        return self.name
+
+    def get_owner(self):
+        if self.owner_id == None:
+            return None
+        return User(self.db_obj, self.owner_id)
+
+    def get_owner_id(self):
+        return self.owner_id
+
+    def get_creation_time(self):
+        return self.creation_time
+
+    def is_complete(self):
+        return self.complete != 0
+
+    def create_upload(db_obj, bucket, name, owner):
+        upload_id = str(uuid.uuid4()).replace("-", "")
+        s = """INSERT INTO multipart_join(upload_id, object_id, name, owner_id, creation_time)
+            values(?, ?, ?, ?, ?)"""
+        data = (upload_id, bucket.get_id(), name, owner.get_id(), datetime.now(),)
+        db_obj._run_no_fetch(s, data)
+        return MultipartUpload.get_upload(db_obj, upload_id)
+    create_upload = staticmethod(create_upload)
+
+    def get_upload(db_obj, upload_id):
+        s = """SELECT id, upload_id, object_id, name, owner_id, creation_time, complete
+            FROM multipart_join WHERE upload_id = ?"""
+        data = (upload_id,)
+        row = db_obj._run_fetch_one(s, data)
+        if row == None or len(row) == 0:
+            return None
+        return MultipartUpload(db_obj, row)
+    get_upload = staticmethod(get_upload)
+
+    # the parts count against the quota of the user who started the upload
+    # until it is completed or aborted.  like File the ledger is changed
+    # before the parts are
+    def _charge(self, delta):
+        if delta != 0 and self.owner_id != None:
+            self.get_owner().add_quota_usage(delta)
+
+    # record a part.  a part uploaded again under the same number replaces
+    # the old one whose data key is returned so the data can be removed
+    def add_part(self, order_num, data_key, size, md5sum):
+        old = self.get_part(order_num)
+        old_size = 0
+        if old != None and old.get_size() != None:
+            old_size = old.get_size()
+        self._charge(size - old_size)
+        if old != None:
+            s = "DELETE FROM multipart WHERE id = ?"
+            self.db_obj._run_no_fetch(s, (old.get_id(),))
+        s = """INSERT INTO multipart(data_key, order_num, mp_id, md5sum, object_size, creation_time)
+            values(?, ?, ?, ?, ?, ?)"""
+        data = (data_key, order_num, self.id, md5sum, size, datetime.now(),)
+        self.db_obj._run_no_fetch(s, data)
+        if old == None:
+            return None
+        return old.get_data_key()
+
+    def get_part(self, order_num):
+        s = "SELECT " + MultipartPart.select_str + " FROM multipart WHERE mp_id = ? and order_num = ?"
+        row = self.db_obj._run_fetch_one(s, (self.id, order_num,))
+        if row == None or len(row) == 0:
+            return None
+        return MultipartPart(row)
+
+    # the bytes of all of the parts
+    def get_parts_size(self):
+        s = "SELECT COALESCE(SUM(object_size), 0) FROM multipart WHERE mp_id = ?"
+        row = self.db_obj._run_fetch_one(s, (self.id,))
+        return row[0]
+
+    # the parts in order, only those after marker if it is given
+    def get_parts(self, marker=None, limit=None):
+        s = "SELECT " + MultipartPart.select_str + " FROM multipart WHERE mp_id = ?"
+        data = [self.id]
+        if marker != None:
+            s = s + " and order_num > ?"
+            data.append(int(marker))
+        s = s + " ORDER BY order_num"
+        if limit != None:
+            s = s + " LIMIT ?"
+            data.append(int(limit))
+        c = self.db_obj._run_fetch_iterator(s, data, _convert_row_to_MultipartPart)
+        return c
+
+    def set_complete(self):
+        s = "UPDATE multipart_join SET complete = 1 WHERE id = ?"
+        self.db_obj._run_no_fetch(s, (self.id,))
+        self.complete = 1
+
+    # forget the upload and all of its parts.  the part data is up to
+    # the caller
+    def delete(self):
+        self._charge(-self.get_parts_size())
+        data = (self.id,)
+        self.db_obj._run_no_fetch("DELETE FROM multipart WHERE mp_id = ?", data)
+        self.db_obj._run_no_fetch("DELETE FROM multipart_join WHERE id = ?", data)
+
+    # the uploads in progress in a bucket, by key name and then age
+    def find_uploads(db_obj, bucket, name=None):
+        s = """SELECT id, upload_id, object_id, name, owner_id, creation_time, complete
+            FROM multipart_join WHERE object_id = ?"""
+        data = [bucket.get_id()]
+        if name != None:
+            s = s + " and name = ?"
+            data.append(name)
+        s = s + " ORDER BY name, creation_time"
+        c = db_obj._run_fetch_iterator(s, data, _convert_row_to_MultipartUpload)
+        return c
+    find_uploads = staticmethod(find_uploads)
+
+class MultipartPart(object):
+
+    select_str = "id, order_num, data_key, object_size, md5sum, creation_time"
+
+    def __init__(self, row):
+        self.id = row[0]
+        self.order_num = row[1]
+        self.data_key = str(row[2])
+        self.size = row[3]
+        self.md5sum = row[4]
+        self.creation_time = _parse_creation_time(row[5])
+
+    def get_id(self):
+        return self.id
+
+    def get_part_number(self):
+        return self.order_num
+
+    def get_data_key(self):
+        return self.data_key
+
+    def get_size(self):
+        return self.size
+
+    def get_md5sum(self):
+        if self.md5sum == None:
+            return None
+        return str(self.md5sum)
+
+    def get_creation_time(self):
+        return self.creation_time
+
+def _convert_row_to_MultipartUpload(db, row, args):
+    return MultipartUpload(db, row)
+
+def _convert_row_to_MultipartPart(db, row, args):
+    return MultipartPart(row)
@@ -1,4 +1,5 @@
 import sqlite3
+import sys
 import pynimbusauthz
 from pynimbusauthz.user import User
 from pynimbusauthz.db import DB
@@ -52,15 +53,7 @@ class File(object):
             self.parent = File.get_file_from_db_id(db_obj, file_id)
         self.md5sum = row[File.cols['md5sum']]
         self.object_size = row[File.cols['object_size']]
-        ctm = row[File.cols['creation_time']]
-        if ctm != None:
-            ctm = str(ctm)
-            ndx = ctm.rfind(".")
-            if ndx > 0:
-                ctm = ctm[:ndx]
-            self.creation_time = time.strptime(ctm, "%Y-%m-%d %H:%M:%S")
-        else:
-            self.creation_time = None
+        self.creation_time = _parse_creation_time(row[File.cols['creation_time']])
 
     def get_owner(self):
         return self.owner
@@ -90,6 +83,8 @@ class File(object):
         return self.object_type
 
     def delete(self):
+        if self.object_size:
+            self.owner.add_quota_usage(-self.object_size, self.object_type)
         d = "DELETE FROM object_acl WHERE object_id = ?"
         d2 = "DELETE FROM objects WHERE id = ?"
         data = (self.id,)
@@ -114,6 +109,17 @@ class File(object):
         self.db_obj._run_no_fetch(s, data)
         self.data_key = data_key
 
+    # set the data key only if it is still old_data_key.  returns False
+    # if the file was changed or removed by someone else in the meantime
+    def swap_data_key(self, old_data_key, data_key):
+        s = "UPDATE objects set data_key = ? where id = ? and data_key = ?"
+        data = (data_key,self.id,old_data_key,)
+        n = self.db_obj._run_no_fetch(s, data)
+        if n < 1:
+            return False
+        self.data_key = data_key
+        return True
+
     def get_file_from_db_id(db_obj, id):
         s = "SELECT " + File.get_select_str() + """
             FROM objects
@@ -161,6 +167,8 @@ class File(object):
             data.append(size)
             key_str = key_str + ", object_size"
             val_str = val_str + ", ?"
+            if size:
+                owner.add_quota_usage(size, object_type)
 
         if md5sum != None:
             data.append(md5sum)
@@ -204,6 +212,38 @@ class File(object):
         c = self.db_obj._run_fetch_iterator(s, data, _convert_alias_row_to_File, None)
         return c
 
+    # list the children of parent_id in name order.  only names greater
+    # than marker, starting at or after start, and beginning with prefix
+    # are returned.  everything is a range on the (parent_id, name) index
+    # so paging through a very large bucket never scans it.
+    #
+    # returns an iterator of FileSummary
+    def list_children(db_obj, parent_id, marker=None, prefix=None, start=None, limit=None):
+        s = """SELECT name, object_size, creation_time, md5sum
+            FROM objects WHERE parent_id = ?"""
+        data = [parent_id]
+        if marker != None:
+            s = s + " and name > ?"
+            data.append(marker)
+        if start != None:
+            s = s + " and name >= ?"
+            data.append(start)
+        if prefix != None and prefix != "":
+            s = s + " and name >= ?"
+            data.append(prefix)
+            upper = prefix_upper_bound(prefix)
+            if upper != None:
+                s = s + " and name < ?"
+                data.append(upper)
+        s = s + " ORDER BY name"
+        if limit != None:
+            s = s + " LIMIT ?"
+            data.append(int(limit))
+
+        c = db_obj._run_fetch_iterator(s, data, _convert_row_to_FileSummary)
+        return c
+    list_children = staticmethod(list_children)
+
     def find_files(db_obj, pattern, object_type, parent=None):
         # look it up
         ot = pynimbusauthz.object_types[object_type]
@@ -220,12 +260,20 @@ class File(object):
 
     find_files = staticmethod(find_files)
 
-    def find_files_from_data(db_obj, pattern):
+    # with limit the files come in id order, after_id picks up where the
+    # last page left off
+    def find_files_from_data(db_obj, pattern, after_id=None, limit=None):
         # look it up
         s = "SELECT " + File.get_select_str() + """
             FROM objects
             WHERE data_key LIKE ?"""
         data = [pattern,]
+        if after_id != None:
+            s = s + " and id > ?"
+            data.append(after_id)
+        if limit != None:
+            s = s + " ORDER BY id LIMIT ?"
+            data.append(int(limit))
         c = db_obj._run_fetch_iterator(s, data, _convert_alias_row_to_File)
         return c
 
@@ -375,6 +423,35 @@ class UserFile(object):
     def get_user(self):
         return self.user
 
+    # find a file by name and, for a child, the name of its root parent,
+    # along with the permissions each user id in user_list has on it.
+    # this is one joined query, no File or User objects are inflated.
+    #
+    # returns a FilePerms or None if there is no such file
+    def resolve_perms(db_obj, user_list, name, object_type, parent_name=None):
+        ot = pynimbusauthz.object_types[object_type]
+        in_str = ",".join(["?"] * len(user_list))
+        s = """SELECT o.id, o.data_key, o.object_size, o.creation_time,
+                    o.md5sum, oa.user_id, oa.access_type_id
+                FROM objects o """
+        if parent_name != None:
+            s = s + " INNER JOIN objects p ON o.parent_id = p.id"
+        s = s + """ LEFT OUTER JOIN object_acl oa
+                    ON oa.object_id = o.id and oa.user_id IN (""" + in_str + ")"
+        s = s + " WHERE o.name = ? and o.object_type = ?"
+        data = list(user_list) + [name, ot]
+        if parent_name != None:
+            s = s + " and p.name = ? and p.object_type = ? and p.parent_id IS NULL"
+            data = data + [parent_name, ot]
+        else:
+            s = s + " and o.parent_id IS NULL"
+
+        rows = db_obj._run_fetch_all(s, data)
+        if rows == None or len(rows) == 0:
+            return None
+        return FilePerms(rows)
+    resolve_perms = staticmethod(resolve_perms)
+
     # returns all of the UserFiles that have this file as a parent
     # the user files will be returned with this objects user
     #
@@ -402,6 +479,108 @@ class UserFile(object):
         return str(self) == str(other)
 
 
+#
+#  the result of UserFile.resolve_perms.  the file columns needed to serve
+#  a request and the permission string of every user asked about
+class FilePerms(object):
+
+    def __init__(self, rows):
+        r = rows[0]
+        self.id = r[0]
+        self.data_key = str(r[1])
+        self.object_size = r[2]
+        self.creation_time = _parse_creation_time(r[3])
+        self.md5sum = r[4]
+        self.perms = {}
+        for r in rows:
+            if r[5] == None:
+                continue
+            user_id = str(r[5])
+            self.perms[user_id] = self.perms.get(user_id, "") + str(r[6])
+
+    def get_id(self):
+        return self.id
+
+    def get_data_key(self):
+        return self.data_key
+
+    def get_size(self):
+        return self.object_size
+
+    def get_creation_time(self):
+        return self.creation_time
+
+    def get_md5sum(self):
+        return str(self.md5sum)
+
+    # same order UserFile.get_perms uses
+    def get_perms(self, user_id):
+        p = self.perms.get(user_id, "")
+        perms_list = ""
+        for c in "rwRW":
+            if c in p:
+                perms_list = perms_list + c
+        return perms_list
+
+#
+#  just enough of a file to list it
+class FileSummary(object):
+
+    def __init__(self, row):
+        self.name = str(row[0])
+        self.object_size = row[1]
+        self.creation_time = _parse_creation_time(row[2])
+        self.md5sum = row[3]
+
+    def get_name(self):
+        return self.name
+
+    def get_size(self):
+        return self.object_size
+
+    def get_creation_time(self):
+        return self.creation_time
+
+    def get_md5sum(self):
+        return str(self.md5sum)
+
+# the smallest string that is greater than every string starting with
+# prefix, or None if there is no such string.  names are utf-8 so the last
+# character is bumped rather than the last byte to keep the bound valid
+def prefix_upper_bound(prefix):
+    try:
+        p = prefix.decode("utf-8")
+        enc = True
+    except UnicodeError:
+        p = prefix
+        enc = False
+    max_c = unichr(sys.maxunicode)
+    if not enc:
+        max_c = chr(0xff)
+    while len(p) > 0 and p[-1] == max_c:
+        p = p[:-1]
+    if len(p) == 0:
+        return None
+    if enc:
+        c = ord(p[-1]) + 1
+        # stay out of the surrogate range
+        if c >= 0xD800 and c <= 0xDFFF:
+            c = 0xE000
+        return (p[:-1] + unichr(c)).encode("utf-8")
+    return p[:-1] + chr(ord(p[-1]) + 1)
+
+def _parse_creation_time(ctm):
+    if ctm == None:
+        return None
+    ctm = str(ctm)
+    ndx = ctm.rfind(".")
+    if ndx > 0:
+        ctm = ctm[:ndx]
+    return time.strptime(ctm, "%Y-%m-%d %H:%M:%S")
+
+def _convert_row_to_FileSummary(db, row, args):
+    return FileSummary(row)
+
 def _convert_alias_row_to_File(db, row, args):
     return File(db, row)
 
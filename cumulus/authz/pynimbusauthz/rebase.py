@@ -22,6 +22,10 @@ def setup_options(argv):
 
         All instances of <old path> are substituted with <new path>.
         Paths that do not match <old path> are left intact.
+
+        Objects may share their data as hard links (copies and cumulus
+        dedup).  Move the files in a way that keeps hard links (mv,
+        cp -a, rsync -H) or each reference becomes a copy.
 """
 
     (parser, all_opts) = pynimbusauthz.get_default_options(u)
@@ -32,6 +36,51 @@ def setup_options(argv):
 
     return (o, args)
 
+#  give each of files the data key new_key(old data key), committing every
+#  batch_size files so a long rebase never holds the db for long.  files
+#  should be a list (or an iterator that does not hold a cursor open
+#  across commits).  new_key returns None to leave a file alone.
+#
+#  to move the data as well as the key new_key has to put it under the new
+#  name while leaving the old one in place.  once the batch is committed
+#  done(old, new, changed) is called for each file so the old name can go.
+#  changed is False if someone else changed or removed the file first, the
+#  data under new is then not used by anything.
+#
+#  returns the number of files rebased
+def rebase_files(db_obj, files, new_key, batch_size=1000, done=None):
+    count = 0
+    batch = []
+    for f in files:
+        old_key = f.get_data_key()
+        key = new_key(old_key)
+        if key == None or key == old_key:
+            continue
+        batch.append((f, old_key, key))
+        if len(batch) >= batch_size:
+            count = count + _commit_batch(db_obj, batch, done)
+            batch = []
+    count = count + _commit_batch(db_obj, batch, done)
+    return count
+
+def _commit_batch(db_obj, batch, done):
+    changed = []
+    try:
+        for (f, old_key, key) in batch:
+            changed.append(f.swap_data_key(old_key, key))
+        db_obj.commit()
+    except:
+        db_obj.rollback()
+        if done != None:
+            for (f, old_key, key) in batch:
+                done(old_key, key, False)
+        raise
+    if done != None:
+        for i in range(0, len(batch)):
+            (f, old_key, key) = batch[i]
+            done(old_key, key, changed[i])
+    return len([c for c in changed if c])
+
 def main(argv=sys.argv[1:]):
     
     try:
@@ -46,12 +95,8 @@ def main(argv=sys.argv[1:]):
         pattern = old_path + "%"
 
         files = list(File.find_files_from_data(db_obj, pattern))
-        for f in files:
-            old_key = f.get_data_key()
-            new_key = old_key.replace(old_path, new_path, 1)
-            f.set_data_key(new_key)
-        db_obj.commit()
-        print "done - %d files rebased" % len(files)
+        count = rebase_files(db_obj, files, lambda k: k.replace(old_path, new_path, 1))
+        print "done - %d files rebased" % count
 
     except AuthzException, ae:
         print ae
@@ -11,3 +11,6 @@ from pynimbusauthz.tests.test_stat import *
 from pynimbusauthz.tests.user_tests import *
 from pynimbusauthz.tests.commit_tests import *
 from pynimbusauthz.tests.test_rebase import *
+from pynimbusauthz.tests.pool_test import *
+from pynimbusauthz.tests.cache_test import *
+from pynimbusauthz.tests.multipart_test import *
@@ -0,0 +1,71 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from pynimbusauthz.cache import TTLCache
+
+class TestTTLCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.stamp = os.path.join(self.dir, "stamp")
+        self.cache = TTLCache(max_size=3, ttl=60, stamp_file=self.stamp)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_put_get(self):
+        self.assertEqual(self.cache.get("a"), None)
+        self.cache.put("a", ("s", "c", "d"))
+        self.assertEqual(self.cache.get("a"), ("s", "c", "d"))
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_lru(self):
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        self.cache.put("c", 3)
+        # touch a so b is the oldest
+        self.cache.get("a")
+        self.cache.put("d", 4)
+        self.assertEqual(self.cache.get_size(), 3)
+        self.assertEqual(self.cache.get("b"), None)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.get("d"), 4)
+
+    def test_ttl(self):
+        self.cache.ttl = 0.1
+        self.cache.put("a", 1)
+        time.sleep(0.2)
+        self.assertEqual(self.cache.get("a"), None)
+
+    def test_invalidate(self):
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        self.cache.invalidate("a")
+        self.assertEqual(self.cache.get("a"), None)
+        self.assertEqual(self.cache.get("b"), 2)
+        self.cache.invalidate()
+        self.assertEqual(self.cache.get("b"), None)
+
+    def test_stamp(self):
+        # another process sharing the stamp file
+        other = TTLCache(max_size=3, ttl=60, stamp_file=self.stamp)
+        self.cache.put("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        other.touch()
+        self.assertEqual(self.cache.get("a"), None)
+        self.cache.put("a", 2)
+        other.touch()
+        other.touch()
+        self.assertEqual(self.cache.get("a"), None)
+        self.cache.put("a", 3)
+        self.assertEqual(self.cache.get("a"), 3)
+
+    def test_disabled(self):
+        c = TTLCache(max_size=0)
+        c.put("a", 1)
+        self.assertEqual(c.get("a"), None)
+        # no stamp file is not an error
+        c.touch()
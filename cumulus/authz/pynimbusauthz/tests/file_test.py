@@ -6,6 +6,7 @@ from pynimbusauthz.db import DB
 from pynimbusauthz.user import User
 from pynimbusauthz.user import UserAlias
 from pynimbusauthz.objects import File
+from pynimbusauthz.objects import prefix_upper_bound
 import unittest
 
 class TestFile(unittest.TestCase):
@@ -131,3 +132,30 @@ class TestFile(unittest.TestCase):
                 found = True
         self.assertTrue(found, "key not found")
 
+
+    def test_list_children(self):
+        user1 = User(self.db)
+        bucket = File.create_file(self.db, "bucket", user1, "data", pynimbusauthz.object_type_s3)
+        names = ["a/1", "a/2", "b", "c/x/1", "c/y", "d"]
+        # insert out of order
+        for n in reversed(names):
+            File.create_file(self.db, n, user1, n, pynimbusauthz.object_type_s3, parent=bucket, size=1)
+        self.db.commit()
+
+        kids = [f.get_name() for f in File.list_children(self.db, bucket.get_id())]
+        self.assertEqual(kids, names)
+        kids = [f.get_name() for f in File.list_children(self.db, bucket.get_id(), marker="a/2", limit=2)]
+        self.assertEqual(kids, ["b", "c/x/1"])
+        kids = [f.get_name() for f in File.list_children(self.db, bucket.get_id(), prefix="c/")]
+        self.assertEqual(kids, ["c/x/1", "c/y"])
+        kids = [f.get_name() for f in File.list_children(self.db, bucket.get_id(), prefix="c/", start="c/y")]
+        self.assertEqual(kids, ["c/y"])
+        kids = [f.get_name() for f in File.list_children(self.db, bucket.get_id(), prefix="nope")]
+        self.assertEqual(kids, [])
+
+    def test_prefix_upper_bound(self):
+        self.assertEqual(prefix_upper_bound("abc"), "abd")
+        self.assertEqual(prefix_upper_bound("a/"), "a0")
+        self.assertEqual(prefix_upper_bound(""), None)
+        self.assertEqual(prefix_upper_bound("\xc3\xa9"), "\xc3\xaa")
+        self.assertEqual(prefix_upper_bound("a\xff\xfe"), "a\xff\xff")
@@ -0,0 +1,90 @@
+import pynimbusauthz
+from pynimbusauthz.db import DB
+from pynimbusauthz.user import User
+from pynimbusauthz.objects import File
+from pynimbusauthz.multipart import MultipartUpload
+import unittest
+
+class TestMultipart(unittest.TestCase):
+
+    def setUp(self):
+        con = pynimbusauthz.db.make_test_database()
+        self.db = DB(con=con)
+        self.user = User(self.db)
+        self.bucket = File.create_file(self.db, "bucket", self.user, "bucket", pynimbusauthz.alias_type_s3)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_create(self):
+        mp = MultipartUpload.create_upload(self.db, self.bucket, "key", self.user)
+        self.db.commit()
+        mp2 = MultipartUpload.get_upload(self.db, mp.get_upload_id())
+        self.assertEqual(mp2.get_name(), "key")
+        self.assertEqual(mp2.get_bucket_id(), self.bucket.get_id())
+        self.assertEqual(mp2.get_owner_id(), self.user.get_id())
+        self.assertFalse(mp2.is_complete())
+        self.assertNotEqual(mp2.get_creation_time(), None)
+        self.assertEqual(MultipartUpload.get_upload(self.db, "nope"), None)
+
+        mp3 = MultipartUpload.create_upload(self.db, self.bucket, "key", self.user)
+        self.assertNotEqual(mp.get_upload_id(), mp3.get_upload_id())
+        ups = list(MultipartUpload.find_uploads(self.db, self.bucket, "key"))
+        self.assertEqual(len(ups), 2)
+
+    def test_parts(self):
+        mp = MultipartUpload.create_upload(self.db, self.bucket, "key", self.user)
+        self.assertEqual(mp.add_part(2, "/d/2", 20, "b" * 32), None)
+        self.assertEqual(mp.add_part(1, "/d/1", 10, "a" * 32), None)
+        self.assertEqual(mp.add_part(3, "/d/3", 30, "c" * 32), None)
+        self.db.commit()
+
+        parts = list(mp.get_parts())
+        self.assertEqual([p.get_part_number() for p in parts], [1, 2, 3])
+        self.assertEqual(parts[0].get_data_key(), "/d/1")
+        self.assertEqual(parts[0].get_size(), 10)
+        self.assertEqual(parts[0].get_md5sum(), "a" * 32)
+
+        parts = list(mp.get_parts(marker=1, limit=1))
+        self.assertEqual([p.get_part_number() for p in parts], [2])
+
+        # upload part 2 again
+        old = mp.add_part(2, "/d/2b", 22, "d" * 32)
+        self.assertEqual(old, "/d/2")
+        self.assertEqual(mp.get_part(2).get_data_key(), "/d/2b")
+        self.assertEqual(len(list(mp.get_parts())), 3)
+
+    def test_delete(self):
+        mp = MultipartUpload.create_upload(self.db, self.bucket, "key", self.user)
+        mp.add_part(1, "/d/1", 10, "a" * 32)
+        mp.set_complete()
+        self.assertTrue(mp.is_complete())
+        mp.delete()
+        self.db.commit()
+        self.assertEqual(MultipartUpload.get_upload(self.db, mp.get_upload_id()), None)
+        self.assertEqual(len(list(mp.get_parts())), 0)
+
+    def test_quota(self):
+        mp = MultipartUpload.create_upload(self.db, self.bucket, "key", self.user)
+        mp.add_part(1, "/d/1", 10, "a" * 32)
+        mp.add_part(2, "/d/2", 20, "b" * 32)
+        self.assertEqual(self.user.get_quota_usage(), 30)
+        self.assertEqual(mp.get_parts_size(), 30)
+        # a part sent again only counts once
+        mp.add_part(2, "/d/2b", 25, "b" * 32)
+        self.assertEqual(self.user.get_quota_usage(), 35)
+        self.assertEqual(User.reconcile_usage(self.db), [])
+        mp.delete()
+        self.assertEqual(self.user.get_quota_usage(), 0)
+        self.assertEqual(User.reconcile_usage(self.db), [])
+
+    def test_reconcile(self):
+        mp = MultipartUpload.create_upload(self.db, self.bucket, "key", self.user)
+        mp.add_part(1, "/d/1", 10, "a" * 32)
+        self.db._run_no_fetch("DELETE FROM object_usage", [])
+        self.db.commit()
+        wrong = User.reconcile_usage(self.db)
+        ot = pynimbusauthz.object_types[pynimbusauthz.object_type_s3]
+        self.assertEqual(wrong, [(self.user.get_id(), ot, None, 10)])
+        self.assertEqual(self.user.get_quota_usage(), 10)
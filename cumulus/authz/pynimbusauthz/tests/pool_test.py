@@ -0,0 +1,132 @@
+import sqlite3
+import os
+import sys
+import pynimbusauthz
+from pynimbusauthz.db import DB
+from pynimbusauthz.db import DBPool
+from pynimbusauthz.user import User
+from pynimbusauthz.authz_exception import AuthzException
+import unittest
+import tempfile
+import threading
+
+class TestDBPool(unittest.TestCase):
+
+    def setUp(self):
+        (osf, self.fname) = tempfile.mkstemp()
+        os.close(osf)
+        pynimbusauthz.db.make_test_database(self.fname)
+        self.pool = DBPool(self.fname, size=2, max_overflow=0, timeout=1)
+
+    def tearDown(self):
+        self.pool.close()
+        os.remove(self.fname)
+
+    def test_reuse(self):
+        db1 = self.pool.get()
+        db1.close()
+        db2 = self.pool.get()
+        self.assertTrue(db1 is db2, "the released handle should be reused")
+        db2.close()
+        self.assertEqual(self.pool.get_open_count(), 1)
+
+    def test_exhausted(self):
+        db1 = self.pool.get()
+        db2 = self.pool.get()
+        try:
+            db3 = self.pool.get()
+            self.fail("the pool should have been exhausted")
+        except AuthzException, ae:
+            pass
+        db1.close()
+        db3 = self.pool.get()
+        self.assertTrue(db1 is db3)
+        db2.close()
+        db3.close()
+
+    def test_overflow(self):
+        self.pool.max_overflow = 1
+        db1 = self.pool.get()
+        db2 = self.pool.get()
+        db3 = self.pool.get()
+        self.assertEqual(self.pool.get_open_count(), 3)
+        db3.close()
+        self.assertEqual(self.pool.get_open_count(), 2)
+        self.assertEqual(self.pool.get_free_count(), 0)
+        db1.close()
+        db2.close()
+        self.assertEqual(self.pool.get_free_count(), 2)
+
+    def test_double_release(self):
+        db1 = self.pool.get()
+        db1.close()
+        db1.close()
+        self.assertEqual(self.pool.get_free_count(), 1)
+
+    def test_uncommitted_dropped(self):
+        db1 = self.pool.get()
+        user1 = User(db1)
+        uu = user1.get_id()
+        db1.close()
+        db2 = self.pool.get()
+        self.assertEqual(User.get_user(db2, uu), None, "uncommitted work should not survive release")
+        db2.close()
+
+    def test_commit_across_handles(self):
+        db1 = self.pool.get()
+        db2 = self.pool.get()
+        user1 = User(db1)
+        db1.commit()
+        u2 = User.get_user(db2, user1.get_id())
+        self.assertEqual(u2, user1)
+        db1.close()
+        db2.close()
+
+    def test_health_check(self):
+        self.pool.check_interval = 0
+        db1 = self.pool.get()
+        db1.close()
+        # break the connection out from under the pool
+        db1.con.close()
+        db2 = self.pool.get()
+        self.assertFalse(db1 is db2, "a dead handle should have been replaced")
+        self.assertTrue(db2.ping())
+        db2.close()
+        self.assertEqual(self.pool.get_open_count(), 1)
+
+    def test_thread_affinity(self):
+        db1 = self.pool.get()
+        db2 = self.pool.get()
+        db2.close()
+        db1.close()
+        # this thread last used db2 so it should get it back even though
+        # db1 was released most recently
+        db3 = self.pool.get()
+        self.assertTrue(db3 is db2)
+        db3.close()
+
+    def test_other_thread(self):
+        db1 = self.pool.get()
+        db1.close()
+        results = []
+        def borrow():
+            db = self.pool.get()
+            results.append(db.ping())
+            db.close()
+        t = threading.Thread(target=borrow)
+        t.start()
+        t.join()
+        self.assertEqual(results, [True])
+
+    def test_query_timer(self):
+        times = []
+        pynimbusauthz.db.set_query_timer(times.append)
+        try:
+            db1 = self.pool.get()
+            user = User(db1)
+            db1.commit()
+            db1.close()
+        finally:
+            pynimbusauthz.db.set_query_timer(None)
+        self.assertTrue(len(times) >= 2)
+        self.assertTrue(min(times) >= 0)
@@ -60,3 +60,78 @@ class TestUser(unittest.TestCase):
         self.assertEqual(u, total)
 
 
+
+    def test_delete_file_usage(self):
+        f1 = File.create_file(self.db, "/file/1", self.user, "/d/1", pynimbusauthz.object_type_s3, size=100)
+        f2 = File.create_file(self.db, "/file/2", self.user, "/d/2", pynimbusauthz.object_type_s3, size=50)
+        f1.delete()
+        self.db.commit()
+        self.assertEqual(self.user.get_quota_usage(), 50)
+
+    def test_usage_from_before_the_ledger(self):
+        File.create_file(self.db, "/file/1", self.user, "/d/1", pynimbusauthz.object_type_s3, size=100)
+        self.db._run_no_fetch("DELETE FROM object_usage", [])
+        self.db.commit()
+        self.assertEqual(self.user.get_quota_usage(), 100)
+        File.create_file(self.db, "/file/2", self.user, "/d/2", pynimbusauthz.object_type_s3, size=10)
+        self.assertEqual(self.user.get_quota_usage(), 110)
+
+    def test_upgrade_old_database(self):
+        # a database made by the acl.sql of an older release
+        File.create_file(self.db, "/file/1", self.user, "/d/1", pynimbusauthz.object_type_s3, size=100)
+        for t in ["object_usage", "multipart", "multipart_join"]:
+            self.db._run_no_fetch("DROP TABLE %s" % (t), [])
+        for i in ["objects_parent_name_idx", "objects_owner_idx", "object_acl_object_idx"]:
+            self.db._run_no_fetch("DROP INDEX %s" % (i), [])
+        self.db.commit()
+        self.assertRaises(sqlite3.OperationalError, self.user.get_quota_usage)
+
+        added = pynimbusauthz.db.upgrade_schema(self.db)
+        self.db.commit()
+        self.assertEqual(sorted(added), sorted(["object_usage", "multipart", "multipart_join", "objects_parent_name_idx", "objects_owner_idx", "object_acl_object_idx"]))
+        self.assertEqual(self.user.get_quota_usage(), 100)
+        File.create_file(self.db, "/file/2", self.user, "/d/2", pynimbusauthz.object_type_s3, size=10)
+        self.assertEqual(self.user.get_quota_usage(), 110)
+        self.assertEqual(pynimbusauthz.db.upgrade_schema(self.db), [])
+
+    def test_reserve(self):
+        File.create_file(self.db, "/file/1", self.user, "/d/1", pynimbusauthz.object_type_s3, size=60)
+        self.assertTrue(self.user.reserve_quota(30, 100))
+        # the first upload holds the space so the second does not fit
+        self.assertFalse(self.user.reserve_quota(30, 100))
+        self.assertEqual(self.user.get_quota_reserved(), 30)
+        # unless it replaces an object
+        self.assertTrue(self.user.reserve_quota(30, 100, credit=60))
+        self.user.release_quota(60)
+        self.assertEqual(self.user.get_quota_reserved(), 0)
+        self.user.release_quota(10)
+        self.assertEqual(self.user.get_quota_reserved(), 0)
+        self.assertTrue(self.user.reserve_quota(40, 100))
+
+    def test_reconcile(self):
+        other = User(self.db)
+        File.create_file(self.db, "/file/1", self.user, "/d/1", pynimbusauthz.object_type_s3, size=100)
+        File.create_file(self.db, "/file/2", other, "/d/2", pynimbusauthz.object_type_s3, size=5)
+        self.user.reserve_quota(10, 1000)
+        self.db.commit()
+        self.assertEqual(User.reconcile_usage(self.db), [])
+
+        self.db._run_no_fetch("UPDATE object_usage SET used = 7 WHERE user_id = ?", [self.user.get_id()])
+        self.db._run_no_fetch("DELETE FROM object_usage WHERE user_id = ?", [other.get_id()])
+        wrong = User.reconcile_usage(self.db, clear_reserved=True)
+        self.db.commit()
+        ot = pynimbusauthz.object_types[pynimbusauthz.object_type_s3]
+        self.assertEqual(sorted(wrong), sorted([(self.user.get_id(), ot, 7, 100), (other.get_id(), ot, None, 5)]))
+        self.assertEqual(self.user.get_quota_usage(), 100)
+        self.assertEqual(self.user.get_quota_reserved(), 0)
+        self.assertEqual(other.get_quota_usage(), 5)
+        other.destroy_brutally()
+
+    def test_destroy_bucket_owner(self):
+        other = User(self.db)
+        bucket = File.create_file(self.db, "bucket", other, "bucket", pynimbusauthz.object_type_s3)
+        File.create_file(self.db, "key", self.user, "/d/1", pynimbusauthz.object_type_s3, parent=bucket, size=100)
+        self.assertEqual(self.user.get_quota_usage(), 100)
+        other.destroy_brutally()
+        self.db.commit()
+        self.assertEqual(self.user.get_quota_usage(), 0)
@@ -105,3 +105,60 @@ class TestRebaseCli(unittest.TestCase):
 
 
 
+
+class TestRebaseFiles(unittest.TestCase):
+
+    def setUp(self):
+        con = pynimbusauthz.db.make_test_database()
+        self.db = DB(con=con)
+        self.user1 = User(self.db)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def make_files(self, count):
+        for i in range(0, count):
+            key = "/OLD/" + str(uuid.uuid1())
+            File.create_file(self.db, "/file/name" + key, self.user1, key, pynimbusauthz.object_type_s3)
+        self.db.commit()
+        return list(File.find_files_from_data(self.db, "/OLD/%"))
+
+    def test_batches(self):
+        files = self.make_files(7)
+        finished = []
+        def new_key(k):
+            return k.replace("/OLD", "/NEW", 1)
+        def done(old, new, changed):
+            finished.append((old, changed))
+
+        count = pynimbusauthz.rebase.rebase_files(self.db, files, new_key, batch_size=3, done=done)
+        self.assertEqual(count, 7)
+        self.assertEqual(len(finished), 7)
+        self.assertTrue(all([c for (o, c) in finished]))
+        self.assertEqual(len(list(File.find_files_from_data(self.db, "/NEW/%"))), 7)
+        self.assertEqual(len(list(File.find_files_from_data(self.db, "/OLD/%"))), 0)
+
+    def test_changed_underneath(self):
+        files = self.make_files(3)
+        # someone else gives one a new key after we looked it up
+        other = File.get_file_from_db_id(self.db, files[1].get_id())
+        other.set_data_key("/ELSEWHERE")
+        self.db.commit()
+
+        finished = {}
+        def done(old, new, changed):
+            finished[old] = changed
+        count = pynimbusauthz.rebase.rebase_files(self.db, files, lambda k: k.replace("/OLD", "/NEW", 1), done=done)
+        self.assertEqual(count, 2)
+        self.assertFalse(finished[files[1].get_data_key()])
+        f = File.get_file_from_db_id(self.db, files[1].get_id())
+        self.assertEqual(f.get_data_key(), "/ELSEWHERE")
+
+    def test_paging(self):
+        files = self.make_files(5)
+        ids = sorted([f.get_id() for f in files])
+        page = list(File.find_files_from_data(self.db, "/OLD/%", limit=2))
+        self.assertEqual([f.get_id() for f in page], ids[:2])
+        page = list(File.find_files_from_data(self.db, "/OLD/%", after_id=ids[1], limit=2))
+        self.assertEqual([f.get_id() for f in page], ids[2:4])
@@ -89,3 +89,40 @@ class TestUser(unittest.TestCase):
                 found = True
         self.assertTrue(found, "We should have found that kid!")
 
+
+    def test_resolve_perms(self):
+        user2 = User(self.db)
+        user3 = User(self.db)
+        child1 = File.create_file(self.db, "kid", self.user1, "/kid/data", pynimbusauthz.object_type_s3, parent=self.file1, size=10, md5sum="abc")
+        UserFile(child1).chmod("rW", user=user2)
+        self.db.commit()
+
+        ids = [self.user1.get_id(), user2.get_id(), user3.get_id()]
+        fp = UserFile.resolve_perms(self.db, ids, self.name, pynimbusauthz.object_type_s3)
+        self.assertEqual(fp.get_id(), self.file1.get_id())
+        self.assertEqual(fp.get_data_key(), self.data)
+        self.assertEqual(fp.get_perms(self.user1.get_id()), "rwRW")
+        self.assertEqual(fp.get_perms(user2.get_id()), "")
+
+        fp = UserFile.resolve_perms(self.db, ids, "kid", pynimbusauthz.object_type_s3, parent_name=self.name)
+        self.assertEqual(fp.get_id(), child1.get_id())
+        self.assertEqual(fp.get_data_key(), "/kid/data")
+        self.assertEqual(fp.get_size(), 10)
+        self.assertEqual(fp.get_md5sum(), "abc")
+        self.assertEqual(fp.get_creation_time(), child1.get_creation_time())
+        self.assertEqual(fp.get_perms(self.user1.get_id()), "rwRW")
+        self.assertEqual(fp.get_perms(user2.get_id()), "rW")
+        self.assertEqual(fp.get_perms(user3.get_id()), "")
+
+    def test_resolve_perms_missing(self):
+        ids = [self.user1.get_id()]
+        fp = UserFile.resolve_perms(self.db, ids, "nope", pynimbusauthz.object_type_s3)
+        self.assertEqual(fp, None)
+        fp = UserFile.resolve_perms(self.db, ids, "nope", pynimbusauthz.object_type_s3, parent_name=self.name)
+        self.assertEqual(fp, None)
+        # a child is not found as a bucket and vice versa
+        File.create_file(self.db, "kid", self.user1, self.data, pynimbusauthz.object_type_s3, parent=self.file1)
+        fp = UserFile.resolve_perms(self.db, ids, "kid", pynimbusauthz.object_type_s3)
+        self.assertEqual(fp, None)
+        fp = UserFile.resolve_perms(self.db, ids, self.name, pynimbusauthz.object_type_s3, parent_name="kid")
+        self.assertEqual(fp, None)
@@ -52,6 +52,17 @@ class User(object):
         s = "DELETE FROM object_quota where user_id = ?"
         data = (self.uuid,)
         self.db_obj._run_no_fetch(s, data)
+        # other users objects in this users buckets go too
+        s = """UPDATE object_usage SET used = used - (SELECT COALESCE(SUM(object_size), 0)
+                FROM objects where owner_id = object_usage.user_id
+                and object_type = object_usage.object_type
+                and parent_id in (select id from objects where owner_id = ?))
+            where user_id != ?"""
+        data = (self.uuid, self.uuid,)
+        self.db_obj._run_no_fetch(s, data)
+        s = "DELETE FROM object_usage where user_id = ?"
+        data = (self.uuid,)
+        self.db_obj._run_no_fetch(s, data)
         s = "DELETE FROM user_alias where user_id = ?"
         data = (self.uuid,)
         self.db_obj._run_no_fetch(s, data)
@@ -197,14 +208,65 @@ class User(object):
             return User.UNLIMITED
         return row[0]
 
+    # the bytes the user has stored, from the usage ledger
     def get_quota_usage(self, object_type=pynimbusauthz.object_type_s3):
-        s = "SELECT SUM(object_size) FROM objects where owner_id = ? and object_type = ?"
+        return self._get_usage(object_type)[0]
+
+    # the bytes held for uploads of the user that are not stored yet
+    def get_quota_reserved(self, object_type=pynimbusauthz.object_type_s3):
+        return self._get_usage(object_type)[1]
+
+    def _get_usage(self, object_type):
         ot = pynimbusauthz.object_types[object_type]
+        self._ensure_usage(ot)
+        s = "SELECT used, reserved FROM object_usage where user_id = ? and object_type = ?"
         data = [self.uuid, ot]
         row = self.db_obj._run_fetch_one(s, data)
-        if row == None or len(row) == 0 or row[0] == None:
-            return 0
-        return row[0]
+        return (row[0], row[1])
+
+    # a user from before the usage ledger has no row in it yet, it is
+    # added up from the objects table the first time it is needed.  that
+    # has to happen before the objects change in the same transaction
+    def _ensure_usage(self, ot):
+        s = "SELECT used FROM object_usage where user_id = ? and object_type = ?"
+        data = [self.uuid, ot]
+        row = self.db_obj._run_fetch_one(s, data)
+        if row != None and len(row) > 0:
+            return
+        (u, data) = _usage_sql(self.uuid, ot)
+        s = "INSERT INTO object_usage(user_id, object_type, used) SELECT ?, ?, " + u
+        self.db_obj._run_no_fetch(s, [self.uuid, ot] + data)
+
+    # add delta bytes (take them away if it is negative) to what the user
+    # has stored.  done with the change to the objects table, in the same
+    # transaction
+    def add_quota_usage(self, delta, object_type=pynimbusauthz.object_type_s3):
+        ot = pynimbusauthz.object_types[object_type]
+        self._ensure_usage(ot)
+        s = "UPDATE object_usage SET used = used + ? where user_id = ? and object_type = ?"
+        data = [delta, self.uuid, ot]
+        self.db_obj._run_no_fetch(s, data)
+
+    # hold size bytes of quota for an upload that is not stored yet, credit
+    # is what the upload frees by replacing an object.  the check and the
+    # reservation are one statement so two uploads at the same time cannot
+    # both get the last of the quota.  returns False if it does not fit
+    def reserve_quota(self, size, quota, credit=0, object_type=pynimbusauthz.object_type_s3):
+        ot = pynimbusauthz.object_types[object_type]
+        self._ensure_usage(ot)
+        s = """UPDATE object_usage SET reserved = reserved + ?
+            where user_id = ? and object_type = ? and used + reserved + ? <= ?"""
+        data = [size, self.uuid, ot, size - credit, quota]
+        n = self.db_obj._run_no_fetch(s, data)
+        return n > 0
+
+    # give back a reservation, once the upload is stored or has failed
+    def release_quota(self, size, object_type=pynimbusauthz.object_type_s3):
+        ot = pynimbusauthz.object_types[object_type]
+        s = """UPDATE object_usage SET reserved = CASE WHEN reserved > ? THEN reserved - ? ELSE 0 END
+            where user_id = ? and object_type = ?"""
+        data = [size, size, self.uuid, ot]
+        self.db_obj._run_no_fetch(s, data)
 
     def set_quota(self, quota, object_type=pynimbusauthz.object_type_s3):
         ot = pynimbusauthz.object_types[object_type]
@@ -254,6 +316,53 @@ class User(object):
         return c
     find_user_by_friendly = staticmethod(find_user_by_friendly)
 
+    # rebuild the usage ledger of every user from the objects and the
+    # parts of the multipart uploads in progress.
+    # returns (user id, object type, ledger, actual) for every row that was
+    # wrong, ledger is None if the user had no row yet.  with
+    # clear_reserved all reservations are dropped too, that is only safe
+    # while no uploads are in progress
+    def reconcile_usage(db_obj, clear_reserved=False):
+        s = """SELECT owner_id, object_type, COALESCE(SUM(object_size), 0)
+            FROM objects where owner_id is not NULL GROUP BY owner_id, object_type"""
+        actual = {}
+        for row in db_obj._run_fetch_all(s, []):
+            actual[(str(row[0]), row[1])] = row[2]
+        s = """SELECT j.owner_id, COALESCE(SUM(p.object_size), 0)
+            FROM multipart p, multipart_join j where p.mp_id = j.id
+            and j.owner_id is not NULL GROUP BY j.owner_id"""
+        ot = pynimbusauthz.object_types[pynimbusauthz.object_type_s3]
+        for row in db_obj._run_fetch_all(s, []):
+            k = (str(row[0]), ot)
+            actual[k] = actual.get(k, 0) + row[1]
+        s = "SELECT user_id, object_type, used FROM object_usage"
+        ledger = {}
+        for row in db_obj._run_fetch_all(s, []):
+            ledger[(str(row[0]), row[1])] = row[2]
+
+        wrong = []
+        keys = set(actual.keys()) | set(ledger.keys())
+        for (uu, ot) in sorted(keys):
+            a = actual.get((uu, ot), 0)
+            l = ledger.get((uu, ot))
+            if l == a:
+                continue
+            wrong.append((uu, ot, l, a))
+            (u, data) = _usage_sql(uu, ot)
+            if l == None:
+                s = "INSERT INTO object_usage(user_id, object_type, used) SELECT ?, ?, " + u
+                data = [uu, ot] + data
+            else:
+                # worked out again here so a change since the look above
+                # is not lost
+                s = "UPDATE object_usage SET used = " + u + " where user_id = ? and object_type = ?"
+                data = data + [uu, ot]
+            db_obj._run_no_fetch(s, data)
+        if clear_reserved:
+            db_obj._run_no_fetch("UPDATE object_usage SET reserved = 0", [])
+        return wrong
+    reconcile_usage = staticmethod(reconcile_usage)
+
 
 class UserAlias(object):
 
@@ -380,6 +489,17 @@ class UserAlias(object):
 #
 #  returns an alias class
 
+# the sql that adds up what a user has stored of one object type and its
+# data.  the parts of multipart uploads in progress count as s3 objects
+def _usage_sql(uu, ot):
+    s = "(SELECT COALESCE(SUM(object_size), 0) FROM objects where owner_id = ? and object_type = ?)"
+    data = [uu, ot]
+    if ot == pynimbusauthz.object_types[pynimbusauthz.object_type_s3]:
+        s = s + """ + (SELECT COALESCE(SUM(p.object_size), 0) FROM multipart p, multipart_join j
+            where p.mp_id = j.id and j.owner_id = ?)"""
+        data.append(uu)
+    return (s, data)
+
 def _convert_alias_row_to_UserAlias(db, row, args):
     return UserAlias(db, row)
 
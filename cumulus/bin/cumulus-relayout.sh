@@ -0,0 +1,7 @@
+#!/bin/bash
+
+dir=`dirname $0`
+cd $dir/..
+source env.sh
+
+exec ./pycb/tools/relayout.py "${@}"
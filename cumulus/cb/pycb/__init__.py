@@ -11,8 +11,12 @@ from pycb.cbAuthzSecurity import cbAuthzUser
 from pycb.cbAuthzSecurity import cbAuthzSec
 import random
 from optparse import OptionParser
+from optparse import SUPPRESS_HELP
 import hmac
 from pycb.cbRedirector import *
+from pycb.cbLog import make_file_handler
+from pycb.cbLog import cbAccessFormatter
+from pycb.cbMetrics import get_snapshot_path
 import boto.provider
 try:
     from hashlib import sha1 as sha
@@ -25,17 +29,25 @@ import base64
 
 Version = "0.1"
 logger = None
+access_logger = None
 authenticated_user_id = "CumulusAuthenticatedUser"
 public_user_id = "CumulusPublicUser"
 
-def log(level, msg, tb=None):
+#  msg is only formatted with args if the level is logged, pass what goes
+#  in it as args rather than formatting it first on busy paths
+def log(level, msg, *args, **kw):
     global logger
 
+    tb = kw.get('tb')
     if logger == None:
+        if args:
+            msg = msg % args
         print msg
         return
+    if not logger.isEnabledFor(level):
+        return
 
-    logger.log(level, msg)
+    logger.log(level, msg, *args)
 
     if tb != None:
         logger.log(level, "Stack trace")
@@ -45,6 +57,11 @@ def log(level, msg, tb=None):
         logger.log(level, "===========")
         logger.log(level, sys.exc_info()[0])
 
+# a dict about one request for the access log, see cbAccessFormatter
+def access_log(entry):
+    if access_logger != None:
+        access_logger.info(entry)
+
 class CBConfig(object):
 
     def __init__(self):
@@ -79,21 +96,37 @@ The search path for cumulus.ini is:
 """
             raise Exception(msg + "\n" + conf_err_msg)
 
+        # the server and the admin tools must agree on the stamp file used
+        # to invalidate cached credentials, by default it lives with the
+        # rest of the installation
+        if isinstance(self.auth, cbAuthzSec) and self.authzdb_cache_stamp == None:
+            self.authzdb_cache_stamp = os.path.join(self.installdir, "etc", "authz_cred.stamp")
+            self.auth.cred_cache.set_stamp_file(self.authzdb_cache_stamp)
+
         self.setup_logger()
 
     def setup_logger(self):
         global logger
+        global access_logger
         if self.log_filename == None:
             self.log_filename = self.installdir + "/log/cumulus.log"
 
         logger = logging.getLogger('cumulus')
-        handler = logging.handlers.RotatingFileHandler(
-          self.log_filename, maxBytes=100*1024*1024, backupCount=2)
-        logger.addHandler(handler)
-        logger.setLevel(self.log_level)
+        handler = make_file_handler(self.log_filename)
         formatter = logging.Formatter("%(asctime)s - %(process)d - %(levelname)s - %(message)s")
         handler.setFormatter(formatter)
         logger.addHandler(handler)
+        logger.setLevel(self.log_level)
+
+        if self.access_filename == None:
+            self.access_filename = self.installdir + "/log/access.log"
+        if self.access_filename != "":
+            access_logger = logging.getLogger('cumulus_access')
+            access_logger.propagate = False
+            handler = make_file_handler(self.access_filename)
+            handler.setFormatter(cbAccessFormatter())
+            access_logger.addHandler(handler)
+            access_logger.setLevel(logging.INFO)
 
     def default_settings(self):
         self.auth_error = ""
@@ -104,14 +137,40 @@ The search path for cumulus.ini is:
         self.bucket = None
         self.log_level = logging.INFO
         self.log_filename = None
+        self.access_filename = None
         self.location = "CumulusLand"
         self.https_key = None
         self.https_cert = None
         self.use_https = False
         self.block_size = 1024*512
+        self.threads = 10
+        self.sendfile = True
+        # seconds an idle connection is kept open and the requests it may
+        # carry, 0 is no limit
+        self.keepalive_timeout = 60
+        self.keepalive_requests = 100
+        # the metrics are served at g_metrics_path on an admin address
+        # and port of their own, 0 is off
+        self.metrics_port = 0
+        self.metrics_address = "127.0.0.1"
+        # where a worker leaves its metrics for the supervisor
+        self.metrics_file = None
+        # several worker processes, see cbSupervisor
+        self.workers = 1
+        self.worker_timeout = 30
+        self.drain_timeout = 60
+        # set on the command line of a worker by its supervisor
+        self.listen_fd = None
+        self.heartbeat_fd = None
         self.lb_file = None
         self.lb_max = 0
         self.redirector = cbRedirectorIface()
+        self.authzdb_pool_size = 10
+        self.authzdb_pool_overflow = 10
+        self.authzdb_pool_check = 60
+        self.authzdb_cache_size = 1000
+        self.authzdb_cache_ttl = 60
+        self.authzdb_cache_stamp = None
 
     def get_contact(self):
         return (self.hostname, self.port)
@@ -153,12 +212,60 @@ The search path for cumulus.ini is:
                 self.location = s.get("cb", "location")
             except:
                 pass
+            try:
+                self.threads = int(s.get("cb", "threads"))
+            except:
+                pass
+            try:
+                self.sendfile = s.getboolean("cb", "sendfile")
+            except:
+                pass
+            try:
+                self.metrics_port = s.getint("cb", "metrics_port")
+            except:
+                pass
+            try:
+                self.metrics_address = s.get("cb", "metrics_address")
+            except:
+                pass
+            try:
+                self.keepalive_timeout = s.getint("cb", "keepalive_timeout")
+            except:
+                pass
+            try:
+                self.keepalive_requests = s.getint("cb", "keepalive_requests")
+            except:
+                pass
+            try:
+                self.workers = s.getint("cb", "workers")
+            except:
+                pass
+            try:
+                self.worker_timeout = s.getint("cb", "worker_timeout")
+            except:
+                pass
+            try:
+                self.drain_timeout = s.getint("cb", "drain_timeout")
+            except:
+                pass
 
             try:
                 backend = s.get("backend", "type")
                 if backend == "posix":
                     posix_dir = s.get("backend", "data_dir")
-                    self.bucket = cbPosixBackend(posix_dir)
+                    dedup = False
+                    try:
+                        dedup = s.getboolean("backend", "dedup")
+                    except:
+                        pass
+                    layout = 1
+                    fanout = 2
+                    try:
+                        layout = s.getint("backend", "layout")
+                        fanout = s.getint("backend", "fanout")
+                    except:
+                        pass
+                    self.bucket = cbPosixBackend(posix_dir, dedup=dedup, layout=layout, fanout=fanout)
                     block_size = s.get("backend", "block_size")
             except:
                 pass
@@ -171,7 +278,31 @@ The search path for cumulus.ini is:
                     self.auth = cbPosixSec(posix_dir)
                 elif sec == "authz":
                     self.authzdb = s.get("security", "authzdb")
-                    self.auth = cbAuthzSec(self.authzdb)
+                    try:
+                        self.authzdb_pool_size = int(s.get("security", "pool_size"))
+                    except:
+                        pass
+                    try:
+                        self.authzdb_pool_overflow = int(s.get("security", "pool_overflow"))
+                    except:
+                        pass
+                    try:
+                        self.authzdb_pool_check = int(s.get("security", "pool_check"))
+                    except:
+                        pass
+                    try:
+                        self.authzdb_cache_size = int(s.get("security", "cache_size"))
+                    except:
+                        pass
+                    try:
+                        self.authzdb_cache_ttl = int(s.get("security", "cache_ttl"))
+                    except:
+                        pass
+                    try:
+                        self.authzdb_cache_stamp = s.get("security", "cache_stamp")
+                    except:
+                        pass
+                    self.auth = cbAuthzSec(self.authzdb, pool_size=self.authzdb_pool_size, pool_overflow=self.authzdb_pool_overflow, pool_check=self.authzdb_pool_check, cache_size=self.authzdb_cache_size, cache_ttl=self.authzdb_cache_ttl, cache_stamp=self.authzdb_cache_stamp)
                 else:
                     self.auth_error = self.auth_error + "no type %s" % (sec)
             except:
@@ -188,6 +319,10 @@ The search path for cumulus.ini is:
                 self.log_filename = s.get("log", "file")
             except:
                 pass
+            try:
+                self.access_filename = s.get("log", "access_file").strip()
+            except:
+                pass
 
             try:
                 self.https_key = s.get("https", "key").strip()
@@ -206,6 +341,8 @@ The search path for cumulus.ini is:
                 redirector_name = s.get("redirector", "type")
                 if redirector_name == "basic":
                     self.redirector = cbBasicRedirector(s)
+                elif redirector_name == "load":
+                    self.redirector = cbLoadRedirector(s)
             except:
                 pass
 
@@ -218,6 +355,19 @@ The search path for cumulus.ini is:
         self.opts.append(opt)
         opt = cbOpts("https", "s", "Enable https", False, flag=True)
         self.opts.append(opt)
+        opt = cbOpts("workers", "w", "number of worker processes", None, range=(1, 64))
+        self.opts.append(opt)
+        opt = cbOpts("metrics_port", "M", "serve the metrics on this port, 0 for none", None, range=(0, 65536))
+        self.opts.append(opt)
+        # how a supervisor hands a worker what it needs
+        opt = cbOpts("listen_fd", "F", SUPPRESS_HELP, None)
+        self.opts.append(opt)
+        opt = cbOpts("heartbeat_fd", "H", SUPPRESS_HELP, None)
+        self.opts.append(opt)
+        opt = cbOpts("counter_file", "C", SUPPRESS_HELP, None)
+        self.opts.append(opt)
+        opt = cbOpts("counter_slot", "S", SUPPRESS_HELP, None)
+        self.opts.append(opt)
 
         u = """ [options]"""
     
@@ -234,15 +384,29 @@ The search path for cumulus.ini is:
         # override anything from the files        
         if options.port != None:
             self.port = int(options.port)
+        if options.workers != None:
+            self.workers = int(options.workers)
+        if options.metrics_port != None:
+            self.metrics_port = int(options.metrics_port)
+        if options.listen_fd != None:
+            self.listen_fd = int(options.listen_fd)
+        if options.heartbeat_fd != None:
+            self.heartbeat_fd = int(options.heartbeat_fd)
+        # connections are counted across all of the workers
+        if options.counter_file != None:
+            counter = cbSharedConnectionCount(options.counter_file, int(options.counter_slot))
+            self.redirector.set_counter(counter)
+            self.metrics_file = get_snapshot_path(options.counter_file, int(options.counter_slot))
 
 
 def get_auth_hash(key, method, path, headers, uri):
 
-    sub_resources = ["?acl", "?location", "?logging", "?torrent"]
-    for sr in sub_resources:
-        ndx = uri.find(sr)
-        if ndx > 0:
-            path = path + sr
+    # the sub resources (?acl, ?uploads, ?partNumber=...) are part of what
+    # is signed.  boto picks them out of the query string the same way the
+    # client did
+    ndx = uri.find("?")
+    if ndx > 0:
+        path = path + uri[ndx:]
 
     myhmac = hmac.new(key, digestmod=sha)
     c_string = boto.utils.canonical_string(method, path, headers, provider=boto.provider.get_default())
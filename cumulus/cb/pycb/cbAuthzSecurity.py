@@ -19,11 +19,21 @@ from pynimbusauthz.user import User
 from pynimbusauthz.user import UserAlias
 from pynimbusauthz.objects import File
 from pynimbusauthz.objects import UserFile
+from pynimbusauthz.objects import prefix_upper_bound
+from pynimbusauthz.multipart import MultipartUpload
 from pynimbusauthz.db import DB
+from pynimbusauthz.db import DBPool
+from pynimbusauthz.db import upgrade_schema
+from pynimbusauthz.cache import TTLCache
 import itertools
+import threading
 
 authed_user = None
 public_user = None
+# what s3 returns when max-keys is not given
+g_default_max_keys = 1000
+# how many rows a listing reads from the db at a time
+g_list_page = 250
 
 def merge_permissions(p1, p2):
     perms = p2
@@ -35,29 +45,96 @@ def merge_permissions(p1, p2):
 
 class cbAuthzUser(object):
 
-    def __init__(self, alias_name, con_str):
-        self.db_obj = DB(con_str=con_str)
-        alias = User.find_alias(self.db_obj, alias_name, pynimbusauthz.alias_type_s3)
-        a_list = list(alias)
-        if len(a_list) < 1:
-            raise cbException('AccessDenied')
-        # pick the first one, hmmm XXX
-        self.alias = a_list[0]
-        self.user = self.alias.get_canonical_user()
+    # cred is the (secret, canonical id, display name) tuple from the
+    # credential cache.  when it is given nothing touches the db until an
+    # operation actually needs it, so authenticating a cached user is free.
+    # the db handle is borrowed from the cbAuthzSec pool on first use and
+    # close() gives it back
+    def __init__(self, alias_name, sec, cred=None):
+        self.alias_name = alias_name
+        self.sec = sec
+        self._db_obj = None
+        self._alias = None
+        self._user = None
+        # (bucket, object) -> FilePerms, only lives as long as the request
+        self.resolved = {}
+        # quota held for an upload of this request, see reserve_quota
+        self.reserved = 0
+        # a request can give the handle back from the thread pool while the
+        # reactor does so for a client that went away
+        self.lock = threading.Lock()
+        if cred == None:
+            try:
+                alias = self.alias
+                cred = (alias.get_data(), alias.get_canonical_user().get_id(), alias.get_friendly_name())
+            except:
+                self.close()
+                raise
+        self.cred = cred
+
+    def _get_db_obj(self):
+        if self._db_obj == None:
+            self._db_obj = self.sec.get_db()
+        return self._db_obj
+    db_obj = property(_get_db_obj)
+
+    def _get_alias(self):
+        if self._alias == None:
+            alias = User.find_alias(self.db_obj, self.alias_name, pynimbusauthz.alias_type_s3)
+            a_list = list(alias)
+            if len(a_list) < 1:
+                raise cbException('AccessDenied')
+            # pick the first one, hmmm XXX
+            self._alias = a_list[0]
+        return self._alias
+    alias = property(_get_alias)
+
+    def _get_user(self):
+        if self._user == None:
+            if self._alias != None:
+                self._user = self._alias.get_canonical_user()
+            else:
+                self._user = User(self.db_obj, uu=self.cred[1])
+        return self._user
+    user = property(_get_user)
+
+    # done with the db for this request, release the handle.  the user
+    # borrows another one if it is used again
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self._db_obj == None:
+                return
+            # the upload never got stored
+            if self.reserved > 0:
+                try:
+                    self.user.release_quota(self.reserved)
+                    self._db_obj.commit()
+                except:
+                    pycb.log(logging.ERROR, "could not release %d bytes of quota for %s" % (self.reserved, self.alias_name))
+                self.reserved = 0
+            db_obj = self._db_obj
+            self._db_obj = None
+            self._alias = None
+            self._user = None
+            self.resolved = {}
+            db_obj.close()
+        finally:
+            self.lock.release()
 
     def get_canonical_id(self):
-        return self.user.get_id()
+        return self.cred[1]
 
     def get_password(self):
-        return self.alias.get_data()
+        return self.cred[0]
 
     # return string user_id
     def get_id(self):
-        return self.alias.get_name()
+        return self.alias_name
 
     # return string email name
     def get_display_name(self):
-        return self.alias.get_friendly_name()
+        return self.cred[2]
 
     def get_file_obj(self, bucketName, objectName=None):
         file = File.get_file(self.db_obj, bucketName, pynimbusauthz.object_type_s3)
@@ -69,12 +146,14 @@ class cbAuthzUser(object):
 
 
     # return the permission string of the given object
-    def get_uf(self, bucketName, objectName=None):
+    def get_uf(self, bucketName, objectName=None, user=None):
         file = self.get_file_obj(bucketName, objectName)
         if file == None:
-            pycb.log(logging.INFO, "b:o not found %s:%s" % (bucketName, str(objectName)))
+            pycb.log(logging.DEBUG, "b:o not found %s:%s", bucketName, objectName)
             raise cbException('NoSuchKey')
-        uf = UserFile(file, self.user)
+        if user == None:
+            user = self.user
+        uf = UserFile(file, user)
         return uf
 
     def set_quota(self, max):
@@ -86,27 +165,43 @@ class cbAuthzUser(object):
         self.db_obj.commit()
         return q
 
-    # return the permission string of the given object
-    def get_perms(self, bucketName, objectName=None):
+    # look up the file and the permissions this user and the pseudo users
+    # have on it in one query.  a request usually asks about the same
+    # object several times so the answer is kept until something changes
+    # or the request is over.  returns None if there is no such file
+    def resolve(self, bucketName, objectName=None):
         global authed_user
         global public_user
-        try:
-            ufa = authed_user.get_uf(bucketName, objectName)
-            ufp = public_user.get_uf(bucketName, objectName)
-            p1 = ufa.get_perms(force=True)
-            p2 = ufp.get_perms(force=True)
-            gperms = merge_permissions(p1, p2)
-        except:
-            pycb.log(logging.ERROR, "error getting global permissions %s" % (sys.exc_info()[0]), tb=traceback)
-            gperms = ""
 
+        key = (bucketName, objectName)
+        if key in self.resolved:
+            return self.resolved[key]
+        user_list = [self.get_canonical_id(), authed_user.get_id(), public_user.get_id()]
         try:
-            uf = self.get_uf(bucketName, objectName)
-            p = uf.get_perms(force=True)
-            p = merge_permissions(p, gperms)
-            return (p, uf.get_file().get_data_key())
+            if objectName == None:
+                fp = UserFile.resolve_perms(self.db_obj, user_list, bucketName, pynimbusauthz.object_type_s3)
+            else:
+                fp = UserFile.resolve_perms(self.db_obj, user_list, objectName, pynimbusauthz.object_type_s3, parent_name=bucketName)
         finally:
             self.db_obj.commit()
+        self.resolved[key] = fp
+        return fp
+
+    # return the permission string of the given object
+    def get_perms(self, bucketName, objectName=None):
+        global authed_user
+        global public_user
+
+        fp = self.resolve(bucketName, objectName)
+        if fp == None:
+            pycb.log(logging.DEBUG, "b:o not found %s:%s", bucketName, objectName)
+            raise cbException('NoSuchKey')
+        p1 = fp.get_perms(authed_user.get_id())
+        p2 = fp.get_perms(public_user.get_id())
+        gperms = merge_permissions(p1, p2)
+        p = fp.get_perms(self.get_canonical_id())
+        p = merge_permissions(p, gperms)
+        return (p, fp.get_data_key())
 
     def get_owner(self, bucketName, objectName=None):
         try:
@@ -129,60 +224,73 @@ class cbAuthzUser(object):
         finally:
             self.db_obj.commit()
 
-    # returns a list of cbObjects
+    # list a bucket with the s3 marker, max-keys, prefix and delimiter
+    # semantics.  the arguments and the bucket are checked here, the rows
+    # are read a page at a time as the returned cbAuthzListing is iterated
     def list_bucket(self, bucketName, args):
-
-        clause = " ORDER BY name"
-        prefix = None
-        if 'prefix' in args:
-            prefix = args['prefix'][0]
-            prefix = "%s%%" % (prefix)
-
-        limit = None
-        if 'max-keys' in args:
-            max_a = args['max-keys']
-            limit = int(max_a[0])
-
-        if 'delimiter' in args:
-            pass
-        if 'key-marker' in args:
-            km = args['key-marker'][0]
-            clause = " and name > '%s'" % (km)
-
+        prefix = _get_arg(args, 'prefix', "")
+        marker = _get_arg(args, 'marker', _get_arg(args, 'key-marker'))
+        if marker == "":
+            marker = None
+        delimiter = _get_arg(args, 'delimiter')
+        if delimiter == "":
+            delimiter = None
         try:
-            bucket = File.get_file(self.db_obj, bucketName, pynimbusauthz.alias_type_s3)
-            iter = bucket.get_all_children(limit=limit, match_str=prefix, clause=clause)
-            new_it = itertools.imap(lambda r: _convert_File_to_cbObject(self, r), iter)
-            return list(new_it)
-        finally:
-            self.db_obj.commit()
+            max_keys = int(_get_arg(args, 'max-keys', g_default_max_keys))
+        except ValueError:
+            raise cbException('InvalidArgument')
+        if max_keys < 0:
+            raise cbException('InvalidArgument')
+        # like s3 no more than that are returned at once, the reply is
+        # built in memory
+        max_keys = min(max_keys, g_default_max_keys)
+
+        bucket = self.resolve(bucketName)
+        if bucket == None:
+            raise cbException('NoSuchBucket')
+        return cbAuthzListing(self, bucket.get_id(), prefix, marker, delimiter, max_keys)
 
     # check if the given bucket/object exists
     # returns a bool 
     def exists(self, bucketName, objectName=None):
-        try:
-            file = self.get_file_obj(bucketName, objectName)
-            return file != None
-        finally:
-            self.db_obj.commit()
+        return self.resolve(bucketName, objectName) != None
 
     def get_info(self, bucketName, objectName=None):
-        try:
-            file = self.get_file_obj(bucketName, objectName)
-            return (file.get_size(), file.get_creation_time(), file.get_md5sum())
-        finally:
-            self.db_obj.commit()
+        fp = self.resolve(bucketName, objectName)
+        if fp == None:
+            raise cbException('NoSuchKey')
+        return (fp.get_size(), fp.get_creation_time(), fp.get_md5sum())
 
+    # what is left once the objects stored and the uploads in progress
+    # are taken off
     def get_remaining_quota(self):
         quota = self.user.get_quota()
         if quota == User.UNLIMITED:
             return User.UNLIMITED
 
         u = self.user.get_quota_usage()
-        return quota - u
+        r = self.user.get_quota_reserved()
+        return quota - u - r
+
+    # hold size bytes of quota for an upload until it is stored by
+    # put_object or the request is over.  credit is the size of an object
+    # the upload replaces
+    def reserve_quota(self, size, credit=0):
+        try:
+            quota = self.user.get_quota()
+            if quota == User.UNLIMITED:
+                return
+            ok = self.user.reserve_quota(size, quota, credit)
+        finally:
+            self.db_obj.commit()
+        if not ok:
+            pycb.log(logging.INFO, "user %s did not pass quota.  file size %d quota %d" % (self.alias_name, size, quota))
+            raise cbException('AccountProblem')
+        self.reserved = self.reserved + size
 
     # add a new bucket owned by this user
     def put_bucket(self, bucketName):
+        self.resolved = {}
         try:
             f = File.create_file(self.db_obj, bucketName, self.user, bucketName, pynimbusauthz.alias_type_s3)
         finally:
@@ -192,6 +300,7 @@ class cbAuthzUser(object):
         data_key = data_obj.get_data_key()
         md5sum = data_obj.get_md5()
         fsize = data_obj.get_size()
+        self.resolved = {}
         try:
             # it is ok for someone to put to an existing object
             # we just need to delete the existing one
@@ -201,12 +310,17 @@ class cbAuthzUser(object):
                 file.delete()
             bf = self.get_file_obj(bucketName)
             f = File.create_file(self.db_obj, objectName, self.user, data_key, pynimbusauthz.alias_type_s3, parent=bf, size=fsize, md5sum=md5sum)
+            # the space is counted as used now
+            if self.reserved > 0:
+                self.user.release_quota(self.reserved)
+                self.reserved = 0
 
         finally:
             self.db_obj.commit()
 
     # grant a new user_id access to the object or bucket
     def grant(self, user_id, bucketName, objectName=None, perms="Rr"):
+        self.resolved = {}
         try:
             uf = self.get_uf(bucketName, objectName)
             new_alias_iter = User.find_alias(self.db_obj, user_id, pynimbusauthz.alias_type_s3)
@@ -220,6 +334,7 @@ class cbAuthzUser(object):
 
     # remove an object from the registry
     def delete_object(self, bucketName, objectName):
+        self.resolved = {}
         try:
             file = self.get_file_obj(bucketName, objectName)
             file.delete()
@@ -228,14 +343,123 @@ class cbAuthzUser(object):
 
     # remove a bucket from the registry
     def delete_bucket(self, bucketName):
+        self.resolved = {}
         try:
             file = self.get_file_obj(bucketName)
-            kids = file.get_all_children()
+            kids = File.list_children(self.db_obj, file.get_id(), limit=1)
             if len(list(kids)) != 0:
                 raise cbException('BucketNotEmpty')
+            # uploads that were never completed go with the bucket
+            data_keys = []
+            for mp in list(MultipartUpload.find_uploads(self.db_obj, file)):
+                data_keys = data_keys + self._drop_multipart(mp)
             file.delete()
         finally:
             self.db_obj.commit()
+        self._delete_data(data_keys)
+
+    #
+    #  multipart uploads.  each part is a backend object of its own that
+    #  only the multipart tables know about until the upload is completed
+    #
+
+    # start an upload of objectName into bucketName, returns the upload id
+    def create_multipart(self, bucketName, objectName):
+        try:
+            bf = self.get_file_obj(bucketName)
+            if bf == None:
+                raise cbException('NoSuchBucket')
+            mp = MultipartUpload.create_upload(self.db_obj, bf, objectName, self.user)
+            return mp.get_upload_id()
+        finally:
+            self.db_obj.commit()
+
+    # the upload in progress with the given id.  it has to be an upload
+    # of bucketName/objectName
+    def get_multipart(self, bucketName, objectName, upload_id):
+        try:
+            mp = MultipartUpload.get_upload(self.db_obj, upload_id)
+            if mp == None or mp.get_name() != objectName:
+                raise cbException('NoSuchUpload')
+            bf = self.get_file_obj(bucketName)
+            if bf == None or bf.get_id() != mp.get_bucket_id():
+                raise cbException('NoSuchUpload')
+            return mp
+        finally:
+            self.db_obj.commit()
+
+    # (id, display name) of the user who started the upload
+    def get_multipart_owner(self, mp):
+        try:
+            owner = mp.get_owner()
+            if owner == None:
+                raise cbException('InternalError')
+            uas = list(owner.get_alias_by_type(pynimbusauthz.alias_type_s3))
+            if len(uas) < 1:
+                raise cbException('InternalError')
+            return (uas[0].get_name(), uas[0].get_friendly_name())
+        finally:
+            self.db_obj.commit()
+
+    # the bytes of the upload that count against the quota of this user,
+    # just part number part_num if it is given
+    def get_multipart_size(self, mp, part_num=None):
+        try:
+            if mp.get_owner_id() != self.user.get_id():
+                return 0
+            if part_num == None:
+                return mp.get_parts_size()
+            p = mp.get_part(part_num)
+            if p == None or p.get_size() == None:
+                return 0
+            return p.get_size()
+        finally:
+            self.db_obj.commit()
+
+    # record the backend object data_obj as part number part_num of the
+    # upload.  a part that it replaces is deleted.  the part counts
+    # against the quota of the user who started the upload until the
+    # upload is completed or aborted
+    def put_multipart_part(self, mp, part_num, data_obj):
+        try:
+            old = mp.add_part(part_num, data_obj.get_data_key(), data_obj.get_size(), data_obj.get_md5())
+            # the space is counted as used now
+            if self.reserved > 0:
+                self.user.release_quota(self.reserved)
+                self.reserved = 0
+        finally:
+            self.db_obj.commit()
+        if old != None:
+            self._delete_data([old])
+
+    # the parts after part number marker, at most limit of them
+    def get_multipart_parts(self, mp, marker=None, limit=None):
+        try:
+            return list(mp.get_parts(marker, limit))
+        finally:
+            self.db_obj.commit()
+
+    # forget an upload and remove the data of all of its parts.  this is
+    # both how an upload is aborted and how it is cleaned up once the
+    # parts have been joined into the new object
+    def delete_multipart(self, mp):
+        try:
+            data_keys = self._drop_multipart(mp)
+        finally:
+            self.db_obj.commit()
+        self._delete_data(data_keys)
+
+    def _drop_multipart(self, mp):
+        data_keys = [p.get_data_key() for p in mp.get_parts()]
+        mp.delete()
+        return data_keys
+
+    def _delete_data(self, data_keys):
+        for data_key in data_keys:
+            try:
+                pycb.config.bucket.delete_object(data_key)
+            except:
+                pycb.log(logging.WARNING, "error deleting part %s" % (data_key), tb=traceback)
 
     # return the acl list of the given bucket/object
     #
@@ -264,6 +488,7 @@ class cbAuthzUser(object):
             self.alias.set_data(password)
         finally:
             self.db_obj.commit()
+        self.sec.invalidate_credentials(self.alias_name)
 
     def remove_user(self, force=False):
         try:
@@ -274,47 +499,165 @@ class cbAuthzUser(object):
                 self.alias.remove()
         finally:
             self.db_obj.commit()
+        self.sec.invalidate_credentials(self.alias_name)
+
+#
+#  iterating a listing yields a cbObject for every key and a string for
+#  every common prefix.  keys that share the part of their name up to the
+#  first delimiter after the prefix are rolled up into one common prefix,
+#  the rest of them are jumped over in the index rather than read.
+#
+#  rows are read g_list_page at a time and the transaction is ended after
+#  each page so a slow reader never holds the db.  truncated and
+#  next_marker are only known once the iteration is over
+class cbAuthzListing(object):
+
+    def __init__(self, user, bucket_id, prefix, marker, delimiter, max_keys):
+        self.user = user
+        self.bucket_id = bucket_id
+        self.prefix = prefix
+        self.marker = marker
+        self.delimiter = delimiter
+        self.max_keys = max_keys
+        self.truncated = False
+        self.next_marker = None
+
+    def _page(self, after, start, limit):
+        db_obj = self.user.db_obj
+        try:
+            return list(File.list_children(db_obj, self.bucket_id, marker=after, prefix=self.prefix, start=start, limit=limit))
+        finally:
+            db_obj.commit()
+
+    def __iter__(self):
+        count = 0
+        after = self.marker
+        start = None
+        last = None
+        while True:
+            # one more than is needed tells us if the list is truncated
+            want = min(self.max_keys - count + 1, g_list_page)
+            kids = self._page(after, start, want)
+            skip = None
+            for f in kids:
+                name = f.get_name()
+                cp = None
+                if self.delimiter != None:
+                    ndx = name.find(self.delimiter, len(self.prefix))
+                    if ndx >= 0:
+                        cp = name[:ndx + len(self.delimiter)]
+                # the marker is inside a prefix already returned
+                if cp != None and self.marker != None and self.marker.startswith(cp):
+                    skip = cp
+                    break
+                if count >= self.max_keys:
+                    self.truncated = True
+                    self.next_marker = last
+                    return
+                count = count + 1
+                if cp != None:
+                    last = cp
+                    skip = cp
+                    yield cp
+                    break
+                last = name
+                yield _convert_File_to_cbObject(self.user, f)
+            if skip != None:
+                start = prefix_upper_bound(skip)
+                if start == None:
+                    return
+            elif len(kids) < want:
+                return
+            else:
+                after = last
 
 class cbAuthzSec(object):
 
-    def __init__(self, con_str):
+    def __init__(self, con_str, pool_size=10, pool_overflow=10, pool_check=60, cache_size=1000, cache_ttl=60, cache_stamp=None):
         global authed_user
         global public_user
 
         self.con_str = con_str
+        self.db_pool = DBPool(con_str, size=pool_size, max_overflow=pool_overflow, check_interval=pool_check)
+        # access id -> (secret, canonical id, display name)
+        self.cred_cache = TTLCache(max_size=cache_size, ttl=cache_ttl, stamp_file=cache_stamp)
+
+        # a database made for an older release is brought up to date.  the
+        # workers of a supervisor all try, one that loses the race finds
+        # it done the next time it starts
+        db_obj = self.get_db()
+        try:
+            added = upgrade_schema(db_obj)
+            db_obj.commit()
+            if len(added) > 0:
+                pycb.log(logging.INFO, "added %s to the authz database" % (", ".join(added)))
+        except:
+            db_obj.rollback()
+            pycb.log(logging.WARNING, "could not upgrade the authz database", tb=traceback)
+        finally:
+            db_obj.close()
 
-        authed_user = self.get_user(pycb.authenticated_user_id)
-        public_user = self.get_user(pycb.public_user_id)
+        # the pseudo users are only needed for their canonical ids so they
+        # do not hold on to a db handle
+        db_obj = self.get_db()
+        try:
+            authed_user = User(db_obj, pycb.authenticated_user_id)
+            public_user = User(db_obj, pycb.public_user_id)
+        finally:
+            db_obj.close()
 
-    # return a user object or raise an exception if no id is found
+    # return a user object or raise an exception if no id is found.
+    # the caller must close() the user when it is done with it
     def get_user(self, id):
-        return cbAuthzUser(id, self.con_str)
+        cred = self.cred_cache.get(id)
+        user = cbAuthzUser(id, self, cred)
+        if cred == None:
+            self.cred_cache.put(id, user.cred)
+        return user
+
+    # called whenever an alias is changed or removed.  the stamp is
+    # replaced so that a running server drops its cached copy too.  if the
+    # stamp cannot be written the entry still expires after cache_ttl
+    def invalidate_credentials(self, id=None):
+        self.cred_cache.invalidate(id)
+        try:
+            self.cred_cache.touch()
+        except:
+            pycb.log(logging.WARNING, "could not update the credential cache stamp %s" % (self.cred_cache.stamp_file), tb=traceback)
 
     def create_user(self, display_name, id, pw, opts):
-        db_obj = DB(con_str=self.con_str)
-        user = User(db_obj, friendly=display_name)
-        user_alias = user.create_alias(id, "s3", display_name, alias_data=pw)
-        db_obj.commit()
-        db_obj.close()
+        db_obj = self.get_db()
+        try:
+            user = User(db_obj, friendly=display_name)
+            user_alias = user.create_alias(id, "s3", display_name, alias_data=pw)
+            db_obj.commit()
+        finally:
+            db_obj.close()
+        self.invalidate_credentials(id)
 
     def get_user_id_by_display(self, display_name):
-        db_obj = DB(con_str=self.con_str)
-        a_it = UserAlias.find_alias_by_friendly(db_obj, display_name)
-        a_list = list(a_it)
-        if len(a_list) < 1:
-            return None
-        alias = a_list[0]
-        return alias.get_name()
+        db_obj = self.get_db()
+        try:
+            a_it = UserAlias.find_alias_by_friendly(db_obj, display_name)
+            a_list = list(a_it)
+            if len(a_list) < 1:
+                return None
+            alias = a_list[0]
+            return alias.get_name()
+        finally:
+            db_obj.close()
 
     def find_user_id_by_display(self, pattern):
-        db_obj = DB(con_str=self.con_str)
-        a_it = UserAlias.find_all_alias_by_friendly(db_obj, pattern)
-        new_it = map(lambda r: r.get_name(), a_it)
-        return new_it
+        db_obj = self.get_db()
+        try:
+            a_it = UserAlias.find_all_alias_by_friendly(db_obj, pattern)
+            new_it = map(lambda r: r.get_name(), a_it)
+            return new_it
+        finally:
+            db_obj.close()
 
-    def get_db():
-        db_obj = DB(con_str=self.con_str)
-        return db_obj
+    def get_db(self):
+        return self.db_pool.get()
 
 def _convert_test_it(a):
     return a.get_name()
@@ -327,8 +670,12 @@ def _convert_bucket_to_cbObject(user, file):
     obj = cbObject(tm, size, key, display_name, user)
     return obj
 
+def _get_arg(args, name, default=None):
+    if name not in args:
+        return default
+    return args[name][0]
+
 def _convert_File_to_cbObject(user, file):
-    data_key = file.get_data_key()
     size = file.get_size()
     tm = file.get_creation_time()
     mds = file.get_md5sum()
@@ -22,9 +22,18 @@ class cbBackendInterface(object):
         return obj
 
 
-    # copy an object, not yet implemented
-    def copy_object(self, srcObjectName, dstObjectName, moveOrCopy, httpHeaders):
-        pass
+    # copy the data of src_data_key to a new key for bucketName/objectName
+    # and return a DataObject for reading it.  md5sum is the md5 of the
+    # source, the copy has the same one
+    def copy_object(self, src_data_key, bucketName, objectName, md5sum):
+        return obj
+
+
+    # create and return a DataObject for writing that already holds the
+    # data of each of the data_keys in order.  used to complete multipart
+    # uploads
+    def join_objects(self, bucketName, objectName, data_keys):
+        return obj
 
 
     # find and return a dataobject with the given key for reading
@@ -65,7 +74,11 @@ class cbDataObject(object):
     def flush(self):
         pass
 
-    #def fileno(self):
+    # the descriptor of a local file holding the data, used to send it
+    # with sendfile.  return None if there is no such file
+    def fileno(self):
+        return None
+
     #def isatty(self):
 
     def next(self):
@@ -78,10 +91,14 @@ class cbDataObject(object):
 #    def readlines(self, size=None):
 #    def xreadlines(self):
 
-    def seek(self, offset, whence=None):
+    # used to serve Range requests.  after a seek get_md5() cannot be
+    # worked out from the bytes read and should return None
+    def seek(self, offset, whence=0):
+        pass
+
+    def tell(self):
         pass
 
-#    def tell(self):
 #    def truncate(self, size=None):
 
     def write(self, st):
@@ -323,6 +323,26 @@ class cbException(Exception):
     errorsHttpCode['UserKeyMustBeSpecified'] = 400
     errorsHttpMsg['UserKeyMustBeSpecified'] = 'Bad Request'
 
+    # errror type 64 NoSuchUpload
+    errorsCode['NoSuchUpload'] = 'The specified multipart upload does not exist.'
+    errorsHttpCode['NoSuchUpload'] = 404
+    errorsHttpMsg['NoSuchUpload'] = 'Not Found'
+
+    # errror type 65 InvalidPart
+    errorsCode['InvalidPart'] = 'One or more of the specified parts could not be found or its entity tag did not match.'
+    errorsHttpCode['InvalidPart'] = 400
+    errorsHttpMsg['InvalidPart'] = 'Bad Request'
+
+    # errror type 66 InvalidPartOrder
+    errorsCode['InvalidPartOrder'] = 'The list of parts was not in ascending order.'
+    errorsHttpCode['InvalidPartOrder'] = 400
+    errorsHttpMsg['InvalidPartOrder'] = 'Bad Request'
+
+    # errror type 67 MalformedXML
+    errorsCode['MalformedXML'] = 'The XML you provided was not well-formed or did not validate against our published schema.'
+    errorsHttpCode['MalformedXML'] = 400
+    errorsHttpMsg['MalformedXML'] = 'Bad Request'
+
     def __init__(self, code, ex=None):
         self.code = code 
         self.ex = ex
@@ -385,17 +405,27 @@ class cbException(Exception):
     def sendErrorResponse(self, request, requestId):
 
         try:
+            # Create the minidom document
+            xml = self.make_xml_string(request.path, requestId)
+            # part of another reply has gone out, the client can only be
+            # told by closing the connection
+            if request.startedWriting:
+                pycb.log(logging.ERROR, "%s %s after the reply was started, closing the connection" % (requestId, self.code))
+                request.loseConnection()
+                return xml
+
             request.setHeader('x-amz-request-id', str(requestId))
             request.setHeader('x-amz-id-2:', str(uuid.uuid1()))
 
             request.setResponseCode(self.httpCode, self.httpDesc)
-            # Create the minidom document
-            xml = self.make_xml_string(request.path, requestId)
+            # the connection can be used again once the reply is framed
+            request.setHeader('Content-Type', 'application/xml')
+            request.setHeader('Content-Length', str(len(xml)))
             request.write(xml)
             request.finish()
 
             return xml
         except:
             # XXX LOG ERROR 
-            pycb.log(logging.ERROR, sys.exc_info()[0], traceback)
+            pycb.log(logging.ERROR, sys.exc_info()[0], tb=traceback)
             return cbException.panicError    
@@ -0,0 +1,110 @@
+import sys
+import time
+import json
+import Queue
+import logging
+import logging.handlers
+import threading
+
+#
+#  log records are written to the file by a thread of their own so the
+#  reactor never waits on the disk.  the caller only puts the record on a
+#  queue, the writer takes everything that has queued up, writes it and
+#  flushes once.  when the queue is full records are dropped and counted
+#  rather than making the caller wait
+#
+class cbAsyncHandler(logging.Handler):
+
+    def __init__(self, target, max_queue=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue.Queue(max_queue)
+        self.dropped = 0
+        self.done = False
+        self.thread = threading.Thread(target=self.run, name="cumulus-log")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.target.setFormatter(fmt)
+
+    def emit(self, record):
+        # the arguments may change once we return, the message is made
+        # now.  one with no arguments is left for the writer to format
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            self.format(record)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped = self.dropped + 1
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < 1000:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            stop = False
+            for r in batch:
+                if r == None:
+                    stop = True
+                    continue
+                self.write(r)
+            if self.dropped > 0:
+                n = self.dropped
+                self.dropped = 0
+                self.write(logging.makeLogRecord({'msg': "%d log records were dropped" % (n), 'levelno': logging.ERROR, 'levelname': 'ERROR'}))
+            try:
+                self.target.flush()
+            except:
+                pass
+            if stop:
+                return
+
+    def write(self, record):
+        target = self.target
+        try:
+            msg = target.format(record)
+            if isinstance(target, logging.handlers.RotatingFileHandler) and target.shouldRollover(record):
+                target.doRollover()
+            target.stream.write(msg + "\n")
+        except:
+            # a record that cannot be written must not stop the writer
+            try:
+                sys.stderr.write("cannot write a log record: %s\n" % (str(sys.exc_info()[1])))
+            except:
+                pass
+
+    def flush(self):
+        pass
+
+    # called by logging at exit, what is queued is written first
+    def close(self):
+        if not self.done:
+            self.done = True
+            try:
+                self.queue.put(None, True, 5)
+                self.thread.join(5)
+            except:
+                pass
+            self.target.close()
+        logging.Handler.close(self)
+
+#  the access log has a line of json for each request
+class cbAccessFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = dict(record.msg)
+        entry['time'] = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + ".%03dZ" % (record.msecs)
+        return json.dumps(entry, sort_keys=True)
+
+def make_file_handler(filename):
+    target = logging.handlers.RotatingFileHandler(filename, maxBytes=100*1024*1024, backupCount=2)
+    return cbAsyncHandler(target)
@@ -0,0 +1,189 @@
+import os
+import bisect
+import json
+import threading
+
+#
+#  counters and latency histograms kept in memory and given out in the
+#  prometheus text format.  recording one is a dict lookup and an add
+#  under a lock so it can be left on.  the db and disk are timed from the
+#  thread pool, requests from the reactor.
+#
+#  they are served on an admin address and port of their own, never on
+#  the port clients use, and only if metrics_port is set.  the workers of
+#  a supervisor each write a snapshot of theirs next to the connection
+#  count file and the supervisor answers with the sum
+#
+
+# where the admin port serves them
+g_metrics_path = "/metrics"
+
+# seconds
+g_latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class cbHistogram(object):
+
+    def __init__(self, bounds=g_latency_buckets):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v):
+        ndx = bisect.bisect_left(self.bounds, v)
+        self.counts[ndx] = self.counts[ndx] + 1
+        self.sum = self.sum + v
+        self.count = self.count + 1
+
+class cbMetrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, labels=(), n=1):
+        key = (name, labels)
+        self.lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + n
+        finally:
+            self.lock.release()
+
+    def observe(self, name, labels, v):
+        key = (name, labels)
+        self.lock.acquire()
+        try:
+            h = self.histograms.get(key)
+            if h == None:
+                h = cbHistogram()
+                self.histograms[key] = h
+            h.observe(v)
+        finally:
+            self.lock.release()
+
+    # everything counted so far in a form json can carry
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            counters = [[name, labels, v] for ((name, labels), v) in self.counters.items()]
+            histograms = [[name, labels, list(h.counts), h.sum, h.count] for ((name, labels), h) in self.histograms.items()]
+        finally:
+            self.lock.release()
+        return {'counters' : counters, 'histograms' : histograms}
+
+    # add a snapshot of another cbMetrics to this one
+    def merge(self, snap):
+        self.lock.acquire()
+        try:
+            for (name, labels, v) in snap['counters']:
+                key = (str(name), _to_labels(labels))
+                self.counters[key] = self.counters.get(key, 0) + v
+            for (name, labels, counts, total, count) in snap['histograms']:
+                key = (str(name), _to_labels(labels))
+                h = self.histograms.get(key)
+                if h == None:
+                    h = cbHistogram()
+                    self.histograms[key] = h
+                h.counts = [a + b for (a, b) in zip(h.counts, counts)]
+                h.sum = h.sum + total
+                h.count = h.count + count
+        finally:
+            self.lock.release()
+
+    def get_counter(self, name, labels=()):
+        return self.counters.get((name, labels), 0)
+
+    def get_histogram(self, name, labels=()):
+        return self.histograms.get((name, labels))
+
+    def render(self):
+        lines = []
+        self.lock.acquire()
+        try:
+            counters = sorted(self.counters.items())
+            histograms = sorted([(k, list(h.counts), h.sum, h.count, h.bounds) for (k, h) in self.histograms.items()])
+        finally:
+            self.lock.release()
+
+        last = None
+        for ((name, labels), v) in counters:
+            if name != last:
+                self.add_header(lines, name, "counter")
+                last = name
+            lines.append("%s%s %d" % (name, format_labels(labels), v))
+        for ((name, labels), counts, total, count, bounds) in histograms:
+            if name != last:
+                self.add_header(lines, name, "histogram")
+                last = name
+            n = 0
+            for (b, c) in zip(bounds, counts):
+                n = n + c
+                lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", repr(b)),)), n))
+            lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", "+Inf"),)), count))
+            lines.append("%s_sum%s %f" % (name, format_labels(labels), total))
+            lines.append("%s_count%s %d" % (name, format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    def add_header(self, lines, name, kind):
+        if name in self.help:
+            lines.append("# HELP %s %s" % (name, self.help[name]))
+        lines.append("# TYPE %s %s" % (name, kind))
+
+def _to_labels(labels):
+    return tuple([(str(k), str(v)) for (k, v) in labels])
+
+# the snapshot of the worker with a slot in the connection count file
+def get_snapshot_path(counter_file, slot):
+    return "%s.metrics.%d" % (counter_file, slot)
+
+# written to a new file that is then renamed so a reader never sees half
+# of one
+def write_snapshot(metrics, path):
+    tmp = path + ".new"
+    f = open(tmp, "w")
+    try:
+        f.write(json.dumps(metrics.snapshot()))
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+# None if there is none
+def read_snapshot(path):
+    try:
+        f = open(path, "r")
+    except IOError:
+        return None
+    try:
+        return json.loads(f.read())
+    finally:
+        f.close()
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for (k, v) in labels]) + "}"
+
+g_metrics = cbMetrics()
+g_metrics.describe("cumulus_requests_total", "Requests by operation and status")
+g_metrics.describe("cumulus_request_seconds", "Time from the request headers to the end of the reply")
+g_metrics.describe("cumulus_request_bytes_in_total", "Request body bytes by operation")
+g_metrics.describe("cumulus_request_bytes_out_total", "Reply body bytes by operation")
+g_metrics.describe("cumulus_phase_seconds", "Time spent authorizing, in the authz db and in backend io")
+
+# time spent in auth, db or backend
+def observe_phase(phase, seconds):
+    g_metrics.observe("cumulus_phase_seconds", (("phase", phase),), seconds)
+
+def observe_request(op, status, seconds, bytes_in, bytes_out):
+    labels = (("op", op),)
+    g_metrics.inc("cumulus_requests_total", labels + (("status", status),))
+    g_metrics.observe("cumulus_request_seconds", labels, seconds)
+    if bytes_in > 0:
+        g_metrics.inc("cumulus_request_bytes_in_total", labels, bytes_in)
+    if bytes_out > 0:
+        g_metrics.inc("cumulus_request_bytes_out_total", labels, bytes_out)
@@ -62,6 +62,21 @@ class cbObject(object):
 
         return xContent
 
+    # the same element as create_xml_element for a cbXmlWriter
+    def write_xml(self, w):
+        w.start("Contents")
+        w.element("Key", self.key)
+        w.element("LastModified", self.get_date_string())
+        w.element("Size", self.size)
+        w.element("StorageClass", self.storage_class)
+        if self.md5sum != None:
+            w.element("ETag", self.md5sum)
+        w.start("Owner")
+        w.element("ID", self.user.get_id())
+        w.element("DisplayName", self.display_name)
+        w.end("Owner")
+        w.end("Contents")
+
     def get_date_string(self):
         d_str = "%04d-%02d-%02dT%02d:%02d:%02d.000Z" % (self.tm.tm_year, self.tm.tm_mon, self.tm.tm_mday, self.tm.tm_hour, self.tm.tm_min, self.tm.tm_sec)
         return d_str
@@ -8,12 +8,133 @@ import tempfile
 import hashlib
 import traceback
 import time
+import uuid
 import pycb
+from pycb.cbSendfile import copy_fd, clone_fd
+from pycb.cbMetrics import observe_phase
+
+#
+#  content addressed storage.  with dedup on, the data of every object that
+#  is written is also linked into cas/<xx>/<sha256 of the data> and if a
+#  file with that name is already there the object is made another link to
+#  it instead, so each distinct content is on disk once.
+#
+#  every object still has a data key of its own, the blob is simply
+#  another name for the same inode, so the reference count is the link
+#  count of the blob and the file system keeps it.  deleting an object
+#  removes its own link and the blob goes when it is the last one.  an
+#  upload linking to a blob while the last other reference is deleted can
+#  at worst end up with a private copy, never a missing one.
+#
+#  the digest of an object is kept on the second line of its .meta file
+#
+
+def cas_path(cas_dir, digest):
+    return os.path.join(cas_dir, digest[:2], digest)
+
+# (md5, sha256) from the .meta file of data_key, either may be None
+def read_meta(data_key):
+    try:
+        mFile = open(data_key + ".meta", 'r')
+    except IOError:
+        return (None, None)
+    try:
+        lines = [l.strip() for l in mFile.readlines()] + ["", ""]
+    finally:
+        mFile.close()
+    return (lines[0] or None, lines[1] or None)
+
+def write_meta(data_key, md5, digest=None):
+    mFile = open(data_key + ".meta", 'w')
+    try:
+        mFile.write(md5)
+        if digest != None:
+            mFile.write("\n" + digest)
+    finally:
+        mFile.close()
+
+# sha256 of a whole file
+def hash_file(fname, block_size=1024*1024):
+    h = hashlib.sha256()
+    f = open(fname, "rb")
+    try:
+        while True:
+            b = f.read(block_size)
+            if len(b) == 0:
+                break
+            h.update(b)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+#  make data_key and the blob for digest the same file.  returns True if
+#  data_key now shares a blob that was already there
+def share_data(cas_dir, data_key, digest):
+    blob = cas_path(cas_dir, digest)
+    try:
+        os.mkdir(os.path.dirname(blob))
+    except OSError, ose:
+        if ose.errno != errno.EEXIST:
+            raise
+    size = os.path.getsize(data_key)
+    while True:
+        try:
+            os.link(data_key, blob)
+            return False
+        except OSError, ose:
+            if ose.errno != errno.EEXIST:
+                raise
+        tmp_name = data_key + ".cas"
+        try:
+            os.link(blob, tmp_name)
+        except OSError, ose:
+            if ose.errno != errno.ENOENT:
+                raise
+            # the last other reference just went away, take its place
+            continue
+        if os.path.getsize(tmp_name) != size:
+            os.unlink(tmp_name)
+            pycb.log(logging.ERROR, "%s and %s have the same digest but not the same size" % (data_key, blob))
+            return False
+        os.rename(tmp_name, data_key)
+        return True
+
+#  drop the blob for digest if no object uses it any more
+def release_data(cas_dir, digest):
+    blob = cas_path(cas_dir, digest)
+    try:
+        st = os.stat(blob)
+        if st.st_nlink == 1:
+            os.unlink(blob)
+    except OSError, ose:
+        if ose.errno != errno.ENOENT:
+            pycb.log(logging.WARNING, "error releasing %s %s" % (blob, str(ose)))
+
+#
+#  data layouts.  1 puts every data file in a directory named after the
+#  first letter of its bucket, so one busy bucket ends up with millions of
+#  files in one directory.  2 spreads them over fanout levels of 256
+#  directories named by a hash of the bucket, key and a uuid, base/3f/a0/...
+#  the layout only decides where new data goes, a data key is always the
+#  full path so both can be in use at once while cumulus-relayout moves
+#  the old files
+#
+layout_first_letter = 1
+layout_hashed = 2
 
 class cbPosixBackend(object):
 
-    def __init__(self, installdir):
+    def __init__(self, installdir, dedup=False, layout=layout_first_letter, fanout=2):
         self.base_dir = installdir
+        self.dedup = dedup
+        if layout not in [layout_first_letter, layout_hashed]:
+            raise Exception("unknown data layout %s" % (str(layout)))
+        if fanout < 1:
+            raise Exception("the fanout must be at least 1")
+        self.layout = layout
+        self.fanout = fanout
+        # blobs are released even when dedup has been turned off since
+        self.cas_dir = os.path.join(self.base_dir, "cas")
 
         try:
             os.mkdir(self.base_dir)
@@ -23,6 +144,11 @@ class cbPosixBackend(object):
             os.mkdir(self.base_dir+"/buckets")
         except:
             pass
+        if self.dedup:
+            try:
+                os.mkdir(self.cas_dir)
+            except:
+                pass
 
     # The POST request operation adds an object to a bucket using HTML forms.
     #
@@ -40,34 +166,182 @@ class cbPosixBackend(object):
     # 0 indicates success
     # 
     def put_object(self, bucketName, objectName):
-        # first make the bucket directory if it does not exist
-        dir_name = bucketName[:1]
-        bdir = self.base_dir + "/" + dir_name
-        
-        try:
-            os.mkdir(bdir)
-        except OSError, ose:
-            if ose.errno != 17:
-                raise
+        data_key = self.new_data_key(bucketName, objectName)
+        cas_dir = None
+        if self.dedup:
+            cas_dir = self.cas_dir
+        obj = cbPosixData(data_key, "w+b", cas_dir=cas_dir)
+        return obj
 
+    # a new unique name for the data of bucketName/objectName.  an empty
+    # file is made with the name to reserve it
+    def new_data_key(self, bucketName, objectName):
         fname = bucketName + "/" + objectName
+        bdir = self.data_dir(fname, uuid.uuid4().hex)
         fname = fname.replace("/", "__")
         (osf, x) = tempfile.mkstemp(dir=bdir, suffix=fname)
         os.close(osf)
-        data_key = x.strip()
-        obj = cbPosixData(data_key, "w+b")
-        return obj
+        return x.strip()
 
+    # the directory, made if it does not exist, that data for name goes in
+    # under the current layout.  salt spreads objects of the same name
+    def data_dir(self, name, salt=""):
+        if self.layout == layout_first_letter:
+            bdir = self.base_dir + "/" + name[:1]
+            try:
+                os.mkdir(bdir)
+            except OSError, ose:
+                if ose.errno != errno.EEXIST:
+                    raise
+            return bdir
+
+        h = hashlib.md5("%s/%s" % (name, salt)).hexdigest()
+        dirs = [h[i*2:i*2+2] for i in range(0, self.fanout)]
+        bdir = os.path.join(self.base_dir, *dirs)
+        try:
+            os.makedirs(bdir)
+        except OSError, ose:
+            if ose.errno != errno.EEXIST:
+                raise
+        return bdir
+
+    # is data_key where the current layout would put it
+    def in_layout(self, data_key):
+        rel = os.path.relpath(data_key, self.base_dir).split(os.sep)
+        if self.layout == layout_first_letter:
+            return len(rel) == 2 and len(rel[0]) == 1
+        if len(rel) != self.fanout + 1:
+            return False
+        for d in rel[:-1]:
+            if len(d) != 2 or d.strip("0123456789abcdef") != "":
+                return False
+        return True
+
+    # link the data (and .meta) of data_key to a new name in the current
+    # layout and return it.  the old name is left for the caller to remove
+    # once nothing refers to it.  the new name only depends on the old one
+    # so linking again after a crash finds the link already there
+    def relink_data(self, data_key):
+        name = os.path.basename(data_key)
+        new_key = os.path.join(self.data_dir(name), name)
+        try:
+            os.link(data_key, new_key)
+        except OSError, ose:
+            if ose.errno != errno.EEXIST or not os.path.samefile(data_key, new_key):
+                raise
+        try:
+            os.link(data_key + ".meta", new_key + ".meta")
+        except OSError, ose:
+            if ose.errno == errno.EEXIST:
+                os.unlink(new_key + ".meta")
+                os.link(data_key + ".meta", new_key + ".meta")
+            elif ose.errno != errno.ENOENT:
+                os.unlink(new_key)
+                raise
+        return new_key
 
-    # Return 2 data objects, a source and dest.
+    # remove a data file name that no object uses any more
+    def unlink_data(self, data_key):
+        for f in [data_key, data_key + ".meta"]:
+            try:
+                os.unlink(f)
+            except OSError, ose:
+                if ose.errno != errno.ENOENT:
+                    raise
+
+    # copy the data of src_data_key to a new data key for
+    # bucketName/objectName without reading it.  md5sum is the md5 of the
+    # source which is known so it is not worked out again.
     #
-    # returns <return code>,<error msg>,<data object|None>,<data object|None>
+    # data files are never changed once they have been written, a new
+    # object always gets a new data key, so the copy can share the data
+    # with the source.  a copy on write clone is tried first, then a hard
+    # link (the file system keeps the reference count and the data goes
+    # when the last key using it is deleted) and only if the data key is
+    # on another file system is it copied.
     #
-    def copy_object(self, srcObjectName, dstObjectName, moveOrCopy, httpHeaders):
-        ex = cbException('NotImplemented')
-        raise ex
+    # returns a data object for the new key, opened for reading
+    def copy_object(self, src_data_key, bucketName, objectName, md5sum):
+        data_key = self.new_data_key(bucketName, objectName)
+        tmp_name = data_key + ".part"
+        try:
+            if not self.clone_data(src_data_key, tmp_name):
+                try:
+                    os.link(src_data_key, tmp_name)
+                except OSError, ex:
+                    if ex.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                        raise
+                    self.copy_data(src_data_key, tmp_name)
+            os.rename(tmp_name, data_key)
+            if md5sum != None:
+                # a link to a blob is one more reference to it
+                (x, digest) = read_meta(src_data_key)
+                write_meta(data_key, md5sum, digest)
+        except (IOError, OSError), ex:
+            obj = cbPosixData(data_key, openIt=False)
+            obj.fname = tmp_name
+            obj.delete()
+            if ex.errno == errno.ENOENT:
+                raise cbException('NoSuchKey')
+            raise
+        return cbPosixData(data_key, "r")
+
+    # True if dst_name was made a clone of src_name
+    def clone_data(self, src_name, dst_name):
+        src = open(src_name, "rb")
+        try:
+            dst = open(dst_name, "wb")
+            try:
+                rc = clone_fd(src.fileno(), dst.fileno())
+            finally:
+                dst.close()
+        finally:
+            src.close()
+        if not rc:
+            os.unlink(dst_name)
+        return rc
+
+    def copy_data(self, src_name, dst_name):
+        src = open(src_name, "rb")
+        try:
+            dst = open(dst_name, "wb")
+            try:
+                size = os.fstat(src.fileno()).st_size
+                n = copy_fd(src.fileno(), dst.fileno(), size)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+        if n != size:
+            pycb.log(logging.ERROR, "only %d of %d bytes of %s were copied" % (n, size, src_name))
+            raise cbException('InternalError')
 
 
+    # a new data object holding the data of each of data_keys one after
+    # the other, this is how a multipart upload is completed.  the data is
+    # copied by the kernel (or shared, see copy_fd) and the parts are left
+    # as they are.  the object is returned open and set to delete on close
+    # like any other new object
+    def join_objects(self, bucketName, objectName, data_keys):
+        obj = self.put_object(bucketName, objectName)
+        obj.set_delete_on_close(True)
+        try:
+            out_fd = obj.fileno()
+            for data_key in data_keys:
+                f = open(data_key, "rb")
+                try:
+                    size = os.fstat(f.fileno()).st_size
+                    n = copy_fd(f.fileno(), out_fd, size)
+                finally:
+                    f.close()
+                if n != size:
+                    pycb.log(logging.ERROR, "only %d of %d bytes of %s were copied" % (n, size, data_key))
+                    raise cbException('InternalError')
+        except:
+            obj.close()
+            raise
+        return obj
+
     # returns a data object for reading.  The controlling code will handle
     # the buffer management.
     #
@@ -81,8 +355,15 @@ class cbPosixBackend(object):
     #   
     # returns <return code>,<error message | None>
     def delete_object(self, data_key):
-        obj = cbPosixData(data_key, openIt=False)
-        obj.delete()
+        start = time.time()
+        try:
+            (md5, digest) = read_meta(data_key)
+            obj = cbPosixData(data_key, openIt=False)
+            obj.delete()
+            if digest != None:
+                release_data(self.cas_dir, digest)
+        finally:
+            observe_phase("backend", time.time() - start)
 
     def get_size(self, data_key):
         st = os.stat(data_key)
@@ -100,8 +381,15 @@ class cbPosixBackend(object):
 
 class cbPosixData(object):
 
-    def __init__(self, data_key, access="r", openIt=True):
+    # data written with cas_dir set is shared through it, see share_data
+    def __init__(self, data_key, access="r", openIt=True, cas_dir=None):
         self.fname = data_key
+        # new data is written next to its final name and only moved there
+        # by close() once it is complete, so a data key never names a
+        # partial file
+        if access.find("w") >= 0:
+            self.fname = data_key + ".part"
+        self.closed = False
         self.metafname = data_key + ".meta"
         self.data_key = data_key
         self.blockSize = pycb.config.block_size
@@ -109,8 +397,21 @@ class cbPosixData(object):
         self.delete_on_close = False
         self.md5er = hashlib.md5()
         self.access = access
-
-        self.seek_count = 0
+        # when reading, md5er only holds the md5 of the object if every byte
+        # went through it in order.  a seek (range requests) or a partial
+        # read breaks that.  twisted seeks back to 0 when it is done writing
+        # an upload so seeks do not count in write mode
+        self.md5_valid = True
+        self.read_all = False
+        self.meta_loaded = False
+        self.cas_dir = cas_dir
+        self.digest = None
+        self.digester = None
+        # bytes that went through write(), the digest is only good if
+        # that is all of them
+        self.written = 0
+        if cas_dir != None:
+            self.digester = hashlib.sha256()
 
         if not openIt:
             return
@@ -119,16 +420,18 @@ class cbPosixData(object):
             # this allows head to be very fast
             if access == "r":
                 mFile = open(self.metafname, 'r')
-                self.hashValue = mFile.readline()
+                self.hashValue = mFile.readline().strip()
                 mFile.close()
+                self.meta_loaded = True
         except:
             pass
 
         try:
             self.file = open(self.fname, access)
-        except OSError, (OsEx):
+        except (IOError, OSError), (OsEx):
             if OsEx.errno == errno.ENOENT:
                raise cbException('NoSuchKey')
+            raise
 
     def get_mod_time(self):
         st = os.stat(self.data_key)
@@ -136,6 +439,9 @@ class cbPosixData(object):
 
     def get_md5(self):
         if self.hashValue == None:
+            # nothing can be said about a file that has not been read through
+            if not self.md5_valid or (self.access == "r" and not self.read_all):
+                return None
             v = str(self.md5er.hexdigest()).strip()
             return v
         return self.hashValue
@@ -149,12 +455,21 @@ class cbPosixData(object):
     def delete(self):
         try:
             os.unlink(self.metafname)
+        except OSError, ex:
+            # an upload that never finished has no meta file
+            if ex.errno != errno.ENOENT:
+                pycb.log(logging.WARNING, "error deleting %s %s" % (self.metafname, str(ex)))
         except Exception, ex:
             pycb.log(logging.WARNING, "error deleting %s %s %s" % (self.metafname, str(sys.exc_info()[0]), str(ex)))
         try:
             os.unlink(self.data_key)
         except:
             pycb.log(logging.WARNING, "error deleting %s %s" % (self.data_key, str(sys.exc_info()[0])))
+        if self.fname != self.data_key:
+            try:
+                os.unlink(self.fname)
+            except:
+                pycb.log(logging.WARNING, "error deleting %s %s" % (self.fname, str(sys.exc_info()[0])))
 
     def set_md5(self, hash):
         self.hashValue = hash
@@ -165,12 +480,31 @@ class cbPosixData(object):
 
     # implement file-like methods
     def close(self):
+        # twisted closes the content of a request again when it is done
+        if self.closed:
+            return
+        self.closed = True
+        start = time.time()
+        try:
+            self.close_file()
+        finally:
+            observe_phase("backend", time.time() - start)
+
+    def close_file(self):
+
         hashValue = self.get_md5()
-        if hashValue != None:
+        if self.cas_dir != None and not self.delete_on_close:
             try:
-                mFile = open(self.metafname, 'w')
-                mFile.write(hashValue)
-                mFile.close()
+                self.file.flush()
+                if self.written == os.path.getsize(self.fname):
+                    self.digest = self.digester.hexdigest()
+                else:
+                    self.digest = hash_file(self.fname)
+            except:
+                pycb.log(logging.WARNING, "could not work out the digest of %s" % (self.fname), tb=traceback)
+        if hashValue != None and not self.meta_loaded and not self.delete_on_close:
+            try:
+                write_meta(self.data_key, hashValue, self.digest)
             except:
                 pass
 
@@ -181,43 +515,64 @@ class cbPosixData(object):
         if self.delete_on_close:
             pycb.log(logging.INFO, "deleting the file on close %s" % (self.fname))
             self.delete()
+        elif self.fname != self.data_key:
+            os.rename(self.fname, self.data_key)
+            self.fname = self.data_key
+            if self.digest != None:
+                try:
+                    share_data(self.cas_dir, self.data_key, self.digest)
+                except:
+                    # it is still stored, just not shared
+                    pycb.log(logging.WARNING, "could not share %s" % (self.data_key), tb=traceback)
 
 
     def flush(self):
         return self.file.flush()
 
-    #def fileno(self):
+    def fileno(self):
+        return self.file.fileno()
+
     #def isatty(self):
 
     def next(self):
         return self.file.next()
 
     def read(self, size=None):
+        start = time.time()
         if size == None:
             st = self.file.read(self.blockSize)
         else:
             st = self.file.read(size)
-        self.md5er.update(st)
+        observe_phase("backend", time.time() - start)
+        if len(st) == 0:
+            self.read_all = True
+        # no need to hash it again if the md5 came from the .meta file
+        if self.hashValue == None:
+            self.md5er.update(st)
         return st
 
 #    def readline(self, size=None):
 #    def readlines(self, size=None):
 #    def xreadlines(self):
 
-    def seek(self, offset, whence=None):
-        self.seek_count = self.seek_count + 1
-        pycb.log(logging.WARNING, "Someone is seeking %s %d :: %d" % (self.fname, offset, self.seek_count), tb=traceback)
-        if self.seek_count > 1:
-            raise cbException('InternalError')
+    def seek(self, offset, whence=0):
+        if self.access == "r" and (self.file.tell() != offset or whence != 0):
+            self.md5_valid = False
         return self.file.seek(offset, whence)
 
+    def tell(self):
+        return self.file.tell()
 
-#    def tell(self):
 #    def truncate(self, size=None):
 
     def write(self, st):
+        start = time.time()
         self.file.write(st)
+        observe_phase("backend", time.time() - start)
         self.md5er.update(st)
+        if self.digester != None:
+            self.digester.update(st)
+            self.written = self.written + len(st)
 
     def writelines(self, seq):
         for s in seq:
@@ -45,6 +45,10 @@ class cbPosixUserObject(object):
     def get_password(self):
         return self.password
 
+    # nothing is held open for a posix user
+    def close(self):
+        pass
+
     def hashFile(self, name):
         return urllib.quote(name, '')
 
@@ -332,6 +336,15 @@ class cbPosixUserObject(object):
         ex = cbException('NotImplemented')
         raise ex
 
+    # multipart uploads need the authz db
+    def create_multipart(self, bucketName, objectName):
+        ex = cbException('NotImplemented')
+        raise ex
+
+    def get_multipart(self, bucketName, objectName, upload_id):
+        ex = cbException('NotImplemented')
+        raise ex
+
     def set_user_pw(self, password):
         raise Exception("sorry, passwords cannot be changed with this tool")
 
@@ -380,6 +393,10 @@ class cbPosixSec(object):
         auth_file.close()
         return cbPosixUserObject(id, display_name, key)
 
+    # users are read from their file on every request, nothing is cached
+    def invalidate_credentials(self, id=None):
+        pass
+
     def get_user_id_by_display(self, display_name):
         raise Exception("sorry, the posix security module can only find users by id")
 
@@ -13,43 +13,142 @@ import tempfile
 import hashlib
 import traceback
 import time
-import pycb
+import mmap
+import struct
+import bisect
+
+#
+#  the number of connections open.  a cumulus of several worker processes
+#  shares one count through a file they all map (see cbSupervisor).  each
+#  worker keeps its own count in a slot of its own so no locking is needed,
+#  the total is the sum of the slots
+#
+class cbConnectionCount(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, n):
+        self.count = self.count + n
+
+    def total(self):
+        return self.count
+
+g_slot_size = struct.calcsize("q")
+
+class cbSharedConnectionCount(cbConnectionCount):
+
+    def __init__(self, path, slot):
+        cbConnectionCount.__init__(self)
+        fd = os.open(path, os.O_RDWR)
+        try:
+            self.map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        self.slot = slot
+        self.slots = len(self.map) / g_slot_size
+        if slot < 0 or slot >= self.slots:
+            raise Exception("connection count slot %d is not in %s" % (slot, path))
+
+    def add(self, n):
+        self.count = self.count + n
+        struct.pack_into("q", self.map, self.slot * g_slot_size, self.count)
+
+    def total(self):
+        return sum(struct.unpack_from("%dq" % (self.slots), self.map, 0))
 
 class cbRedirectorIface(object):
 
+    def __init__(self):
+        self.counter = cbConnectionCount()
+
     # return new host direction or None
-    def new_connection(self, request):
+    def new_connection(self, request, bucketName=None):
+        self.counter.add(1)
         return None
 
     # called when a connection is closed
     def end_connection(self, request):
+        self.counter.add(-1)
+
+    # count connections with counter from now on
+    def set_counter(self, counter):
+        self.counter = counter
+
+    # the connections open across this cumulus, what a peer probing it
+    # is told
+    def get_load(self):
+        return self.counter.total()
+
+    # called once the reactor is running
+    def start(self):
         pass
 
+    # (name, labels, value) of what the redirector has been doing
+    def get_stats(self):
+        return []
+
 
-class cbBasicRedirector(object):
+#
+#  the hosts in a load balanced set of cumulus servers, one host:port a
+#  line.  kept in memory and read again when the file changes
+#
+class cbHostList(object):
+
+    def __init__(self, host_file):
+        self.host_file = host_file
+        self.mtime = None
+        self.hosts = []
+
+    # true if the list was read again
+    def refresh(self):
+        try:
+            st = os.stat(self.host_file)
+        except OSError, ex:
+            pycb.log(logging.ERROR, "cannot read the host file %s: %s" % (self.host_file, str(ex)))
+            return False
+        if st.st_mtime == self.mtime:
+            return False
+        hosts = []
+        f = open(self.host_file, "r")
+        try:
+            for l in f.readlines():
+                l = l.strip()
+                if l == "" or l[0] == "#":
+                    continue
+                if l not in hosts:
+                    hosts.append(l)
+        finally:
+            f.close()
+        self.mtime = st.st_mtime
+        self.hosts = hosts
+        pycb.log(logging.INFO, "read %d hosts from %s" % (len(hosts), self.host_file))
+        return True
+
+    def get_hosts(self):
+        return self.hosts
+
+
+class cbBasicRedirector(cbRedirectorIface):
 
     def __init__(self, parser):
-        self.connection_count = 0
-        self.host_file = parser.get("load_balanced", "hostfile")
+        cbRedirectorIface.__init__(self)
+        self.hosts = cbHostList(parser.get("load_balanced", "hostfile"))
         self.max = int(parser.get("load_balanced", "max"))
 
-    def new_connection(self, request):
+    def new_connection(self, request, bucketName=None):
         h = None
-        self.connection_count = self.connection_count + 1
-        if self.connection_count > self.max:
+        self.counter.add(1)
+        if self.counter.total() > self.max:
             h = self.get_next_host()
         return h
 
-    def end_connection(self, request):
-        self.connection_count = self.connection_count - 1
- 
     def get_next_host(self):
         try:
-            hosts = []
-            f = open(self.host_file, "r")
-            for l in f.readlines():
-                hosts.append(l.strip())
-            f.close()
+            self.hosts.refresh()
+            hosts = self.hosts.get_hosts()
+            if len(hosts) == 0:
+                return None
 
             my_host = "%s:%d" % (pycb.config.hostname, pycb.config.port)
             for i in range(0, 5):
@@ -62,4 +161,209 @@ class cbBasicRedirector(object):
         except Exception, ex:
             pycb.log(logging.ERROR, "get next host error %s" % (str(ex)))
             return None
- 
+
+
+# the path a cumulus answers with its load, no authorization is needed
+g_load_path = "/?load"
+
+# what is sent to a probe, the load and then what the redirector has been
+# doing.  it is in the prometheus text format so it can be scraped too
+def make_load_body(redirector):
+    lines = ["cumulus_connections %d" % (redirector.get_load())]
+    for (name, labels, value) in redirector.get_stats():
+        l = ",".join(['%s="%s"' % (k, v) for (k, v) in sorted(labels.items())])
+        lines.append("%s{%s} %d" % (name, l, value))
+    return "\n".join(lines) + "\n"
+
+def parse_load_body(body):
+    for l in body.split("\n"):
+        a = l.split()
+        if len(a) == 2 and a[0] == "cumulus_connections":
+            return int(a[1])
+    raise Exception("no load in %s" % (body[:100]))
+
+class cbPeer(object):
+
+    def __init__(self, name):
+        self.name = name
+        # a peer is not sent anything until it has answered a probe
+        self.healthy = False
+        self.load = 0
+        # redirects sent since the last probe, the peer has not counted
+        # them yet
+        self.sent = 0
+        self.failures = 0
+        self.last_ok = None
+        self.probing = False
+        self.redirects = 0
+
+    def get_load(self):
+        return self.load + self.sent
+
+#
+#  sends work over max to the healthy peer with the fewest connections.
+#  every probe_interval seconds each peer is asked for its load, one that
+#  fails probe_failures probes in a row is left out until it answers
+#  again.  a peer busier than this one is never picked.
+#
+#  with affinity the peers are placed on a hash ring and the overflow of
+#  a bucket goes to the peer that owns the bucket's name.  the same
+#  objects are then read from the same peer and stay in its page cache.
+#  a bucket whose owner is down or over max falls to the next peer on the
+#  ring.  adding or removing a peer only moves the buckets next to it
+#
+class cbLoadRedirector(cbRedirectorIface):
+
+    # points each peer has on the ring, more spreads buckets more evenly
+    vnodes = 64
+
+    def __init__(self, parser):
+        cbRedirectorIface.__init__(self)
+        self.hosts = cbHostList(parser.get("load_balanced", "hostfile"))
+        self.max = int(parser.get("load_balanced", "max"))
+        self.interval = _get_option(parser, "probe_interval", 5.0, float)
+        self.timeout = _get_option(parser, "probe_timeout", 2.0, float)
+        self.fail_limit = _get_option(parser, "probe_failures", 2, int)
+        self.affinity = _get_option(parser, "affinity", False, _to_bool)
+        self.peers = {}
+        self.ring = []
+        self.agent = None
+        self.prober = None
+        # why no peer was picked, and how often
+        self.kept = {"no_peer": 0, "peers_busier": 0}
+
+    def get_my_host(self):
+        return "%s:%d" % (pycb.config.hostname, pycb.config.port)
+
+    # read once the port from the command line is known
+    def refresh_peers(self):
+        if not self.hosts.refresh():
+            return
+        my_host = self.get_my_host()
+        names = [h for h in self.hosts.get_hosts() if h != my_host]
+        peers = {}
+        for n in names:
+            peers[n] = self.peers.get(n, cbPeer(n))
+        self.peers = peers
+        ring = []
+        for n in names:
+            for i in range(0, self.vnodes):
+                ring.append((_ring_hash("%s#%d" % (n, i)), n))
+        ring.sort()
+        self.ring = ring
+
+    def start(self):
+        from twisted.internet import reactor, task
+        from twisted.web.client import Agent
+        self.agent = Agent(reactor, connectTimeout=self.timeout)
+        self.prober = task.LoopingCall(self.probe_all)
+        self.prober.start(self.interval)
+
+    def probe_all(self):
+        self.refresh_peers()
+        for p in self.peers.values():
+            if not p.probing:
+                self.probe(p)
+
+    def probe(self, peer):
+        from twisted.internet import reactor
+        from twisted.web.client import readBody
+        peer.probing = True
+        d = self.agent.request("GET", "http://%s%s" % (peer.name, g_load_path))
+        d.addCallback(readBody)
+        d.addTimeout(self.timeout, reactor)
+        d.addCallbacks(self.probe_ok, self.probe_failed, callbackArgs=(peer,), errbackArgs=(peer,))
+
+    def probe_ok(self, body, peer):
+        peer.probing = False
+        try:
+            load = parse_load_body(body)
+        except Exception, ex:
+            return self.probe_failed(ex, peer)
+        if not peer.healthy:
+            pycb.log(logging.INFO, "redirector peer %s is up with %d connections" % (peer.name, load))
+        peer.healthy = True
+        peer.load = load
+        peer.sent = 0
+        peer.failures = 0
+        peer.last_ok = time.time()
+
+    def probe_failed(self, failure, peer):
+        peer.probing = False
+        peer.failures = peer.failures + 1
+        if peer.healthy and peer.failures >= self.fail_limit:
+            peer.healthy = False
+            pycb.log(logging.ERROR, "redirector peer %s is down: %s" % (peer.name, str(failure)))
+
+    def new_connection(self, request, bucketName=None):
+        self.counter.add(1)
+        load = self.counter.total()
+        if load <= self.max:
+            return None
+        peer = None
+        if self.affinity and bucketName != None:
+            peer = self.get_owner(bucketName, load)
+        if peer == None:
+            peer = self.get_least_loaded(load)
+        if peer == None:
+            return None
+        peer.sent = peer.sent + 1
+        peer.redirects = peer.redirects + 1
+        return peer.name
+
+    # a peer that will take the work, it is healthy and has room
+    def will_take(self, peer, load):
+        return peer.healthy and peer.get_load() < self.max and peer.get_load() < load
+
+    # the first peer on the ring from the bucket's point that will take it
+    def get_owner(self, bucketName, load):
+        if len(self.ring) == 0:
+            return None
+        ndx = bisect.bisect(self.ring, (_ring_hash(bucketName), ""))
+        seen = set()
+        for i in range(0, len(self.ring)):
+            name = self.ring[(ndx + i) % len(self.ring)][1]
+            if name in seen:
+                continue
+            seen.add(name)
+            peer = self.peers[name]
+            if self.will_take(peer, load):
+                return peer
+            if len(seen) == len(self.peers):
+                break
+        return None
+
+    # the peer with the least load of those that will take it
+    def get_least_loaded(self, load):
+        healthy = [p for p in self.peers.values() if p.healthy]
+        if len(healthy) == 0:
+            self.kept["no_peer"] = self.kept["no_peer"] + 1
+            return None
+        takers = [p for p in healthy if self.will_take(p, load)]
+        if len(takers) == 0:
+            self.kept["peers_busier"] = self.kept["peers_busier"] + 1
+            return None
+        return min(takers, key=lambda p: p.get_load())
+
+    def get_stats(self):
+        stats = []
+        for p in sorted(self.peers.values(), key=lambda p: p.name):
+            labels = {"peer": p.name}
+            stats.append(("cumulus_redirects_total", labels, p.redirects))
+            stats.append(("cumulus_peer_up", labels, int(p.healthy)))
+            stats.append(("cumulus_peer_connections", labels, p.get_load()))
+        for (why, n) in sorted(self.kept.items()):
+            stats.append(("cumulus_redirects_skipped_total", {"reason": why}, n))
+        return stats
+
+def _ring_hash(s):
+    return int(hashlib.md5(s).hexdigest()[:8], 16)
+
+def _to_bool(s):
+    return s.strip().lower() in ["true", "yes", "on", "1"]
+
+def _get_option(parser, name, default, conv):
+    try:
+        return conv(parser.get("load_balanced", name))
+    except:
+        return default
@@ -3,6 +3,7 @@ import sys
 import time
 from time import strftime
 import stat
+import calendar
 import hashlib
 from xml.dom.minidom import Document, parseString
 import uuid
@@ -19,6 +20,11 @@ from twisted.protocols.basic import FileSender
 from twisted.python.log import err
 import twisted.web.http
 from pynimbusauthz.user import User
+from pycb.cbObject import cbObject
+from pycb.cbXmlStream import cbXmlWriter
+from pycb.cbThreads import cbGeneratorProducer
+from pycb.cbThreads import call_in_reactor
+from pycb.cbSendfile import can_sendfile, cbSendfileWriter
 
 
 #
@@ -39,6 +45,136 @@ def perm2string(p):
             return k
     return None
 
+#
+#  conditional and range GET support
+#
+
+# tm is a utc struct_time
+def http_date(tm):
+    return twisted.web.http.datetimeToString(calendar.timegm(tm))
+
+# seconds since the epoch or None if it cannot be parsed
+def parse_http_date(s):
+    try:
+        return twisted.web.http.stringToDatetime(s)
+    except:
+        return None
+
+# the entity tags in an If-Match/If-None-Match header, without the quotes.
+# weak tags are compared as if they were strong, the md5 is all we have
+def parse_etags(value):
+    tags = []
+    for t in value.split(","):
+        t = t.strip()
+        if t.startswith("W/"):
+            t = t[2:]
+        tags.append(t.strip('"'))
+    return tags
+
+def etag_matches(value, etag):
+    tags = parse_etags(value)
+    return "*" in tags or etag in tags
+
+#  check the If-* headers against the object.  returns 304 if the client
+#  copy is still good and None if the request should go ahead.  the order
+#  is the one given in rfc 7232, If-None-Match wins over If-Modified-Since
+def check_conditions(request, etag, tm):
+    if tm == None:
+        mtime = None
+    else:
+        mtime = calendar.timegm(tm)
+
+    h = request.getHeader('if-match')
+    if h != None:
+        if not etag_matches(h, etag):
+            raise cbException('PreconditionFailed')
+    else:
+        h = request.getHeader('if-unmodified-since')
+        if h != None and mtime != None:
+            since = parse_http_date(h)
+            if since != None and mtime > since:
+                raise cbException('PreconditionFailed')
+
+    h = request.getHeader('if-none-match')
+    if h != None:
+        if etag_matches(h, etag):
+            return 304
+    else:
+        h = request.getHeader('if-modified-since')
+        if h != None and mtime != None:
+            since = parse_http_date(h)
+            if since != None and mtime <= since:
+                return 304
+    return None
+
+# If-Range, the Range header only counts if the object has not changed
+def if_range_ok(request, etag, tm):
+    h = request.getHeader('if-range')
+    if h == None:
+        return True
+    h = h.strip()
+    if h.startswith('"') or h.startswith('W/'):
+        return h.strip('"') == etag
+    since = parse_http_date(h)
+    return since != None and tm != None and calendar.timegm(tm) == since
+
+#  parse a Range header against an object of size bytes.  returns a sorted
+#  list of (first, last) inclusive byte offsets with overlapping ranges
+#  merged, or None if there is no usable Range header in which case the
+#  whole object is sent.  raises InvalidRange if none of the ranges fall
+#  inside the object
+def parse_range(value, size):
+    if value == None:
+        return None
+    value = value.strip()
+    if not value.startswith("bytes="):
+        return None
+    specs = [s.strip() for s in value[6:].split(",") if s.strip() != ""]
+    if len(specs) == 0:
+        return None
+
+    ranges = []
+    for spec in specs:
+        ndx = spec.find("-")
+        if ndx < 0:
+            return None
+        first = spec[:ndx].strip()
+        last = spec[ndx+1:].strip()
+        if (first != "" and not first.isdigit()) or (last != "" and not last.isdigit()):
+            return None
+        if first == "":
+            # the last n bytes
+            if last == "":
+                return None
+            n = int(last)
+            if n == 0 or size == 0:
+                continue
+            ranges.append((max(size - n, 0), size - 1))
+        else:
+            start = int(first)
+            if last == "":
+                end = size - 1
+            else:
+                end = int(last)
+                if end < start:
+                    return None
+            if start >= size:
+                continue
+            ranges.append((start, min(end, size - 1)))
+
+    if len(ranges) == 0:
+        raise cbException('InvalidRange')
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for (start, end) in ranges[1:]:
+        (mstart, mend) = merged[-1]
+        if start <= mend + 1:
+            merged[-1] = (mstart, max(mend, end))
+        else:
+            merged.append((start, end))
+    return merged
+
 def getText(nodelist):
     rc = ""
     for node in nodelist:
@@ -193,8 +329,7 @@ class cbRequest(object):
         self.responseMsg = msg
 
     def finish(self, request):
-        pycb.log(logging.INFO, "%s %s Reply sent %d %s" % (self.requestId, str(datetime.now()), self.responseCode, self.responseMsg))
-        pycb.log(logging.INFO, str(self.outGoingHeaders))
+        pycb.log(logging.DEBUG, "%s Reply sent %s %s %s", self.requestId, self.responseCode, self.responseMsg, self.outGoingHeaders)
         request.finish()
 
     def set_common_headers(self):
@@ -210,15 +345,20 @@ class cbRequest(object):
         xLen = len(x)
         self.set_common_headers()
         self.setHeader(self.request, 'Content-Length', str(xLen))
-        self.setHeader(self.request, 'Connection', 'close')
         self.setResponseCode(self.request, 200, 'OK')
         self.request.write(x)
-        pycb.log(logging.INFO, "Sent %s" % (x))
+        pycb.log(logging.DEBUG, "Sent %s", x)
 
 
+    # send a reply generated a piece at a time, see cbXmlStream
+    def send_xml_stream(self, pieces):
+        self.set_common_headers()
+        self.setResponseCode(self.request, 200, 'OK')
+        p = cbGeneratorProducer(self.request, pieces, lambda: self.finish(self.request))
+        p.start()
+
     def set_no_content_header(self):
         self.set_common_headers()
-        self.setHeader(self.request, 'Connection', 'close')
         self.setHeader(self.request, 'Content-Length', "0")
         self.setResponseCode(self.request, 204, 'No Content')
 
@@ -270,48 +410,28 @@ class cbGetService(cbRequest):
 
     def work(self):
         dirL = self.user.get_my_buckets()
-        request = self.request
-        doc = Document()
-
-        self.setHeader(request, "content-type", "application/xml")
-        # Create the <xml> base element
-        listAll = doc.createElement("ListAllMyBucketsResult")
-        listAll.setAttribute("xmlns", "http://doc.s3.amazonaws.com/2006-03-01")
-        doc.appendChild(listAll)
-
-        # Create the main <card> element
-        owner = doc.createElement("Owner")
-        listAll.appendChild(owner)
-
-        id = doc.createElement("ID")
-        owner.appendChild(id)
-        idText = doc.createTextNode(str(self.user.get_id()))
-        id.appendChild(idText)
-
-        dN = doc.createElement("DisplayName")
-        owner.appendChild(dN)
-        dNText = doc.createTextNode(str(self.user.get_display_name()))
-        dN.appendChild(dNText)
-
-        buckets = doc.createElement("Buckets")
-        listAll.appendChild(buckets)
-
+        self.setHeader(self.request, "content-type", "application/xml")
+        self.send_xml_stream(self.service_xml(dirL))
+
+    def service_xml(self, dirL):
+        w = cbXmlWriter()
+        w.declaration()
+        w.start("ListAllMyBucketsResult", [("xmlns", "http://doc.s3.amazonaws.com/2006-03-01")])
+        w.start("Owner")
+        w.element("ID", self.user.get_id())
+        w.element("DisplayName", self.user.get_display_name())
+        w.end("Owner")
+        w.start("Buckets")
+        yield w.pop()
         for obj in dirL:
-            bucketOne = doc.createElement("Bucket")
-            buckets.appendChild(bucketOne)
-
-            nameOne = doc.createElement("Name")
-            bucketOne.appendChild(nameOne)
-            nameText = doc.createTextNode(str(obj.get_key()))
-            nameOne.appendChild(nameText)
-            dateOne = doc.createElement("CreationDate")
-            bucketOne.appendChild(dateOne)
-            dateText = doc.createTextNode(str(obj.get_date_string()))
-            dateOne.appendChild(dateText)
-
-        x = doc.toxml();
-        self.send_xml(x)
-        self.finish(self.request)
+            w.start("Bucket")
+            w.element("Name", obj.get_key())
+            w.element("CreationDate", obj.get_date_string())
+            w.end("Bucket")
+            yield w.pop()
+        w.end("Buckets")
+        w.end("ListAllMyBucketsResult")
+        yield w.pop()
 
 class cbGetBucket(cbRequest):
 
@@ -339,7 +459,7 @@ class cbGetBucket(cbRequest):
 
     def get_acl(self):
         payload = self.get_acl_xml()
-        pycb.log(logging.INFO, "GET BUCKET ACL XML %s" % (payload))
+        pycb.log(logging.DEBUG, "GET BUCKET ACL XML %s", payload)
         self.send_xml(payload)
         self.finish(self.request)
 
@@ -355,33 +475,42 @@ class cbGetBucket(cbRequest):
         self.finish(self.request)
 
     def list_bucket(self):
-        dirL = self.user.list_bucket(self.bucketName, self.request.args)
-        doc = Document()
-
-        # Create the <wml> base element
-        xList = doc.createElement("ListBucketResult")
-        xList.setAttribute("xmlns", "http://doc.s3.amazonaws.com/2006-03-01")
-        doc.appendChild(xList)
-
-        # Create the main <card> element
-        xName = doc.createElement("Name")
-        xList.appendChild(xName)
-        xNameText = doc.createTextNode(str(self.bucketName))
-        xName.appendChild(xNameText)
-
-        xIsTruncated = doc.createElement("IsTruncated")
-        xList.appendChild(xIsTruncated)
-        xIsTText = doc.createTextNode('false')
-        xIsTruncated.appendChild(xIsTText)
-
-        for obj in dirL:
-            xObj = obj.create_xml_element(doc)
-            xList.appendChild(xObj)
-
-        x = doc.toxml();
+        listing = self.user.list_bucket(self.bucketName, self.request.args)
+        self.send_xml_stream(self.list_bucket_xml(listing))
+
+    # the schema puts IsTruncated and NextMarker before the keys, so the
+    # listing is read before any of it is written.  that is no more than
+    # max_keys entries, the row after them tells if it is truncated
+    def list_bucket_xml(self, listing):
+        ents = list(listing)
+        w = cbXmlWriter()
+        w.declaration()
+        w.start("ListBucketResult", [("xmlns", "http://doc.s3.amazonaws.com/2006-03-01")])
+        w.element("Name", self.bucketName)
+        w.element("Prefix", listing.prefix)
+        if listing.marker == None:
+            w.element("Marker", "")
+        else:
+            w.element("Marker", listing.marker)
+        if listing.next_marker != None:
+            w.element("NextMarker", listing.next_marker)
+        w.element("MaxKeys", listing.max_keys)
+        if listing.delimiter != None:
+            w.element("Delimiter", listing.delimiter)
+        w.element("IsTruncated", str(listing.truncated).lower())
+        yield w.pop()
+
+        for ent in ents:
+            if isinstance(ent, cbObject):
+                ent.write_xml(w)
+            else:
+                w.start("CommonPrefixes")
+                w.element("Prefix", ent)
+                w.end("CommonPrefixes")
+            yield w.pop()
 
-        self.send_xml(x)
-        self.finish(self.request)
+        w.end("ListBucketResult")
+        yield w.pop()
 
 class cbGetObject(cbRequest):
 
@@ -411,7 +540,7 @@ class cbGetObject(cbRequest):
 
     def get_acl(self):
         payload = self.get_acl_xml()
-        pycb.log(logging.INFO, "GET BUCKET ACL XML %s" % (payload))
+        pycb.log(logging.DEBUG, "GET BUCKET ACL XML %s", payload)
         self.send_xml(payload)
         self.finish(self.request)
 
@@ -430,46 +559,147 @@ class cbGetObject(cbRequest):
         return etag
 
 
+    def get_etag(self, dataObj):
+        etag = dataObj.get_md5()
+        if etag == None:
+            etag = self.etag
+        if etag == None:
+            etag = self.calcMd5Sum(dataObj)
+            dataObj.set_md5(etag)
+        return etag
+
     def sendFile(self, dataObj):
         try:
-            etag = dataObj.get_md5()
-            if etag == None:
-                etag = self.etag
-            if etag == None:
-                etag = self.calcMd5Sum(dataObj)
-                dataObj.set_md5(etag)
-            self.setHeader(self.request, 'ETag', '"%s"' % (etag))
+            size = dataObj.get_size()
+            self.setHeader(self.request, 'Content-Length', str(size))
             self.setResponseCode(self.request, 200, 'OK')
 
-            fp = dataObj
-            d = FileSender().beginFileTransfer(fp, self.request)
-            def cbFinished(ignored):
-                fp.close()
-                self.request.finish()
-            d.addErrback(err).addCallback(cbFinished)
+            if can_sendfile(self.request, dataObj):
+                call_in_reactor(self.beginSendfile, dataObj, 0, size)
+            else:
+                call_in_reactor(self.beginTransfer, dataObj)
 
         except cbException, (ex):
             ex.sendErrorResponse(self.request, self.requestId)
             traceback.print_exc(file=sys.stdout)
-            pycb.log(logging.ERROR, "Error sending file %s" % (str(ex)), traceback)
+            pycb.log(logging.ERROR, "Error sending file %s" % (str(ex)), tb=traceback)
         except Exception, ex2:
             traceback.print_exc(file=sys.stdout)
             gdEx = cbException('InvalidArgument')
             gdEx.sendErrorResponse(self.request, self.requestId)
-            pycb.log(logging.ERROR, "Error sending file %s" % (str(ex2)), traceback)
+            pycb.log(logging.ERROR, "Error sending file %s" % (str(ex2)), tb=traceback)
 
 
+    # a FileSender has to be started from the reactor thread
+    def beginTransfer(self, fp):
+        d = FileSender().beginFileTransfer(fp, self.request)
+        def cbFinished(ignored):
+            fp.close()
+            self.request.finish()
+        d.addErrback(err).addCallback(cbFinished)
+
+    # zero copy, see cbSendfile.  also from the reactor thread
+    def beginSendfile(self, dataObj, offset, count):
+        w = cbSendfileWriter(self.request, dataObj, offset, count, lambda: self.finish(self.request))
+        w.start()
+
+    # the bytes first to last of the object, read in the thread pool by
+    # a cbGeneratorProducer
+    def read_range(self, dataObj, first, last):
+        dataObj.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            b = dataObj.read(min(remaining, pycb.config.block_size))
+            if len(b) == 0:
+                raise Exception("%s is shorter than expected" % (dataObj.get_data_key()))
+            remaining = remaining - len(b)
+            yield b
+
+    def range_pieces(self, dataObj, ranges, size, boundary):
+        try:
+            if boundary == None:
+                (first, last) = ranges[0]
+                for b in self.read_range(dataObj, first, last):
+                    yield b
+            else:
+                for (first, last) in ranges:
+                    yield self.part_header(boundary, first, last, size)
+                    for b in self.read_range(dataObj, first, last):
+                        yield b
+                    yield "\r\n"
+                yield "--%s--\r\n" % (boundary)
+        finally:
+            dataObj.close()
+
+    def part_header(self, boundary, first, last, size):
+        return "--%s\r\nContent-Type: binary/octet-stream\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" % (boundary, first, last, size)
+
+    # 206 with one range in the body, or a multipart/byteranges body
+    # if there is more than one
+    def sendRanges(self, dataObj, ranges, size):
+        request = self.request
+        if len(ranges) == 1:
+            boundary = None
+            (first, last) = ranges[0]
+            self.setHeader(request, 'Content-Type', 'binary/octet-stream')
+            self.setHeader(request, 'Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+            length = last - first + 1
+        else:
+            boundary = str(uuid.uuid4()).replace("-", "")
+            self.setHeader(request, 'Content-Type', 'multipart/byteranges; boundary=%s' % (boundary))
+            length = len("--%s--\r\n" % (boundary))
+            for (first, last) in ranges:
+                length = length + len(self.part_header(boundary, first, last, size)) + last - first + 1 + 2
+        self.setHeader(request, 'Content-Length', str(length))
+        self.setResponseCode(request, 206, 'Partial Content')
+
+        if boundary == None and can_sendfile(request, dataObj):
+            call_in_reactor(self.beginSendfile, dataObj, first, length)
+            return
+        pieces = self.range_pieces(dataObj, ranges, size, boundary)
+        p = cbGeneratorProducer(request, pieces, lambda: self.finish(request))
+        p.start()
+
     def sendObject(self, dataObj):
         request = self.request
         self.dataObj = dataObj
 
-        self.set_common_headers()
-        self.setHeader(request, 'Content-Type', 'binary/octet-stream')
-        self.setHeader(request, 'Content-Length', str(dataObj.get_size()))
+        try:
+            (s, ctm, self.etag) = self.user.get_info(self.bucketName, self.objectName)
+            size = dataObj.get_size()
+            etag = self.get_etag(dataObj)
 
-        (s,ct,self.etag) = self.user.get_info(self.bucketName, self.objectName)
+            self.set_common_headers()
+            self.setHeader(request, 'ETag', '"%s"' % (etag))
+            if ctm != None:
+                self.setHeader(request, 'Last-Modified', http_date(ctm))
+            self.setHeader(request, 'Accept-Ranges', 'bytes')
+
+            if check_conditions(request, etag, ctm) == 304:
+                dataObj.close()
+                self.setResponseCode(request, 304, 'Not Modified')
+                self.finish(request)
+                return
 
-        reactor.callInThread(self.sendFile, dataObj)
+            ranges = None
+            if if_range_ok(request, etag, ctm):
+                try:
+                    ranges = parse_range(request.getHeader('range'), size)
+                except cbException:
+                    self.setHeader(request, 'Content-Range', 'bytes */%d' % (size))
+                    raise
+        except:
+            dataObj.close()
+            raise
+
+        # sending the data does not need the db, a slow client must not
+        # hold a handle from the pool for the whole download
+        self.user.close()
+        if ranges == None:
+            self.setHeader(request, 'Content-Type', 'binary/octet-stream')
+            self.sendFile(dataObj)
+        else:
+            self.sendRanges(dataObj, ranges, size)
 
 class cbDeleteBucket(cbRequest):
 
@@ -539,7 +769,7 @@ class cbPutBucket(cbRequest):
             rc = self.grant_public_permissions(self.bucketName, self.objectName)
             if not rc:
                 xml = self.request.content.read()
-                pycb.log(logging.INFO, "xml %s" % (xml))
+                pycb.log(logging.DEBUG, "xml %s", xml)
                 grants = parse_acl_request(xml)
                 for g in grants:
                     pycb.log(logging.INFO, "granting %s to %s" % (g[2], g[0]))
@@ -552,12 +782,44 @@ class cbPutBucket(cbRequest):
 
         self.set_common_headers()
         self.setHeader(request, 'Content-Length', 0)
-        self.setHeader(request, 'Connection', 'close')
         self.setHeader(request, 'Location', "/" + self.bucketName)
         self.setResponseCode(request, 200, 'OK')
 
         self.finish(request)
 
+#  make sure user can put new_len bytes at bucketName/objectName.  this is
+#  run as soon as the headers of an upload are in and again once all the
+#  data is.  the second time the quota is reserved for the request so
+#  uploads finishing together cannot all fit in the same space.  credit is
+#  space the user gets back once the object is stored besides the object
+#  it replaces
+def check_put_object(user, bucketName, objectName, new_len, reserve=False, credit=0):
+    (bperms, bdata_key) = user.get_perms(bucketName)
+    ndx = bperms.find("w")
+    if ndx < 0:
+        raise cbException('AccessDenied')
+
+    file_size = 0
+    exists = user.exists(bucketName, objectName)
+    if exists:
+        (perms, data_key) = user.get_perms(bucketName, objectName)
+        ndx = perms.find("w")
+        if ndx < 0:
+            raise cbException('AccessDenied')
+        (file_size, ctm, md5) = user.get_info(bucketName, objectName)
+
+    # gotta decide quota, if existed should get credit for the
+    # existing size
+    file_size = file_size + credit
+    if reserve:
+        user.reserve_quota(new_len, file_size)
+        return
+    remaining_quota = user.get_remaining_quota()
+    if remaining_quota != User.UNLIMITED:
+        if remaining_quota + file_size < new_len:
+            pycb.log(logging.INFO, "user %s did not pass quota.  file size %d quota %d" % (user, new_len, remaining_quota))
+            raise cbException('AccountProblem')
+
 class cbPutObject(cbRequest):
 
     def __init__(self, request, user, bucketName, objName, requestId, bucketIface):
@@ -593,38 +855,17 @@ class cbPutObject(cbRequest):
 
             self.set_common_headers()
             self.setHeader(self.request, 'Content-Length', 0)
-            self.setHeader(self.request, 'Connection', 'close')
             self.setHeader(self.request, 'Location', "/" + self.bucketName)
             self.setResponseCode(self.request, 200, 'OK')
             self.finish(self.request)
         else:
-            (bperms, bdata_key) = self.user.get_perms(self.bucketName)
-            ndx = bperms.find("w")
-            if ndx < 0:
-                raise cbException('AccessDenied')
-
-            file_size = 0
-            if exists:
-                (perms, data_key) = self.user.get_perms(self.bucketName, self.objectName)
-                ndx = perms.find("w")
-                if ndx < 0:
-                    raise cbException('AccessDenied')
-
-                # make sure they can write to the bucket
-                (perms, data_key) = self.user.get_perms(self.bucketName)
-                ndx = perms.find("w")
-                if ndx < 0:
-                    raise cbException('AccessDenied')
-                (file_size, ctm, md5) = self.user.get_info(self.bucketName, self.objectName)
-
-            # gotta decide quota, if existed should get credit for the
-            # existing size
-            remaining_quota = self.user.get_remaining_quota()
-            if remaining_quota != User.UNLIMITED:
-                new_file_len = int(self.request.getHeader('content-length'))
-                if remaining_quota + file_size < new_file_len:
-                    pycb.log(logging.INFO, "user %s did not pass quota.  file size %d quota %d" % (self.user, new_file_len, remaining_quota))
-                    raise cbException('AccountProblem')
+            # checked once already when the headers came in, see
+            # CumulusHTTPChannel, but things may have changed since
+            new_file_len = self.request.getHeader('content-length')
+            if new_file_len == None:
+                raise cbException('MissingContentLength')
+            new_file_len = int(new_file_len)
+            check_put_object(self.user, self.bucketName, self.objectName, new_file_len, reserve=True)
 
             obj = self.request.content
             self.recvObject(self.request, obj)
@@ -633,21 +874,35 @@ class cbPutObject(cbRequest):
     def endGet(self, dataObj):
         try:
             eTag = dataObj.get_md5()
-            mSum = base64.encodestring(base64.b16decode(eTag.upper()))
-            self.checkMD5 = mSum
+            mSum = base64.encodestring(base64.b16decode(eTag.upper())).strip()
 
-            pycb.log(logging.INFO, "sent %s etag %s" % (self.objectName, self.checkMD5))
-            self.setHeader(self.request, 'ETag', '"%s"' % (eTag))
+            # twisted stops at Content-Length so less means the client went
+            # away, but the backend may not have everything on disk
+            if dataObj.get_size() != int(self.request.getHeader('content-length')):
+                raise cbException('IncompleteBody')
+            if self.checkMD5 != None and self.checkMD5.strip() != mSum:
+                pycb.log(logging.INFO, "%s md5 %s does not match Content-MD5 %s" % (self.objectName, mSum, self.checkMD5))
+                raise cbException('BadDigest')
+
+            pycb.log(logging.DEBUG, "sent %s etag %s", self.objectName, mSum)
 
             # now that we have the file set delete on close to false
             # it will now be safe to deal with dropped connections
-            # without having large files left around
+            # without having large files left around.  closing it moves
+            # it to its final name, that has to happen before the db
+            # points at it
             dataObj.set_delete_on_close(False)
-            # dataObj.close() do no need to close for now.  twisted will
-            # do this for us
-            self.user.put_object(dataObj, self.bucketName, self.objectName)
-            self.grant_public_permissions(self.bucketName, self.objectName)
+            dataObj.close()
+            try:
+                self.store(dataObj)
+            except:
+                self.bucketIface.delete_object(dataObj.get_data_key())
+                raise
 
+            self.set_common_headers()
+            self.setHeader(self.request, 'Content-Length', 0)
+            self.setHeader(self.request, 'ETag', '"%s"' % (eTag))
+            self.setResponseCode(self.request, 200, 'OK')
             self.finish(self.request)
         except cbException, (ex):
             ex.sendErrorResponse(self.request, self.requestId)
@@ -656,14 +911,15 @@ class cbPutObject(cbRequest):
             gdEx = cbException('InvalidArgument')
             gdEx.sendErrorResponse(self.request, self.requestId)
 
-    #  receive object looks strange because twisted has already received
-    #  the entire file and put it in a temp location.  we now just have
-    #  to recognize that we have it all
+    # the data is all here, make it the object
+    def store(self, dataObj):
+        self.user.put_object(dataObj, self.bucketName, self.objectName)
+        self.grant_public_permissions(self.bucketName, self.objectName)
+
+    #  receive object looks strange because twisted has already written
+    #  the entire body to the backend data object as it came in.  we now
+    #  just have to recognize that we have it all
     def recvObject(self, request, dataObj):
-        self.set_common_headers()
-        self.setHeader(request, 'Connection', 'close')
-        self.setHeader(request, 'Content-Length', 0)
-        self.setResponseCode(request, 200, 'OK')
         self.dataObj = dataObj
         self.block_size = 1024*256
 
@@ -693,18 +949,19 @@ class cbHeadObject(cbGetObject):
             raise cbException('AccessDenied')
         (sz, tm, md5) = self.user.get_info(self.bucketName, self.objectName)
 
-        d_str = "%04d-%02d-%02dT%02d:%02d:%02d.000Z" % (tm.tm_year, tm.tm_mon, tm.tm_wday, tm.tm_hour, tm.tm_min, tm.tm_sec)
-
         self.set_common_headers()
-        self.setHeader(self.request, 'Content-Type', 'binary/octet-stream')
-        self.setHeader(self.request, 'Last-Modified', d_str)
         self.setHeader(self.request, 'ETag', '"%s"' % (str(md5)))
-        self.setHeader(self.request, 'Content-Length', str(sz))
-
-
-#Content-Type: text/plain
+        if tm != None:
+            self.setHeader(self.request, 'Last-Modified', http_date(tm))
+        self.setHeader(self.request, 'Accept-Ranges', 'bytes')
 
+        if check_conditions(self.request, str(md5), tm) == 304:
+            self.setResponseCode(self.request, 304, 'Not Modified')
+            self.finish(self.request)
+            return
 
+        self.setHeader(self.request, 'Content-Type', 'binary/octet-stream')
+        self.setHeader(self.request, 'Content-Length', str(sz))
         self.setResponseCode(self.request, 200, 'OK')
         self.finish(self.request)
 
@@ -743,7 +1000,6 @@ class cbCopyObject(cbRequest):
         if ndx < 0:
             raise cbException('AccessDenied')
 
-        dst_data_key = None
         dst_size = 0
         if dstExists:
             (perms, dst_data_key) = self.user.get_perms(self.dstBucketName, self.dstObjectName)
@@ -755,33 +1011,22 @@ class cbCopyObject(cbRequest):
         (src_size, self.src_ctm, self.src_md5) = self.user.get_info(self.srcBucketName, self.srcObjectName)
 
         # check the quota
-        remaining_quota = self.user.get_remaining_quota()
-        if remaining_quota != User.UNLIMITED:
-            if remaining_quota < src_size - dst_size:
-                pycb.log(logging.INFO, "user %s did not pass quota.  file size %d quota %d" % (self.user, src_size, remaining_quota))
-                raise cbException('AccountProblem')
+        self.user.reserve_quota(src_size, dst_size)
 
         # if we get to here we are allowed to do the copy
-        if dst_data_key == None:
-            self.dst_file = self.bucketIface.put_object(self.dstBucketName, self.dstObjectName)
-        else:
-            self.dst_file = self.bucketIface.get_object(dst_data_key)
-        self.dst_file.set_delete_on_close(True)
-        self.src_file = self.bucketIface.get_object(src_data_key) 
+        self.src_data_key = src_data_key
 
+    # the backend shares the data with the source where it can, the md5
+    # is the one in the db.  an old object may not have one recorded
     def copy_file(self):
         try:
-            done = False
-            while not done:
-                b = self.src_file.read()
-                if len(b) > 0:
-                    self.dst_file.write(b)
-                else:
-                    done = True
-
-            self.dst_file.set_delete_on_close(False)
+            md5 = self.src_md5
+            if md5 == None or md5 == "None":
+                md5 = self.bucketIface.get_md5(self.src_data_key)
+                self.src_md5 = md5
+            self.dst_file = self.bucketIface.copy_object(self.src_data_key, self.dstBucketName, self.dstObjectName, md5)
             self.dst_file.close()
-            reactor.callFromThread(self.end_copy)
+            self.end_copy()
         except cbException, (ex):
             ex.sendErrorResponse(self.request, self.requestId)
             traceback.print_exc(file=sys.stdout)
@@ -795,7 +1040,11 @@ class cbCopyObject(cbRequest):
     def end_copy(self):
 
         try:
-            self.user.put_object(self.dst_file, self.dstBucketName, self.dstObjectName)
+            try:
+                self.user.put_object(self.dst_file, self.dstBucketName, self.dstObjectName)
+            except:
+                self.bucketIface.delete_object(self.dst_file.get_data_key())
+                raise
             self.grant_public_permissions(self.dstBucketName, self.dstObjectName)
 
             doc = Document()
@@ -829,5 +1078,278 @@ class cbCopyObject(cbRequest):
 
     def work(self):
         self.check_permissions()
+        self.copy_file()
+
+#
+#  multipart uploads
+#
+#  an upload is started with POST ?uploads, each part is PUT with
+#  ?partNumber=N&uploadId=ID into a backend object of its own (so parts
+#  can be sent at the same time over several connections) and
+#  POST ?uploadId=ID joins the parts named in its body into the object.
+#
+
+# every part but the last has to be at least this big
+g_min_part_size = 5 * 1024 * 1024
+g_max_part_number = 10000
+# what s3 returns when max-parts is not given
+g_default_max_parts = 1000
+
+def _get_arg(args, name, default=None):
+    if name not in args:
+        return default
+    return args[name][0]
+
+def parse_part_number(value):
+    try:
+        n = int(value)
+    except (TypeError, ValueError):
+        raise cbException('InvalidArgument')
+    if n < 1 or n > g_max_part_number:
+        raise cbException('InvalidArgument')
+    return n
+
+# the etag s3 gives an object made from parts: the md5 of the part md5s
+# followed by the number of parts
+def multipart_etag(md5s):
+    m = hashlib.md5()
+    for md5 in md5s:
+        m.update(base64.b16decode(md5.upper()))
+    return "%s-%d" % (m.hexdigest(), len(md5s))
+
+# the iso 8601 time s3 uses in xml replies, tm is a utc struct_time
+def amz_date(tm):
+    return "%04d-%02d-%02dT%02d:%02d:%02d.000Z" % (tm.tm_year, tm.tm_mon, tm.tm_mday, tm.tm_hour, tm.tm_min, tm.tm_sec)
+
+# list of (part number, etag) from a CompleteMultipartUpload document
+def parse_complete_request(xml):
+    try:
+        dom = parseString(xml)
+        parts = []
+        for p in dom.getElementsByTagName("Part"):
+            num = getText(p.getElementsByTagName("PartNumber")[0].childNodes)
+            etag = getText(p.getElementsByTagName("ETag")[0].childNodes)
+            parts.append((int(num.strip()), etag.strip().strip('"')))
+    except Exception, ex:
+        pycb.log(logging.INFO, "bad complete multipart xml %s" % (str(ex)))
+        raise cbException('MalformedXML')
+    if len(parts) == 0:
+        raise cbException('MalformedXML')
+    return parts
+
+#  make sure user can add a new_len byte part number part_num to the
+#  upload.  like check_put_object this is run as soon as the headers are
+#  in and again once all the data is, when the quota is reserved.  a part
+#  sent again gets credit for the one it replaces.  returns the upload
+def check_put_part(user, bucketName, objectName, upload_id, part_num, new_len, reserve=False):
+    (bperms, bdata_key) = user.get_perms(bucketName)
+    ndx = bperms.find("w")
+    if ndx < 0:
+        raise cbException('AccessDenied')
+    mp = user.get_multipart(bucketName, objectName, upload_id)
+
+    old_size = user.get_multipart_size(mp, part_num)
+    if reserve:
+        user.reserve_quota(new_len, old_size)
+        return mp
+    remaining_quota = user.get_remaining_quota()
+    if remaining_quota != User.UNLIMITED and remaining_quota + old_size < new_len:
+        pycb.log(logging.INFO, "user %s did not pass quota.  part size %d quota %d" % (user, new_len, remaining_quota))
+        raise cbException('AccountProblem')
+    return mp
+
+class cbInitiateMultipart(cbRequest):
+
+    def __init__(self, request, user, bucketName, objName, requestId, bucketIface):
+        cbRequest.__init__(self, request, user, requestId, bucketIface)
+        ndx = objName.find("cumulus:/")
+        if ndx >= 0:
+            pycb.log(logging.ERROR, "someone tried to make a key named cumulus://... why would someone do that? %d" % (ndx))
+            raise cbException('InvalidURI')
+        self.bucketName = bucketName
+        self.objectName = objName
+
+    def work(self):
+        if not self.user.exists(self.bucketName):
+            raise cbException('NoSuchBucket')
+        check_put_object(self.user, self.bucketName, self.objectName, 0)
+        upload_id = self.user.create_multipart(self.bucketName, self.objectName)
+
+        w = cbXmlWriter()
+        w.declaration()
+        w.start("InitiateMultipartUploadResult", [("xmlns", "http://doc.s3.amazonaws.com/2006-03-01")])
+        w.element("Bucket", self.bucketName)
+        w.element("Key", self.objectName)
+        w.element("UploadId", upload_id)
+        w.end("InitiateMultipartUploadResult")
+        self.setHeader(self.request, "content-type", "application/xml")
+        self.send_xml(w.pop())
+        self.finish(self.request)
+
+#  the body has been written to the backend as it came in just like any
+#  other upload, the difference is that it is recorded as a part
+class cbPutPart(cbPutObject):
 
-        reactor.callInThread(self.copy_file)
+    def __init__(self, request, user, bucketName, objName, requestId, bucketIface):
+        cbPutObject.__init__(self, request, user, bucketName, objName, requestId, bucketIface)
+        args = self.request.args
+        self.uploadId = _get_arg(args, 'uploadId')
+        self.partNumber = parse_part_number(_get_arg(args, 'partNumber'))
+        self.mp = None
+
+    def work(self):
+        new_file_len = self.request.getHeader('content-length')
+        if new_file_len == None:
+            raise cbException('MissingContentLength')
+        self.mp = check_put_part(self.user, self.bucketName, self.objectName, self.uploadId, self.partNumber, int(new_file_len), reserve=True)
+        self.recvObject(self.request, self.request.content)
+
+    def store(self, dataObj):
+        self.user.put_multipart_part(self.mp, self.partNumber, dataObj)
+
+class cbCompleteMultipart(cbRequest):
+
+    def __init__(self, request, user, bucketName, objName, requestId, bucketIface):
+        cbRequest.__init__(self, request, user, requestId, bucketIface)
+        self.bucketName = bucketName
+        self.objectName = objName
+        self.uploadId = _get_arg(self.request.args, 'uploadId')
+
+    # the parts named in the request in order, each one has to have been
+    # uploaded with the etag given and all but the last have to be at
+    # least g_min_part_size
+    def choose_parts(self, mp):
+        wanted = parse_complete_request(self.request.content.read())
+        have = {}
+        for p in self.user.get_multipart_parts(mp):
+            have[p.get_part_number()] = p
+
+        parts = []
+        last = 0
+        for (num, etag) in wanted:
+            if num <= last:
+                raise cbException('InvalidPartOrder')
+            last = num
+            p = have.get(num)
+            if p == None or p.get_md5sum() != etag:
+                raise cbException('InvalidPart')
+            parts.append(p)
+        for p in parts[:-1]:
+            if p.get_size() < g_min_part_size:
+                raise cbException('EntityTooSmall')
+        return parts
+
+    def work(self):
+        mp = self.user.get_multipart(self.bucketName, self.objectName, self.uploadId)
+        parts = self.choose_parts(mp)
+        size = sum([p.get_size() for p in parts])
+        # the parts stop counting once they are joined
+        credit = self.user.get_multipart_size(mp)
+        check_put_object(self.user, self.bucketName, self.objectName, size, reserve=True, credit=credit)
+
+        dataObj = self.bucketIface.join_objects(self.bucketName, self.objectName, [p.get_data_key() for p in parts])
+        eTag = multipart_etag([p.get_md5sum() for p in parts])
+        dataObj.set_md5(eTag)
+        dataObj.set_delete_on_close(False)
+        dataObj.close()
+        try:
+            self.user.put_object(dataObj, self.bucketName, self.objectName)
+        except:
+            self.bucketIface.delete_object(dataObj.get_data_key())
+            raise
+        # the parts that were left out go too
+        self.user.delete_multipart(mp)
+
+        w = cbXmlWriter()
+        w.declaration()
+        w.start("CompleteMultipartUploadResult", [("xmlns", "http://doc.s3.amazonaws.com/2006-03-01")])
+        w.element("Location", "http://%s/%s/%s" % (self.request.getHeader('host'), self.bucketName, self.objectName))
+        w.element("Bucket", self.bucketName)
+        w.element("Key", self.objectName)
+        w.element("ETag", '"%s"' % (eTag))
+        w.end("CompleteMultipartUploadResult")
+        self.setHeader(self.request, "content-type", "application/xml")
+        self.send_xml(w.pop())
+        self.finish(self.request)
+
+class cbAbortMultipart(cbRequest):
+
+    def __init__(self, request, user, bucketName, objName, requestId, bucketIface):
+        cbRequest.__init__(self, request, user, requestId, bucketIface)
+        self.bucketName = bucketName
+        self.objectName = objName
+        self.uploadId = _get_arg(self.request.args, 'uploadId')
+
+    def work(self):
+        (bperms, bdata_key) = self.user.get_perms(self.bucketName)
+        ndx = bperms.find("w")
+        if ndx < 0:
+            raise cbException('AccessDenied')
+        mp = self.user.get_multipart(self.bucketName, self.objectName, self.uploadId)
+        self.user.delete_multipart(mp)
+        self.set_no_content_header()
+        self.finish(self.request)
+
+class cbListParts(cbRequest):
+
+    def __init__(self, request, user, bucketName, objName, requestId, bucketIface):
+        cbRequest.__init__(self, request, user, requestId, bucketIface)
+        self.bucketName = bucketName
+        self.objectName = objName
+        self.uploadId = _get_arg(self.request.args, 'uploadId')
+
+    def work(self):
+        args = self.request.args
+        marker = _get_arg(args, 'part-number-marker')
+        if marker == "":
+            marker = None
+        try:
+            if marker != None:
+                marker = int(marker)
+            max_parts = int(_get_arg(args, 'max-parts', g_default_max_parts))
+        except ValueError:
+            raise cbException('InvalidArgument')
+        if max_parts < 0:
+            raise cbException('InvalidArgument')
+
+        (bperms, bdata_key) = self.user.get_perms(self.bucketName)
+        ndx = bperms.find("w")
+        if ndx < 0:
+            raise cbException('AccessDenied')
+        mp = self.user.get_multipart(self.bucketName, self.objectName, self.uploadId)
+        (owner_id, owner_name) = self.user.get_multipart_owner(mp)
+        # one more than is needed tells us if the list is truncated
+        parts = self.user.get_multipart_parts(mp, marker, max_parts + 1)
+        truncated = len(parts) > max_parts
+        parts = parts[:max_parts]
+
+        w = cbXmlWriter()
+        w.declaration()
+        w.start("ListPartsResult", [("xmlns", "http://doc.s3.amazonaws.com/2006-03-01")])
+        w.element("Bucket", self.bucketName)
+        w.element("Key", self.objectName)
+        w.element("UploadId", self.uploadId)
+        for tag in ["Initiator", "Owner"]:
+            w.start(tag)
+            w.element("ID", owner_id)
+            w.element("DisplayName", owner_name)
+            w.end(tag)
+        w.element("StorageClass", "STANDARD")
+        if marker == None:
+            marker = 0
+        w.element("PartNumberMarker", marker)
+        if len(parts) > 0:
+            w.element("NextPartNumberMarker", parts[-1].get_part_number())
+        w.element("MaxParts", max_parts)
+        w.element("IsTruncated", str(truncated).lower())
+        for p in parts:
+            w.start("Part")
+            w.element("PartNumber", p.get_part_number())
+            w.element("LastModified", amz_date(p.get_creation_time()))
+            w.element("ETag", '"%s"' % (p.get_md5sum()))
+            w.element("Size", p.get_size())
+            w.end("Part")
+        w.end("ListPartsResult")
+        self.setHeader(self.request, "content-type", "application/xml")
+        self.send_xml(w.pop())
+        self.finish(self.request)
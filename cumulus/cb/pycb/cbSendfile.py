@@ -0,0 +1,237 @@
+import os
+import sys
+import errno
+import logging
+from twisted.internet import reactor, interfaces
+import pycb
+
+#
+#  Zero copy downloads.  FileSender reads the object into python strings
+#  a block at a time and hands them to the transport which copies them
+#  again into the socket.  For plain http the data can instead go straight
+#  from the page cache to the socket with sendfile(2).
+#
+#  python 2 has no os.sendfile so the pysendfile module is used if it is
+#  installed, otherwise libc is called directly on linux.  sendfile is
+#  None if neither works and the old path is used.
+
+def _libc_sendfile():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        f = libc.sendfile64
+    except:
+        return None
+    f.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    f.restype = ctypes.c_ssize_t
+
+    # same interface as os.sendfile
+    def libc_sendfile(out_fd, in_fd, offset, count):
+        off = ctypes.c_int64(offset)
+        n = f(out_fd, in_fd, ctypes.byref(off), count)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return n
+    return libc_sendfile
+
+if hasattr(os, "sendfile"):
+    sendfile = os.sendfile
+else:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = _libc_sendfile()
+
+#
+#  copying one file into another without the data passing through python,
+#  used to join the parts of a multipart upload.  copy_file_range(2) lets
+#  file systems that can (btrfs, xfs, nfs 4.2) share the blocks rather
+#  than copy them.  it is newer than sendfile(2) and refuses some pairs of
+#  file systems, in which case sendfile and then plain reads and writes
+#  are used.
+def _libc_copy_file_range():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        f = libc.copy_file_range
+    except:
+        return None
+    f.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint]
+    f.restype = ctypes.c_ssize_t
+
+    # the same interface as sendfile, out_fd is written at its position
+    def libc_copy_file_range(out_fd, in_fd, offset, count):
+        off = ctypes.c_int64(offset)
+        n = f(in_fd, ctypes.byref(off), out_fd, None, count, 0)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return n
+    return libc_copy_file_range
+
+if hasattr(os, "copy_file_range"):
+    copy_file_range = lambda out_fd, in_fd, offset, count: os.copy_file_range(in_fd, out_fd, count, offset)
+else:
+    copy_file_range = _libc_copy_file_range()
+
+def _rw_copy(out_fd, in_fd, offset, count):
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    buf = os.read(in_fd, min(count, pycb.config.block_size))
+    n = 0
+    while n < len(buf):
+        n = n + os.write(out_fd, buf[n:])
+    return n
+
+# errors that mean the kernel will not do this copy, not that it failed
+_copy_unsupported = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP)
+
+#  append the first count bytes of in_fd to out_fd.  returns the number of
+#  bytes copied, less than count if in_fd is shorter
+def copy_fd(in_fd, out_fd, count):
+    offset = 0
+    for f in (copy_file_range, sendfile, _rw_copy):
+        if f == None:
+            continue
+        try:
+            while offset < count:
+                n = f(out_fd, in_fd, offset, count - offset)
+                if n == 0:
+                    return offset
+                offset = offset + n
+            return offset
+        except OSError, ex:
+            if ex.errno not in _copy_unsupported or f == _rw_copy:
+                raise
+            pycb.log(logging.DEBUG, "falling back from %s %s" % (str(f), str(ex)))
+    return offset
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+#  make out_fd a copy on write clone of all of in_fd.  nothing is copied,
+#  the two files share blocks until one of them is changed.  only some
+#  file systems (btrfs, xfs) can do it, returns False if this one cannot
+def clone_fd(in_fd, out_fd):
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+    try:
+        fcntl.ioctl(out_fd, FICLONE, in_fd)
+    except (IOError, OSError), ex:
+        if ex.errno not in _copy_unsupported + (errno.ENOTTY,):
+            raise
+        return False
+    return True
+
+# the bytes would have to be encrypted in userspace for https, and the
+# backend has to be able to give us a real file
+def can_sendfile(request, dataObj):
+    if not pycb.config.sendfile or sendfile == None:
+        return False
+    transport = request.channel.transport
+    if interfaces.ISSLTransport.providedBy(transport):
+        return False
+    if getattr(transport, 'socket', None) == None:
+        return False
+    return dataObj.fileno() != None
+
+#
+#  sends count bytes of dataObj starting at offset to the client.  twisted
+#  owns the socket so the headers are written as usual and once they have
+#  left twisted's buffer the rest is sent from a second descriptor (a dup
+#  of the socket) that the reactor tells us is writable.  done is called
+#  when everything has been sent.  this is also registered with the
+#  request as a producer only to hear about the client going away
+class cbSendfileWriter(object):
+
+    def __init__(self, request, dataObj, offset, count, done):
+        self.request = request
+        self.dataObj = dataObj
+        self.offset = offset
+        self.remaining = count
+        self.done = done
+        self.chunk_size = pycb.config.block_size
+        self.stopped = False
+        self.fd = None
+
+    # must be called from the reactor thread
+    def start(self):
+        if self.request._disconnected:
+            self.stopped = True
+            self.dataObj.close()
+            return
+        self.transport = self.request.channel.transport
+        self.in_fd = self.dataObj.fileno()
+        self.request.write("")
+        self.fd = os.dup(self.transport.fileno())
+        self.request.registerProducer(self, True)
+        reactor.addWriter(self)
+
+    def fileno(self):
+        return self.fd
+
+    def logPrefix(self):
+        return "cbSendfileWriter"
+
+    # the headers are still waiting in the transport
+    def _pending(self):
+        t = self.transport
+        buffered = len(t.dataBuffer) - getattr(t, 'offset', 0)
+        return buffered > 0 or getattr(t, '_tempDataLen', 0) > 0
+
+    def doWrite(self):
+        if self.stopped or self._pending():
+            return
+        try:
+            n = sendfile(self.fd, self.in_fd, self.offset, min(self.remaining, self.chunk_size))
+        except OSError, ex:
+            if ex.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            pycb.log(logging.INFO, "sendfile of %s stopped %s" % (self.dataObj.get_data_key(), str(ex)))
+            self._failed()
+            return
+        if n == 0:
+            pycb.log(logging.ERROR, "%s is shorter than expected" % (self.dataObj.get_data_key()))
+            self._failed()
+            return
+        self.offset = self.offset + n
+        self.remaining = self.remaining - n
+        self.request.sentLength = self.request.sentLength + n
+        if self.remaining == 0:
+            self._stop()
+            self.request.unregisterProducer()
+            self.done()
+
+    # the headers promised more than was sent, all we can do is hang up
+    def _failed(self):
+        self._stop()
+        self.request.unregisterProducer()
+        self.transport.loseConnection()
+
+    def _stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        reactor.removeWriter(self)
+        os.close(self.fd)
+        self.dataObj.close()
+
+    # the reactor gave up on the descriptor
+    def connectionLost(self, reason):
+        self._stop()
+
+    def stopProducing(self):
+        self._stop()
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
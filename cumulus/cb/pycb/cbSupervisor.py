@@ -0,0 +1,370 @@
+import os
+import sys
+import time
+import errno
+import signal
+import select
+import socket
+import struct
+import mmap
+import tempfile
+import logging
+import subprocess
+import pycb
+from pycb.cbRedirector import g_slot_size
+from pycb.cbMetrics import cbMetrics, g_metrics, g_metrics_path
+from pycb.cbMetrics import get_snapshot_path, read_snapshot
+
+#
+#  a cumulus made of several worker processes.  the supervisor opens the
+#  listening socket and starts workers that each run a reactor of their
+#  own on it, the kernel hands every new connection to one of them.  the
+#  workers are started fresh (not forked copies of the supervisor) so they
+#  read cumulus.ini and the code again and share no db connections.
+#
+#  each worker writes a line about itself to a pipe every few seconds.  a
+#  worker that stops doing that is wedged and is killed, one that exits is
+#  replaced.  SIGHUP starts a new set of workers and once they are all up
+#  the old ones stop taking connections and leave when the requests they
+#  have are done.  SIGTERM and SIGINT stop every worker that way and then
+#  the supervisor.  SIGUSR1 logs the state of each worker
+#
+#  the supervisor serves the metrics port.  each worker saves what it has
+#  counted with its heartbeat and a scrape is answered with the sum, what
+#  workers that have gone counted is kept so the totals never go down
+#
+
+# connection count slots, there have to be enough for two sets of workers
+# while one replaces the other
+g_slots = 256
+# seconds to wait before starting a worker again after one died young
+g_max_backoff = 30
+
+class cbWorker(object):
+
+    def __init__(self, proc, fd, slot, generation):
+        self.proc = proc
+        self.pid = proc.pid
+        self.fd = fd
+        self.slot = slot
+        self.generation = generation
+        self.started = time.time()
+        self.last_seen = self.started
+        # the worker is up once it has said so, stop_sent is when it was
+        # asked to leave
+        self.up = False
+        self.stop_sent = None
+        self.status = ""
+        self.buf = ""
+
+    def get_state(self):
+        if self.stop_sent != None:
+            return "stopping"
+        if self.up:
+            return "up"
+        return "starting"
+
+class cbSupervisor(object):
+
+    def __init__(self, program, argv, count, timeout, drain):
+        self.program = program
+        self.argv = argv
+        self.count = count
+        self.timeout = timeout
+        self.drain = drain
+        self.workers = {}
+        self.generation = 0
+        self.failures = 0
+        self.next_spawn = 0
+        self.reload_wanted = False
+        self.stop_wanted = False
+        self.status_wanted = False
+        self.stopping = False
+
+        self.sock = self.listen()
+        shm = "/dev/shm"
+        if not os.path.isdir(shm):
+            shm = None
+        (fd, self.counter_file) = tempfile.mkstemp(prefix="cumulus-connections-", dir=shm)
+        try:
+            os.ftruncate(fd, g_slots * g_slot_size)
+            self.counters = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        self.free_slots = range(0, g_slots)
+
+        self.admin = None
+        self.retired = cbMetrics()
+        if pycb.config.metrics_port:
+            self.admin = self.listen_admin()
+
+    def listen(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(("", pycb.config.port))
+        s.listen(socket.SOMAXCONN)
+        s.setblocking(0)
+        return s
+
+    def get_port(self):
+        return self.sock.getsockname()[1]
+
+    def listen_admin(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((pycb.config.metrics_address, pycb.config.metrics_port))
+        s.listen(16)
+        s.setblocking(0)
+        return s
+
+    def spawn(self):
+        slot = self.free_slots.pop(0)
+        struct.pack_into("q", self.counters, slot * g_slot_size, 0)
+        (r, w) = os.pipe()
+        argv = [sys.executable, self.program] + self.argv
+        argv = argv + ["--listen-fd", str(self.sock.fileno()), "--heartbeat-fd", str(w)]
+        argv = argv + ["--counter-file", self.counter_file, "--counter-slot", str(slot)]
+        keep = [self.sock.fileno(), w]
+        try:
+            proc = subprocess.Popen(argv, preexec_fn=lambda: _close_fds_but(keep))
+        except:
+            os.close(r)
+            os.close(w)
+            self.free_slots.append(slot)
+            raise
+        os.close(w)
+        worker = cbWorker(proc, r, slot, self.generation)
+        self.workers[worker.pid] = worker
+        pycb.log(logging.INFO, "started worker %d generation %d" % (worker.pid, worker.generation))
+        return worker
+
+    def on_hup(self, signum, frame):
+        self.reload_wanted = True
+
+    def on_term(self, signum, frame):
+        self.stop_wanted = True
+
+    def on_usr1(self, signum, frame):
+        self.status_wanted = True
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.on_hup)
+        signal.signal(signal.SIGTERM, self.on_term)
+        signal.signal(signal.SIGINT, self.on_term)
+        signal.signal(signal.SIGUSR1, self.on_usr1)
+        pycb.log(logging.INFO, "supervisor %d listening on port %d with %d workers" % (os.getpid(), self.get_port(), self.count))
+        try:
+            for i in range(0, self.count):
+                self.spawn()
+            while True:
+                if self.stop_wanted and not self.stopping:
+                    self.stopping = True
+                    pycb.log(logging.INFO, "stopping all workers")
+                    for w in self.workers.values():
+                        self.stop_worker(w)
+                if self.reload_wanted:
+                    self.reload_wanted = False
+                    self.reload()
+                if self.status_wanted:
+                    self.status_wanted = False
+                    self.log_status()
+
+                self.read_heartbeats(1.0)
+                self.reap()
+                self.check_health()
+                if self.stopping:
+                    if len(self.workers) == 0:
+                        break
+                    continue
+                self.replace_dead()
+                self.retire_old()
+        finally:
+            for w in self.workers.values():
+                _kill(w.pid, signal.SIGKILL)
+                self.drop_snapshot(w.slot)
+            self.sock.close()
+            if self.admin != None:
+                self.admin.close()
+            self.counters.close()
+            os.unlink(self.counter_file)
+        pycb.log(logging.INFO, "supervisor done")
+        return 0
+
+    # a new set of workers, the old ones go once these are all up
+    def reload(self):
+        self.generation = self.generation + 1
+        self.failures = 0
+        pycb.log(logging.INFO, "reloading, starting workers of generation %d" % (self.generation))
+        for i in range(0, self.count):
+            self.spawn()
+
+    def stop_worker(self, w):
+        if w.stop_sent != None:
+            return
+        w.stop_sent = time.time()
+        _kill(w.pid, signal.SIGTERM)
+
+    def read_heartbeats(self, timeout):
+        fds = [w.fd for w in self.workers.values() if w.fd != None]
+        if self.admin != None:
+            fds.append(self.admin)
+        try:
+            (r, wr, x) = select.select(fds, [], [], timeout)
+        except select.error, ex:
+            if ex[0] != errno.EINTR:
+                raise
+            return
+        if self.admin in r:
+            self.serve_metrics()
+        now = time.time()
+        for w in self.workers.values():
+            if w.fd not in r:
+                continue
+            try:
+                data = os.read(w.fd, 4096)
+            except OSError, ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                data = ""
+            if data == "":
+                # the worker is going, reap will find out how
+                os.close(w.fd)
+                w.fd = None
+                continue
+            w.buf = w.buf + data
+            lines = w.buf.split("\n")
+            w.buf = lines[-1]
+            if len(lines) > 1:
+                w.status = lines[-2]
+                w.last_seen = now
+                if not w.up:
+                    w.up = True
+                    self.failures = 0
+                    pycb.log(logging.INFO, "worker %d is up" % (w.pid))
+
+    def reap(self):
+        for w in self.workers.values():
+            rc = w.proc.poll()
+            if rc == None:
+                continue
+            del self.workers[w.pid]
+            if w.fd != None:
+                os.close(w.fd)
+                w.fd = None
+            struct.pack_into("q", self.counters, w.slot * g_slot_size, 0)
+            snap = read_snapshot(get_snapshot_path(self.counter_file, w.slot))
+            if snap != None:
+                self.retired.merge(snap)
+            self.drop_snapshot(w.slot)
+            self.free_slots.append(w.slot)
+            if w.stop_sent != None:
+                pycb.log(logging.INFO, "worker %d stopped" % (w.pid))
+                continue
+            pycb.log(logging.ERROR, "worker %d exited with %d" % (w.pid, rc))
+            # one that dies as soon as it starts will do so again, do not
+            # start them as fast as they can fail
+            if w.generation == self.generation and not w.up:
+                self.failures = self.failures + 1
+                self.next_spawn = time.time() + min(2 ** self.failures, g_max_backoff)
+
+    def check_health(self):
+        now = time.time()
+        for w in self.workers.values():
+            if w.stop_sent != None:
+                if now - w.stop_sent > self.drain + self.timeout:
+                    pycb.log(logging.ERROR, "worker %d did not stop, killing it" % (w.pid))
+                    _kill(w.pid, signal.SIGKILL)
+            elif now - w.last_seen > self.timeout:
+                pycb.log(logging.ERROR, "worker %d has not been heard from in %d seconds (%s), killing it" % (w.pid, now - w.last_seen, w.status))
+                _kill(w.pid, signal.SIGKILL)
+
+    def replace_dead(self):
+        current = [w for w in self.workers.values() if w.generation == self.generation and w.stop_sent == None]
+        if len(current) >= self.count or time.time() < self.next_spawn:
+            return
+        for i in range(len(current), self.count):
+            self.spawn()
+
+    def retire_old(self):
+        current = [w for w in self.workers.values() if w.generation == self.generation]
+        if len(current) < self.count or len([w for w in current if not w.up]) > 0:
+            return
+        for w in self.workers.values():
+            if w.generation != self.generation and w.stop_sent == None:
+                pycb.log(logging.INFO, "retiring worker %d of generation %d" % (w.pid, w.generation))
+                self.stop_worker(w)
+
+    def drop_snapshot(self, slot):
+        path = get_snapshot_path(self.counter_file, slot)
+        for p in [path, path + ".new"]:
+            try:
+                os.unlink(p)
+            except OSError:
+                pass
+
+    # what all of the workers have counted, those that are gone too
+    def render_metrics(self):
+        m = cbMetrics()
+        m.help = g_metrics.help
+        m.merge(self.retired.snapshot())
+        for w in self.workers.values():
+            snap = read_snapshot(get_snapshot_path(self.counter_file, w.slot))
+            if snap != None:
+                m.merge(snap)
+        connections = sum(struct.unpack_from("%dq" % (g_slots), self.counters, 0))
+        return m.render() + "cumulus_connections %d\n" % (connections)
+
+    # a scrape is a short request so it is answered here, the timeout
+    # keeps a slow client from holding up the workers' heartbeats
+    def serve_metrics(self):
+        try:
+            (conn, addr) = self.admin.accept()
+        except socket.error:
+            return
+        try:
+            try:
+                conn.settimeout(2.0)
+                req = ""
+                while req.find("\r\n") < 0 and len(req) < 4096:
+                    data = conn.recv(4096)
+                    if data == "":
+                        break
+                    req = req + data
+                a = req.split(" ")
+                if len(a) > 1 and a[0] == "GET" and a[1] == g_metrics_path:
+                    status = "200 OK"
+                    body = self.render_metrics()
+                else:
+                    status = "404 Not Found"
+                    body = ""
+                conn.sendall("HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n%s" % (status, len(body), body))
+            except socket.error, ex:
+                pycb.log(logging.WARNING, "metrics scrape from %s failed: %s" % (str(addr), str(ex)))
+        finally:
+            conn.close()
+
+    def log_status(self):
+        now = time.time()
+        pycb.log(logging.INFO, "supervisor %d generation %d, %d workers" % (os.getpid(), self.generation, len(self.workers)))
+        for w in sorted(self.workers.values(), key=lambda w: w.pid):
+            pycb.log(logging.INFO, "worker %d generation %d %s, last heard from %.1f seconds ago: %s" % (w.pid, w.generation, w.get_state(), now - w.last_seen, w.status))
+
+# run in a new worker before it execs, it gets only the fds it needs
+def _close_fds_but(keep):
+    try:
+        fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
+    except OSError:
+        fds = range(0, os.sysconf("SC_OPEN_MAX"))
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+def _kill(pid, sig):
+    try:
+        os.kill(pid, sig)
+    except OSError, ex:
+        if ex.errno != errno.ESRCH:
+            raise
@@ -0,0 +1,184 @@
+import time
+import logging
+from twisted.internet import reactor, threads, task
+from twisted.python import threadable
+import pycb
+
+#
+#  Cumulus keeps the reactor thread for network io only.  Anything that
+#  can block, the authz db and the posix backend, is run in the reactor
+#  thread pool with defer_work() and the result comes back as a Deferred.
+#  the pool size is the [cb] threads option in cumulus.ini.
+
+def defer_work(f, *args, **kwargs):
+    return threads.deferToThread(f, *args, **kwargs)
+
+# run f in the reactor thread, directly if we are already there
+def call_in_reactor(f, *args, **kwargs):
+    if threadable.isInIOThread():
+        return f(*args, **kwargs)
+    reactor.callFromThread(f, *args, **kwargs)
+
+#
+#  twisted requests may only be touched from the reactor thread.  a
+#  cbRequest working in the pool is given one of these instead.  calls
+#  that change the reply are queued to the reactor in the order they are
+#  made, everything else (headers, args, the content file) is read
+#  straight from the real request which does not change once it has been
+#  handed to the resource
+class cbRequestProxy(object):
+
+    def __init__(self, request):
+        self.__dict__['_request'] = request
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._request, name, value)
+
+    def _call(self, name, *args):
+        call_in_reactor(self._reply, name, args)
+
+    def _reply(self, name, args):
+        # the client went away while we were working, nothing to tell it
+        if self._request._disconnected:
+            return
+        getattr(self._request, name)(*args)
+
+    def setHeader(self, k, v):
+        self._call('setHeader', k, v)
+
+    def setResponseCode(self, code, msg=None):
+        self._call('setResponseCode', code, msg)
+
+    def write(self, data):
+        self._call('write', data)
+
+    def finish(self):
+        self._call('finish')
+
+    def loseConnection(self):
+        self._call('loseConnection')
+
+    def registerProducer(self, producer, streaming):
+        self._call('registerProducer', producer, streaming)
+
+    def unregisterProducer(self):
+        self._call('unregisterProducer')
+
+#
+#  a twisted pull producer that drives a generator of strings into a
+#  request.  the generator usually reads the db or the disk so each chunk
+#  is made in the thread pool and written from the reactor when it is
+#  ready.  done is called once everything has been written.  if the
+#  generator blows up part way through the headers are long gone so the
+#  only honest thing left to do is drop the connection
+class cbGeneratorProducer(object):
+
+    def __init__(self, request, pieces, done, chunk_size=64*1024):
+        self.request = request
+        self.pieces = pieces
+        self.done = done
+        self.chunk_size = chunk_size
+        self.stopped = False
+        self.busy = False
+
+    def start(self):
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if self.stopped or self.busy:
+            return
+        self.busy = True
+        d = defer_work(self._next_chunk)
+        d.addCallbacks(self._write_chunk, self._failed)
+
+    def _next_chunk(self):
+        chunk = []
+        size = 0
+        while size < self.chunk_size:
+            try:
+                p = self.pieces.next()
+            except StopIteration:
+                return ("".join(chunk), True)
+            chunk.append(p)
+            size = size + len(p)
+        return ("".join(chunk), False)
+
+    def _write_chunk(self, result):
+        self.busy = False
+        if self.stopped:
+            self.pieces.close()
+            return
+        (data, finished) = result
+        if len(data) > 0:
+            self.request.write(data)
+        if finished:
+            self.stopped = True
+            self.request.unregisterProducer()
+            self.done()
+
+    def _failed(self, failure):
+        self.busy = False
+        pycb.log(logging.ERROR, "error generating a reply %s" % (failure.getTraceback()))
+        if self.stopped:
+            return
+        self.stopped = True
+        self.request.unregisterProducer()
+        self.request.channel.transport.loseConnection()
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        # a chunk being made in the pool closes the generator when it is back
+        if not self.busy:
+            self.pieces.close()
+
+#
+#  measures how long the reactor thread is kept from running its timers.
+#  a call is scheduled every interval seconds, anything past that before
+#  it actually runs is time the reactor was blocked.  stalls longer than
+#  warn seconds are logged
+class cbReactorMonitor(object):
+
+    def __init__(self, interval=0.1, warn=0.5):
+        self.interval = interval
+        self.warn = warn
+        self.blocked_total = 0.0
+        self.blocked_max = 0.0
+        self.stalls = 0
+        self.samples = 0
+        self.last = None
+        self.loop = None
+
+    def start(self):
+        self.last = time.time()
+        self.loop = task.LoopingCall(self.tick)
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self.loop != None and self.loop.running:
+            self.loop.stop()
+
+    def tick(self):
+        now = time.time()
+        blocked = now - self.last - self.interval
+        self.last = now
+        self.samples = self.samples + 1
+        if blocked <= 0:
+            return
+        self.blocked_total = self.blocked_total + blocked
+        if blocked > self.blocked_max:
+            self.blocked_max = blocked
+        if blocked > self.warn:
+            self.stalls = self.stalls + 1
+            pycb.log(logging.WARNING, "reactor blocked for %.3f seconds" % (blocked))
+
+    # (seconds blocked in total, longest single block, stalls over warn)
+    def get_stats(self):
+        return (self.blocked_total, self.blocked_max, self.stalls)
@@ -0,0 +1,49 @@
+from xml.sax.saxutils import escape, quoteattr
+
+#
+#  Incremental xml for the listing replies.  Rather than building a
+#  minidom Document and calling toxml() the reply is generated a piece at
+#  a time by a python generator and handed to the request in chunks as
+#  the transport asks for them by a cbGeneratorProducer, so memory stays
+#  bounded no matter how long the listing is.
+#
+#  minidom is still used for the small documents (acls, errors).
+
+def _to_str(v):
+    if isinstance(v, unicode):
+        return v.encode("utf-8")
+    return str(v)
+
+class cbXmlWriter(object):
+
+    def __init__(self):
+        self.buf = []
+        self.size = 0
+
+    def _add(self, s):
+        self.buf.append(s)
+        self.size = self.size + len(s)
+
+    def declaration(self):
+        self._add('<?xml version="1.0" encoding="UTF-8"?>')
+
+    def start(self, tag, attrs=None):
+        s = "<" + tag
+        if attrs != None:
+            for (k, v) in attrs:
+                s = s + " %s=%s" % (k, quoteattr(_to_str(v)))
+        self._add(s + ">")
+
+    def end(self, tag):
+        self._add("</" + tag + ">")
+
+    # <tag>text</tag>
+    def element(self, tag, text):
+        self._add("<%s>%s</%s>" % (tag, escape(_to_str(text)), tag))
+
+    # give back everything written since the last call
+    def pop(self):
+        s = "".join(self.buf)
+        self.buf = []
+        self.size = 0
+        return s
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
 from twisted.web import server, resource, http
-from twisted.internet import reactor, ssl
+from twisted.internet import reactor, ssl, task
+from twisted.protocols.tls import TLSMemoryBIOFactory
 from cbPosixBackend import cbPosixBackend
 from ConfigParser import SafeConfigParser
 import hashlib
@@ -15,11 +16,27 @@ from pycb.cbRequest import cbPutBucket
 from pycb.cbRequest import cbPutObject
 from pycb.cbRequest import cbHeadObject
 from pycb.cbRequest import cbCopyObject
+from pycb.cbRequest import cbInitiateMultipart
+from pycb.cbRequest import cbPutPart
+from pycb.cbRequest import cbCompleteMultipart
+from pycb.cbRequest import cbAbortMultipart
+from pycb.cbRequest import cbListParts
+from pycb.cbRequest import check_put_object
+from pycb.cbRequest import check_put_part
+from pycb.cbRequest import parse_part_number
 from pycb.cbRedirector import *
+from pycb.cbThreads import defer_work
+from pycb.cbThreads import cbRequestProxy
+from pycb.cbThreads import cbReactorMonitor
+from pycb.cbSupervisor import cbSupervisor
+from pycb.cbMetrics import g_metrics, g_metrics_path, observe_phase, observe_request
+from pycb.cbMetrics import write_snapshot
+import pynimbusauthz.db
 from datetime import date, datetime
 from xml.dom.minidom import Document
 import uuid
 import urllib
+import urlparse
 import traceback
 import sys
 import os
@@ -27,14 +44,26 @@ import socket
 import logging
 import pycb
 import threading
+import time
+import errno
+import fcntl
+import signal
 import tempfile
 import threading
 
+def end_user(result, user):
+    # giving back quota an upload did not use is a db write, keep it off
+    # the reactor
+    if getattr(user, 'reserved', 0) > 0:
+        defer_work(user.close)
+    else:
+        user.close()
+
 def end_redirector(result, request):
     pycb.config.redirector.end_connection(request)
 
 def init_redirector(req, bucketName, objectName):
-    redir_host = pycb.config.redirector.new_connection(req)
+    redir_host = pycb.config.redirector.new_connection(req, bucketName)
     req.notifyFinish().addBoth(end_redirector, req)
 
     if redir_host:
@@ -62,6 +91,29 @@ def path_to_bucket_object(path):
             objectName = None
     return (bucketName, objectName)
 
+# the query of a uri as a dict of lists.  twisted leaves keys without a
+# value (?uploads) out of request.args
+def query_args(uri):
+    ndx = uri.find('?')
+    if ndx < 0:
+        return {}
+    return urlparse.parse_qs(uri[ndx+1:], True)
+
+#  the checks cbPutObject (or cbPutPart) makes, run as soon as the
+#  headers of an upload are in so an upload that is going to fail is
+#  refused before its data is written
+def check_upload(headers, message_type, path, uri, bucketName, objectName, args):
+    user = authorize(headers, message_type, path, uri)
+    try:
+        new_len = int(headers['content-length'])
+        if 'uploadId' in args:
+            part_num = parse_part_number(args.get('partNumber', [None])[0])
+            check_put_part(user, bucketName, objectName, args['uploadId'][0], part_num, new_len)
+        else:
+            check_put_object(user, bucketName, objectName, new_len)
+    finally:
+        user.close()
+
 def createPath(headers, path):
 
     host = headers['host']
@@ -72,20 +124,33 @@ def createPath(headers, path):
 
     return path
 
+# the time this takes, db lookups and all, is the auth phase of the metrics
 def authorize(headers, message_type, path, uri):
+    start = time.time()
+    try:
+        return check_authorization(headers, message_type, path, uri)
+    finally:
+        observe_phase("auth", time.time() - start)
+
+def check_authorization(headers, message_type, path, uri):
 
     sent_auth = headers['authorization']
     auth_A = sent_auth.split(':')
     auth_hash = auth_A[1]
     id = auth_A[0].split()[1].strip()
     user = pycb.config.auth.get_user(id)
-    key = user.get_password()
+    try:
+        key = user.get_password()
 
-    pycb.log(logging.INFO, "AUTHORIZING %s %s %s" % (message_type, path, headers))
-    b64_hmac = pycb.get_auth_hash(key, message_type, path, headers, uri)
+        pycb.log(logging.DEBUG, "AUTHORIZING %s %s %s", message_type, path, headers)
+        b64_hmac = pycb.get_auth_hash(key, message_type, path, headers, uri)
+    except:
+        user.close()
+        raise
 
     if auth_hash == b64_hmac:
         return user
+    user.close()
     pycb.log(logging.ERROR, "%s %s %s" % (key, b64_hmac, auth_hash))
     ec = 'AccessDenied'
     ex = cbException(ec)
@@ -97,7 +162,8 @@ class CBService(resource.Resource):
     isLeaf = True
 
     def __init__(self):
-        pass
+        # requests seen, reported to a supervisor
+        self.served = 0
 
     def get_port(self):
         return pycb.config.port
@@ -112,7 +178,6 @@ class CBService(resource.Resource):
 
     #  object
     def request_object_factory(self, request, user, path, requestId):
-        pycb.log(logging.INFO, "path %s" % (path))
         # handle the one service operation
         if path == "/":
             if request.method == 'GET':
@@ -123,10 +188,15 @@ class CBService(resource.Resource):
         (bucketName, objectName) = path_to_bucket_object(path)
         init_redirector(request, bucketName, objectName)
 
-        pycb.log(logging.INFO, "path %s bucket %s object %s" % (path, bucketName, str(objectName)))
+        pycb.log(logging.DEBUG, "path %s bucket %s object %s", path, bucketName, objectName)
+        # the multipart upload operations are told apart by their query
+        query = query_args(request.uri)
+        upload = objectName != None and 'uploadId' in query
         if request.method == 'GET':
             if objectName == None:
                 cbR = cbGetBucket(request, user, bucketName, requestId, pycb.config.bucket)
+            elif upload:
+                cbR = cbListParts(request, user, bucketName, objectName, requestId, pycb.config.bucket)
             else:
                 cbR = cbGetObject(request, user, bucketName, objectName, requestId, pycb.config.bucket)
             return cbR
@@ -138,14 +208,24 @@ class CBService(resource.Resource):
                 if 'x-amz-copy-source' in args:
                     (srcBucketName, srcObjectName) = path_to_bucket_object(args['x-amz-copy-source'])
                     cbR = cbCopyObject(request, user, requestId, pycb.config.bucket, srcBucketName, srcObjectName, bucketName, objectName)
+                elif upload:
+                    cbR = cbPutPart(request, user, bucketName, objectName, requestId, pycb.config.bucket)
                 else:
                     cbR = cbPutObject(request, user, bucketName, objectName, requestId, pycb.config.bucket)
             return cbR
-        elif request.method == 'POST':
+        elif request.method == 'POST' and objectName != None:
+            if 'uploads' in query:
+                cbR = cbInitiateMultipart(request, user, bucketName, objectName, requestId, pycb.config.bucket)
+                return cbR
+            elif upload:
+                cbR = cbCompleteMultipart(request, user, bucketName, objectName, requestId, pycb.config.bucket)
+                return cbR
             pycb.log(logging.ERROR, "Nothing to handle POST")
         elif request.method == 'DELETE':
             if objectName == None:
                 cbR = cbDeleteBucket(request, user, bucketName, requestId, pycb.config.bucket)
+            elif upload:
+                cbR = cbAbortMultipart(request, user, bucketName, objectName, requestId, pycb.config.bucket)
             else:
                 cbR = cbDeleteObject(request, user, bucketName, objectName, requestId, pycb.config.bucket)
             return cbR
@@ -156,41 +236,81 @@ class CBService(resource.Resource):
         raise cbException('InvalidArgument')
 
     # everything does through here to localize access control
+    #
+    # authorization and the request work are run in the thread pool, the
+    # reactor only glues the steps together
     def process_event(self, request):
+        # refused as soon as its headers came in, see CumulusHTTPChannel
+        if getattr(request, '_cumulus_killed', None) != None:
+            return
+        request._cumulus_started = True
+        self.served = self.served + 1
+        # a peer redirector asking how busy we are
+        if request.method == 'GET' and request.uri == g_load_path:
+            self.send_text(request, make_load_body(pycb.config.redirector))
+            return
+        requestId = self.next_request_id()
+        request._cumulus_id = requestId
         try:
             rPath = createPath(request.getAllHeaders(), request.path)
- 
-            requestId = self.next_request_id()
+            pycb.log(logging.DEBUG, "%s incoming %s %s path %s headers %s", requestId, request.method, request.uri, rPath, request.getAllHeaders())
 
-            pycb.log(logging.INFO, "%s %s Incoming" % (requestId, str(datetime.now())))
-            pycb.log(logging.INFO, "%s %s" % (requestId, str(request)))
-            pycb.log(logging.INFO, "%s %s" % (requestId, rPath))
-            pycb.log(logging.INFO, "%s %s" %(requestId, request.getAllHeaders()))
-            pycb.log(logging.INFO, "request URI %s method %s %s" %(request.uri, request.method, str(request.args)))
-
-            user = authorize(request.getAllHeaders(), request.method, rPath, request.uri)
-            self.allowed_event(request, user, requestId, rPath)
+            d = defer_work(authorize, request.getAllHeaders(), request.method, rPath, request.uri)
+            d.addCallback(self.authorized, request, requestId, rPath)
+            d.addErrback(self.request_failed, request, requestId)
         except cbException, ex:
             eMsg = ex.sendErrorResponse(request, requestId)
-            pycb.log(logging.ERROR, eMsg, traceback)
+            pycb.log(logging.ERROR, eMsg, tb=traceback)
         except Exception, ex2:
             traceback.print_exc(file=sys.stdout)
             gdEx = cbException('InternalError')
             eMsg = gdEx.sendErrorResponse(request, requestId)
-            pycb.log(logging.ERROR, eMsg, traceback)
+            pycb.log(logging.ERROR, eMsg, tb=traceback)
+
+    def send_text(self, request, body):
+        request.setResponseCode(200)
+        request.setHeader('Content-Type', 'text/plain')
+        request.setHeader('Content-Length', str(len(body)))
+        request.write(body)
+        request.finish()
+
+    def authorized(self, user, request, requestId, path):
+        # the client gave up while we were looking them up
+        if request._disconnected or request.finished:
+            user.close()
+            return
+        # a request gives its db handle back once its db work is done, this
+        # is for the ones that did not get that far
+        request.notifyFinish().addBoth(end_user, user)
+        return self.allowed_event(request, user, requestId, path)
+
+    def request_failed(self, failure, request, requestId):
+        if request._disconnected or request.finished:
+            pycb.log(logging.ERROR, "%s failed after the reply was done %s" % (requestId, failure.getTraceback()))
+            return
+        ex = failure.value
+        if not isinstance(ex, cbException):
+            ex = cbException('InternalError')
+        eMsg = ex.sendErrorResponse(request, requestId)
+        pycb.log(logging.ERROR, eMsg)
+        pycb.log(logging.ERROR, failure.getTraceback())
 
     def allowed_event(self, request, user, requestId, path):
-        pycb.log(logging.INFO, "Access granted to ID=%s requestId=%s uri=%s" % (user.get_id(), requestId, request.uri))
+        request._cumulus_user = user.get_id()
+        pycb.log(logging.DEBUG, "Access granted to ID=%s requestId=%s uri=%s", request._cumulus_user, requestId, request.uri)
         cbR = self.request_object_factory(request, user, path, requestId)
+        # cbGetObject is GetObject in the metrics
+        request._cumulus_op = cbR.__class__.__name__[2:]
 
-        cbR.work()
+        cbR.request = cbRequestProxy(request)
+        return defer_work(cbR.work)
 
     # http events.  all do the same thing
     def render_GET(self, request):
         self.process_event(request)
         return server.NOT_DONE_YET
 
-    # not implementing any post stuff for now
+    # only multipart uploads are POSTed
     def render_POST(self, request):
         self.process_event(request)
         return server.NOT_DONE_YET
@@ -205,6 +325,8 @@ class CBService(resource.Resource):
 
 class CumulusHTTPChannel(http.HTTPChannel):
 
+    hold_continue = False
+
     def getAllHeaders(self, req):
         """
         Return dictionary mapping the names of all received headers to the last
@@ -218,65 +340,199 @@ class CumulusHTTPChannel(http.HTTPChannel):
             headers[k.lower()] = v[-1]
         return headers
 
-    def send_access_error(self, req):
-        ex = cbException('AccessDenied')
-        m_msg = "HTTP/1.1 %s %s\r\n" % (ex.httpCode, ex.httpDesc)
-        self.transport.write(m_msg)
-        m_msg = "%s: %s\r\n" % (('x-amz-request-id', str(uuid.uuid1())))
-        self.transport.write(m_msg)
-        self.transport.write('content-type: text/html')
-        e_msg = ex.make_xml_string(self._path, str(uuid.uuid1()))
-        self.transport.write(e_msg)
-        self.transport.loseConnection()
-
-    def send_redirect(self):
-        m_msg = "HTTP/1.1 %s %s\r\n" % (ex.httpCode, ex.httpDesc)
-        self.transport.write(m_msg)
-        m_msg = "%s: %s\r\n" % (('x-amz-request-id', str(uuid.uuid1())))
-        self.transport.write(m_msg)
-        self.transport.write('content-type: text/html\r\n')
-        e_msg = ex.make_xml_string(self._path, str(uuid.uuid1()))
+    request_count = 0
+
+    # the site keeps count of the open connections so a worker that is
+    # going away knows when it is done
+    def connectionMade(self):
+        http.HTTPChannel.connectionMade(self)
+        self.site.open_connections = self.site.open_connections + 1
+        # a reply is often its headers and then the body written apart
+        # (sendfile, FileSender).  on a connection that is kept open the
+        # body would wait for the client to ack the headers
+        t = self.transport
+        while not hasattr(t, 'setTcpNoDelay') and hasattr(t, 'transport'):
+            t = t.transport
+        if hasattr(t, 'setTcpNoDelay'):
+            t.setTcpNoDelay(True)
+        self.site.channels.add(self)
+
+    def connectionLost(self, reason):
+        self.site.open_connections = self.site.open_connections - 1
+        self.site.channels.discard(self)
+        http.HTTPChannel.connectionLost(self, reason)
+
+    # twisted keeps an http/1.1 connection open unless the client asks
+    # otherwise.  it is closed after keepalive_requests requests so no one
+    # client holds on to it forever, and by a worker that is going away
+    def checkPersistence(self, request, version):
+        self.request_count = self.request_count + 1
+        persistent = http.HTTPChannel.checkPersistence(self, request, version)
+        limit = pycb.config.keepalive_requests
+        if persistent and (self.site.closing or (limit > 0 and self.request_count >= limit)):
+            request.responseHeaders.setRawHeaders('connection', ['close'])
+            persistent = False
+        return persistent
+
+    # a connection waiting for its next request is closed now, one with a
+    # request is closed once the reply has gone out
+    def close_when_idle(self):
+        if len(self.requests) == 0:
+            self.transport.loseConnection()
+            return
+        for req in self.requests:
+            if not req.startedWriting:
+                req.responseHeaders.setRawHeaders('connection', ['close'])
+        self.persistent = False
+
+    # answer a request before twisted has handed it to the resource, the
+    # body has not been read so the connection cannot be used again
+    def send_early_error(self, ex):
+        requestId = str(uuid.uuid1()).replace("-", "")
+        e_msg = ex.make_xml_string(self._path, requestId)
+        self.transport.write("HTTP/1.1 %s %s\r\n" % (ex.httpCode, ex.httpDesc))
+        self.transport.write("x-amz-request-id: %s\r\n" % (requestId))
+        self.transport.write("Content-Type: application/xml\r\n")
+        self.transport.write("Content-Length: %d\r\n" % (len(e_msg)))
+        self.transport.write("Connection: close\r\n\r\n")
         self.transport.write(e_msg)
         self.transport.loseConnection()
-        return ex
 
+    # twisted answers Expect: 100-continue as soon as the headers are in.
+    # an upload is only told to go ahead once it has been checked
+    def _send100Continue(self):
+        if self.hold_continue:
+            return
+        http.HTTPChannel._send100Continue(self)
 
     # intercept the key event
     def allHeadersReceived(self):
-        http.HTTPChannel.allHeadersReceived(self)
-
         req = self.requests[-1]
         req._cumulus_killed = None
+        req._cumulus_started = False
+        req._cumulus_begin = time.time()
+        req._cumulus_id = None
+        req._cumulus_user = None
+        req._cumulus_bucket = None
+        req._cumulus_key = None
+        req._cumulus_op = None
+        req.notifyFinish().addBoth(self.request_done, req)
         h = self.getAllHeaders(req)
         # we can check the authorization here
         rPath = self._path
         ndx = rPath.rfind('?')
+        query = ""
         if ndx >= 0:
+            query = rPath[ndx+1:]
             rPath = rPath[0:ndx]
         rPath = createPath(h, rPath)
-#        try:
-#            user = authorize(h, self._command, rPath, self._path)
-#        except:
-#            self.send_access_error(req)
-#            return
-
-        if 'expect' in h:
-            if h['expect'].lower() == '100-continue':
-                self.transport.write("HTTP/1.1 100 Continue\r\n\r\n")
 
         (bucketName, objectName) = path_to_bucket_object(rPath)
-        # if we are putting an object
-        if objectName != None and self._command == "PUT":
-            #  free up the temp object that we will not be using
-            req.content.close()
-            # give twisted our own file like object
-            req.content = pycb.config.bucket.put_object(bucketName, objectName)
-            req.content.set_delete_on_close(True)
-
+        req._cumulus_bucket = bucketName
+        req._cumulus_key = objectName
+        # if we are putting an object, acls and copies have no data
+        upload = objectName != None and self._command == "PUT" and 'x-amz-copy-source' not in h and 'acl' not in query.split('&')
+        self.hold_continue = upload
+        http.HTTPChannel.allHeadersReceived(self)
+        self.hold_continue = False
+        if not upload:
+            return
+
+        if 'content-length' not in h:
+            req._cumulus_killed = cbException('MissingContentLength')
+            self.send_early_error(req._cumulus_killed)
+            return
+
+        #  free up the temp object that we will not be using
+        req.content.close()
+        # give twisted our own file like object, the body is written
+        # straight to the backend as it arrives
+        req.content = pycb.config.bucket.put_object(bucketName, objectName)
+        req.content.set_delete_on_close(True)
+
+        # find out if the upload is allowed while the body is coming in
+        # rather than after all of it has been written
+        d = defer_work(check_upload, h, self._command, rPath, self._path, bucketName, objectName, query_args(self._path))
+        d.addCallbacks(self.upload_allowed, self.upload_refused, callbackArgs=(req, h), errbackArgs=(req,))
+
+    # one line for the access log and the metrics however the request
+    # ended
+    def request_done(self, result, req):
+        status = req.code
+        try:
+            bytes_in = int(req.getHeader('content-length') or 0)
+        except ValueError:
+            bytes_in = 0
+        if req._cumulus_killed != None:
+            status = req._cumulus_killed.httpCode
+        elif not req.finished:
+            # the client went away first
+            status = 499
+        took = time.time() - req._cumulus_begin
+        entry = {
+            'id': req._cumulus_id,
+            'method': req.method,
+            'bucket': req._cumulus_bucket,
+            'key': req._cumulus_key,
+            'user': req._cumulus_user,
+            'status': status,
+            'bytes_in': bytes_in,
+            'bytes_out': req.sentLength,
+            'ms': int(took * 1000),
+            'remote': req.getClientIP(),
+        }
+        pycb.access_log(entry)
+        # one that did not get as far as an operation is known by its method
+        op = req._cumulus_op
+        if op == None:
+            op = req.method
+        observe_request(op, status, took, bytes_in, req.sentLength)
+
+    def upload_allowed(self, result, req, h):
+        if req._disconnected or req._cumulus_started:
+            return
+        if h.get('expect', '').lower() == '100-continue' and self._version == "HTTP/1.1":
+            http.HTTPChannel._send100Continue(self)
+
+    def upload_refused(self, failure, req):
+        ex = failure.value
+        if not isinstance(ex, cbException):
+            pycb.log(logging.ERROR, "error checking upload %s" % (failure.getTraceback()))
+            ex = cbException('InternalError')
+        # once twisted has all of the body the request is answered as usual
+        if req._disconnected or req._cumulus_started:
+            return
+        pycb.log(logging.INFO, "upload to %s refused %s" % (self._path, ex.code))
+        req._cumulus_killed = ex
+        self.send_early_error(ex)
 
 
 class CumulusSite(server.Site):
     protocol = CumulusHTTPChannel
+    open_connections = 0
+    # no connection is kept open past its request once this is set
+    closing = False
+
+    def __init__(self, resource):
+        server.Site.__init__(self, resource, timeout=pycb.config.keepalive_timeout)
+        self.channels = set()
+
+    def close_connections(self):
+        self.closing = True
+        for c in list(self.channels):
+            c.close_when_idle()
+
+
+#  the admin port, the metrics are all it has
+class cbMetricsResource(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        if request.path != g_metrics_path:
+            request.setResponseCode(404)
+            return ""
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return g_metrics.render() + make_load_body(pycb.config.redirector)
 
 
 class CumulusRunner(object):
@@ -285,9 +541,29 @@ class CumulusRunner(object):
         self.done = False
         self.cb = CBService()
         self.site = CumulusSite(self.cb)
-
+        self.reactor_monitor = cbReactorMonitor()
+        self.heartbeat = None
+        self.draining = None
+        pynimbusauthz.db.set_query_timer(lambda t: observe_phase("db", t))
+        # the supervisor serves the metrics of its workers
+        self.admin = None
+        if pycb.config.metrics_port and pycb.config.listen_fd == None:
+            self.admin = reactor.listenTCP(pycb.config.metrics_port, server.Site(cbMetricsResource()), interface=pycb.config.metrics_address)
+            pycb.log(logging.INFO, "metrics at %s:%d%s" % (pycb.config.metrics_address, self.admin.getHost().port, g_metrics_path))
+
+        # a worker of a supervisor takes connections on the socket the
+        # supervisor opened, see cbSupervisor
+        if pycb.config.listen_fd != None:
+            factory = self.site
+            if pycb.config.use_https:
+                sslContext = ssl.DefaultOpenSSLContextFactory(
+                  pycb.config.https_key,
+                  pycb.config.https_cert)
+                factory = TLSMemoryBIOFactory(sslContext, False, self.site)
+            self.iconnector = reactor.adoptStreamPort(pycb.config.listen_fd, socket.AF_INET, factory)
+            os.close(pycb.config.listen_fd)
         # figure out if we need http of https 
-        if pycb.config.use_https:
+        elif pycb.config.use_https:
             pycb.log(logging.INFO, "using https")
             sslContext = ssl.DefaultOpenSSLContextFactory(
               pycb.config.https_key,
@@ -307,16 +583,86 @@ class CumulusRunner(object):
         return l.port
 
     def run(self):
-        reactor.suggestThreadPoolSize(10)
+        reactor.suggestThreadPoolSize(pycb.config.threads)
+        reactor.callWhenRunning(pycb.config.redirector.start)
+        self.reactor_monitor.start()
+        if pycb.config.heartbeat_fd != None:
+            fd = pycb.config.heartbeat_fd
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self.heartbeat = task.LoopingCall(self.send_heartbeat)
+            self.heartbeat.start(max(1, pycb.config.worker_timeout / 5.0))
+            # after twisted has put in its own handlers
+            reactor.callWhenRunning(self.take_signals)
         reactor.run()
 
     def stop(self):
         self.iconnector.stopListening()
+        if self.admin != None:
+            self.admin.stopListening()
+
+    #
+    #  a worker.  the first heartbeat tells the supervisor the worker is
+    #  up, after that they say it is still well.  asked to stop it finishes
+    #  the requests it has first
+    #
+    def take_signals(self):
+        signal.signal(signal.SIGTERM, self.on_term)
+        signal.signal(signal.SIGINT, self.on_term)
+
+    def on_term(self, signum, frame):
+        reactor.callFromThread(self.drain)
+
+    def send_heartbeat(self):
+        (blocked, worst, stalls) = self.reactor_monitor.get_stats()
+        line = "connections=%d requests=%d blocked_max=%.3f stalls=%d\n" % (self.site.open_connections, self.cb.served, worst, stalls)
+        self.save_metrics()
+        try:
+            os.write(pycb.config.heartbeat_fd, line)
+        except OSError, ex:
+            if ex.errno == errno.EAGAIN:
+                return
+            # the supervisor is gone
+            pycb.log(logging.ERROR, "lost the supervisor: %s" % (str(ex)))
+            self.drain()
+
+    # left for the supervisor to add up with those of the other workers
+    def save_metrics(self):
+        if pycb.config.metrics_file == None or not pycb.config.metrics_port:
+            return
+        try:
+            write_snapshot(g_metrics, pycb.config.metrics_file)
+        except (IOError, OSError), ex:
+            pycb.log(logging.WARNING, "could not save the metrics: %s" % (str(ex)))
+
+    def drain(self):
+        if self.draining != None:
+            return
+        self.draining = time.time()
+        pycb.log(logging.INFO, "worker %d stopping, %d connections open" % (os.getpid(), self.site.open_connections))
+        if self.heartbeat != None and self.heartbeat.running:
+            self.heartbeat.stop()
+        self.iconnector.stopListening()
+        self.site.close_connections()
+        task.LoopingCall(self.check_drained).start(0.2)
+
+    def check_drained(self):
+        if self.site.open_connections > 0 and time.time() - self.draining < pycb.config.drain_timeout:
+            return
+        self.save_metrics()
+        reactor.stop()
 
 
 def main(argv=sys.argv[0:]):
     pycb.config.parse_cmdline(argv)
 
+    if pycb.config.workers > 1 and pycb.config.listen_fd == None:
+        try:
+            supervisor = cbSupervisor(os.path.abspath(argv[0]), argv[1:], pycb.config.workers, pycb.config.worker_timeout, pycb.config.drain_timeout)
+        except Exception, ex:
+            pycb.log(logging.ERROR, "error starting the server, check that the port is not already taken: %s" % (str(ex)), tb=traceback)
+            raise ex
+        return supervisor.run()
+
     try:
         cumulus = CumulusRunner()
     except Exception, ex:
@@ -58,12 +58,18 @@ def make_user():
 def set_user_quota(id, quota):
     auth = pycb.config.auth
     u = auth.get_user(id)
-    u.set_quota(quota)
+    try:
+        u.set_quota(quota)
+    finally:
+        u.close()
 
 def clean_user(id):
     auth = pycb.config.auth
     u = auth.get_user(id)
-    u.remove_user(force=True)
+    try:
+        u.remove_user(force=True)
+    finally:
+        u.close()
 
 def get_contact():
     try:
@@ -78,10 +78,13 @@ def main_trap(argv=sys.argv[1:]):
     except:
         raise cbToolsException('UNKNOWN_USER', (user_id), ex)
 
-    opts.ID = user_id
-    opts.canonical_id = u.get_canonical_id()
-    opts.quota = u.get_quota()
-    opts.id = u.set_user_pw(opts.password)
+    try:
+        opts.ID = user_id
+        opts.canonical_id = u.get_canonical_id()
+        opts.quota = u.get_quota()
+        opts.id = u.set_user_pw(opts.password)
+    finally:
+        u.close()
 
     pycb.tools.print_report(opts, opts.report, opts)
 
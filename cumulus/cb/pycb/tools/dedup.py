@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+import traceback
+import os
+import sys
+import errno
+import hashlib
+import pycb
+import pynimbusauthz
+from pycb.tools.cbToolsException import cbToolsException
+from pycb.cbPosixBackend import cbPosixBackend
+from pycb.cbPosixBackend import read_meta, write_meta, share_data, cas_path
+from pynimbusauthz.cmd_opts import cbOpts
+
+def setup_options(argv):
+
+    u = """[options]
+Report how much space the content addressed store of the posix backend
+saves (see dedup in the [backend] section of cumulus.ini).
+
+With --migrate the objects already stored are shared too.  This is done
+in place and can be run while cumulus is serving requests.
+"""
+    (parser, all_opts) = pynimbusauthz.get_default_options(u)
+    opt = cbOpts("migrate", "m", "Share the data of the objects already in the store", False, flag=True)
+    all_opts.append(opt)
+    opt = cbOpts("gc", "g", "Remove stored content that no object uses any more", False, flag=True)
+    all_opts.append(opt)
+
+    (o, args) = pynimbusauthz.parse_args(parser, all_opts, argv)
+
+    return (o, args)
+
+# every data key under the backend in any layout, skipping files that are
+# still being written and the store itself
+def data_keys(backend):
+    for (ddir, dirs, files) in os.walk(backend.base_dir):
+        if ddir == backend.base_dir:
+            for d in ["cas", "buckets"]:
+                if d in dirs:
+                    dirs.remove(d)
+            continue
+        dirs.sort()
+        names = set(files)
+        for n in sorted(names):
+            if n.endswith(".meta") or n.endswith(".part") or n.endswith(".cas"):
+                continue
+            if n + ".part" in names:
+                continue
+            yield os.path.join(ddir, n)
+
+# (sha256, md5) of a file
+def hash_data(fname):
+    h = hashlib.sha256()
+    m = hashlib.md5()
+    f = open(fname, "rb")
+    try:
+        while True:
+            b = f.read(pycb.config.block_size)
+            if len(b) == 0:
+                break
+            h.update(b)
+            m.update(b)
+    finally:
+        f.close()
+    return (h.hexdigest(), m.hexdigest())
+
+def migrate(opts, backend):
+    count = 0
+    shared = 0
+    saved = 0
+    for data_key in data_keys(backend):
+        try:
+            (md5, digest) = read_meta(data_key)
+            if digest != None:
+                blob = cas_path(backend.cas_dir, digest)
+                if os.path.exists(blob) and os.path.samefile(blob, data_key):
+                    continue
+            (digest, new_md5) = hash_data(data_key)
+            if md5 == None:
+                md5 = new_md5
+            write_meta(data_key, md5, digest)
+            size = os.path.getsize(data_key)
+            if share_data(backend.cas_dir, data_key, digest):
+                shared = shared + 1
+                saved = saved + size
+            count = count + 1
+        except (IOError, OSError), ex:
+            # deleted while we were looking at it
+            if ex.errno != errno.ENOENT:
+                raise
+        pynimbusauthz.print_msg(opts, 2, "%s" % (data_key))
+    pynimbusauthz.print_msg(opts, 1, "%d objects added to the store, %d of them were already there saving %s" % (count, shared, pynimbusauthz.pretty_number(saved)))
+
+def report(opts, backend):
+    blobs = 0
+    refs = 0
+    stored = 0
+    referenced = 0
+    unused = 0
+    unused_size = 0
+    if os.path.isdir(backend.cas_dir):
+        for d in sorted(os.listdir(backend.cas_dir)):
+            ddir = os.path.join(backend.cas_dir, d)
+            for n in os.listdir(ddir):
+                blob = os.path.join(ddir, n)
+                try:
+                    st = os.stat(blob)
+                    # the blob itself is one of the links
+                    r = st.st_nlink - 1
+                    if r == 0:
+                        unused = unused + 1
+                        unused_size = unused_size + st.st_size
+                        if opts.gc:
+                            os.unlink(blob)
+                        continue
+                except OSError, ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+                    continue
+                blobs = blobs + 1
+                refs = refs + r
+                stored = stored + st.st_size
+                referenced = referenced + st.st_size * r
+
+    saved = referenced - stored
+    if opts.batch:
+        pynimbusauthz.print_msg(opts, 0, "%d,%d,%d,%d,%d,%d,%d" % (blobs, refs, stored, referenced, saved, unused, unused_size))
+        return
+    pn = pynimbusauthz.pretty_number
+    pynimbusauthz.print_msg(opts, 0, "objects in the store     : %d" % (refs))
+    pynimbusauthz.print_msg(opts, 0, "distinct contents        : %d" % (blobs))
+    pynimbusauthz.print_msg(opts, 0, "size of the objects      : %s" % (pn(referenced)))
+    pynimbusauthz.print_msg(opts, 0, "size on disk             : %s" % (pn(stored)))
+    pynimbusauthz.print_msg(opts, 0, "saved                    : %s" % (pn(saved)))
+    if opts.gc:
+        pynimbusauthz.print_msg(opts, 0, "removed unused contents  : %d (%s)" % (unused, pn(unused_size)))
+    else:
+        pynimbusauthz.print_msg(opts, 0, "unused contents          : %d (%s)" % (unused, pn(unused_size)))
+
+def main_trap(argv=sys.argv[1:]):
+
+    (opts, args) = setup_options(argv)
+    if len(args) != 0:
+        raise cbToolsException('CMDLINE', ("unexpected arguments.  See --help"))
+    backend = pycb.config.bucket
+    if not isinstance(backend, cbPosixBackend):
+        raise cbToolsException('CMDLINE', ("only the posix backend can be deduplicated"))
+
+    if opts.migrate:
+        try:
+            os.mkdir(backend.cas_dir)
+        except OSError, ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        migrate(opts, backend)
+    report(opts, backend)
+    return 0
+
+def main(argv=sys.argv[1:]):
+    try:
+        rc = main_trap(argv)
+    except cbToolsException, tex:
+        print tex
+        rc = tex.get_rc()
+    except SystemExit:
+        rc = 0
+    except:
+        traceback.print_exc(file=sys.stdout)
+        print 'An unknown error occurred'
+        rc = 128
+    return rc
+
+if __name__ == "__main__":
+    rc = main()
+    sys.exit(rc)
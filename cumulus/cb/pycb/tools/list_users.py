@@ -50,12 +50,15 @@ def main_trap(argv=sys.argv[1:]):
 
     for id in all_matches:
         u = auth.get_user(id)
-        p = printer_obj() 
-        p.ID = id
-        p.canonical_id = u.get_canonical_id()
-        p.quota = u.get_quota()
-        p.password = u.get_password()
-        p.friendly = u.get_display_name()
+        try:
+            p = printer_obj() 
+            p.ID = id
+            p.canonical_id = u.get_canonical_id()
+            p.quota = u.get_quota()
+            p.password = u.get_password()
+            p.friendly = u.get_display_name()
+        finally:
+            u.close()
 
         pycb.tools.print_report(p, opts.report, opts)
 
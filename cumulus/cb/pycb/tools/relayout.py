@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import traceback
+import os
+import sys
+import errno
+import pycb
+import pynimbusauthz
+import pynimbusauthz.rebase
+from pycb.tools.cbToolsException import cbToolsException
+from pycb.cbPosixBackend import cbPosixBackend
+from pycb.cbAuthzSecurity import cbAuthzSec
+from pynimbusauthz.cmd_opts import cbOpts
+from pynimbusauthz.objects import File
+
+def setup_options(argv):
+
+    u = """[options]
+Move the data files of the posix backend into the layout set in the
+[backend] section of cumulus.ini (see layout and fanout there).
+
+This can be run while cumulus is serving requests.  Each file is first
+linked under its new name, the objects are then pointed at the new names
+a batch at a time and the old names are removed once that is committed.
+Running it again picks up where it left off.
+"""
+    (parser, all_opts) = pynimbusauthz.get_default_options(u)
+    opt = cbOpts("commit", "c", "Number of objects moved per database transaction", 1000)
+    all_opts.append(opt)
+    opt = cbOpts("dryrun", "n", "Only count the objects that would be moved", False, flag=True)
+    all_opts.append(opt)
+
+    (o, args) = pynimbusauthz.parse_args(parser, all_opts, argv)
+
+    return (o, args)
+
+# the files with data in the backend that are not where the layout puts
+# them.  fetched a page at a time so no cursor is open across a commit
+def misplaced_files(db_obj, backend, page_size):
+    base = backend.base_dir.rstrip("/") + "/"
+    last = None
+    while True:
+        files = list(File.find_files_from_data(db_obj, base + "%", after_id=last, limit=page_size))
+        if len(files) == 0:
+            return
+        last = files[-1].get_id()
+        for f in files:
+            key = f.get_data_key()
+            if key.startswith(base) and not backend.in_layout(key):
+                yield f
+
+def main_trap(argv=sys.argv[1:]):
+
+    (opts, args) = setup_options(argv)
+    if len(args) != 0:
+        raise cbToolsException('CMDLINE', ("unexpected arguments.  See --help"))
+    backend = pycb.config.bucket
+    if not isinstance(backend, cbPosixBackend):
+        raise cbToolsException('CMDLINE', ("only the posix backend has a data layout"))
+    auth = pycb.config.auth
+    if not isinstance(auth, cbAuthzSec):
+        raise cbToolsException('CMDLINE', ("the data keys are only known to the authz security module"))
+    try:
+        batch_size = int(opts.commit)
+    except ValueError:
+        raise cbToolsException('CMDLINE', ("--commit must be a number"))
+    if batch_size < 1:
+        raise cbToolsException('CMDLINE', ("--commit must be at least 1"))
+
+    db_obj = auth.get_db()
+    try:
+        if opts.dryrun:
+            count = len(list(misplaced_files(db_obj, backend, batch_size)))
+            pynimbusauthz.print_msg(opts, 0, "%d objects to move into layout %d" % (count, backend.layout))
+            return 0
+
+        def done(old_key, new_key, changed):
+            # whoever changed the object under us took care of its old data
+            if changed:
+                pynimbusauthz.print_msg(opts, 2, "%s -> %s" % (old_key, new_key))
+                backend.unlink_data(old_key)
+            else:
+                backend.unlink_data(new_key)
+
+        def new_key(old_key):
+            try:
+                return backend.relink_data(old_key)
+            except OSError, ex:
+                # deleted since we looked it up
+                if ex.errno != errno.ENOENT:
+                    raise
+                return None
+
+        files = misplaced_files(db_obj, backend, batch_size)
+        count = pynimbusauthz.rebase.rebase_files(db_obj, files, new_key, batch_size=batch_size, done=done)
+    finally:
+        db_obj.close()
+    if opts.batch:
+        pynimbusauthz.print_msg(opts, 0, "%d" % (count))
+    else:
+        pynimbusauthz.print_msg(opts, 0, "%d objects moved into layout %d" % (count, backend.layout))
+    return 0
+
+def main(argv=sys.argv[1:]):
+    try:
+        rc = main_trap(argv)
+    except cbToolsException, tex:
+        print tex
+        rc = tex.get_rc()
+    except SystemExit:
+        rc = 0
+    except:
+        traceback.print_exc(file=sys.stdout)
+        print 'An unknown error occurred'
+        rc = 128
+    return rc
+
+if __name__ == "__main__":
+    rc = main()
+    sys.exit(rc)
@@ -43,7 +43,10 @@ def main_trap(argv=sys.argv[1:]):
         u = auth.get_user(user_id)
     except Exception, ex:
         raise cbToolsException('UNKNOWN_USER', (display_name), ex)
-    u.remove_user(force=opts.all)
+    try:
+        u.remove_user(force=opts.all)
+    finally:
+        u.close()
 
     return 0
 
@@ -79,7 +79,10 @@ def main_trap(argv=sys.argv[1:]):
     if u == None:
         raise cbToolsException('UNKNOWN_USER', (display_name))
 
-    u.set_quota(q)
+    try:
+        u.set_quota(q)
+    finally:
+        u.close()
 
     return 0
 
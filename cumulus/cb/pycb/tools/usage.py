@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+import traceback
+import sys
+import pycb
+import pynimbusauthz
+from pycb.tools.cbToolsException import cbToolsException
+from pycb.cbAuthzSecurity import cbAuthzSec
+from pynimbusauthz.cmd_opts import cbOpts
+from pynimbusauthz.user import User
+from pynimbusauthz.db import upgrade_schema
+
+def setup_options(argv):
+
+    u = """[options]
+Check the quota usage kept for each cumulus user against the objects they
+own and correct it where it is wrong.  Every user found wrong is listed.
+
+The tables and indexes a database from an older release is missing are
+added first (cumulus also does that when it starts).  Users from before
+the usage was kept are added up the first time they upload, running this
+once after an upgrade saves them the wait.
+"""
+    (parser, all_opts) = pynimbusauthz.get_default_options(u)
+    opt = cbOpts("dryrun", "n", "Only report what is wrong", False, flag=True)
+    all_opts.append(opt)
+    opt = cbOpts("clear_reserved", "r", "Also drop the space held for uploads in progress.  Only use this while cumulus is not running", False, flag=True)
+    all_opts.append(opt)
+
+    (o, args) = pynimbusauthz.parse_args(parser, all_opts, argv)
+
+    return (o, args)
+
+def main_trap(argv=sys.argv[1:]):
+
+    (opts, args) = setup_options(argv)
+    if len(args) != 0:
+        raise cbToolsException('CMDLINE', ("unexpected arguments.  See --help"))
+    auth = pycb.config.auth
+    if not isinstance(auth, cbAuthzSec):
+        raise cbToolsException('CMDLINE', ("quotas are only kept by the authz security module"))
+
+    db_obj = auth.get_db()
+    try:
+        added = upgrade_schema(db_obj)
+        db_obj.commit()
+        wrong = User.reconcile_usage(db_obj, clear_reserved=opts.clear_reserved)
+        if opts.dryrun:
+            db_obj.rollback()
+        else:
+            db_obj.commit()
+    finally:
+        db_obj.close()
+
+    for name in added:
+        pynimbusauthz.print_msg(opts, 1, "added %s to the database" % (name))
+
+    for (user_id, ot, ledger, actual) in wrong:
+        if opts.batch:
+            pynimbusauthz.print_msg(opts, 0, "%s,%d,%s,%d" % (user_id, ot, str(ledger), actual))
+        else:
+            if ledger == None:
+                ledger = "not counted"
+            else:
+                ledger = pynimbusauthz.pretty_number(ledger)
+            pynimbusauthz.print_msg(opts, 0, "%s : %s should be %s" % (user_id, ledger, pynimbusauthz.pretty_number(actual)))
+    if not opts.batch:
+        if opts.dryrun:
+            pynimbusauthz.print_msg(opts, 1, "%d users would be corrected" % (len(wrong)))
+        else:
+            pynimbusauthz.print_msg(opts, 1, "%d users corrected" % (len(wrong)))
+    return 0
+
+def main(argv=sys.argv[1:]):
+    try:
+        rc = main_trap(argv)
+    except cbToolsException, tex:
+        print tex
+        rc = tex.get_rc()
+    except SystemExit:
+        rc = 0
+    except:
+        traceback.print_exc(file=sys.stdout)
+        print 'An unknown error occurred'
+        rc = 128
+    return rc
+
+if __name__ == "__main__":
+    rc = main()
+    sys.exit(rc)
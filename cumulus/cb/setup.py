@@ -28,6 +28,9 @@ setup(name='pycb',
             'cumulus-list-users = pycb.tools.list_users:main',
             'cumulus-quota = pycb.tools.set_quota:main',
             'cumulus-create-repo-admin = pycb.tools.base_repo:main',
+            'cumulus-dedup = pycb.tools.dedup:main',
+            'cumulus-relayout = pycb.tools.relayout:main',
+            'cumulus-usage = pycb.tools.usage:main',
         ]
       },
 
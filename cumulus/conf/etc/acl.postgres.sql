@@ -125,12 +125,38 @@ create table objects(
     object_type INTEGER REFERENCES object_types(id) NOT NULL,
     parent_id INTEGER REFERENCES objects(id) ON DELETE CASCADE DEFAULT NULL,
 
-    md5sum CHAR(32),
+    -- the md5 of a multipart upload is <md5 of the part md5s>-<parts>
+    md5sum varchar(64),
     object_size bigint DEFAULT 0,
     creation_time TIMESTAMP,
     UNIQUE(object_type, name, parent_id)
 );
 
+-- multipart uploads
+-- =================
+--  an upload in progress of the key name into the bucket object_id.  each
+--  part is its own backend file until the upload is completed
+create table multipart_join(
+    id SERIAL PRIMARY KEY,
+    upload_id varchar(64) UNIQUE NOT NULL,
+    object_id INTEGER REFERENCES objects(id) ON DELETE CASCADE NOT NULL,
+    name varchar(1024) NOT NULL,
+    owner_id char(36) REFERENCES users_canonical(id) ON DELETE CASCADE NOT NULL,
+    creation_time TIMESTAMP,
+    complete INTEGER DEFAULT 0
+);
+
+create table multipart(
+    id SERIAL PRIMARY KEY,
+    data_key varchar(1024) UNIQUE NOT NULL,
+    order_num INTEGER NOT NULL,
+    mp_id INTEGER REFERENCES multipart_join(id) ON DELETE CASCADE NOT NULL,
+    md5sum CHAR(32),
+    object_size bigint DEFAULT 0,
+    creation_time TIMESTAMP,
+    UNIQUE(mp_id, order_num)
+);
+
 -- object_acl
 -- ==========
 --  This is a join table for descovering acl permissions associated with 
@@ -143,6 +169,18 @@ create table object_acl(
     unique(user_id, object_id, access_type_id)
 );
 
+-- indexes
+-- =======
+--  bucket listings page through a bucket by name, permission lookups go
+--  from an object to its acl rows, and a users buckets are found by owner
+--
+--  the name ranges used for prefix listing follow the index order, create
+--  the database with a C collation (createdb --lc-collate=C) so that it
+--  is the same byte order s3 uses
+create index objects_parent_name_idx on objects(parent_id, name);
+create index objects_owner_idx on objects(owner_id, parent_id);
+create index object_acl_object_idx on object_acl(object_id, user_id);
+
 
 create table object_quota(
     id SERIAL PRIMARY KEY,
@@ -152,4 +190,16 @@ create table object_quota(
     UNIQUE(user_id, object_type)
 );
 
+-- the bytes each user has stored, kept up to date as objects are added
+-- and removed so a quota check does not have to add up all of their
+-- objects.  reserved is space promised to uploads that are not done yet.
+-- cumulus-usage rebuilds used from the objects table
+create table object_usage(
+    user_id char(36) REFERENCES users_canonical(id) ON DELETE CASCADE NOT NULL,
+    object_type INTEGER REFERENCES object_types(id) NOT NULL,
+    used bigint DEFAULT 0 NOT NULL,
+    reserved bigint DEFAULT 0 NOT NULL,
+    PRIMARY KEY(user_id, object_type)
+);
+
 
@@ -0,0 +1,472 @@
+#!/usr/bin/python
+
+#
+#  a self contained cumulus benchmark.  it makes a cumulus of its own in a
+#  temp dir (cumulus.ini, a posix backend and a fresh sqlite authz db),
+#  runs the server from this tree in a child process and drives it with
+#  clients in processes of their own.  nothing has to be installed or
+#  running first.
+#
+#  each workload is run for every client count asked for and reports
+#  throughput, latency percentiles and the cpu and memory the server used.
+#  the results go to a json file, --compare prints how they differ from
+#  an older one:
+#
+#      bench.py -o before.json
+#      (change something)
+#      bench.py -o after.json --compare before.json
+#
+import os
+import sys
+import time
+import json
+import errno
+import random
+import shutil
+import signal
+import socket
+import urllib2
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from optparse import OptionParser
+
+g_here = os.path.dirname(os.path.abspath(__file__))
+for d in ["cb", "authz"]:
+    p = os.path.join(g_here, "..", d)
+    if p not in sys.path:
+        sys.path.insert(0, p)
+
+import boto
+import boto.s3.key
+from boto.s3.connection import S3Connection
+from boto.s3.connection import OrdinaryCallingFormat
+
+g_workloads = ["small_put", "small_get", "head", "list", "large_put", "large_get", "mixed"]
+
+def setup_options(argv):
+    u = """[options]
+Run cumulus benchmarks against a cumulus of its own.  The workloads are:
+%s""" % (", ".join(g_workloads))
+    parser = OptionParser(usage=u)
+    parser.add_option("-w", "--workloads", dest="workloads", default=",".join(g_workloads), help="comma separated workloads to run")
+    parser.add_option("-c", "--clients", dest="clients", default="1,8", help="comma separated numbers of concurrent clients")
+    parser.add_option("-d", "--duration", dest="duration", type="float", default=10.0, help="seconds each run lasts")
+    parser.add_option("--small-size", dest="small_size", type="int", default=4096, help="bytes in a small object")
+    parser.add_option("--large-size", dest="large_size", type="int", default=32*1024*1024, help="bytes in a large object")
+    parser.add_option("--keys", dest="keys", type="int", default=200, help="small objects the get and head workloads read")
+    parser.add_option("--list-keys", dest="list_keys", type="int", default=1000, help="objects in the bucket that is listed")
+    parser.add_option("--server-workers", dest="server_workers", type="int", default=1, help="cumulus worker processes")
+    parser.add_option("--log-level", dest="log_level", default="INFO", help="cumulus log level")
+    parser.add_option("--seed", dest="seed", type="int", default=1, help="random seed, the same seed makes the same requests")
+    parser.add_option("--dir", dest="dir", default=None, help="where to make the cumulus, a temp dir by default")
+    parser.add_option("--keep", dest="keep", action="store_true", default=False, help="leave the cumulus dir behind")
+    parser.add_option("-l", "--label", dest="label", default="", help="a name for this run kept with the results")
+    parser.add_option("-o", "--output", dest="output", default=None, help="json file to write the results to")
+    parser.add_option("--compare", dest="compare", default=None, help="json results of an earlier run to compare with")
+    (opts, args) = parser.parse_args(argv)
+    if len(args) != 0:
+        parser.error("unexpected arguments")
+    opts.workloads = [w.strip() for w in opts.workloads.split(",")]
+    for w in opts.workloads:
+        if w not in g_workloads:
+            parser.error("unknown workload %s" % (w))
+    opts.clients = [int(c) for c in opts.clients.split(",")]
+    return opts
+
+# pseudo random bytes, the same for the same seed
+def make_data(size, seed):
+    rnd = random.Random(seed)
+    block = "".join([chr(rnd.randint(0, 255)) for i in range(0, 65536)])
+    return (block * (size / len(block) + 1))[:size]
+
+class NullFile(object):
+    def write(self, data):
+        pass
+
+#
+#  the cumulus under test
+#
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def write_ini(dir, port, opts):
+    fname = os.path.join(dir, "cumulus.ini")
+    f = open(fname, "w")
+    f.write("""[cb]
+installdir=%(dir)s
+port=%(port)d
+hostname=localhost
+
+[backend]
+type=posix
+data_dir=%(dir)s/posixdata
+
+[security]
+type=authz
+authzdb=sqlite://%(dir)s/authz.db
+
+[log]
+level=%(level)s
+file=%(dir)s/log/cumulus.log
+""" % {'dir': dir, 'port': port, 'level': opts.log_level.upper()})
+    f.close()
+    return fname
+
+def make_db(dir):
+    if 'CUMULUS_AUTHZ_DDL' not in os.environ:
+        os.environ['CUMULUS_AUTHZ_DDL'] = os.path.join(g_here, "..", "conf", "etc", "acl.sql")
+    import pynimbusauthz.db
+    conn = pynimbusauthz.db.make_test_database(os.path.join(dir, "authz.db"))
+    conn.close()
+
+# run in the child, pycb is only imported here so its log writer is the
+# server's own
+def run_server(argv):
+    import pycb.cumulus
+    prog = pycb.cumulus.__file__
+    if prog.endswith(".pyc"):
+        prog = prog[:-1]
+    sys.exit(pycb.cumulus.main([prog] + argv))
+
+def wait_for_server(port, proc, timeout=60):
+    end = time.time() + timeout
+    while time.time() < end:
+        if not proc.is_alive():
+            raise Exception("cumulus exited with %s, see its log" % (str(proc.exitcode)))
+        try:
+            urllib2.urlopen("http://localhost:%d/?load" % (port)).read()
+            return
+        except:
+            time.sleep(0.2)
+    raise Exception("cumulus did not start in %d seconds" % (timeout))
+
+def child_pids(pid):
+    kids = []
+    for p in os.listdir("/proc"):
+        if not p.isdigit():
+            continue
+        try:
+            stat = open("/proc/%s/stat" % (p)).read()
+        except IOError:
+            continue
+        fields = stat[stat.rfind(")") + 2:].split()
+        if int(fields[1]) == pid:
+            kids.append(int(p))
+    return kids
+
+# (cpu seconds, rss bytes, peak rss bytes) of a server and its workers
+def server_usage(pid):
+    cpu = 0.0
+    rss = 0
+    peak = 0
+    for p in [pid] + child_pids(pid):
+        try:
+            stat = open("/proc/%d/stat" % (p)).read()
+            status = open("/proc/%d/status" % (p)).read()
+        except IOError:
+            continue
+        fields = stat[stat.rfind(")") + 2:].split()
+        cpu = cpu + float(int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        for l in status.split("\n"):
+            a = l.split()
+            if len(a) >= 2 and a[0] == "VmRSS:":
+                rss = rss + int(a[1]) * 1024
+            elif len(a) >= 2 and a[0] == "VmHWM:":
+                peak = peak + int(a[1]) * 1024
+    return (cpu, rss, peak)
+
+#
+#  the workloads.  setup runs once in the bench before the clients are
+#  forked, op is one request made by a client and returns the bytes moved
+#
+class Workload(object):
+
+    def __init__(self, name, opts):
+        self.name = name
+        self.opts = opts
+        self.small = make_data(opts.small_size, opts.seed)
+        self.keys = []
+        self.list_bucket = None
+        self.large_key = None
+        self.large_file = None
+
+    def setup(self, conn, bucket, dir):
+        n = self.name
+        if n in ["small_get", "head", "mixed"]:
+            self.keys = ["obj%06d" % (i) for i in range(0, self.opts.keys)]
+            for k in self.keys:
+                boto.s3.key.Key(bucket, k).set_contents_from_string(self.small)
+        if n in ["list", "mixed"]:
+            self.list_bucket = "bench-%s-list" % (n.replace("_", "-"))
+            b = conn.create_bucket(self.list_bucket)
+            for i in range(0, self.opts.list_keys):
+                boto.s3.key.Key(b, "item%06d" % (i)).set_contents_from_string("x")
+        if n in ["large_put", "large_get"]:
+            self.large_file = os.path.join(dir, "large")
+            f = open(self.large_file, "w")
+            f.write(make_data(self.opts.large_size, self.opts.seed))
+            f.close()
+            f = open(self.large_file, "r")
+            k = boto.s3.key.Key(bucket, "large")
+            self.large_md5 = k.compute_md5(f)
+            f.close()
+        if n == "large_get":
+            self.large_key = "large"
+            f = open(self.large_file, "r")
+            boto.s3.key.Key(bucket, "large").set_contents_from_file(f, md5=self.large_md5)
+            f.close()
+
+    def op(self, client, bucket, rnd, i):
+        n = self.name
+        if n == "mixed":
+            r = rnd.random()
+            if r < 0.7:
+                n = "small_get"
+            elif r < 0.9:
+                n = "small_put"
+            elif r < 0.95:
+                n = "head"
+            else:
+                n = "list"
+        if n == "small_put":
+            boto.s3.key.Key(bucket, "put%03d-%08d" % (client, i)).set_contents_from_string(self.small)
+            return len(self.small)
+        if n == "small_get":
+            data = boto.s3.key.Key(bucket, rnd.choice(self.keys)).get_contents_as_string()
+            return len(data)
+        if n == "head":
+            bucket.get_key(rnd.choice(self.keys))
+            return 0
+        if n == "list":
+            b = bucket.connection.get_bucket(self.list_bucket, validate=False)
+            count = 0
+            for k in b.list():
+                count = count + 1
+            return 0
+        if n == "large_put":
+            f = open(self.large_file, "r")
+            try:
+                boto.s3.key.Key(bucket, "large%03d" % (client)).set_contents_from_file(f, md5=self.large_md5)
+            finally:
+                f.close()
+            return self.opts.large_size
+        if n == "large_get":
+            boto.s3.key.Key(bucket, self.large_key).get_contents_to_file(NullFile())
+            return self.opts.large_size
+        raise Exception("unknown workload %s" % (n))
+
+def get_conn(port, id, pw):
+    return S3Connection(id, pw, host="localhost", port=port, is_secure=False, calling_format=OrdinaryCallingFormat())
+
+def run_client(client, workload, port, id, pw, bucketName, seed, go, deadline, results):
+    rnd = random.Random(seed * 1000 + client)
+    conn = get_conn(port, id, pw)
+    bucket = conn.get_bucket(bucketName, validate=False)
+    lat = []
+    moved = 0
+    errors = 0
+    go.wait()
+    i = 0
+    while time.time() < deadline.value:
+        start = time.time()
+        try:
+            moved = moved + workload.op(client, bucket, rnd, i)
+            lat.append(time.time() - start)
+        except Exception, ex:
+            errors = errors + 1
+        i = i + 1
+    (u, s) = os.times()[0:2]
+    results.put((lat, moved, errors, u + s))
+
+def percentile(sorted_vals, p):
+    if len(sorted_vals) == 0:
+        return None
+    ndx = int(round(p * (len(sorted_vals) - 1)))
+    return sorted_vals[ndx] * 1000.0
+
+def run_one(workload, clients, opts, port, id, pw, bucketName, server_pid):
+    go = multiprocessing.Event()
+    deadline = multiprocessing.Value('d', 0.0)
+    results = multiprocessing.Queue()
+    procs = []
+    for c in range(0, clients):
+        p = multiprocessing.Process(target=run_client, args=(c, workload, port, id, pw, bucketName, opts.seed, go, deadline, results))
+        p.start()
+        procs.append(p)
+    # give the clients time to connect before the clock starts
+    time.sleep(0.5)
+    (cpu0, rss0, peak0) = server_usage(server_pid)
+    start = time.time()
+    deadline.value = start + opts.duration
+    go.set()
+    lat = []
+    moved = 0
+    errors = 0
+    client_cpu = 0.0
+    for p in procs:
+        (l, m, e, c) = results.get()
+        lat.extend(l)
+        moved = moved + m
+        errors = errors + e
+        client_cpu = client_cpu + c
+    took = time.time() - start
+    (cpu1, rss1, peak1) = server_usage(server_pid)
+    for p in procs:
+        p.join()
+
+    lat.sort()
+    ops = len(lat)
+    server_cpu = cpu1 - cpu0
+    r = {
+        'workload': workload.name,
+        'clients': clients,
+        'ops': ops,
+        'errors': errors,
+        'seconds': took,
+        'ops_per_sec': ops / took,
+        'mb_per_sec': moved / took / (1024.0 * 1024.0),
+        'latency_ms': {
+            'p50': percentile(lat, 0.50),
+            'p90': percentile(lat, 0.90),
+            'p99': percentile(lat, 0.99),
+            'max': percentile(lat, 1.0),
+            'mean': (sum(lat) / ops * 1000.0) if ops > 0 else None,
+        },
+        'server_cpu_s': server_cpu,
+        'server_cpu_ms_per_op': (server_cpu / ops * 1000.0) if ops > 0 else None,
+        'server_rss_mb': rss1 / (1024.0 * 1024.0),
+        'server_peak_rss_mb': peak1 / (1024.0 * 1024.0),
+        'client_cpu_s': client_cpu,
+    }
+    return r
+
+def git(args):
+    p = subprocess.Popen(["git"] + args, cwd=g_here, stdout=subprocess.PIPE, stderr=open(os.devnull, "w"))
+    out = p.communicate()[0].strip()
+    if p.returncode != 0:
+        raise OSError("git %s failed" % (" ".join(args)))
+    return out
+
+# what was measured, with -dirty when the tree has changes of its own
+def git_commit():
+    try:
+        commit = git(["rev-parse", "HEAD"])
+        if git(["status", "--porcelain", "--untracked-files=no", "--", ".."]) != "":
+            commit = commit + "-dirty"
+        return commit
+    except OSError:
+        return None
+
+def print_result(r):
+    l = r['latency_ms']
+    print "%-10s %4d clients %8.1f ops/s %8.2f MB/s  p50 %7.2f p99 %8.2f ms  cpu %6.3f ms/op  rss %6.1f MB  errors %d" % (r['workload'], r['clients'], r['ops_per_sec'], r['mb_per_sec'], l['p50'] or 0, l['p99'] or 0, r['server_cpu_ms_per_op'] or 0, r['server_rss_mb'], r['errors'])
+
+def compare(old_file, results):
+    old = json.load(open(old_file))
+    before = {}
+    for r in old['results']:
+        before[(r['workload'], r['clients'])] = r
+    print
+    print "compared with %s (%s)" % (old_file, old['meta'].get('label') or old['meta'].get('commit'))
+    for r in results:
+        o = before.get((r['workload'], r['clients']))
+        if o == None or o['ops_per_sec'] == 0:
+            continue
+        tput = (r['ops_per_sec'] / o['ops_per_sec'] - 1.0) * 100.0
+        p99 = ""
+        if o['latency_ms']['p99'] and r['latency_ms']['p99']:
+            p99 = "%+7.1f%%" % ((r['latency_ms']['p99'] / o['latency_ms']['p99'] - 1.0) * 100.0)
+        cpu = ""
+        if o['server_cpu_ms_per_op'] and r['server_cpu_ms_per_op']:
+            cpu = "%+7.1f%%" % ((r['server_cpu_ms_per_op'] / o['server_cpu_ms_per_op'] - 1.0) * 100.0)
+        print "%-10s %4d clients  ops/s %+7.1f%%  p99 %8s  cpu/op %8s" % (r['workload'], r['clients'], tput, p99, cpu)
+
+def main(argv=sys.argv[1:]):
+    opts = setup_options(argv)
+    dir = opts.dir
+    if dir == None:
+        dir = tempfile.mkdtemp(prefix="cumulus-bench-")
+    else:
+        dir = os.path.abspath(dir)
+    for d in ["log", "posixdata", "etc"]:
+        try:
+            os.makedirs(os.path.join(dir, d))
+        except OSError, ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+    port = free_port()
+    os.environ['CUMULUS_SETTINGS_FILE'] = write_ini(dir, port, opts)
+    make_db(dir)
+    argv = ["-p", str(port)]
+    if opts.server_workers > 1:
+        argv = argv + ["-w", str(opts.server_workers)]
+    server = multiprocessing.Process(target=run_server, args=(argv,))
+    server.start()
+    results = []
+    try:
+        wait_for_server(port, server)
+        # the server is running with a pycb of its own, this one is only
+        # used to make the user
+        import pycb
+        id = "benchuser%d" % (os.getpid())
+        pw = "benchpassword%d" % (opts.seed)
+        pycb.config.auth.create_user("bench@cumulus", id, pw, None)
+        conn = get_conn(port, id, pw)
+
+        for w in opts.workloads:
+            bucketName = "bench-%s" % (w.replace("_", "-"))
+            bucket = conn.create_bucket(bucketName)
+            workload = Workload(w, opts)
+            workload.setup(conn, bucket, dir)
+            for c in opts.clients:
+                r = run_one(workload, c, opts, port, id, pw, bucketName, server.pid)
+                print_result(r)
+                results.append(r)
+    finally:
+        os.kill(server.pid, signal.SIGTERM)
+        server.join(60)
+        if server.is_alive():
+            server.terminate()
+        if not opts.keep:
+            shutil.rmtree(dir, True)
+
+    out = {
+        'meta': {
+            'label': opts.label,
+            'commit': git_commit(),
+            'time': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'cpus': multiprocessing.cpu_count(),
+            'options': {
+                'duration': opts.duration,
+                'small_size': opts.small_size,
+                'large_size': opts.large_size,
+                'keys': opts.keys,
+                'list_keys': opts.list_keys,
+                'server_workers': opts.server_workers,
+                'log_level': opts.log_level,
+                'seed': opts.seed,
+            },
+        },
+        'results': results,
+    }
+    if opts.output != None:
+        f = open(opts.output, "w")
+        json.dump(out, f, indent=2, sort_keys=True)
+        f.write("\n")
+        f.close()
+    if opts.compare != None:
+        compare(opts.compare, results)
+    return 0
+
+if __name__ == "__main__":
+    rc = main()
+    sys.exit(rc)
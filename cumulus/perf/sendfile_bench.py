@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+#
+#  download throughput and cpu cost of GETs.  run it once against a
+#  server with sendfile=True in the [cb] section of cumulus.ini and once
+#  with sendfile=False to compare the zero copy path with FileSender.
+#
+#  usage: sendfile_bench.py <label> <sizeMB> <downloads> [<server pid>]
+#
+#  the server pid is used to read the server cpu time from /proc, without
+#  it only the client side is reported.
+#
+import os
+import sys
+import string
+import random
+import time
+import boto
+from boto.s3.connection import S3Connection
+from boto.s3.connection import OrdinaryCallingFormat
+from ConfigParser import SafeConfigParser
+
+def cb_get_conn(s):
+    cf = OrdinaryCallingFormat()
+    hostname = s.get("cb", "hostname")
+    p = int(s.get("cb", "port"))
+    pw = s.get("tests", "pw")
+    id = s.get("tests", "id")
+    return S3Connection(id, pw, host=hostname, port=p, is_secure=False, calling_format=cf)
+
+def random_name(len):
+    chars = string.letters.lower() + string.digits
+    return "".join([random.choice(chars) for i in range(len)])
+
+# seconds of cpu used by pid so far
+def proc_cpu(pid):
+    if pid == None:
+        return 0.0
+    f = open("/proc/%d/stat" % (pid), "r")
+    fields = f.read().rsplit(")", 1)[1].split()
+    f.close()
+    ticks = int(fields[11]) + int(fields[12])
+    return float(ticks) / float(os.sysconf("SC_CLK_TCK"))
+
+class NullFile(object):
+    def write(self, data):
+        pass
+
+def main():
+    settings = os.environ.get('CUMULUS_SETTINGS_FILE', os.path.expanduser('~/.nimbus/cumulus.ini'))
+    s = SafeConfigParser()
+    s.readfp(open(settings, "r"))
+
+    label = sys.argv[1]
+    size_mb = int(sys.argv[2])
+    count = int(sys.argv[3])
+    pid = None
+    if len(sys.argv) > 4:
+        pid = int(sys.argv[4])
+
+    conn = cb_get_conn(s)
+    bucket = conn.create_bucket(random_name(20))
+    k = boto.s3.key.Key(bucket)
+    k.key = random_name(10)
+    f = open("/dev/urandom", "r")
+    k.set_contents_from_string(f.read(size_mb*1024*1024))
+    f.close()
+
+    try:
+        s_cpu = proc_cpu(pid)
+        c_cpu = os.times()
+        start_tm = time.time()
+        for i in range(0, count):
+            k.get_contents_to_file(NullFile())
+        tm = time.time() - start_tm
+        end_c_cpu = os.times()
+        s_cpu = proc_cpu(pid) - s_cpu
+        c_cpu = (end_c_cpu[0] - c_cpu[0]) + (end_c_cpu[1] - c_cpu[1])
+    finally:
+        k.delete()
+        bucket.delete()
+
+    total_mb = size_mb * count
+    total_gb = float(total_mb) / 1024.0
+    print "label,sizeMB,downloads,totalMB,totaltime,MBps,serverCPUperGB,clientCPUperGB"
+    print "%s,%d,%d,%d,%f,%f,%f,%f" % (label, size_mb, count, total_mb, tm, float(total_mb) / tm, s_cpu / total_gb, c_cpu / total_gb)
+
+if __name__ == "__main__":
+    rc = main()
+    sys.exit(rc)
@@ -0,0 +1,97 @@
+import os
+import time
+import json
+import shutil
+import logging
+import tempfile
+import boto
+import pycb
+import pycb.test_common
+from pycb.cbLog import cbAsyncHandler, cbAccessFormatter, make_file_handler
+import unittest
+
+class TestAsyncHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, "log")
+        self.logger = logging.getLogger("cumulus_test_%s" % (os.path.basename(self.dir)))
+        self.logger.propagate = False
+        self.handler = make_file_handler(self.fname)
+        self.handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+        shutil.rmtree(self.dir)
+
+    def test_write(self):
+        d = {'a': 1}
+        self.logger.info("one %s", d)
+        # the message was made when it was logged
+        d['a'] = 2
+        self.logger.debug("not logged %s", d)
+        try:
+            raise Exception("oops")
+        except:
+            self.logger.exception("two")
+        self.handler.close()
+        lines = open(self.fname).read().split("\n")
+        self.assertEqual(lines[0], "INFO one {'a': 1}")
+        self.assertEqual(lines[1], "ERROR two")
+        self.assertEqual(lines[2], "Traceback (most recent call last):")
+        self.assertTrue("not logged" not in "".join(lines))
+
+    def test_access_format(self):
+        self.handler.setFormatter(cbAccessFormatter())
+        self.logger.info({'method': 'GET', 'status': 200})
+        self.handler.close()
+        entry = json.loads(open(self.fname).readline())
+        self.assertEqual(entry['method'], 'GET')
+        self.assertEqual(entry['status'], 200)
+        self.assertTrue(entry['time'].endswith('Z'))
+
+class TestAccessLog(unittest.TestCase):
+
+    def setUp(self):
+        (self.host, self.port) = pycb.test_common.get_contact()
+        (self.id, self.pw) = pycb.test_common.make_user()
+
+    def tearDown(self):
+        pycb.test_common.clean_user(self.id)
+
+    def find(self, bucketName, count):
+        end = time.time() + 10
+        while time.time() < end:
+            entries = []
+            for l in open(pycb.config.access_filename).readlines():
+                entry = json.loads(l)
+                if entry['bucket'] == bucketName:
+                    entries.append(entry)
+            if len(entries) >= count:
+                return entries
+            time.sleep(0.2)
+        self.fail("%d entries for %s not found" % (count, bucketName))
+
+    def test_entries(self):
+        conn = pycb.test_common.cb_get_conn(self.host, self.port, self.id, self.pw)
+        bucketName = pycb.test_common.random_string(20).lower()
+        bucket = conn.create_bucket(bucketName)
+        k = boto.s3.key.Key(bucket)
+        k.key = "key"
+        k.set_contents_from_string("some data")
+        self.assertEqual(k.get_contents_as_string(), "some data")
+        k.delete()
+        bucket.delete()
+
+        entries = self.find(bucketName, 5)
+        ops = [(e['method'], e['key'], e['status']) for e in entries]
+        self.assertEqual(ops, [('PUT', None, 200), ('PUT', 'key', 200), ('GET', 'key', 200), ('DELETE', 'key', 204), ('DELETE', None, 204)])
+        self.assertEqual(entries[1]['bytes_in'], 9)
+        self.assertEqual(entries[2]['bytes_out'], 9)
+        for e in entries:
+            self.assertEqual(e['user'], self.id)
+            self.assertNotEqual(e['id'], None)
+            self.assertTrue(e['ms'] >= 0)
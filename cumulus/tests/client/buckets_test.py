@@ -104,6 +104,45 @@ class TestBucketsWithBoto(unittest.TestCase):
 
         buckets = conn.get_all_buckets()
 
+    def test_list_paging(self):
+        conn = pycb.test_common.cb_get_conn(self.host, self.port, self.id, self.pw)
+        (bucketname,bucket) = self.create_bucket(conn)
+
+        names = ["a/1", "a/2", "b", "c/x/1", "c/y", "d"]
+        for n in names:
+            k = boto.s3.key.Key(bucket)
+            k.key = n
+            k.set_contents_from_string(n)
+
+        rs = bucket.get_all_keys(max_keys=4)
+        self.assertTrue(rs.is_truncated)
+        self.assertEqual([k.name for k in rs], names[:4])
+        rs = bucket.get_all_keys(marker=names[3])
+        self.assertFalse(rs.is_truncated)
+        self.assertEqual([k.name for k in rs], names[4:])
+
+        # the schema has IsTruncated and NextMarker before the keys
+        r = conn.make_request("GET", bucketname, query_args="max-keys=4")
+        body = r.read()
+        self.assertTrue(body.find("<NextMarker>") < body.find("<MaxKeys>"), body)
+        self.assertTrue(body.find("<IsTruncated>true") < body.find("<Contents>"), body)
+
+        # boto follows the markers itself
+        self.assertEqual([k.name for k in bucket.list()], names)
+
+        # keys come back before the common prefixes
+        rs = bucket.get_all_keys(delimiter="/")
+        self.assertEqual(sorted([k.name for k in rs]), ["a/", "b", "c/", "d"])
+        rs = bucket.get_all_keys(delimiter="/", max_keys=1)
+        self.assertTrue(rs.is_truncated)
+        self.assertEqual([k.name for k in rs], ["a/"])
+        rs = bucket.get_all_keys(delimiter="/", marker="a/")
+        self.assertEqual(sorted([k.name for k in rs]), ["b", "c/", "d"])
+        rs = bucket.get_all_keys(prefix="c/", delimiter="/")
+        self.assertEqual(sorted([k.name for k in rs]), ["c/x/", "c/y"])
+        rs = bucket.get_all_keys(prefix="c/")
+        self.assertEqual([k.name for k in rs], ["c/x/1", "c/y"])
+
     def test_simple_bucket(self):
         conn = pycb.test_common.cb_get_conn(self.host, self.port, self.id, self.pw)
         (bucketname,bucket) = self.create_bucket(conn)
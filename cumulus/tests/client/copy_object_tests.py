@@ -73,6 +73,27 @@ class TestCopyObjectAuthWithBoto(unittest.TestCase):
         rc = filecmp.cmp("/etc/group", filename)
         self.assertTrue(rc)
 
+    def test_copy_keeps_data_and_etag(self):
+        (id, pw) = self.make_user()
+        conn = pycb.test_common.cb_get_conn(self.host, self.port, id, pw)
+        bucket = conn.create_bucket(self.cb_random_bucketname(20))
+        k = boto.s3.key.Key(bucket)
+        k.key = self.cb_random_bucketname(20)
+        k.set_contents_from_filename("/etc/group")
+        etag = bucket.get_key(k.key).etag
+
+        # a new key and then over the top of an existing one
+        new_key = self.cb_random_bucketname(20)
+        for i in range(0, 2):
+            k.copy(bucket.name, new_key)
+            new_k = bucket.get_key(new_key)
+            self.assertEqual(new_k.etag, etag)
+
+        # the copy does not depend on the source
+        k.delete()
+        data = new_k.get_contents_as_string()
+        self.assertEqual(data, open("/etc/group").read())
+
     def cp_object_perm_read(self, type, delete=False):
         (id, pw) = self.make_user()
         conn = pycb.test_common.cb_get_conn(self.host, self.port, id, pw)
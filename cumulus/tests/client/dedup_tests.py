@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import hashlib
+import pycb
+import pycb.tools.dedup
+from pycb.cbPosixBackend import cbPosixBackend
+from pycb.cbPosixBackend import cas_path
+import unittest
+
+# these talk to the posix backend directly, no server is needed
+class TestDedupBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.backend = cbPosixBackend(self.dir, dedup=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def put(self, data, backend=None):
+        if backend == None:
+            backend = self.backend
+        obj = backend.put_object("bucket", "key")
+        obj.write(data)
+        obj.set_delete_on_close(False)
+        obj.close()
+        return obj.get_data_key()
+
+    def blob(self, data):
+        return cas_path(self.backend.cas_dir, hashlib.sha256(data).hexdigest())
+
+    def test_shared(self):
+        k1 = self.put("some data")
+        k2 = self.put("some data")
+        k3 = self.put("other data")
+        self.assertNotEqual(k1, k2)
+        self.assertTrue(os.path.samefile(k1, k2))
+        self.assertFalse(os.path.samefile(k1, k3))
+        self.assertEqual(os.stat(self.blob("some data")).st_nlink, 3)
+        self.assertEqual(open(k2).read(), "some data")
+
+        self.backend.delete_object(k1)
+        self.assertEqual(open(k2).read(), "some data")
+        self.assertTrue(os.path.exists(self.blob("some data")))
+        self.backend.delete_object(k2)
+        self.assertFalse(os.path.exists(self.blob("some data")))
+        self.assertTrue(os.path.exists(self.blob("other data")))
+
+    def test_md5_kept(self):
+        k1 = self.put("some data")
+        k2 = self.put("some data")
+        obj = self.backend.get_object(k2)
+        self.assertEqual(obj.get_md5(), hashlib.md5("some data").hexdigest())
+        obj.close()
+
+    def test_copy_and_join(self):
+        k1 = self.put("onetwo")
+        k2 = self.backend.copy_object(k1, "bucket", "copy", hashlib.md5("onetwo").hexdigest()).get_data_key()
+        self.assertTrue(os.path.samefile(k1, k2))
+
+        p1 = self.put("one")
+        p2 = self.put("two")
+        obj = self.backend.join_objects("bucket", "joined", [p1, p2])
+        obj.set_md5("x")
+        obj.set_delete_on_close(False)
+        obj.close()
+        self.assertTrue(os.path.samefile(k1, obj.get_data_key()))
+
+        for k in [k1, k2, p1, p2, obj.get_data_key()]:
+            self.backend.delete_object(k)
+        for d in os.listdir(self.backend.cas_dir):
+            self.assertEqual(os.listdir(os.path.join(self.backend.cas_dir, d)), [])
+
+    def test_migrate(self):
+        plain = cbPosixBackend(self.dir)
+        keys = [self.put("some data", plain) for i in range(0, 3)]
+        self.assertFalse(os.path.samefile(keys[0], keys[1]))
+
+        old = pycb.config.bucket
+        out = os.path.join(self.dir, "out")
+        pycb.config.bucket = plain
+        try:
+            rc = pycb.tools.dedup.main(["--migrate", "--batch", "-O", out])
+        finally:
+            pycb.config.bucket = old
+        self.assertEqual(rc, 0)
+        self.assertTrue(os.path.samefile(keys[0], keys[1]))
+        self.assertTrue(os.path.samefile(keys[0], keys[2]))
+        self.assertEqual(open(keys[2]).read(), "some data")
+        # blobs, objects, stored, size of the objects, saved
+        vals = open(out).read().strip().split(",")
+        self.assertEqual(vals[:5], ["1", "3", "9", "27", "18"])
@@ -0,0 +1,70 @@
+import os
+import time
+import socket
+import httplib
+import pycb
+from pycb.cbRedirector import g_load_path
+import unittest
+
+# the server these run against has the default keepalive settings
+class TestKeepAlive(unittest.TestCase):
+
+    def setUp(self):
+        self.host = os.environ.get('CUMULUS_TEST_HOST', 'localhost')
+        self.port = int(os.environ.get('CUMULUS_TEST_PORT', '8888'))
+        self.conn = httplib.HTTPConnection(self.host, self.port)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def get(self, path, headers={}):
+        self.conn.request("GET", path, headers=headers)
+        r = self.conn.getresponse()
+        body = r.read()
+        return (r, body)
+
+    def test_reuse(self):
+        self.conn.connect()
+        sock = self.conn.sock
+        for i in range(0, 5):
+            (r, body) = self.get(g_load_path)
+            self.assertEqual(r.status, 200)
+            self.assertEqual(r.getheader('connection'), None)
+            self.assertTrue(self.conn.sock is sock)
+
+    def test_error(self):
+        self.conn.connect()
+        sock = self.conn.sock
+        (r, body) = self.get("/nosuchbucket/key", {'Authorization': 'AWS nosuchuser:bad'})
+        self.assertEqual(r.status, 403)
+        self.assertEqual(int(r.getheader('content-length')), len(body))
+        self.assertTrue(body.find("AccessDenied") > 0)
+        # the error did not cost the connection
+        (r, body) = self.get(g_load_path)
+        self.assertEqual(r.status, 200)
+        self.assertTrue(self.conn.sock is sock)
+
+    def test_request_cap(self):
+        limit = pycb.config.keepalive_requests
+        for i in range(0, limit - 1):
+            (r, body) = self.get(g_load_path)
+            self.assertEqual(r.getheader('connection'), None)
+        (r, body) = self.get(g_load_path)
+        self.assertEqual(r.getheader('connection'), 'close')
+        self.assertEqual(self.conn.sock, None)
+
+    def test_pipelined(self):
+        s = socket.create_connection((self.host, self.port))
+        try:
+            req = "GET %s HTTP/1.1\r\nHost: %s\r\n\r\n" % (g_load_path, self.host)
+            s.sendall(req * 3)
+            data = ""
+            end = time.time() + 10
+            while data.count("cumulus_connections") < 3 and time.time() < end:
+                d = s.recv(65536)
+                if d == "":
+                    break
+                data = data + d
+            self.assertEqual(data.count("HTTP/1.1 200"), 3)
+        finally:
+            s.close()
@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import pycb
+import pycb.tools.relayout
+from pycb.cbPosixBackend import cbPosixBackend
+from pycb.cbAuthzSecurity import cbAuthzSec
+import pynimbusauthz
+from pynimbusauthz.db import DB
+from pynimbusauthz.user import User
+from pynimbusauthz.objects import File
+import unittest
+
+# these talk to the posix backend and a db of their own, no server is needed
+class TestDataLayout(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.dir, "authz.db")
+        pynimbusauthz.db.make_test_database(self.dbfile)
+        self.db = DB(con_str=self.dbfile)
+        self.user = User(self.db)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def put(self, backend, key, data):
+        obj = backend.put_object("bucket", key)
+        obj.write(data)
+        obj.set_delete_on_close(False)
+        obj.close()
+        data_key = obj.get_data_key()
+        File.create_file(self.db, key, self.user, data_key, pynimbusauthz.object_type_s3)
+        self.db.commit()
+        return data_key
+
+    def relayout(self, backend, argv=[]):
+        old = (pycb.config.bucket, pycb.config.auth)
+        pycb.config.bucket = backend
+        pycb.config.auth = cbAuthzSec(self.dbfile)
+        try:
+            return pycb.tools.relayout.main(["-q"] + argv)
+        finally:
+            (pycb.config.bucket, pycb.config.auth) = old
+
+    def test_hashed(self):
+        backend = cbPosixBackend(self.dir, layout=2, fanout=3)
+        k1 = backend.new_data_key("bucket", "key")
+        k2 = backend.new_data_key("bucket", "key")
+        rel = os.path.relpath(k1, self.dir).split(os.sep)
+        self.assertEqual(len(rel), 4)
+        self.assertTrue(rel[3].endswith("bucket__key"))
+        self.assertTrue(backend.in_layout(k1))
+        # the same name does not always land in the same directory
+        keys = [os.path.dirname(backend.new_data_key("bucket", "key")) for i in range(0, 20)]
+        self.assertTrue(len(set(keys)) > 1)
+
+        plain = cbPosixBackend(self.dir)
+        k3 = plain.new_data_key("bucket", "key")
+        self.assertEqual(os.path.dirname(k3), os.path.join(self.dir, "b"))
+        self.assertTrue(plain.in_layout(k3))
+        self.assertFalse(plain.in_layout(k1))
+        self.assertFalse(backend.in_layout(k3))
+        self.assertFalse(backend.in_layout("/elsewhere/b/x"))
+
+    def test_relayout(self):
+        plain = cbPosixBackend(self.dir)
+        keys = [self.put(plain, "key%d" % (i), "data %d" % (i)) for i in range(0, 5)]
+        # one object is removed behind the db's back
+        plain.delete_object(keys[4])
+
+        hashed = cbPosixBackend(self.dir, layout=2)
+        rc = self.relayout(hashed, ["--commit", "2"])
+        self.assertEqual(rc, 0)
+        for i in range(0, 4):
+            f = File.get_file(self.db, "key%d" % (i), pynimbusauthz.object_type_s3)
+            new_key = f.get_data_key()
+            self.assertTrue(hashed.in_layout(new_key), new_key)
+            self.assertFalse(os.path.exists(keys[i]))
+            obj = hashed.get_object(new_key)
+            self.assertEqual(obj.read(100), "data %d" % (i))
+            self.assertNotEqual(obj.get_md5(), None)
+            obj.close()
+        self.assertEqual(os.listdir(os.path.join(self.dir, "b")), [])
+
+        # nothing left to do
+        out = os.path.join(self.dir, "out")
+        rc = self.relayout(hashed, ["--batch", "-O", out])
+        self.assertEqual(rc, 0)
+        self.assertEqual(open(out).read().strip(), "0")
+
+    def test_relink_again(self):
+        plain = cbPosixBackend(self.dir)
+        k = self.put(plain, "key", "data")
+        hashed = cbPosixBackend(self.dir, layout=2)
+        # a link left by a run that never committed is reused
+        n1 = hashed.relink_data(k)
+        n2 = hashed.relink_data(k)
+        self.assertEqual(n1, n2)
+        self.assertTrue(os.path.samefile(k, n1))
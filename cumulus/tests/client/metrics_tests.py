@@ -0,0 +1,105 @@
+import os
+import json
+import urllib2
+import boto
+import pycb
+import pycb.test_common
+from pycb.cbMetrics import cbMetrics, g_metrics_path
+import unittest
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        m = cbMetrics()
+        m.describe("x_total", "some x")
+        m.inc("x_total", (("op", "a"),))
+        m.inc("x_total", (("op", "a"),), 2)
+        m.inc("x_total", (("op", 'b"'),))
+        for v in [0.0001, 0.003, 0.003, 100]:
+            m.observe("x_seconds", (("op", "a"),), v)
+        lines = m.render().split("\n")
+        self.assertTrue("# HELP x_total some x" in lines)
+        self.assertTrue("# TYPE x_total counter" in lines)
+        self.assertTrue('x_total{op="a"} 3' in lines)
+        self.assertTrue('x_total{op="b\\""} 1' in lines)
+        self.assertTrue("# TYPE x_seconds histogram" in lines)
+        self.assertTrue('x_seconds_bucket{op="a",le="0.0005"} 1' in lines)
+        self.assertTrue('x_seconds_bucket{op="a",le="0.005"} 3' in lines)
+        self.assertTrue('x_seconds_bucket{op="a",le="60.0"} 3' in lines)
+        self.assertTrue('x_seconds_bucket{op="a",le="+Inf"} 4' in lines)
+        self.assertTrue('x_seconds_count{op="a"} 4' in lines)
+
+    def test_merge(self):
+        m = cbMetrics()
+        m.inc("x_total", (("op", "a"),), 2)
+        m.observe("x_seconds", (("op", "a"),), 0.003)
+        m2 = cbMetrics()
+        m2.inc("x_total", (("op", "a"),))
+        m2.inc("y_total")
+        m2.observe("x_seconds", (("op", "a"),), 100)
+        total = cbMetrics()
+        for x in [m, m2]:
+            total.merge(json.loads(json.dumps(x.snapshot())))
+        lines = total.render().split("\n")
+        self.assertTrue('x_total{op="a"} 3' in lines)
+        self.assertTrue('y_total 1' in lines)
+        self.assertTrue('x_seconds_bucket{op="a",le="0.005"} 1' in lines)
+        self.assertTrue('x_seconds_count{op="a"} 2' in lines)
+
+# name{labels} -> value of the prometheus text format
+def parse_metrics(body):
+    values = {}
+    for l in body.split("\n"):
+        if l == "" or l[0] == "#":
+            continue
+        (k, v) = l.rsplit(" ", 1)
+        values[k] = float(v)
+    return values
+
+class TestMetricsPath(unittest.TestCase):
+
+    def setUp(self):
+        (self.host, self.port) = pycb.test_common.get_contact()
+        (self.id, self.pw) = pycb.test_common.make_user()
+
+    def tearDown(self):
+        pycb.test_common.clean_user(self.id)
+
+    # on the admin port, see metrics_port in cumulus_tests.ini
+    def scrape(self):
+        url = "http://%s:%d%s" % (pycb.config.metrics_address, pycb.config.metrics_port, g_metrics_path)
+        return parse_metrics(urllib2.urlopen(url).read())
+
+    def test_not_public(self):
+        # it is just an s3 request without a signature there
+        try:
+            body = urllib2.urlopen("http://%s:%d/?metrics" % (self.host, self.port)).read()
+            self.assertFalse("cumulus_requests_total" in body)
+        except urllib2.HTTPError, ex:
+            self.assertFalse("cumulus_requests_total" in ex.read())
+
+    def test_counts(self):
+        before = self.scrape()
+        conn = pycb.test_common.cb_get_conn(self.host, self.port, self.id, self.pw)
+        bucketName = pycb.test_common.random_string(20).lower()
+        bucket = conn.create_bucket(bucketName)
+        k = boto.s3.key.Key(bucket)
+        k.key = "key"
+        k.set_contents_from_string("some data")
+        self.assertEqual(k.get_contents_as_string(), "some data")
+        k.delete()
+        bucket.delete()
+        after = self.scrape()
+
+        def grew(name, n=1):
+            self.assertEqual(after.get(name, 0) - before.get(name, 0), n, name)
+        grew('cumulus_requests_total{op="PutObject",status="200"}')
+        grew('cumulus_requests_total{op="GetObject",status="200"}')
+        grew('cumulus_requests_total{op="DeleteObject",status="204"}')
+        grew('cumulus_request_bytes_in_total{op="PutObject"}', 9)
+        grew('cumulus_request_bytes_out_total{op="GetObject"}', 9)
+        grew('cumulus_request_seconds_count{op="PutBucket"}')
+        for phase in ["auth", "db", "backend"]:
+            name = 'cumulus_phase_seconds_count{phase="%s"}' % (phase)
+            self.assertTrue(after[name] > before.get(name, 0), name)
+        self.assertTrue("cumulus_connections" in after)
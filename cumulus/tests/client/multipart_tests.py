@@ -0,0 +1,168 @@
+import os
+import sys
+import hashlib
+import threading
+import StringIO
+import boto
+from boto.exception import S3ResponseError
+import pycb
+import pycb.test_common
+import unittest
+
+class TestMultipartWithBoto(unittest.TestCase):
+
+    def setUp(self):
+        (self.host, self.port) = pycb.test_common.get_contact()
+        (self.id, self.pw) = pycb.test_common.make_user()
+        self.conn = pycb.test_common.cb_get_conn(self.host, self.port, self.id, self.pw)
+        self.bucketname = pycb.test_common.random_string(20).lower()
+        self.bucket = self.conn.create_bucket(self.bucketname)
+        self.keyname = pycb.test_common.random_string(20)
+
+    def tearDown(self):
+        for key in self.bucket.list():
+            key.delete()
+        self.bucket.delete()
+        pycb.test_common.clean_user(self.id)
+
+    def part_data(self, n, size):
+        return (chr(ord('a') + n) * size)
+
+    def upload(self, mp, n, data):
+        mp.upload_part_from_file(StringIO.StringIO(data), n)
+
+    def test_multipart(self):
+        big = 5 * 1024 * 1024
+        datas = [self.part_data(1, big), self.part_data(2, big), self.part_data(3, 1000)]
+        mp = self.bucket.initiate_multipart_upload(self.keyname)
+        # the parts go up at the same time on connections of their own
+        threads = []
+        for i in range(0, len(datas)):
+            conn = pycb.test_common.cb_get_conn(self.host, self.port, self.id, self.pw)
+            b = conn.get_bucket(self.bucketname, validate=False)
+            mp2 = boto.s3.multipart.MultiPartUpload(b)
+            mp2.id = mp.id
+            mp2.key_name = self.keyname
+            t = threading.Thread(target=self.upload, args=(mp2, i + 1, datas[i]))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        parts = mp.get_all_parts()
+        self.assertEqual([p.part_number for p in parts], [1, 2, 3])
+        self.assertEqual(parts[0].size, big)
+        self.assertEqual(parts[2].etag, '"%s"' % (hashlib.md5(datas[2]).hexdigest()))
+
+        mp.complete_upload()
+        k = self.bucket.get_key(self.keyname)
+        m = hashlib.md5()
+        for d in datas:
+            m.update(hashlib.md5(d).digest())
+        self.assertEqual(k.etag, '"%s-3"' % (m.hexdigest()))
+        self.assertEqual(k.size, len("".join(datas)))
+        self.assertEqual(k.get_contents_as_string(), "".join(datas))
+
+        # the upload is gone once it is complete
+        try:
+            mp.cancel_upload()
+            self.fail("the upload should be over")
+        except S3ResponseError, ex:
+            self.assertEqual(ex.status, 404)
+
+    def test_replace_part(self):
+        mp = self.bucket.initiate_multipart_upload(self.keyname)
+        self.upload(mp, 1, "first")
+        self.upload(mp, 1, "second")
+        parts = mp.get_all_parts()
+        self.assertEqual(len(parts), 1)
+        self.assertEqual(parts[0].etag, '"%s"' % (hashlib.md5("second").hexdigest()))
+        mp.complete_upload()
+        k = self.bucket.get_key(self.keyname)
+        self.assertEqual(k.get_contents_as_string(), "second")
+
+    def test_cancel(self):
+        mp = self.bucket.initiate_multipart_upload(self.keyname)
+        self.upload(mp, 1, "some data")
+        mp.cancel_upload()
+        self.assertEqual(self.bucket.get_key(self.keyname), None)
+        try:
+            mp.cancel_upload()
+            self.fail("the upload should be gone")
+        except S3ResponseError, ex:
+            self.assertEqual(ex.status, 404)
+        # only works if the server shares this file system
+        base = pycb.config.bucket.base_dir
+        left = [f for (d, ds, fs) in os.walk(base) for f in fs if self.keyname in f]
+        self.assertEqual(left, [])
+
+    def test_too_small(self):
+        mp = self.bucket.initiate_multipart_upload(self.keyname)
+        self.upload(mp, 1, "small")
+        self.upload(mp, 2, "parts")
+        try:
+            mp.complete_upload()
+            self.fail("the parts are too small")
+        except S3ResponseError, ex:
+            self.assertEqual(ex.status, 400)
+            self.assertTrue('EntityTooSmall' in ex.body)
+        mp.cancel_upload()
+
+    def test_bad_parts(self):
+        mp = self.bucket.initiate_multipart_upload(self.keyname)
+        self.upload(mp, 1, "data")
+        etag = '"%s"' % (hashlib.md5("data").hexdigest())
+        bad = [("<Part><PartNumber>2</PartNumber><ETag>%s</ETag></Part>" % (etag), 'InvalidPart'),
+               ("<Part><PartNumber>1</PartNumber><ETag>\"0123\"</ETag></Part>", 'InvalidPart'),
+               ("<Part><PartNumber>1</PartNumber><ETag>%s</ETag></Part>" % (etag) * 2, 'InvalidPartOrder'),
+               ("<Part>", 'MalformedXML')]
+        for (parts, code) in bad:
+            xml = "<CompleteMultipartUpload>%s</CompleteMultipartUpload>" % (parts)
+            try:
+                self.bucket.complete_multipart_upload(self.keyname, mp.id, xml)
+                self.fail("%s should not have completed" % (xml))
+            except S3ResponseError, ex:
+                self.assertEqual(ex.status, 400)
+                self.assertTrue(code in ex.body, ex.body)
+        mp.cancel_upload()
+
+    def test_no_such_upload(self):
+        mp = self.bucket.initiate_multipart_upload(self.keyname)
+        mp2 = boto.s3.multipart.MultiPartUpload(self.bucket)
+        mp2.id = mp.id
+        mp2.key_name = self.keyname + "x"
+        try:
+            self.upload(mp2, 1, "data")
+            self.fail("the upload is of another key")
+        except S3ResponseError, ex:
+            self.assertEqual(ex.status, 404)
+        mp.cancel_upload()
+
+    def test_unfinished_upload(self):
+        mp = self.bucket.initiate_multipart_upload(self.keyname)
+        self.upload(mp, 1, "some data")
+        # deleting the bucket in tearDown takes the upload with it
+        self.assertEqual(len(list(self.bucket.list())), 0)
+
+    def test_part_quota(self):
+        pycb.test_common.set_user_quota(self.id, 1500)
+        mp = self.bucket.initiate_multipart_upload(self.keyname)
+        self.upload(mp, 1, self.part_data(1, 1000))
+        try:
+            self.upload(mp, 2, self.part_data(2, 1000))
+            self.fail("the parts are over the quota")
+        except S3ResponseError, ex:
+            self.assertEqual(ex.status, 403)
+        # a part sent again gets credit for the one it replaces
+        self.upload(mp, 1, self.part_data(1, 1200))
+        # and the parts stop counting once they are joined
+        mp.complete_upload()
+        k = self.bucket.get_key(self.keyname)
+        self.assertEqual(k.size, 1200)
+        k.delete()
+        # or the upload is cancelled
+        mp = self.bucket.initiate_multipart_upload(self.keyname)
+        self.upload(mp, 1, self.part_data(1, 1200))
+        mp.cancel_upload()
+        k = self.bucket.new_key(self.keyname)
+        k.set_contents_from_string(self.part_data(3, 1500))
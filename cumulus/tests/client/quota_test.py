@@ -15,6 +15,7 @@ import pycb.test_common
 import unittest
 import tempfile
 import filecmp
+import threading
 #
 class TestBucketsWithBoto(unittest.TestCase):
 
@@ -213,3 +214,39 @@ class TestBucketsWithBoto(unittest.TestCase):
 
 
 
+
+    def test_parallel_uploads_quota(self):
+        fsize = 60
+        data = self.cb_random_bucketname(fsize)
+        (id, pw) = self.make_user()
+        pycb.test_common.set_user_quota(id, fsize + 40)
+        conn = pycb.test_common.cb_get_conn(self.host, self.port, id, pw)
+        (bucketname,bucket) = self.create_bucket(conn)
+
+        # each would fit on its own, only one fits with the others
+        results = []
+        def upload(n):
+            c = pycb.test_common.cb_get_conn(self.host, self.port, id, pw)
+            b = c.get_bucket(bucketname, validate=False)
+            k = boto.s3.key.Key(b)
+            k.key = "key%d" % (n)
+            try:
+                k.set_contents_from_string(data)
+                results.append(True)
+            except:
+                results.append(False)
+        threads = [threading.Thread(target=upload, args=(i,)) for i in range(0, 4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len([r for r in results if r]), 1)
+        self.assertEqual(len(list(bucket.list())), 1)
+
+        # nothing is left held once the requests are over
+        user = pycb.config.auth.get_user(id)
+        try:
+            self.assertEqual(user.user.get_quota_reserved(), 0)
+            self.assertEqual(user.user.get_quota_usage(), fsize)
+        finally:
+            user.close()
@@ -0,0 +1,174 @@
+import string
+import random
+import os
+import sys
+import nose.tools
+import boto
+from boto.s3.connection import OrdinaryCallingFormat
+import time
+import socket
+import pycb.test_common
+import unittest
+
+class TestRangeWithBoto(unittest.TestCase):
+
+    def setUp(self):
+        (self.host, self.port) = pycb.test_common.get_contact()
+        (self.id, self.pw) = pycb.test_common.make_user()
+        self.conn = pycb.test_common.cb_get_conn(self.host, self.port, self.id, self.pw)
+        self.bucketname = pycb.test_common.random_string(20).lower()
+        self.bucket = self.conn.create_bucket(self.bucketname)
+        self.keyname = pycb.test_common.random_string(20)
+        self.data = "".join([chr(i % 256) for i in range(100000)])
+        k = boto.s3.key.Key(self.bucket)
+        k.key = self.keyname
+        k.set_contents_from_string(self.data)
+
+    def tearDown(self):
+        for key in self.bucket.list():
+            key.delete()
+        self.bucket.delete()
+        pycb.test_common.clean_user(self.id)
+
+    def get(self, headers, method='GET'):
+        r = self.conn.make_request(method, self.bucketname, self.keyname, headers=headers)
+        body = r.read()
+        return (r, body)
+
+    def test_single_range(self):
+        (r, body) = self.get({'Range': 'bytes=10-19'})
+        self.assertEqual(r.status, 206)
+        self.assertEqual(body, self.data[10:20])
+        self.assertEqual(r.getheader('content-range'), 'bytes 10-19/100000')
+
+        (r, body) = self.get({'Range': 'bytes=99990-'})
+        self.assertEqual(r.status, 206)
+        self.assertEqual(body, self.data[99990:])
+
+        (r, body) = self.get({'Range': 'bytes=-5'})
+        self.assertEqual(r.status, 206)
+        self.assertEqual(body, self.data[-5:])
+
+        # past the end is cut short
+        (r, body) = self.get({'Range': 'bytes=99000-200000'})
+        self.assertEqual(r.status, 206)
+        self.assertEqual(body, self.data[99000:])
+
+    def test_multi_range(self):
+        (r, body) = self.get({'Range': 'bytes=0-9,50-59,55-69'})
+        self.assertEqual(r.status, 206)
+        ct = r.getheader('content-type')
+        self.assertTrue(ct.startswith('multipart/byteranges'))
+        self.assertEqual(int(r.getheader('content-length')), len(body))
+        boundary = ct.split("boundary=")[1]
+        parts = body.split("--" + boundary)
+        # the overlapping ranges are merged
+        self.assertEqual(len(parts), 4)
+        self.assertEqual(parts[3], "--\r\n")
+        (h, d) = parts[1].split("\r\n\r\n", 1)
+        self.assertTrue("Content-Range: bytes 0-9/100000" in h)
+        self.assertEqual(d, self.data[0:10] + "\r\n")
+        (h, d) = parts[2].split("\r\n\r\n", 1)
+        self.assertTrue("Content-Range: bytes 50-69/100000" in h)
+        self.assertEqual(d, self.data[50:70] + "\r\n")
+
+    def test_bad_range(self):
+        (r, body) = self.get({'Range': 'bytes=100000-'})
+        self.assertEqual(r.status, 416)
+        self.assertEqual(r.getheader('content-range'), 'bytes */100000')
+
+        # syntactically broken ranges are ignored
+        (r, body) = self.get({'Range': 'bytes=20-10'})
+        self.assertEqual(r.status, 200)
+        self.assertEqual(body, self.data)
+
+    def test_conditional(self):
+        (r, body) = self.get({})
+        self.assertEqual(r.status, 200)
+        etag = r.getheader('etag')
+        lm = r.getheader('last-modified')
+        self.assertEqual(r.getheader('accept-ranges'), 'bytes')
+
+        (r, body) = self.get({'If-None-Match': etag})
+        self.assertEqual(r.status, 304)
+        self.assertEqual(body, "")
+        (r, body) = self.get({'If-None-Match': '"nope"'})
+        self.assertEqual(r.status, 200)
+        (r, body) = self.get({'If-Modified-Since': lm})
+        self.assertEqual(r.status, 304)
+        # If-None-Match wins over If-Modified-Since
+        (r, body) = self.get({'If-None-Match': '"nope"', 'If-Modified-Since': lm})
+        self.assertEqual(r.status, 200)
+        (r, body) = self.get({'If-Modified-Since': 'Thu, 01 Jan 1998 00:00:00 GMT'})
+        self.assertEqual(r.status, 200)
+
+        (r, body) = self.get({'If-Match': '"nope"'})
+        self.assertEqual(r.status, 412)
+        (r, body) = self.get({'If-Unmodified-Since': 'Thu, 01 Jan 1998 00:00:00 GMT'})
+        self.assertEqual(r.status, 412)
+
+        (r, body) = self.get({'If-None-Match': etag}, method='HEAD')
+        self.assertEqual(r.status, 304)
+
+    def test_if_range(self):
+        (r, body) = self.get({})
+        etag = r.getheader('etag')
+        (r, body) = self.get({'Range': 'bytes=0-9', 'If-Range': etag})
+        self.assertEqual(r.status, 206)
+        self.assertEqual(body, self.data[:10])
+        (r, body) = self.get({'Range': 'bytes=0-9', 'If-Range': '"nope"'})
+        self.assertEqual(r.status, 200)
+        self.assertEqual(body, self.data)
+
+
+class TestSlowDownloads(unittest.TestCase):
+
+    def setUp(self):
+        (self.host, self.port) = pycb.test_common.get_contact()
+        (self.id, self.pw) = pycb.test_common.make_user()
+        self.conn = pycb.test_common.cb_get_conn(self.host, self.port, self.id, self.pw)
+        self.bucketname = pycb.test_common.random_string(20).lower()
+        self.bucket = self.conn.create_bucket(self.bucketname)
+        self.keyname = pycb.test_common.random_string(20)
+        # more than the kernel will buffer for a client that reads nothing
+        k = boto.s3.key.Key(self.bucket)
+        k.key = self.keyname
+        k.set_contents_from_string("x" * (16*1024*1024))
+        self.socks = []
+
+    def tearDown(self):
+        for s in self.socks:
+            s.close()
+        for key in self.bucket.list():
+            key.delete()
+        self.bucket.delete()
+        pycb.test_common.clean_user(self.id)
+
+    # starts a GET and reads only the start of the reply
+    def stall(self, headers):
+        path = "/%s/%s" % (self.bucketname, self.keyname)
+        req = self.conn.build_base_http_request('GET', path, path, headers=headers)
+        req.authorize(connection=self.conn)
+        lines = ["GET %s HTTP/1.1" % (path), "Host: %s:%d" % (self.host, self.port)]
+        for (k, v) in req.headers.items():
+            lines.append("%s: %s" % (k, v))
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        s.connect((self.host, self.port))
+        self.socks.append(s)
+        s.sendall("\r\n".join(lines) + "\r\n\r\n")
+        self.assertTrue(s.recv(64).startswith("HTTP/1.1 20"))
+
+    def test_stalled_downloads(self):
+        # more downloads than the db pool has handles do not hold up the
+        # requests that need one
+        n = pycb.config.authzdb_pool_size + pycb.config.authzdb_pool_overflow + 1
+        for i in range(n):
+            if i % 2 == 0:
+                self.stall({})
+            else:
+                self.stall({'Range': 'bytes=10-'})
+        start = time.time()
+        keys = self.bucket.get_all_keys()
+        self.assertEqual([k.name for k in keys], [self.keyname])
+        self.assertTrue(time.time() - start < 10.0)
@@ -0,0 +1,123 @@
+import os
+import time
+import shutil
+import urllib2
+import tempfile
+from ConfigParser import SafeConfigParser
+import pycb
+import pycb.test_common
+from pycb.cbRedirector import *
+import unittest
+
+class TestLoadRedirector(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.host_file = os.path.join(self.dir, "hosts")
+        self.write_hosts(["a:1", "b:1", "c:1", "%s:%d" % (pycb.config.hostname, pycb.config.port)])
+        self.parser = SafeConfigParser()
+        self.parser.add_section("load_balanced")
+        self.parser.set("load_balanced", "hostfile", self.host_file)
+        self.parser.set("load_balanced", "max", "2")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_hosts(self, hosts):
+        f = open(self.host_file, "w")
+        f.write("# the set\n")
+        for h in hosts:
+            f.write(h + "\n")
+        f.close()
+
+    def make(self, affinity=False):
+        self.parser.set("load_balanced", "affinity", str(affinity))
+        r = cbLoadRedirector(self.parser)
+        r.refresh_peers()
+        for (name, load) in [("a:1", 1), ("b:1", 0), ("c:1", 1)]:
+            r.probe_ok("cumulus_connections %d\n" % (load), r.peers[name])
+        return r
+
+    def test_least_loaded(self):
+        r = self.make()
+        self.assertEqual(sorted(r.peers.keys()), ["a:1", "b:1", "c:1"])
+        self.assertEqual(r.new_connection(None), None)
+        self.assertEqual(r.new_connection(None), None)
+        self.assertEqual(r.new_connection(None), "b:1")
+        # b has been sent one since it was probed, it ties with the others
+        h = r.new_connection(None)
+        self.assertTrue(h in ["a:1", "b:1", "c:1"])
+
+        # the peers are all busier than we are
+        for p in r.peers.values():
+            r.probe_ok("cumulus_connections 10\n", p)
+        self.assertEqual(r.new_connection(None), None)
+
+        # less busy than we are but full themselves
+        r.counter.add(20)
+        for p in r.peers.values():
+            r.probe_ok("cumulus_connections 2\n", p)
+        self.assertEqual(r.new_connection(None), None)
+        stats = dict([((n, l.get("reason")), v) for (n, l, v) in r.get_stats()])
+        self.assertEqual(stats[("cumulus_redirects_skipped_total", "peers_busier")], 2)
+
+    def test_health(self):
+        r = self.make()
+        r.counter.add(5)
+        for i in range(0, 2):
+            r.probe_failed(Exception("refused"), r.peers["b:1"])
+        self.assertFalse(r.peers["b:1"].healthy)
+        self.assertTrue(r.new_connection(None) in ["a:1", "c:1"])
+        for n in ["a:1", "c:1"]:
+            r.probe_failed(Exception("refused"), r.peers[n])
+            r.probe_failed(Exception("refused"), r.peers[n])
+        self.assertEqual(r.new_connection(None), None)
+        stats = dict([((n, l.get("reason")), v) for (n, l, v) in r.get_stats()])
+        self.assertEqual(stats[("cumulus_redirects_skipped_total", "no_peer")], 1)
+        # back again
+        r.probe_ok("cumulus_connections 0\n", r.peers["c:1"])
+        self.assertEqual(r.new_connection(None), "c:1")
+
+    def test_affinity(self):
+        r = self.make(affinity=True)
+        r.counter.add(5)
+        owners = {}
+        for b in ["bucket%d" % (i) for i in range(0, 20)]:
+            owners[b] = r.new_connection(None, b)
+            self.assertTrue(owners[b] != None)
+            # the owner is not kept busy by the test
+            r.peers[owners[b]].sent = 0
+        self.assertTrue(len(set(owners.values())) > 1)
+        for b in owners:
+            self.assertEqual(r.new_connection(None, b), owners[b])
+            r.peers[owners[b]].sent = 0
+
+        # the buckets of a peer that goes down move, the rest stay put
+        r.probe_failed(Exception("refused"), r.peers["a:1"])
+        r.probe_failed(Exception("refused"), r.peers["a:1"])
+        for b in owners:
+            h = r.new_connection(None, b)
+            r.peers[h].sent = 0
+            if owners[b] == "a:1":
+                self.assertNotEqual(h, "a:1")
+            else:
+                self.assertEqual(h, owners[b])
+
+    def test_host_file_change(self):
+        r = self.make()
+        self.write_hosts(["b:1", "d:1"])
+        # make sure the change is seen on file systems with coarse times
+        os.utime(self.host_file, (time.time() + 10, time.time() + 10))
+        r.refresh_peers()
+        self.assertEqual(sorted(r.peers.keys()), ["b:1", "d:1"])
+        # what was known about a peer is kept
+        self.assertTrue(r.peers["b:1"].healthy)
+        self.assertFalse(r.peers["d:1"].healthy)
+
+class TestLoadPath(unittest.TestCase):
+
+    def test_load(self):
+        host = os.environ.get('CUMULUS_TEST_HOST', 'localhost')
+        port = int(os.environ.get('CUMULUS_TEST_PORT', '8888'))
+        body = urllib2.urlopen("http://%s:%d%s" % (host, port, g_load_path)).read()
+        self.assertTrue(parse_load_body(body) >= 0)
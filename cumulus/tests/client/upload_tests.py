@@ -0,0 +1,99 @@
+import os
+import sys
+import socket
+import boto
+from boto.exception import S3ResponseError
+import pycb
+import pycb.test_common
+import unittest
+
+class TestUploadWithBoto(unittest.TestCase):
+
+    def setUp(self):
+        (self.host, self.port) = pycb.test_common.get_contact()
+        (self.id, self.pw) = pycb.test_common.make_user()
+        self.conn = pycb.test_common.cb_get_conn(self.host, self.port, self.id, self.pw)
+        self.bucketname = pycb.test_common.random_string(20).lower()
+        self.bucket = self.conn.create_bucket(self.bucketname)
+        self.keyname = pycb.test_common.random_string(20)
+
+    def tearDown(self):
+        for key in self.bucket.list():
+            key.delete()
+        self.bucket.delete()
+        pycb.test_common.clean_user(self.id)
+
+    # send just the headers of a signed PUT and return the first reply
+    # line the server sends without ever sending the body
+    def put_headers_only(self, length):
+        c = self.conn
+        path = "/%s/%s" % (self.bucketname, self.keyname)
+        headers = {'Content-Length': str(length), 'Expect': '100-continue'}
+        r = c.build_base_http_request('PUT', path, path, headers=headers, host="%s:%d" % (self.host, self.port))
+        r.authorize(connection=c)
+        s = socket.create_connection((self.host, self.port))
+        try:
+            msg = "PUT %s HTTP/1.1\r\n" % (path)
+            for (k, v) in r.headers.iteritems():
+                msg = msg + "%s: %s\r\n" % (k, v)
+            msg = msg + "Host: %s:%d\r\n\r\n" % (self.host, self.port)
+            s.sendall(msg)
+            s.settimeout(10)
+            return s.recv(4096)
+        finally:
+            s.close()
+
+    def test_quota_refused_early(self):
+        pycb.test_common.set_user_quota(self.id, 1024)
+        reply = self.put_headers_only(1024*1024)
+        self.assertTrue(reply.startswith("HTTP/1.1 403"), reply)
+        self.assertTrue("AccountProblem" in reply)
+
+    def test_continue(self):
+        reply = self.put_headers_only(1024)
+        self.assertTrue(reply.startswith("HTTP/1.1 100"), reply)
+
+    def test_access_refused_early(self):
+        (id2, pw2) = pycb.test_common.make_user()
+        try:
+            conn2 = pycb.test_common.cb_get_conn(self.host, self.port, id2, pw2)
+            k = boto.s3.key.Key(conn2.get_bucket(self.bucketname, validate=False))
+            k.key = self.keyname
+            try:
+                k.set_contents_from_string("hello")
+                self.fail("should not be able to write")
+            except S3ResponseError, ex:
+                self.assertEqual(ex.status, 403)
+        finally:
+            pycb.test_common.clean_user(id2)
+
+    def test_bad_md5(self):
+        k = boto.s3.key.Key(self.bucket)
+        k.key = self.keyname
+        data = "some data"
+        # the md5 of something else
+        md5 = k.compute_md5(open("/etc/group", "r"))
+        try:
+            k.set_contents_from_string(data, md5=md5)
+            self.fail("the md5 should not have matched")
+        except S3ResponseError, ex:
+            self.assertEqual(ex.status, 400)
+            self.assertTrue('BadDigest' in ex.body)
+        self.assertEqual(self.bucket.get_key(self.keyname), None)
+
+        f = open("/etc/group", "r")
+        data = f.read()
+        f.seek(0)
+        k.set_contents_from_string(data, md5=k.compute_md5(f))
+        f.close()
+        self.assertEqual(k.get_contents_as_string(), data)
+
+    def test_no_partial_files(self):
+        k = boto.s3.key.Key(self.bucket)
+        k.key = self.keyname
+        k.set_contents_from_string("x" * 100000)
+        self.assertEqual(k.get_contents_as_string(), "x" * 100000)
+        # only works if the server shares this file system
+        base = pycb.config.bucket.base_dir
+        parts = [f for (d, ds, fs) in os.walk(base) for f in fs if f.endswith(".part")]
+        self.assertEqual(parts, [])
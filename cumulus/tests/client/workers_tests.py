@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import signal
+import socket
+import tempfile
+import subprocess
+import urllib2
+import boto
+import pycb
+import pycb.cumulus
+import pycb.test_common
+from pycb.cbRedirector import cbSharedConnectionCount, g_slot_size
+from pycb.cbMetrics import g_metrics_path
+from metrics_tests import parse_metrics
+import unittest
+
+class TestSharedConnectionCount(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.fname) = tempfile.mkstemp()
+        os.ftruncate(fd, 4 * g_slot_size)
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.fname)
+
+    def test_count(self):
+        c1 = cbSharedConnectionCount(self.fname, 0)
+        c2 = cbSharedConnectionCount(self.fname, 3)
+        c1.add(1)
+        c1.add(1)
+        c2.add(1)
+        self.assertEqual(c1.total(), 3)
+        self.assertEqual(c2.total(), 3)
+        c1.add(-1)
+        self.assertEqual(c2.total(), 2)
+        self.assertRaises(Exception, cbSharedConnectionCount, self.fname, 4)
+
+# the pids of the children of pid
+def children(pid):
+    kids = []
+    for p in os.listdir("/proc"):
+        if not p.isdigit():
+            continue
+        try:
+            stat = open("/proc/%s/stat" % (p)).read()
+        except IOError:
+            continue
+        # the name is in () and may have spaces in it
+        fields = stat[stat.rfind(")") + 2:].split()
+        if fields[0] != "Z" and int(fields[1]) == pid:
+            kids.append(int(p))
+    return sorted(kids)
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for(check, timeout=60):
+    end = time.time() + timeout
+    while time.time() < end:
+        if check():
+            return True
+        time.sleep(0.2)
+    return False
+
+# a cumulus of 2 workers of its own on a port of its own
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.port = free_port()
+        self.metrics_port = free_port()
+        prog = pycb.cumulus.__file__
+        if prog.endswith(".pyc"):
+            prog = prog[:-1]
+        self.proc = subprocess.Popen([sys.executable, prog, "-p", str(self.port), "-w", "2", "-M", str(self.metrics_port)])
+        self.assertTrue(wait_for(lambda: len(children(self.proc.pid)) == 2))
+        (self.id, self.pw) = pycb.test_common.make_user()
+
+    def tearDown(self):
+        if self.proc.poll() == None:
+            self.proc.send_signal(signal.SIGTERM)
+            if not wait_for(lambda: self.proc.poll() != None):
+                for pid in children(self.proc.pid):
+                    os.kill(pid, signal.SIGKILL)
+                self.proc.kill()
+                self.proc.wait()
+        pycb.test_common.clean_user(self.id)
+
+    def roundtrip(self):
+        conn = pycb.test_common.cb_get_conn("localhost", self.port, self.id, self.pw)
+        bucketname = pycb.test_common.random_string(20).lower()
+        bucket = conn.create_bucket(bucketname)
+        k = boto.s3.key.Key(bucket)
+        k.key = "key"
+        k.set_contents_from_string("some data")
+        self.assertEqual(k.get_contents_as_string(), "some data")
+        k.delete()
+        bucket.delete()
+
+    def test_requests(self):
+        for i in range(0, 5):
+            self.roundtrip()
+
+    def test_reload(self):
+        old = children(self.proc.pid)
+        self.proc.send_signal(signal.SIGHUP)
+        def replaced():
+            kids = children(self.proc.pid)
+            return len(kids) == 2 and len(set(kids) & set(old)) == 0
+        self.assertTrue(wait_for(replaced))
+        self.roundtrip()
+
+    def test_replace_dead(self):
+        old = children(self.proc.pid)
+        os.kill(old[0], signal.SIGKILL)
+        def replaced():
+            kids = children(self.proc.pid)
+            return len(kids) == 2 and old[0] not in kids
+        self.assertTrue(wait_for(replaced))
+        self.roundtrip()
+
+    def test_stop(self):
+        self.roundtrip()
+        self.proc.send_signal(signal.SIGTERM)
+        self.assertTrue(wait_for(lambda: self.proc.poll() != None))
+        self.assertEqual(self.proc.returncode, 0)
+
+    def puts(self):
+        url = "http://%s:%d%s" % (pycb.config.metrics_address, self.metrics_port, g_metrics_path)
+        values = parse_metrics(urllib2.urlopen(url).read())
+        return values.get('cumulus_requests_total{op="PutObject",status="200"}', 0)
+
+    def test_metrics(self):
+        # the supervisor adds up what every worker counted, there is no
+        # label for the worker
+        for i in range(0, 4):
+            self.roundtrip()
+        self.assertTrue(wait_for(lambda: self.puts() == 4))
+        # and keeps what one that is gone counted
+        old = children(self.proc.pid)
+        os.kill(old[0], signal.SIGKILL)
+        self.assertTrue(wait_for(lambda: len(children(self.proc.pid)) == 2 and old[0] not in children(self.proc.pid)))
+        self.assertEqual(self.puts(), 4)
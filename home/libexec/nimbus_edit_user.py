@@ -178,6 +178,9 @@ def edit_user(o, db):
     dnu = user.get_alias_by_friendly(o.emailaddr, pynimbusauthz.alias_type_x509)
 
     s3u = user.get_alias_by_friendly(o.emailaddr, pynimbusauthz.alias_type_s3)
+    old_access_id = None
+    if s3u != None:
+        old_access_id = s3u.get_name()
     # if there is a dn set it
     if o.access_id != None:
         if s3u == None:
@@ -228,6 +231,10 @@ def edit_user(o, db):
             
     db.commit()
 
+    # a running cumulus may have the old s3 credentials cached
+    if o.access_id != None or o.access_secret != None:
+        pycb.config.auth.invalidate_credentials(old_access_id)
+
     # todo, reset options structure to report user
 
 def main(argv=sys.argv[1:]):
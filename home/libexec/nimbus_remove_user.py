@@ -127,6 +127,8 @@ def delete_user(o):
 
     user.destroy_brutally()
     db.commit()
+    # a running cumulus may still have the s3 credentials cached
+    pycb.config.auth.invalidate_credentials()
 
 def remove_web(o):
     # import this here because otherwise errors will be thrown when
@@ -51,6 +51,8 @@ def reset_users(nh, clean_pattern='%'):
         # commit after every user because otherwise the file delete inner 
         # loop will commit in less obvious ways
         dbobj.commit()
+    # a running cumulus may still have the s3 credentials cached
+    pycb.config.auth.invalidate_credentials()
 
 def get_nimbus_home():
     """Determines home directory of Nimbus install we are using.
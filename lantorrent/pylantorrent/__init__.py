@@ -78,6 +78,29 @@ class VConfig(object):
         self.dbfile = "%s/reqs.db" % (self.lt_home)
         self.db_error_max = 10
         self.insert_delay = 30
+        # blocks held for each next hop before the source is made to wait
+        self.buffer_blocks = 32
+        # how long a hop has to say where a resumed transfer starts
+        self.offset_timeout = 60
+        # send the data to the next hops in checked blocks.  it is offered
+        # in the header and a hop that does not answer within
+        # framing_timeout is sent it raw, see ltConnection.py
+        self.framing = True
+        self.framing_timeout = 10
+        # how long a failed request waits before it is sent again
+        self.retry_delay = 5
+        # the daemon takes requests on this socket, a group is sent once no
+        # request for it came in for batch_min seconds (longer when they
+        # come in slowly) or after insert_delay.  see ltQueue.py
+        self.queue_socket = "%s/lt.sock" % (self.lt_home)
+        self.batch_min = 1.0
+        # see planner.py, link speeds are in megabits per second
+        self.links_file = "%s/etc/links" % (self.lt_home)
+        self.default_mbps = 1000.0
+        self.source_mbps = 1000.0
+        self.uplink_mbps = 0.0
+        self.max_degree = 4
+        self.hop_latency = 0.001
 
     def load_settings(self, ini_file):
         log_levels = {'debug': logging.DEBUG,
@@ -100,6 +123,44 @@ class VConfig(object):
             self.dbfile = s.get("db", "file").replace("@LANTORRENT_HOME@", self.lt_home)
         except:
             pass
+        try:
+            self.buffer_blocks = s.getint("server", "buffer_blocks")
+        except:
+            pass
+        try:
+            self.offset_timeout = s.getint("server", "offset_timeout")
+        except:
+            pass
+        try:
+            self.framing = s.getboolean("server", "framing")
+        except:
+            pass
+        try:
+            self.framing_timeout = s.getint("server", "framing_timeout")
+        except:
+            pass
+        try:
+            self.retry_delay = s.getint("db", "retry_delay")
+        except:
+            pass
+        try:
+            self.queue_socket = s.get("daemon", "socket").replace("@LANTORRENT_HOME@", self.lt_home)
+        except:
+            pass
+        for (name, get) in [("batch_min", s.getfloat), ("insert_delay", s.getint)]:
+            try:
+                setattr(self, name, get("daemon", name))
+            except:
+                pass
+        try:
+            self.links_file = s.get("planner", "links").replace("@LANTORRENT_HOME@", self.lt_home)
+        except:
+            pass
+        for (name, get) in [("default_mbps", s.getfloat), ("source_mbps", s.getfloat), ("uplink_mbps", s.getfloat), ("max_degree", s.getint), ("hop_latency", s.getfloat)]:
+            try:
+                setattr(self, name, get("planner", name))
+            except:
+                pass
 
 config = VConfig()
 
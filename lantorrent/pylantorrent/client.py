@@ -94,8 +94,23 @@ class LTClient(object):
         self.data_file.close()
 
     def write(self, data):
+        # the first hop of a resumed transfer says where the data starts
+        if data.find("OFFSET : ") == 0:
+            self.seek_data(long(data[len("OFFSET : "):].strip()))
+            return
         self.incoming_data = self.incoming_data + data
 
+    def seek_data(self, offset):
+        self.data_file.seek(0)
+        self.md5er = hashlib.md5()
+        left = offset
+        while left > 0:
+            d = self.data_file.read(min(left, 1024*1024))
+            if not d:
+                break
+            self.md5er.update(d)
+            left = left - len(d)
+
     def process_incoming_data(self):
         lines = self.incoming_data.split('\n')
         for data in lines:
@@ -108,7 +123,9 @@ class LTClient(object):
                             c = self.dest.pop(rid)
                             self.complete[rid] = json_outs
                             self.success_count = self.success_count + 1
-                    else:
+                    elif rid in self.dest:
+                        # an error with no request, or for one that was
+                        # later sent on another way, says nothing more
                         d = self.dest[rid]
                         d['emsg'] = json_outs
                 except Exception, ex:
@@ -168,7 +185,7 @@ def main(argv=sys.argv[1:]):
     final['destinations'] = dests
 
     c = LTClient(argv[0], final)
-    v = LTServer(c, c)
+    v = LTServer(c, c, repair_path=argv[0], framing=pylantorrent.config.framing)
     v.store_and_forward()
     v.clean_up()
     c.close()
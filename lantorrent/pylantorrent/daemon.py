@@ -1,12 +1,12 @@
-import sqlite3
 import sys
 import os
 from socket import *
 import logging
 import pylantorrent
-from pylantorrent.db import LantorrentDB
 from pylantorrent.server import LTServer
 from pylantorrent.client import LTClient
+from pylantorrent import planner
+from pylantorrent.ltQueue import LTRequestQueue, LTQueueServer, open_journal
 try:
     import json
 except ImportError:
@@ -16,44 +16,29 @@ import uuid
 import time
 import datetime
 
-def getrows(con):
+# the rates hosts got, in bytes per second
+def get_measured(con):
     c = con.cursor()
-    tm = datetime.datetime.now() - datetime.timedelta(0, pylantorrent.config.insert_delay)
-    s = "select distinct src_filename from requests where state = 0 and attempt_count < 3 and entry_time < ? order by entry_time limit 1"
-    data = (tm, )
-    c.execute(s, data)
-    r = c.fetchone()
-    if r == None or len(r) < 1:
-        return None
-    src_file = r[0]
-    # do a commit here.  THe assumption is that jsut one daemon is pulling
-    # from the db.  better to grab any that came in since the initial
-    # select
+    c.execute("select hostname,rate from links")
+    measured = {}
+    for r in c.fetchall():
+        measured[r[0]] = float(r[1])
     con.commit()
-    pylantorrent.log(logging.INFO, "selected rows with fname %s" % (src_file))
-
-    #  need to find a way to determine that nothing new has been added for this
-    #  file recently
-    #s = 'select max(entry_time) as "e [timestamp]" from requests where src_filename = ? and state = 0 and attempt_count < 3'
-    #data = (src_file, )
-    #done = False
-    #while not done:
-    #    c.execute(s, data)
-    #    row = c.fetchone()
-    #    con.commit()
-    #    td = datetime.datetime.now() - datetime.timedelta(0, 2)
-    #    if row[0] < td:
-    #        done = True
-    #    else:
-    #        time.sleep(0.1)
-
-    s = "select hostname,port,src_filename,dst_filename,rid from requests where src_filename = ? and state = 0 and attempt_count < 3 order by hostname,port"
-    data = (src_file, )
-    c.execute(s, data)
-    rows = c.fetchall()
-    con.commit()
-    return rows
-
+    return measured
+
+# half of the new rate and half of the old
+def put_measured(c, results):
+    for r in results:
+        if 'rate' not in r:
+            continue
+        c.execute("select rate from links where hostname = ?", (r['host'],))
+        row = c.fetchone()
+        rate = float(r['rate'])
+        if row != None:
+            rate = (rate + float(row[0])) / 2.0
+        c.execute("insert or replace into links(hostname, rate, update_time) values (?, ?, ?)", (r['host'], rate, datetime.datetime.now()))
+
+# sends a group, returns the requests that did not make it by rid
 def do_it_live(con, rows):
 
     pylantorrent.log(logging.INFO, "lan torrent daemon setting up to send %d in a group" % (len(rows)))
@@ -63,14 +48,16 @@ def do_it_live(con, rows):
     last_host = None
     last_port = None
     json_dest = None
-    rids_all = []
+    resume = False
     for r in rows:
         new_host = r[0]
         new_port = int(r[1])
         dst_filename = r[3]
         src_filename = r[2]
         rid = r[4]
-        rids_all.append(rid)
+        # a request sent before picks up from what it got then
+        if int(r[5]) > 0:
+            resume = True
         sz = os.path.getsize(src_filename)
         # if it is the same host just tack on another dest file
         if new_host == last_host and last_port == new_port:
@@ -103,77 +90,69 @@ def do_it_live(con, rows):
     final['port'] = 2893
     final['block_size'] = 131072
     final['degree'] = 1
-    final['destinations'] = dests
+    final['length'] = sz
+    if resume:
+        final['resume'] = True
+
+    # the shape of the tree comes from the link speeds
+    links = planner.get_links()
+    links.set_measured(get_measured(con))
+    (final, predicted) = planner.plan(final, dests, links, pylantorrent.config.max_degree, pylantorrent.config.hop_latency)
 
     pylantorrent.log(logging.INFO, "request send %s" % (json.dumps(final, sort_keys=True, indent=4)))
     pylantorrent.log(logging.INFO, "sending em!")
 
     client = LTClient(src_filename, final)
-    v = LTServer(client, client)
+    v = LTServer(client, client, repair_path=src_filename, framing=pylantorrent.config.framing)
+    start = time.time()
     try:
         v.store_and_forward()
     except Exception, ex:
         pylantorrent.log(logging.ERROR, "an error occured on store and forward: %s" % (str(ex)), traceback)
-    rc = 0
+    pylantorrent.log(logging.INFO, "sent in %f seconds, %f were predicted" % (time.time() - start, predicted))
     es = client.get_incomplete()
-    bad_rid = []
-    for k in es:
-        rc = rc + 1
-        e = es[k]
-        pylantorrent.log(logging.ERROR, "error trying to send %s" % (str(e)))
-        rid = e['id']
-        bad_rid.append(rid)
-        # set to retry
-        u = "update requests set state = ?, message = ?, attempt_count = attempt_count + 1 where rid = ?"
-        data = (0,str(e),rid,)
-        c.execute(u, data)
-        rids_all.remove(rid)
-
-    for rid in rids_all:
-        # set to compelte
-        u = "update requests set state = ?, message = ? where rid = ?"
-        data = (1,"Success",rid,)
-        c.execute(u, data)
-
+    put_measured(c, client.complete.values())
     con.commit()
-
-    if len(bad_rid) > 0:
-        # wait for soemthing in the system to change
-        # obviously we need something more sophisticated than this
-        # eventually
-        time.sleep(5)
-    return rc
+    return es
 
 
 def main(argv=sys.argv[1:]):
     """
-    This is the lantorrent daemon program.  it mines the db for transfers
-    that it can group together and send.  Only one should be running at 
-    one time
+    This is the lantorrent daemon program.  it takes requests on its
+    socket (see ltQueue.py), groups them together and sends them.  Only
+    one should be running at one time
     """
 
     pylantorrent.log(logging.INFO, "enter %s" % (sys.argv[0]))
 
-    # use sqlaclh to make sure the db is there
-    x = LantorrentDB("sqlite:///%s" % pylantorrent.config.dbfile)
-    x.close()
-    con_str = pylantorrent.config.dbfile
-    #con = sqlite3.connect(con_str, isolation_level="EXCLUSIVE")
-    con = sqlite3.connect(con_str, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+    c = pylantorrent.config
+    con = open_journal(c.dbfile)
+    queue = LTRequestQueue(open_journal(c.dbfile), c.batch_min, c.insert_delay, c.retry_delay)
+    listener = LTQueueServer(queue, c.queue_socket)
+    listener.start()
 
     done = False
     while not done:
-        pylantorrent.log(logging.DEBUG, "Top of the getrows loop")
+        pylantorrent.log(logging.DEBUG, "Top of the queue loop")
         try:
-            rows = getrows(con)
-            if rows and len(rows) > 0:
-                pylantorrent.log(logging.DEBUG, "%d rows found" % (len(rows)))
-                do_it_live(con, rows)
-            else:
-                time.sleep(5)
+            rows = queue.next_group(c.insert_delay)
+            if rows == None:
+                # anything put in the journal by a request without the
+                # daemon there
+                queue.sweep()
+                continue
+            pylantorrent.log(logging.DEBUG, "%d rows found" % (len(rows)))
+            try:
+                es = do_it_live(con, rows)
+            except Exception, ex:
+                pylantorrent.log(logging.ERROR, "failed to send the group %s" % (str(ex)), traceback)
+                es = {}
+                for r in rows:
+                    es[r[4]] = {'id' : r[4], 'message' : str(ex)}
+            queue.finish(rows, es)
         except Exception, ex:
             pylantorrent.log(logging.ERROR, "top level error %s" % (str(ex)), traceback)
-            con = sqlite3.connect(con_str, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+            time.sleep(1)
 
     return 0
 
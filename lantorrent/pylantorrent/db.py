@@ -27,6 +27,13 @@ request_table = Table('requests', metadata,
     Column('attempt_count', Integer, nullable=False, default=0),
     )
 
+# the rate each host got the last times it was sent to, see planner.py
+links_table = Table('links', metadata,
+    Column('hostname', String(1024), nullable=False, primary_key = True),
+    Column('rate', types.Float(), nullable=False),
+    Column('update_time', types.TIMESTAMP(), default=datetime.now()),
+    )
+
 class RequestTable(object):
     def __init__(self):
         self.id = None
@@ -10,7 +10,50 @@ import traceback
 from pylantorrent.ltException import LTException
 import pylantorrent
 import select
+import errno
+import time
 import zlib
+import struct
+
+#
+#  a sender that can frame the data says so with framing set to the
+#  version it knows in the header.  a receiver that knows framing answers
+#  at once with
+#
+#      FRAMING : <version>
+#
+#  the lower of the two versions.  only then is each block of the data
+#  sent as a frame:
+#
+#      "LTB1" <offset, 8 bytes> <length, 4 bytes> <crc32, 4 bytes> <data>
+#
+#  all in network order.  the crc32 covers the offset and length as well as
+#  the data.  a receiver checks each block before it writes or
+#  forwards it and asks for a bad one again with a line up the result
+#  channel:
+#
+#      RESEND : <offset> <length>
+#
+#  once it has every block it says
+#
+#      VERIFIED : <length>
+#
+#  and the sender may finish.  a receiver of a version from before framing
+#  does not answer, after framing_timeout it is sent the data as it always
+#  was
+#
+g_framing_version = 1
+g_frame_magic = "LTB1"
+g_frame_format = "!4sQII"
+g_frame_header_len = struct.calcsize(g_frame_format)
+g_max_frame = 64*1024*1024
+
+def block_checksum(offset, data):
+    crc = zlib.crc32(struct.pack("!QI", offset, len(data)))
+    return zlib.crc32(data, crc) & 0xffffffff
+
+def make_frame_header(offset, data):
+    return struct.pack(g_frame_format, g_frame_magic, offset, len(data), block_checksum(offset, data))
 
 class LTDataTransformZip(object):
 
@@ -24,6 +67,20 @@ class LTDestConnection(object):
         self.read_buffer_len = 1024
         self.output_printer = output_printer
         self.data_transform = data_transform
+        self.ring = None
+        self.eof = False
+        # set once it has gone away, the hops under it are then sent to
+        # by this node.  see LTServer._repair
+        self.failed = False
+        self.destinations = None
+        # where the data this hop wants starts
+        self.offset = 0
+        self.framing = False
+        # it did not answer the header, a version from before framing
+        self.old = False
+        self.verified = False
+        self.resends = []
+        self.partial = ""
 
         if json_ent == None:
             self.valid = False
@@ -59,9 +116,11 @@ class LTDestConnection(object):
             return 1024*128
         return self.block_size
 
-    def send_header(self, destinations):
+    def send_header(self, destinations, resume=False, framing=False):
         if not self.valid:
             return
+        self.destinations = destinations
+        self.framing = False
 
         header = {}
         header['requests'] = self.requests
@@ -71,6 +130,10 @@ class LTDestConnection(object):
         header['degree'] = self.degree
         header['length'] = self.data_length
         header['destinations'] = destinations
+        if resume:
+            header['resume'] = True
+        if framing:
+            header['framing'] = g_framing_version
         send_str = json.dumps(header)
         send_str = send_str + "\n"
         pylantorrent.log(logging.DEBUG, "sending header %s" % (send_str))
@@ -78,18 +141,72 @@ class LTDestConnection(object):
         self.send(send_str)
         self.send("EOH : %s\r\n" % (signature))
 
-    def _poll(self, poll_period=0.0):
+    #  a hop that was offered framing and answers in time is sent frames
+    def read_framing(self, timeout):
         if not self.valid:
             return
+        line = ""
         try:
-            self.socket.settimeout(poll_period)
-            data = self._read_from_socket(self.read_buffer_len)
-            if data:
-                self.output_printer.print_results(data)
-        except:
-            # there may jsut be no data now
-            pass
-        self.socket.settimeout(None)
+            line = self._read_reply(time.time() + timeout)
+            if line == None:
+                pylantorrent.log(logging.WARNING, "%s:%d did not answer the framing after %d seconds, sending it raw" % (self.host, self.port, timeout))
+                self.old = True
+                return
+            if line.find("FRAMING : ") != 0:
+                raise Exception("no framing was sent")
+            self.framing = int(line[len("FRAMING : "):].strip()) > 0
+        except Exception, ex:
+            if line.strip():
+                self.output_printer.print_results(line)
+            self._send_failed(ex)
+
+    #  a hop sent a resume header answers with the offset its subtree
+    #  wants the data from before any data is sent.  one that does not
+    #  answer in time is taken to be of a version from before resume, it
+    #  is sent all of the data
+    def read_offset(self, timeout):
+        if not self.valid:
+            return None
+        # it has been waited for once already
+        if self.old:
+            self.offset = 0
+            return self.offset
+        line = ""
+        try:
+            line = self._read_reply(time.time() + timeout)
+            if line == None:
+                pylantorrent.log(logging.WARNING, "%s:%d sent no offset after %d seconds, sending it all" % (self.host, self.port, timeout))
+                self.offset = 0
+                return self.offset
+            if line.find("OFFSET : ") != 0:
+                raise Exception("no offset was sent")
+            self.offset = long(line[len("OFFSET : "):].strip())
+        except Exception, ex:
+            if line.strip():
+                self.output_printer.print_results(line)
+            self._send_failed(ex)
+            return None
+        return self.offset
+
+    # the line a hop answers a header with, None if it did not by end.
+    # a byte at a time so none of the results are taken
+    def _read_reply(self, end):
+        line = ""
+        try:
+            while line.find("\n") < 0:
+                self.socket.settimeout(max(end - time.time(), 0.01))
+                try:
+                    d = self._read_from_socket(1)
+                except socket.timeout:
+                    # what there is of it goes up with the results
+                    self.partial = self.partial + line
+                    return None
+                if not d:
+                    raise Exception("closed before it answered the header")
+                line = line + d
+        finally:
+            self.socket.settimeout(None)
+        return line
 
     def _read_from_socket(self, size):
         data = self.socket.recv(size)
@@ -104,8 +221,11 @@ class LTDestConnection(object):
         self.socket.settimeout(None)
         data = self._read_from_socket(self.read_buffer_len)
         while data:
-            self.output_printer.print_results(data)
+            self._pass_up(data)
             data = self._read_from_socket(self.read_buffer_len)
+        if self.partial:
+            self.output_printer.print_results(self.partial)
+            self.partial = ""
 
     def send(self, data):
         if not self.valid:
@@ -113,24 +233,140 @@ class LTDestConnection(object):
         try:
             self._write_to_socket(data)
         except Exception, ex:
-            self.valid = False
-            self.ex = LTException(506, "%s:%s %s" % (self.host, str(self.port), str(ex)), self.host, self.port, self.requests)
-            pylantorrent.log(logging.WARNING, "send error " + str(self.ex), traceback)
+            self._send_failed(ex)
+
+    def _send_failed(self, ex):
+        self.valid = False
+        self.failed = True
+        if self.partial:
+            self.output_printer.print_results(self.partial)
+            self.partial = ""
+        if self.ring != None:
+            self.ring.clear()
+        self.ex = LTException(506, "%s:%s %s" % (self.host, str(self.port), str(ex)), self.host, self.port, self.requests)
+        pylantorrent.log(logging.WARNING, "send error " + str(self.ex), traceback)
+        try:
+            self.socket.setblocking(1)
             data = self._read_from_socket(self.read_buffer_len)
             while data:
                 pylantorrent.log(logging.WARNING, "bad data: " + str(data))
                 data = self._read_from_socket(self.read_buffer_len)
-            j = self.ex.get_json()
-            s = json.dumps(j)
-            self.output_printer.print_results(s)
-        # see if there is anything to read
-        self._poll()
+        except Exception, rex:
+            pylantorrent.log(logging.WARNING, "read after send error " + str(rex))
+        # one line per request so the id of each failed file goes back
+        s = self.ex.get_printable()
+        self.output_printer.print_results(s)
+
+    #
+    #  the data of the transfer goes through a ring drained by the engine in
+    #  ltForward rather than send().  the socket is non blocking until
+    #  end_stream
+    #
+    def start_stream(self, ring):
+        self.ring = ring
+        if self.valid:
+            self.socket.setblocking(0)
+
+    def end_stream(self):
+        self.ring = None
+        if self.valid:
+            self.socket.setblocking(1)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def has_room(self, n):
+        if not self.valid:
+            return True
+        return self.ring.has_room(n)
+
+    def pending(self):
+        if not self.valid:
+            return 0
+        return len(self.ring)
+
+    def queue(self, offset, data):
+        if not self.valid:
+            return
+        # a hop that resumed further on than the stream skips what it has
+        if offset + len(data) <= self.offset:
+            return
+        if offset < self.offset:
+            data = data[self.offset - offset:]
+            offset = self.offset
+        if self.framing:
+            self.ring.push(make_frame_header(offset, data))
+        self.ring.push(data)
+
+    # a block it asked for again is gone, it resumes later from what it has
+    def abandon(self, msg):
+        if not self.valid:
+            return
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        self._send_failed(Exception(msg))
+
+    # the blocks a framed hop asked for again
+    def take_resends(self):
+        r = self.resends
+        self.resends = []
+        return r
+
+    # send what the socket will take now
+    def flush_some(self):
+        try:
+            while self.valid and len(self.ring) > 0:
+                n = self.socket.send(self.ring.peek())
+                self.ring.consume(n)
+        except socket.error, ex:
+            if ex.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._send_failed(ex)
+
+    # anything the peer says before the end is passed up the chain
+    def read_some(self):
+        try:
+            data = self.socket.recv(64*1024)
+        except socket.error, ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = None
+        if not data:
+            # a send will fail if it has really gone away
+            self.eof = True
+            if self.framing and not self.verified and self.valid:
+                self._send_failed(Exception("closed before the data was verified"))
+            return
+        self._pass_up(data)
+
+    # what a hop says is passed up the chain a line at a time.  the lines
+    # for this node are taken out, as is an answer to the header that came
+    # after it was given up on
+    def _pass_up(self, data):
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        out = []
+        for l in lines:
+            if l.find("RESEND : ") == 0:
+                a = l[len("RESEND : "):].split()
+                self.resends.append((long(a[0]), int(a[1])))
+            elif l.find("VERIFIED : ") == 0:
+                self.verified = True
+            elif l.find("OFFSET : ") == 0 or l.find("FRAMING : ") == 0:
+                pylantorrent.log(logging.WARNING, "%s:%d answered late with %s" % (self.host, self.port, l.strip()))
+            else:
+                out.append(l + "\n")
+        if len(out) > 0:
+            self.output_printer.print_results("".join(out))
 
 
     def close(self, force=False):
-        # reading of footer waits for eof so this is needed
-        self.socket.shutdown(socket.SHUT_WR)
-        self.read_to_eof()
+        # reading of footer waits for eof so this is needed.  one that
+        # failed has already been read to the end
+        if self.valid:
+            self.socket.shutdown(socket.SHUT_WR)
+            self.read_to_eof()
         self.valid = False
         self.socket.close()
 
@@ -170,8 +406,10 @@ class LTSourceConnection(object):
             l = self._read()
         pylantorrent.log(logging.DEBUG, "footer is %s" % (lines))
         foot = json.loads(lines)
-        if foot['md5sum'] != md5str:
-            raise LTException(510, "%s != %s" % (md5str, foot['md5sum']), header['host'], int(header['port']), requests_a, md5sum=md5str)
+        # a resumed node that keeps no data cannot check the sum
+        if md5str != None and foot['md5sum'] != md5str:
+            header = self.header
+            raise LTException(510, "%s != %s" % (md5str, foot['md5sum']), header['host'], int(header['port']), header['requests'], md5sum=md5str)
         self.footer = foot
         return foot
 
@@ -193,7 +431,7 @@ class LTSourceConnection(object):
             l = self._readline()
             count = count + 1
             if count == self.max_header_lines:
-                raise LTException(501, "%d lines long, only %d allowed" % (count, max_header_lines))
+                raise LTException(501, "%d lines long, only %d allowed" % (count, self.max_header_lines))
         if l == None:
             raise LTException(501, "No signature found")
         signature = l[len("EOH : "):].strip()
@@ -226,6 +464,20 @@ class LTSourceConnection(object):
     def read_data(self, bs):
         return self._read(bs)
 
+    # returns (offset, data, good).  a frame that cannot be made out at all
+    # means the stream is lost
+    def read_frame(self, data_length):
+        h = self._read(g_frame_header_len)
+        if not h or len(h) != g_frame_header_len:
+            raise Exception("the stream ended inside a frame")
+        (magic, offset, length, crc) = struct.unpack(g_frame_format, h)
+        if magic != g_frame_magic or length > g_max_frame or offset + length > data_length:
+            raise LTException(511, "bad frame header at %d" % (offset), self.header['host'], int(self.header['port']), self.header['requests'])
+        data = self._read(length)
+        if not data or len(data) != length:
+            raise Exception("the stream ended inside a frame")
+        return (offset, data, block_checksum(offset, data) == crc)
+
 class LTDestConnectionZip(LTDestConnection):
 
     def __init__(self, json_ent, output_printer):
@@ -22,9 +22,11 @@ class LTException(Exception):
     errorsCode[508] = "Access denied: %s"
     errorsCode[509] = "completion status never received %s"
     errorsCode[510] = "Incorrect checksum %s"
+    errorsCode[511] = "The framing of the data was lost %s"
 
-    def __init__(self, code, msg, host=None, port=None, reqs=None, md5sum=""):
+    def __init__(self, code, msg, host=None, port=None, reqs=None, md5sum="", rate=None):
         self.code = code
+        self.rate = rate
         self.host = host
         self.port = port
         self.reqs = reqs
@@ -47,6 +49,7 @@ class LTException(Exception):
     #               file
     #               id
     #               message
+    #               rate        (bytes per second, on success)
     #           }
     #       ]
     #  }
@@ -59,6 +62,8 @@ class LTException(Exception):
         header['id'] = rid
         header['message'] = self.msg
         header['md5sum'] = self.md5sum
+        if self.rate != None:
+            header['rate'] = self.rate
 
         return header
 
@@ -66,7 +71,7 @@ class LTException(Exception):
     def get_printable(self):
         if self.reqs == None:
             s = self.get_json()
-            return json.dumps(s)
+            return json.dumps(s) + os.linesep
 
         str_out = ""
         for req in self.reqs:
@@ -0,0 +1,332 @@
+import select
+import logging
+import threading
+import Queue
+from collections import deque
+import pylantorrent
+from pylantorrent.ltException import LTException
+
+#
+#  the store and forward engine.  one block at a time is read from the
+#  source and put on the ring of every destination and on the queue of the
+#  disk writer.  the destination sockets are non blocking and are drained
+#  from a select loop as they can take data, the files are written by a
+#  thread of their own.  the source is only waited on when every ring has
+#  room for another block, so a slow hop only holds up the chain once its
+#  ring is full.
+#
+#  a block is an offset and its data.  with framing a block that fails its
+#  check is neither written nor forwarded, it is asked for again and fills
+#  its hole when it comes.  the last blocks forwarded are kept so a hop
+#  that asks for one again is sent it from here
+#
+
+#  a bounded fifo of blocks.  a partial send leaves an offset into the
+#  first block so no data is copied
+class LTRingBuffer(object):
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.blocks = deque()
+        self.offset = 0
+        self.size = 0
+
+    def has_room(self, n):
+        # an empty ring always takes a block no matter its size
+        return self.size == 0 or self.size + n <= self.capacity
+
+    def push(self, data):
+        self.blocks.append(data)
+        self.size = self.size + len(data)
+
+    def peek(self):
+        return buffer(self.blocks[0], self.offset)
+
+    def consume(self, n):
+        self.size = self.size - n
+        self.offset = self.offset + n
+        if self.offset == len(self.blocks[0]):
+            self.blocks.popleft()
+            self.offset = 0
+
+    def clear(self):
+        self.blocks.clear()
+        self.offset = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+
+#  writes the blocks to all of the local files.  put blocks when the queue
+#  is full, the first error is kept and raised to the engine
+class LTFileWriter(object):
+
+    def __init__(self, files_a, max_blocks):
+        self.files_a = files_a
+        self.queue = Queue.Queue(max_blocks)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="lantorrent-writer")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        position = None
+        while True:
+            block = self.queue.get()
+            if block == None:
+                return
+            if self.error != None:
+                continue
+            (offset, data) = block
+            try:
+                for f in self.files_a:
+                    if offset != position:
+                        f.seek(offset)
+                    f.write(data)
+                position = offset + len(data)
+            except Exception, ex:
+                pylantorrent.log(logging.ERROR, "failed to write a block: %s" % (str(ex)))
+                self.error = ex
+
+    def put(self, offset, data):
+        if self.error != None:
+            raise self.error
+        self.queue.put((offset, data))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error != None:
+            raise self.error
+
+
+#  a file already written, the source when a node sends the data again to
+#  the hops under one that failed
+class LTFileSource(object):
+
+    def __init__(self, filename, offset):
+        self.f = open(filename, "rb")
+        self.f.seek(offset)
+
+    def read_data(self, bs):
+        return self.f.read(bs)
+
+    def close(self):
+        self.f.close()
+
+
+#  the data read as it is, a connection or an LTFileSource
+class LTStreamSource(object):
+
+    def __init__(self, conn, start, data_length):
+        self.conn = conn
+        self.offset = start
+        self.data_length = data_length
+
+    def next_block(self, bs):
+        bs = min(bs, self.data_length - self.offset)
+        data = self.conn.read_data(bs)
+        if not data:
+            raise Exception("Data is None prior to receiving full file %d %d" % (self.offset, self.data_length))
+        offset = self.offset
+        self.offset = self.offset + len(data)
+        return (offset, data)
+
+    def done(self):
+        return self.offset >= self.data_length
+
+    def verified(self):
+        return self.offset
+
+
+#  the frames of a source connection.  a hole is a range not yet had.  one
+#  that failed its check is asked for with a RESEND line to the node above,
+#  one that was skipped is being fetched by the node above and is just
+#  waited for.  output_printer is the server, it is told how much is whole
+#  whenever that goes down so a resume does not trust a hole
+class LTFramedSource(object):
+
+    def __init__(self, conn, start, data_length, output_printer):
+        self.conn = conn
+        self.received = start
+        self.data_length = data_length
+        self.output_printer = output_printer
+        self.holes = []
+
+    def _add_hole(self, start, end):
+        self.holes.append((start, end))
+        self.output_printer.mark_verified(self.verified())
+
+    # takes the range out of the holes, False if none of it was missing
+    def _fill(self, start, end):
+        holes = []
+        hit = False
+        for (hs, he) in self.holes:
+            if end <= hs or start >= he:
+                holes.append((hs, he))
+                continue
+            hit = True
+            if hs < start:
+                holes.append((hs, start))
+            if end < he:
+                holes.append((end, he))
+        self.holes = holes
+        return hit
+
+    # returns None when the frame read was not one to use
+    def next_block(self, bs):
+        (offset, data, good) = self.conn.read_frame(self.data_length)
+        end = offset + len(data)
+        if not good:
+            # only a block that was expected next can be asked for again,
+            # anything else means the header itself is bad
+            if offset != self.received and offset not in [hs for (hs, he) in self.holes]:
+                h = self.conn.header
+                raise LTException(511, "bad block at %d" % (offset), h['host'], int(h['port']), h['requests'])
+            pylantorrent.log(logging.WARNING, "block %d %d failed its check" % (offset, len(data)))
+            if offset == self.received:
+                self._add_hole(offset, end)
+                self.received = end
+            self.output_printer.print_results("RESEND : %d %d\r\n" % (offset, len(data)))
+            return None
+        if offset < self.received:
+            if not self._fill(offset, end):
+                return None
+        else:
+            if offset > self.received:
+                self._add_hole(self.received, offset)
+            self.received = end
+        return (offset, data)
+
+    def done(self):
+        return self.received >= self.data_length and len(self.holes) == 0
+
+    def verified(self):
+        if len(self.holes) > 0:
+            return min([hs for (hs, he) in self.holes])
+        return self.received
+
+
+#  a stream that is resumed starts at start, the md5er is then what was
+#  kept before it (or None if this node cannot know).  a block asked for
+#  again that is no longer kept is read from resend_path if there is one.
+#  on_done is called once all of the data is here
+class LTForwarder(object):
+
+    def __init__(self, source, v_con_array, files_a, data_length, block_size, buffer_blocks=32, start=0, md5er=None, resend_path=None, on_done=None):
+        self.source = source
+        self.v_con_array = v_con_array
+        self.files_a = files_a
+        self.data_length = data_length
+        self.block_size = block_size
+        self.buffer_blocks = buffer_blocks
+        self.start = start
+        self.md5er = md5er
+        self.resend_path = resend_path
+        self.on_done = on_done
+        self.history = deque()
+        self.resent = 0
+
+    def _find_block(self, offset, length):
+        for (o, data) in self.history:
+            if o <= offset and offset + length <= o + len(data):
+                return data[offset - o:offset - o + length]
+        if self.resend_path == None:
+            return None
+        f = open(self.resend_path, "rb")
+        try:
+            f.seek(offset)
+            data = f.read(length)
+        finally:
+            f.close()
+        if len(data) != length:
+            return None
+        return data
+
+    def _resend(self, v_con):
+        for (offset, length) in v_con.take_resends():
+            pylantorrent.log(logging.WARNING, "%s:%d asked for %d %d again" % (v_con.host, v_con.port, offset, length))
+            data = self._find_block(offset, length)
+            if data == None:
+                v_con.abandon("block %d %d is no longer kept" % (offset, length))
+            else:
+                v_con.queue(offset, data)
+                self.resent = self.resent + 1
+
+    # returns the md5sum of all the data, None if it was not summed or
+    # came out of order
+    def run(self):
+        md5er = self.md5er
+        md5_end = self.start
+        read_count = 0
+        said_done = False
+        writer = None
+        if len(self.files_a) > 0:
+            writer = LTFileWriter(self.files_a, self.buffer_blocks)
+        for v_con in self.v_con_array:
+            v_con.start_stream(LTRingBuffer(self.buffer_blocks * self.block_size))
+        try:
+            while True:
+                live = [v_con for v_con in self.v_con_array if v_con.valid]
+                bs = self.block_size
+                source_done = self.source.done()
+                if source_done and not said_done:
+                    said_done = True
+                    if self.on_done != None:
+                        self.on_done()
+                room = not source_done
+                for v_con in live:
+                    if not v_con.has_room(bs):
+                        room = False
+                wl = [v_con for v_con in live if v_con.pending() > 0]
+                # a framed hop is done when it says it has it all
+                waiting = [v_con for v_con in live if v_con.framing and not v_con.verified]
+                if source_done and len(wl) == 0 and len(waiting) == 0:
+                    break
+                rl = [v_con for v_con in live if not v_con.eof]
+
+                # when there is room only look at what is ready now and get
+                # back to the source, otherwise wait for a destination
+                if room:
+                    timeout = 0
+                else:
+                    timeout = None
+                if len(rl) > 0 or len(wl) > 0:
+                    (r, w, x) = select.select(rl, wl, [], timeout)
+                    for v_con in w:
+                        v_con.flush_some()
+                    for v_con in r:
+                        v_con.read_some()
+                        self._resend(v_con)
+
+                if room:
+                    block = self.source.next_block(bs)
+                    if block == None:
+                        continue
+                    (offset, data) = block
+                    if md5er != None:
+                        if offset == md5_end:
+                            md5er.update(data)
+                            md5_end = offset + len(data)
+                        else:
+                            md5er = None
+                    for v_con in live:
+                        v_con.queue(offset, data)
+                    if writer != None:
+                        writer.put(offset, data)
+                    self.history.append(block)
+                    if len(self.history) > 2 * self.buffer_blocks:
+                        self.history.popleft()
+                    read_count = read_count + len(data)
+        finally:
+            for v_con in self.v_con_array:
+                v_con.end_stream()
+            if writer != None:
+                writer.close()
+
+        md5str = None
+        if md5er != None:
+            md5str = str(md5er.hexdigest()).strip()
+        pylantorrent.log(logging.DEBUG, "We have received sent %d bytes, %d blocks sent again. The md5sum is %s" % (read_count, self.resent, md5str))
+        return md5str
@@ -0,0 +1,387 @@
+import os
+import errno
+import socket
+import sqlite3
+import threading
+import datetime
+import time
+import logging
+import traceback
+import pylantorrent
+from pylantorrent.db import LantorrentDB
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+#
+#  the requests the daemon has to send.  they are handed to it over a unix
+#  socket and kept in memory grouped by source file, the requests table is
+#  only the journal that lets a restarted daemon pick up where it was.
+#
+#  a client sends one json object per line and gets one back for each:
+#
+#      {"cmd" : "submit", "rid", "src", "dst", "host", "port", "group"}
+#      {"cmd" : "status", "rid"}
+#      {"cmd" : "await", "rid"}
+#      {"cmd" : "cancel", "rid"}
+#
+#  the reply is {"rid", "done", "rc", "message"}.  an await is answered
+#  when the request is done, there is no polling.  group is how many
+#  requests for the source file are expected, optional.  cancel also
+#  forgets a request that is done.
+#
+#  a group is sent once it has the expected number of requests, or no
+#  request for it has come in for a while, or it is insert_delay old.  the
+#  while is three times the gap between the requests seen for it so far,
+#  no less than batch_min, so requests that trickle in are still sent as
+#  one group and a lone request is not held up
+#
+
+g_max_attempts = 3
+
+def open_journal(dbfile):
+    # use sqlalchemy to make sure the db is there
+    x = LantorrentDB("sqlite:///%s" % dbfile)
+    x.close()
+    con = sqlite3.connect(dbfile, timeout=30, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+    # readers are never locked out by the daemon writing
+    con.execute("pragma journal_mode=wal")
+    return con
+
+class LTRequest(object):
+
+    def __init__(self, rid, src_filename, dst_filename, hostname, port, attempt_count=0, ready_time=None):
+        self.rid = rid
+        self.src_filename = src_filename
+        self.dst_filename = dst_filename
+        self.hostname = hostname
+        self.port = int(port)
+        self.attempt_count = attempt_count
+        if ready_time == None:
+            ready_time = time.time()
+        self.ready_time = ready_time
+
+    # as the rows of the requests table are used by the daemon
+    def get_row(self):
+        return (self.hostname, self.port, self.src_filename, self.dst_filename, self.rid, self.attempt_count)
+
+#  when the requests for one source file came in
+class LTBatch(object):
+
+    def __init__(self, now):
+        self.first = now
+        self.last = now
+        self.count = 0
+        self.gap = None
+        self.expected = None
+
+    def arrived(self, now, expected=None):
+        if self.count > 0:
+            gap = max(now - self.last, 0.0)
+            if self.gap == None:
+                self.gap = gap
+            else:
+                self.gap = (self.gap + gap) / 2.0
+        self.count = self.count + 1
+        self.last = max(self.last, now)
+        if expected != None and (self.expected == None or expected > self.expected):
+            self.expected = expected
+
+class LTRequestQueue(object):
+
+    def __init__(self, con, batch_min=1.0, batch_max=30.0, retry_delay=5):
+        self.con = con
+        self.batch_min = batch_min
+        self.batch_max = batch_max
+        self.retry_delay = retry_delay
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.in_flight = {}
+        self.batches = {}
+        self.sweep()
+
+    def _journal(self, sql, data):
+        c = self.con.cursor()
+        c.execute(sql, data)
+        self.con.commit()
+        return c
+
+    def _add(self, req, expected=None):
+        self.pending[req.rid] = req
+        b = self.batches.get(req.src_filename)
+        if b == None:
+            b = LTBatch(req.ready_time)
+            self.batches[req.src_filename] = b
+        b.arrived(req.ready_time, expected)
+        self.cond.notifyAll()
+
+    def submit(self, req, expected=None):
+        os.path.getsize(req.src_filename)
+        self.cond.acquire()
+        try:
+            i = "insert into requests(src_filename, dst_filename, hostname, port, rid, entry_time, state, attempt_count) values (?, ?, ?, ?, ?, ?, ?, ?)"
+            data = (req.src_filename, req.dst_filename, req.hostname, req.port, req.rid, datetime.datetime.now(), 0, 0, )
+            self._journal(i, data)
+            self._add(req, expected)
+            pylantorrent.log(logging.INFO, "new request %s" % (req.rid))
+        finally:
+            self.cond.release()
+
+    # picks up what is in the journal and not here, what was left by a
+    # daemon that stopped or put there by a request without the daemon
+    def sweep(self):
+        self.cond.acquire()
+        try:
+            s = "select hostname,port,src_filename,dst_filename,rid,attempt_count from requests where state = 0 and attempt_count < ?"
+            c = self._journal(s, (g_max_attempts,))
+            for r in c.fetchall():
+                rid = r[4]
+                if rid in self.pending or rid in self.in_flight:
+                    continue
+                pylantorrent.log(logging.INFO, "picked up request %s from the journal" % (rid))
+                self._add(LTRequest(rid, r[2], r[3], r[0], r[1], int(r[5])))
+        finally:
+            self.cond.release()
+
+    def cancel(self, rid):
+        self.cond.acquire()
+        try:
+            if rid in self.in_flight:
+                return False
+            req = self.pending.pop(rid, None)
+            # a batch with nothing left in it is not waited on
+            if req != None and not self._has_pending(req.src_filename):
+                self.batches.pop(req.src_filename, None)
+            self._journal("delete from requests where rid = ?", (rid,))
+            self.cond.notifyAll()
+            return True
+        finally:
+            self.cond.release()
+
+    # (done, rc, message)
+    def status(self, rid):
+        self.cond.acquire()
+        try:
+            if rid in self.pending or rid in self.in_flight:
+                return (False, 0, None)
+            c = self._journal("select state,message,attempt_count from requests where rid = ?", (rid,))
+            rs = c.fetchone()
+            if rs == None:
+                return (True, 1, "no request %s" % (rid))
+            (state, message, attempt_count) = (int(rs[0]), rs[1], int(rs[2]))
+            if state == 1:
+                return (True, 0, message)
+            if attempt_count >= g_max_attempts:
+                if message == None:
+                    message = "too many attempts %d" % (attempt_count)
+                return (True, 1, message)
+            return (False, 0, message)
+        finally:
+            self.cond.release()
+
+    def wait(self, rid):
+        self.cond.acquire()
+        try:
+            while True:
+                (done, rc, message) = self.status(rid)
+                if done:
+                    return (done, rc, message)
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+    def _has_pending(self, src_filename):
+        for r in self.pending.values():
+            if r.src_filename == src_filename:
+                return True
+        return False
+
+    # (ready, the time it will be ready).  the time is None if the batch
+    # has no requests
+    def _ready(self, src_filename, b, now):
+        if not self._has_pending(src_filename):
+            return (False, None)
+        n = len([r for r in self.pending.values() if r.src_filename == src_filename and r.ready_time <= now])
+        if n > 0 and b.expected != None and n >= b.expected:
+            return (True, now)
+        quiet = self.batch_min
+        if b.gap != None:
+            quiet = max(quiet, 3.0 * b.gap)
+        when = min(b.first + self.batch_max, b.last + quiet)
+        return (n > 0 and when <= now, when)
+
+    # the rows of the next group to send, None if there is none before
+    # the timeout
+    def next_group(self, timeout=None):
+        self.cond.acquire()
+        try:
+            end = None
+            if timeout != None:
+                end = time.time() + timeout
+            while True:
+                now = time.time()
+                best = None
+                wake = end
+                for (src_filename, b) in self.batches.items():
+                    (ready, when) = self._ready(src_filename, b, now)
+                    if ready:
+                        if best == None or b.first < self.batches[best].first:
+                            best = src_filename
+                    elif when != None and (wake == None or when < wake):
+                        wake = when
+                if best != None:
+                    return self._take(best, now)
+                if end != None and now >= end:
+                    return None
+                if wake == None:
+                    self.cond.wait()
+                else:
+                    self.cond.wait(max(wake - now, 0.01))
+        finally:
+            self.cond.release()
+
+    def _take(self, src_filename, now):
+        reqs = [r for r in self.pending.values() if r.src_filename == src_filename and r.ready_time <= now]
+        for r in reqs:
+            del self.pending[r.rid]
+            self.in_flight[r.rid] = r
+        del self.batches[src_filename]
+        # retries not yet due start a batch of their own
+        for r in self.pending.values():
+            if r.src_filename == src_filename:
+                b = self.batches.get(src_filename)
+                if b == None:
+                    self.batches[src_filename] = LTBatch(r.ready_time)
+                else:
+                    b.arrived(r.ready_time)
+        reqs.sort(key=lambda r: (r.hostname, r.port))
+        pylantorrent.log(logging.INFO, "selected %d requests for %s" % (len(reqs), src_filename))
+        return [r.get_row() for r in reqs]
+
+    # errors are the incomplete requests of the transfer by rid
+    def finish(self, rows, errors):
+        self.cond.acquire()
+        try:
+            now = time.time()
+            for row in rows:
+                rid = row[4]
+                req = self.in_flight.pop(rid)
+                if rid not in errors:
+                    u = "update requests set state = ?, message = ? where rid = ?"
+                    self._journal(u, (1, "Success", rid,))
+                    continue
+                e = errors[rid]
+                pylantorrent.log(logging.ERROR, "error trying to send %s" % (str(e)))
+                req.attempt_count = req.attempt_count + 1
+                u = "update requests set state = ?, message = ?, attempt_count = ?, entry_time = ? where rid = ?"
+                self._journal(u, (0, str(e), req.attempt_count, datetime.datetime.now(), rid,))
+                # a retry waits retry_delay, other groups are sent in the
+                # mean time
+                if req.attempt_count < g_max_attempts:
+                    req.ready_time = now + self.retry_delay
+                    self._add(req)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+
+#  serves the socket, a thread for each client
+class LTQueueServer(object):
+
+    def __init__(self, queue, path):
+        self.queue = queue
+        self.path = path
+        try:
+            os.remove(path)
+        except OSError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, 0600)
+        self.sock.listen(16)
+        self.thread = threading.Thread(target=self.run, name="lantorrent-queue")
+        self.thread.setDaemon(True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.sock.close()
+        try:
+            os.remove(self.path)
+        except:
+            pass
+
+    def run(self):
+        while True:
+            try:
+                (conn, addr) = self.sock.accept()
+            except socket.error, ex:
+                pylantorrent.log(logging.INFO, "queue socket closed %s" % (str(ex)))
+                return
+            t = threading.Thread(target=self.serve, args=(conn,))
+            t.setDaemon(True)
+            t.start()
+
+    def _do(self, msg):
+        cmd = msg['cmd']
+        rid = msg['rid']
+        if cmd == "submit":
+            req = LTRequest(rid, msg['src'], msg['dst'], msg['host'], msg.get('port', 2893))
+            group = msg.get('group')
+            if group != None:
+                group = int(group)
+            self.queue.submit(req, group)
+            return (False, 0, "queued")
+        if cmd == "status":
+            return self.queue.status(rid)
+        if cmd == "await":
+            return self.queue.wait(rid)
+        if cmd == "cancel":
+            if not self.queue.cancel(rid):
+                return (False, 1, "%s is being sent" % (rid))
+            return (True, 0, "cancelled")
+        raise Exception("unknown command %s" % (cmd))
+
+    def serve(self, conn):
+        f = conn.makefile("r+")
+        try:
+            l = f.readline()
+            while l:
+                rid = None
+                try:
+                    msg = json.loads(l)
+                    rid = msg.get('rid')
+                    (done, rc, message) = self._do(msg)
+                except Exception, ex:
+                    pylantorrent.log(logging.ERROR, "bad queue request %s" % (l.strip()), traceback)
+                    (done, rc, message) = (True, 1, str(ex))
+                reply = {'rid' : rid, 'done' : done, 'rc' : rc, 'message' : message}
+                f.write(json.dumps(reply) + "\n")
+                f.flush()
+                l = f.readline()
+        finally:
+            f.close()
+            conn.close()
+
+
+class LTQueueClient(object):
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.f = self.sock.makefile("r+")
+
+    def call(self, msg):
+        self.f.write(json.dumps(msg) + "\n")
+        self.f.flush()
+        l = self.f.readline()
+        if not l:
+            raise Exception("the lantorrent daemon closed the connection")
+        return json.loads(l)
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
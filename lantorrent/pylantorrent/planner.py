@@ -0,0 +1,290 @@
+import sys
+import os
+import logging
+import pylantorrent
+from pylantorrent import cbOpts
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+#
+#  picks the shape of the tree a group of destinations is sent down.
+#
+#  a server takes the first 'degree' entries of the destinations it is
+#  given as the hops it sends to, the rest is split in order into 'degree'
+#  runs (the first run also gets what does not divide evenly) and each hop
+#  is sent its run.  so a plan is just the order of the flat list and the
+#  degree of each entry, which is what this makes.  every server already
+#  understands it.
+#
+#  for each root and node degree up to max_degree the destinations are laid
+#  into the tree, the hosts of a rack next to each other so a subtree stays
+#  in its rack, and the fastest hosts of a rack where there are the most
+#  hops to feed.  the plan with the shortest predicted time is used.
+#
+#  a prediction treats the transfer as a pipeline.  every hop gets the
+#  nic of its parent divided by the parent's fanout, no more than its own
+#  nic, and links that leave a rack share that rack's uplink.  a node's
+#  rate is the lowest rate on its path and it finishes after the whole
+#  file at that rate plus a block and the latency for every hop above it
+#
+
+g_mbit = 1000.0 * 1000.0 / 8.0
+
+#  capacities come from the links file, lines of
+#
+#       <host> <megabits per second> [<rack>]
+#
+#  any host not in the file uses what was measured the last time it was
+#  sent to, or the default
+class LTLinks(object):
+
+    def __init__(self, filename=None, default_mbps=1000.0, source_mbps=1000.0, uplink_mbps=0.0):
+        self.default = default_mbps * g_mbit
+        self.source = source_mbps * g_mbit
+        self.uplink = uplink_mbps * g_mbit
+        self.configured = {}
+        self.racks = {}
+        self.measured = {}
+        if filename != None and os.path.exists(filename):
+            self.load(filename)
+
+    def load(self, filename):
+        f = open(filename, "r")
+        try:
+            for l in f.readlines():
+                l = l.strip()
+                if l == "" or l[0] == "#":
+                    continue
+                a = l.split()
+                self.configured[a[0]] = float(a[1]) * g_mbit
+                if len(a) > 2:
+                    self.racks[a[0]] = a[2]
+        finally:
+            f.close()
+
+    # rates in bytes per second
+    def set_measured(self, measured):
+        self.measured = measured
+
+    def capacity(self, host):
+        if host in self.configured:
+            return self.configured[host]
+        if host in self.measured:
+            return self.measured[host]
+        return self.default
+
+    def rack(self, host):
+        return self.racks.get(host)
+
+def get_links():
+    c = pylantorrent.config
+    return LTLinks(c.links_file, c.default_mbps, c.source_mbps, c.uplink_mbps)
+
+class LTPlanNode(object):
+
+    def __init__(self, entry, depth):
+        self.entry = entry
+        self.depth = depth
+        self.degree = 1
+        self.children = []
+
+    def walk(self):
+        yield self
+        for c in self.children:
+            for n in c.walk():
+                yield n
+
+# the runs a server with the given degree gives to each of its n hops
+def _runs(n, degree):
+    k = min(degree, n)
+    r = n - k
+    each = r / degree
+    rem = r % degree
+    runs = []
+    for i in range(k):
+        runs.append(each + rem)
+        rem = 0
+    return runs
+
+# the tree the servers will build from this header
+def decode_plan(header):
+    root = LTPlanNode(header, 0)
+    _decode(root, list(header.get('destinations', [])), int(header.get('degree', 1)))
+    return root
+
+def _decode(node, destinations, degree):
+    runs = _runs(len(destinations), degree)
+    hops = destinations[:len(runs)]
+    ndx = len(runs)
+    for (ent, run) in zip(hops, runs):
+        child = LTPlanNode(ent, node.depth + 1)
+        node.children.append(child)
+        _decode(child, destinations[ndx:ndx + run], int(ent.get('degree', 1)))
+        ndx = ndx + run
+
+# the flat list that decodes to the tree
+def encode_plan(root):
+    destinations = []
+    for c in root.children:
+        destinations.append(c.entry)
+    for c in root.children:
+        destinations = destinations + encode_plan(c)
+    return destinations
+
+def _host(entry):
+    return entry['host']
+
+# the time it takes every node to have the file
+def simulate(header, links, length=None, hop_latency=0.001):
+    if length == None:
+        length = long(header['length'])
+    block_size = int(header.get('block_size', 128*1024))
+    root = decode_plan(header)
+
+    cross_out = {}
+    cross_in = {}
+    for n in root.walk():
+        for c in n.children:
+            (pr, cr) = (links.rack(_host(n.entry)), links.rack(_host(c.entry)))
+            if n != root and pr != None and cr != None and pr != cr:
+                cross_out[pr] = cross_out.get(pr, 0) + 1
+                cross_in[cr] = cross_in.get(cr, 0) + 1
+
+    times = {}
+    worst = [0.0]
+    def visit(n, rate):
+        if n == root:
+            out = links.source
+        else:
+            out = links.capacity(_host(n.entry))
+        for c in n.children:
+            r = min(rate, out / len(n.children), links.capacity(_host(c.entry)))
+            (pr, cr) = (links.rack(_host(n.entry)), links.rack(_host(c.entry)))
+            if n != root and links.uplink > 0 and pr != None and cr != None and pr != cr:
+                r = min(r, links.uplink / cross_out[pr], links.uplink / cross_in[cr])
+            t = length / r + c.depth * (block_size / r + hop_latency)
+            times["%s:%s" % (_host(c.entry), str(c.entry['port']))] = t
+            worst[0] = max(worst[0], t)
+            visit(c, r)
+    visit(root, float("inf"))
+    return (worst[0], times)
+
+#  lay the entries into the tree given by the degrees
+def _layout(dests, links, root_degree, degree, rack_aware):
+    def build(node, n):
+        for run in _runs(n, node.degree):
+            c = LTPlanNode(None, node.depth + 1)
+            c.degree = degree
+            node.children.append(c)
+            build(c, run)
+    root = LTPlanNode(None, 0)
+    root.degree = root_degree
+    build(root, len(dests))
+    positions = list(root.walk())[1:]
+
+    # the racks with the most hosts first, a rack is a run of positions
+    if rack_aware:
+        racks = {}
+        for d in dests:
+            racks.setdefault(links.rack(_host(d)), []).append(d)
+        groups = sorted(racks.values(), key=lambda g: (-len(g), _host(g[0])))
+    else:
+        groups = [list(dests)]
+
+    ndx = 0
+    for g in groups:
+        run = positions[ndx:ndx + len(g)]
+        ndx = ndx + len(g)
+        # the fast hosts go where there are the most hops to feed
+        run = sorted(run, key=lambda p: (-len(p.children), p.depth))
+        g = sorted(g, key=lambda d: (-links.capacity(_host(d)), _host(d), d['port']))
+        for (p, d) in zip(run, g):
+            p.entry = dict(d)
+            p.entry['degree'] = degree
+    return root
+
+#  picks the plan for this group.  dests are destination entries as made
+#  by create_endpoint_entry, header is the entry for the root (it is not
+#  changed).  returns the header to send with the prediction for it
+def plan(header, dests, links, max_degree=4, hop_latency=0.001):
+    best = None
+    if len(dests) == 0:
+        final = dict(header)
+        final['destinations'] = []
+        return (final, 0.0)
+    for rack_aware in [True, False]:
+        for root_degree in range(1, max_degree + 1):
+            for degree in range(1, max_degree + 1):
+                root = _layout(dests, links, root_degree, degree, rack_aware)
+                final = dict(header)
+                final['degree'] = root_degree
+                final['destinations'] = encode_plan(root)
+                (t, times) = simulate(final, links, hop_latency=hop_latency)
+                total = sum(times.values())
+                # the last to finish decides, then how long all of them
+                # wait.  on a tie the narrower tree wins
+                if best == None or t < best[0] * 0.999 or (t < best[0] * 1.001 and total < best[1] * 0.999):
+                    best = (t, total, final)
+    pylantorrent.log(logging.INFO, "planned %d destinations with degree %d, predicted %f seconds" % (len(dests), best[2]['degree'], best[0]))
+    return (best[2], best[0])
+
+
+def setup_options(argv):
+
+    u = """[options] <size in bytes>
+Plan the transfer of a file of the given size to the host:port/path
+destinations read from stdin, or with --simulate predict the time of the
+header read from stdin
+    """
+    (parser, all_opts) = pylantorrent.get_default_options(u)
+
+    opt = cbOpts("simulate", "s", "Predict the time of a header rather than planning one", False, flag=True)
+    all_opts.append(opt)
+    opt = cbOpts("links", "l", "The links file", None)
+    all_opts.append(opt)
+
+    (o, args) = pylantorrent.parse_args(parser, all_opts, argv)
+    return (o, args, parser)
+
+def main(argv=sys.argv[1:]):
+
+    (o, args, p) = setup_options(argv)
+    c = pylantorrent.config
+    links_file = o.links
+    if links_file == None:
+        links_file = c.links_file
+    links = LTLinks(links_file, c.default_mbps, c.source_mbps, c.uplink_mbps)
+
+    if o.simulate:
+        header = json.loads(o.in_file.read())
+        (t, times) = simulate(header, links, hop_latency=c.hop_latency)
+    else:
+        if len(args) < 1:
+            p.print_usage()
+            return 1
+        size = long(args[0])
+        dests = []
+        l = o.in_file.readline()
+        while l:
+            l = l.strip()
+            if l:
+                (host, rest) = l.split(":", 1)
+                (port, path) = rest.split("/", 1)
+                dests.append(pylantorrent.create_endpoint_entry(host, ["/" + path], size, port=int(port)))
+            l = o.in_file.readline()
+        header = pylantorrent.create_endpoint_entry("localhost", ["/dev/null"], size, rename=False)
+        (header, t) = plan(header, dests, links, c.max_degree, c.hop_latency)
+        (t, times) = simulate(header, links, hop_latency=c.hop_latency)
+        o.out_file.write(json.dumps(header, sort_keys=True, indent=4) + "\n")
+
+    if not o.batch:
+        for k in sorted(times.keys(), key=lambda k: times[k]):
+            o.out_file.write("%s %.3f\n" % (k, times[k]))
+    o.out_file.write("predicted %.3f seconds\n" % (t))
+    return 0
+
+if __name__ == "__main__":
+    rc = main()
+    sys.exit(rc)
@@ -2,9 +2,9 @@ import sqlite3
 from socket import *
 import logging
 import pylantorrent
-from pylantorrent.db import LantorrentDB
 from pylantorrent.server import LTServer
 from pylantorrent.client import LTClient
+from pylantorrent.ltQueue import LTQueueClient, open_journal
 import os
 try:
     import json
@@ -29,6 +29,8 @@ Submit a transfer request
     all_opts.append(opt)
     opt = cbOpts("cancel", "c", "Cancel", False, flag=True)
     all_opts.append(opt)
+    opt = cbOpts("group", "g", "The number of requests expected for this source file", None)
+    all_opts.append(opt)
 
     (o, args) = pylantorrent.parse_args(parser, all_opts, argv)
     return (o, args, parser)
@@ -92,7 +94,7 @@ def delete_rid(con, rid):
                 raise sqlex
             time.sleep(random.random() * 2.0)
 
-def request(argv, con):
+def parse_request(argv):
     if len(argv) < 4:
         raise Exception("You must provide 4 arguments: <src file> <dst file> <a uuid for this request> <the contanct string of the receiving nodes lt server>")
     src_filename = argv[0]
@@ -115,6 +117,10 @@ def request(argv, con):
         port = int(ha[1])
     else:
         port = 2893
+    return (src_filename, dst_filename, rid, host, port, sz)
+
+def request(argv, con):
+    (src_filename, dst_filename, rid, host, port, sz) = parse_request(argv)
 
     now = datetime.datetime.now()
     i = "insert into requests(src_filename, dst_filename, hostname, port, rid, entry_time, state, attempt_count) values (?, ?, ?, ?, ?, ?, ?, ?)"
@@ -138,13 +144,41 @@ def request(argv, con):
     # should never get here
     raise Exception("LANTorrent should not have gotten here")
 
+#  the same through the daemon's socket, the answer to an await is sent
+#  when the request is done.  returns None for a cancel.  a request the
+#  daemon would not take is done with its error, like any other it is
+#  printed for the caller
+def queue_request(o, args, q):
+    if o.reattach is None:
+        (src_filename, dst_filename, rid, host, port, sz) = parse_request(args)
+        msg = {'cmd' : "submit", 'rid' : rid, 'src' : src_filename, 'dst' : dst_filename, 'host' : host, 'port' : port, 'group' : o.group}
+        r = q.call(msg)
+        if r['rc'] != 0:
+            pylantorrent.log(logging.ERROR, "the daemon did not take %s: %s" % (rid, r['message']))
+            return (True, r['rc'], r['message'])
+        pylantorrent.log(logging.INFO, "new request %s %d" % (rid, sz))
+    else:
+        rid = o.reattach
+        if o.cancel:
+            q.call({'cmd' : "cancel", 'rid' : rid})
+            return None
+
+    if o.nonblock:
+        r = q.call({'cmd' : "status", 'rid' : rid})
+    else:
+        r = q.call({'cmd' : "await", 'rid' : rid})
+    if r['done']:
+        q.call({'cmd' : "cancel", 'rid' : rid})
+    return (r['done'], r['rc'], r['message'])
+
 
 def main(argv=sys.argv[1:]):
     """
     This program allows a file to be requested from the lantorrent system.  The
-    file will be sent out of band.  When the file has been delived the 
-    database entry for this request will be updated.  This program will
-    block until that entry is update.
+    file will be sent out of band.  The request is handed to the lantorrent
+    daemon on its socket and this program blocks until the daemon says the
+    file has been delivered.  When the daemon is not running the request
+    is put in its database and the entry is polled until it is updated.
 
     As options, the program takes the source file, the
     target file location, the group_id and the group count.
@@ -158,12 +192,23 @@ def main(argv=sys.argv[1:]):
 
     (o, args, p) = setup_options(argv)
 
-    # use sqlaclh to make sure the db is there
-    x = LantorrentDB("sqlite:///%s" % pylantorrent.config.dbfile)
-    x.close()
-    
-    con_str = pylantorrent.config.dbfile
-    con = sqlite3.connect(con_str, isolation_level="EXCLUSIVE")
+    try:
+        q = LTQueueClient(pylantorrent.config.queue_socket)
+    except Exception, ex:
+        q = None
+        pylantorrent.log(logging.WARNING, "the daemon is not on %s, using the db: %s" % (pylantorrent.config.queue_socket, str(ex)))
+    if q != None:
+        try:
+            res = queue_request(o, args, q)
+        finally:
+            q.close()
+        if res == None:
+            return 0
+        (done, rc, message) = res
+        print "%d,%s,%s" % (rc, str(done), message)
+        return 0
+
+    con = open_journal(pylantorrent.config.dbfile)
 
     rc = 0
     sz = -1
@@ -5,9 +5,11 @@ import logging
 import pylantorrent
 from pylantorrent.ltException import LTException
 from pylantorrent.ltConnection import *
+from pylantorrent.ltForward import LTForwarder, LTFileSource, LTStreamSource, LTFramedSource
 import simplejson as json
 import traceback
 import hashlib
+import time
 
 #  The first thing sent is a json header terminated by a single line
 #  of EOH
@@ -24,11 +26,69 @@ import hashlib
 #           requests = [ { filename, id, rename } ]
 #           block_size
 #       }, ]
+#      resume           (optional)
+#      framing          (optional)
 #  }
 #
+#  framing is offered by a sender that can send the data in checked
+#  blocks, see ltConnection.  a node answers an offer and reads the data
+#  as it answered, it offers framing to its hops as it is configured, by
+#  default if it was offered it
+#
+#  when resume is set each node answers the header with a line of
+#
+#      OFFSET : <n>
+#
+#  n is the least that it or any node under it already has, the data then
+#  starts at byte n.  a node knows what it has from the .lantorrent file
+#  of a request and the .state file next to it that says which request
+#  and length it was written for, and how much of it is whole if a block
+#  is still missing.  they are kept when a transfer fails, unless the data
+#  failed its checksum
+#
+#  the first 'degree' destinations are the hops this node sends to, the
+#  rest is split in order among them.  the first also gets what is left
+#  over
+def split_runs(destinations, degree, count):
+    each = len(destinations) / degree
+    rem = len(destinations) % degree
+    runs = []
+    ndx = 0
+    for i in range(count):
+        end = ndx + each + rem
+        runs.append(destinations[ndx:end])
+        rem = 0
+        ndx = end
+    return runs
+
+# the hops a node with these destinations sends to, each with its run
+def split_destinations(destinations, degree):
+    hops = destinations[:degree]
+    runs = split_runs(destinations[len(hops):], degree, len(hops))
+    return zip(hops, runs)
+
+def get_resume_offset(tmpname, rid, length):
+    try:
+        f = open(tmpname + ".state", "r")
+        try:
+            state = json.loads(f.read())
+        finally:
+            f.close()
+        if state['id'] != rid or long(state['length']) != length:
+            return 0
+        return min(os.path.getsize(tmpname), long(state.get('verified', length)))
+    except:
+        return 0
+
+def _is_dev(filename):
+    return filename.strip().find("/dev") == 0
+
 class LTServer(object):
 
-    def __init__(self, inf, outf):
+    # repair_path is the whole file to send again from when a hop fails
+    # and this node has none of its own (as with the daemon).  framing
+    # True or False says how to send to the hops, None does as the header
+    def __init__(self, inf, outf, repair_path=None, framing=None):
         self.json_header = {}
         self.source_conn = LTSourceConnection(inf)
         self.outf = outf
@@ -38,6 +98,11 @@ class LTServer(object):
         self.v_con_array = []
         self.files_a = []
         self.md5str = None
+        self.resume = False
+        self.repair_path = repair_path
+        self.framing = framing
+        self.in_framing = 0
+        self.out_framing = False
 
     def _close_files(self):
         for f in self.files_a:
@@ -55,30 +120,60 @@ class LTServer(object):
         pylantorrent.log(logging.DEBUG, "cleaning up")
         for f in self.created_files:
             try:
-                pylantorrent.log(logging.DEBUG, "deleting file %s" % (f))
                 # dont delete /dev/null (or any other dev really)
-                ndx = f.strip().find("/dev")
-                if ndx != 0:
-                    os.remove(f)
+                if _is_dev(f):
+                    continue
+                # what was received of a request is kept for a resume
+                if os.path.exists(f + ".state") and os.path.getsize(f) > 0:
+                    pylantorrent.log(logging.INFO, "keeping %s to resume" % (f))
+                    continue
+                pylantorrent.log(logging.DEBUG, "deleting file %s" % (f))
+                os.remove(f)
+                os.remove(f + ".state")
             except:
                 pass
         self.created_files = []
 
     def _read_footer(self):
-        self.footer = self.source_conn.read_footer(self.md5str)
+        try:
+            self.footer = self.source_conn.read_footer(self.md5str)
+        except LTException, ex:
+            # what was written is not what was sent, none of it can be
+            # resumed from.  without the state clean_up deletes it
+            if ex.code == 510:
+                self._drop_state()
+            raise
+        self.md5str = self.footer['md5sum']
 
-    def _send_footer(self):
+    def _drop_state(self):
+        for f in self.created_files:
+            if _is_dev(f):
+                continue
+            try:
+                os.remove(f + ".state")
+            except OSError:
+                pass
+
+    def _send_footer(self, v_con_array):
         foot = {}
         foot['md5sum'] = self.md5str
         foot_str = json.dumps(foot)
         pylantorrent.log(logging.DEBUG, "sending footer %s" % (foot_str))
-        for v_con in self.v_con_array:
+        for v_con in v_con_array:
             v_con.send(foot_str)
 
     def _read_header(self):
         self.json_header = self.source_conn.read_header()
         self.degree = int(self.json_header['degree'])
         self.data_length = long(self.json_header['length'])
+        self.resume = bool(self.json_header.get('resume', False))
+        self.in_framing = min(int(self.json_header.get('framing', 0)), g_framing_version)
+        if self.in_framing > 0:
+            self.print_results("FRAMING : %d\r\n" % (self.in_framing))
+        if self.framing == None:
+            self.out_framing = self.in_framing > 0
+        else:
+            self.out_framing = bool(self.framing)
 
     def print_results(self, s):
         pylantorrent.log(logging.DEBUG, "printing\n--------- \n%s\n---------------" % (s))
@@ -99,17 +194,84 @@ class LTServer(object):
                 s = vex.get_printable()
                 self.print_results(s)
 
-        each = len(destinations) / self.degree
-        rem = len(destinations) % self.degree
-        ndx = 0
-        for v_con in v_con_array:
-            end = ndx + each + rem
-            mine = destinations[ndx:end]
-            rem = 0
-            v_con.send_header(mine)
+        runs = split_runs(destinations, self.degree, len(v_con_array))
+        for (v_con, mine) in zip(v_con_array, runs):
+            v_con.send_header(mine, self.resume, self.out_framing)
+        self._agree_framing(v_con_array)
         self.v_con_array = v_con_array
 
-    def _open_dest_files(self, requests_a):
+    # the hops are waited on together, only the old ones take the time
+    def _agree_framing(self, v_con_array):
+        if not self.out_framing:
+            return
+        end = time.time() + pylantorrent.config.framing_timeout
+        for v_con in v_con_array:
+            v_con.read_framing(max(end - time.time(), 0))
+
+    # the least this node has of its requests, None if it keeps no data
+    def _get_local_offset(self, requests_a):
+        offset = None
+        for req in requests_a:
+            filename = req['filename']
+            if _is_dev(filename):
+                continue
+            o = 0
+            if req['rename']:
+                o = get_resume_offset(filename + self.suffix, req['id'], self.data_length)
+            if offset == None or o < offset:
+                offset = o
+        return offset
+
+    def _agree_offset(self, requests_a):
+        offset = self._get_local_offset(requests_a)
+        for v_con in self.v_con_array:
+            o = v_con.read_offset(pylantorrent.config.offset_timeout)
+            if o != None and (offset == None or o < offset):
+                offset = o
+        if offset == None:
+            offset = 0
+        pylantorrent.log(logging.INFO, "resuming at %d of %d" % (offset, self.data_length))
+        self.print_results("OFFSET : %d\r\n" % (offset))
+        return offset
+
+    # the sum of what is kept, None if no file was kept to sum
+    def _get_md5er(self, requests_a, offset):
+        md5er = hashlib.md5()
+        if offset == 0:
+            return md5er
+        for req in requests_a:
+            if _is_dev(req['filename']) or not req['rename']:
+                continue
+            f = open(req['filename'] + self.suffix, "rb")
+            try:
+                left = offset
+                while left > 0:
+                    data = f.read(min(left, 1024*1024))
+                    md5er.update(data)
+                    left = left - len(data)
+            finally:
+                f.close()
+            return md5er
+        return None
+
+    def _write_state(self, filename, req, verified=None):
+        state = {'id' : req['id'], 'length' : self.data_length}
+        if verified != None:
+            state['verified'] = verified
+        sf = open(filename + ".state", "w")
+        try:
+            sf.write(json.dumps(state))
+        finally:
+            sf.close()
+
+    # called by the framed source when a block goes missing
+    def mark_verified(self, verified):
+        for req in self.json_header['requests']:
+            filename = req['filename'] + self.suffix
+            if req['rename'] and filename in self.created_files:
+                self._write_state(filename, req, verified)
+
+    def _open_dest_files(self, requests_a, offset=0):
         files_a = []
         for req in requests_a:
             filename = req['filename']
@@ -117,7 +279,14 @@ class LTServer(object):
                 rn = req['rename']
                 if rn:
                     filename = filename + self.suffix
-                f = open(filename, "w")
+                if offset > 0 and not _is_dev(filename):
+                    f = open(filename, "r+b")
+                    f.seek(offset)
+                    f.truncate()
+                else:
+                    f = open(filename, "w")
+                if rn and not _is_dev(filename):
+                    self._write_state(filename, req)
                 files_a.append(f)
                 self.created_files.append(filename)
             except Exception, ex:
@@ -125,28 +294,77 @@ class LTServer(object):
                 raise LTException(503, str(ex), self.json_header['host'], int(self.json_header['port']), reqs=requests_a)
         self.files_a = files_a
 
-    # perhaps this should even be an io event system or threads.  For now
-    # it will throttle on the one blocking socket from the data source
-    # and push the rest to the vcon objects
-    def _process_io(self):
-        md5er = hashlib.md5()
-        read_count = 0
-        bs = self.block_size
-        while read_count < self.data_length:
-            if bs + read_count > self.data_length:
-                bs = self.data_length - read_count
-            data = self.source_conn.read_data(bs)
-            if data == None:
-                raise Exception("Data is None prior to receiving full file %d %d" % (read_count, self.data_length))
-            md5er.update(data)
-            for v_con in self.v_con_array:
-                v_con.send(data)
-            for f in self.files_a:
-                f.write(data)
-            read_count = read_count + len(data)
-        self.md5str = str(md5er.hexdigest()).strip()
-        pylantorrent.log(logging.DEBUG, "We have received sent %d bytes. The md5sum is %s" % (read_count, self.md5str))
+    # the blocks are moved by the engine in ltForward: the sockets to the
+    # next hops are drained as they can take data and the files are written
+    # from a thread, so only a full buffer holds up the source.  a block
+    # asked for again once the engine no longer keeps it is read back from
+    # what this node wrote, the engine keeps more blocks than the writer
+    # has waiting so it is in the file by then
+    def _process_io(self, requests_a, offset=0, md5er=None):
+        if self.in_framing > 0:
+            source = LTFramedSource(self.source_conn, offset, self.data_length, self)
+        else:
+            source = LTStreamSource(self.source_conn, offset, self.data_length)
+        engine = LTForwarder(source, self.v_con_array, self.files_a, self.data_length, self.block_size, pylantorrent.config.buffer_blocks, offset, md5er, self._get_repair_path(requests_a), self._data_done)
+        self.md5str = engine.run()
+
+    def _data_done(self):
+        if self.in_framing > 0:
+            self.print_results("VERIFIED : %d\r\n" % (self.data_length))
+
+    def _get_repair_path(self, requests_a):
+        for req in requests_a:
+            if req['rename'] and not _is_dev(req['filename']):
+                return req['filename'] + self.suffix
+        return self.repair_path
+
+    #  the hops of one that failed are sent the file from here once this
+    #  node has all of it.  each subtree picks up where it left off, the
+    #  rest of the tree is not held up.  the failed hop itself is reported
+    #  and left to the daemon
+    def _repair(self, requests_a):
+        orphans = []
+        for v_con in self.v_con_array:
+            if v_con.failed and v_con.destinations:
+                orphans = orphans + split_destinations(v_con.destinations, v_con.degree)
+        path = self._get_repair_path(requests_a)
+        if len(orphans) > 0 and path == None:
+            pylantorrent.log(logging.WARNING, "no file to send %d orphaned hops from" % (len(orphans)))
+            return
 
+        while len(orphans) > 0:
+            pylantorrent.log(logging.INFO, "sending to %d orphaned hops" % (len(orphans)))
+            v_con_array = []
+            next = []
+            for (ent, run) in orphans:
+                try:
+                    v_con = LTDestConnection(ent, self)
+                    v_con.send_header(run, True, self.out_framing)
+                    v_con_array.append(v_con)
+                except LTException, vex:
+                    self.print_results(vex.get_printable())
+                    next = next + split_destinations(run, int(ent['degree']))
+            self._agree_framing(v_con_array)
+            offsets = []
+            for v_con in v_con_array:
+                o = v_con.read_offset(pylantorrent.config.offset_timeout)
+                if o != None:
+                    offsets.append(o)
+            if len(offsets) > 0:
+                start = min(offsets)
+                src = LTFileSource(path, start)
+                try:
+                    source = LTStreamSource(src, start, self.data_length)
+                    engine = LTForwarder(source, v_con_array, [], self.data_length, self.block_size, pylantorrent.config.buffer_blocks, start, resend_path=path)
+                    engine.run()
+                finally:
+                    src.close()
+                self._send_footer(v_con_array)
+            self.v_con_array = self.v_con_array + v_con_array
+            for v_con in v_con_array:
+                if v_con.failed and v_con.destinations:
+                    next = next + split_destinations(v_con.destinations, v_con.degree)
+            orphans = next
 
     def store_and_forward(self):
 
@@ -154,17 +372,31 @@ class LTServer(object):
         header = self.json_header
         requests_a = header['requests']
 
-        self._open_dest_files(requests_a)
         destinations = header['destinations']
         self._get_valid_vcons(destinations)
-        self._process_io()
+        offset = 0
+        if self.resume:
+            offset = self._agree_offset(requests_a)
+        md5er = self._get_md5er(requests_a, offset)
+        self._open_dest_files(requests_a, offset)
+        start = time.time()
+        self._process_io(requests_a, offset, md5er)
+        # what this hop got, the daemon keeps it to plan the next transfer
+        rate = (self.data_length - offset) / max(time.time() - start, 0.000001)
 
         # close all open files
         self._close_files()
+        # blocks that came again out of order are summed from the file
+        if self.md5str == None:
+            md5er = self._get_md5er(requests_a, self.data_length)
+            if md5er != None:
+                self.md5str = str(md5er.hexdigest()).strip()
         # read the footer from the sending machine
         self._read_footer()
         # send foot to all machines this is streaming to
-        self._send_footer()
+        self._send_footer(self.v_con_array)
+        # and the file again to those cut off by a hop that failed
+        self._repair(requests_a)
         # wait for eof and close
         self._close_connections()
         self._rename_files(requests_a)
@@ -173,7 +405,7 @@ class LTServer(object):
         # if we got to here it was successfully written to a file
         # and we can call it success.  Print out a success message for 
         # everyfile written
-        vex = LTException(0, "Success", header['host'], int(header['port']), requests_a, md5sum=self.md5str)
+        vex = LTException(0, "Success", header['host'], int(header['port']), requests_a, md5sum=self.md5str, rate=rate)
         s = vex.get_printable()
         self.print_results(s)
         self.clean_up()
@@ -188,6 +420,10 @@ class LTServer(object):
 
                 os.rename(tmpname, realname)
                 self.created_files.remove(tmpname)
+                try:
+                    os.remove(tmpname + ".state")
+                except:
+                    pass
 
 
 def main(argv=sys.argv[1:]):
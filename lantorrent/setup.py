@@ -25,6 +25,7 @@ setup(name='lantorrent',
             'ltserver = pylantorrent.server:main',
             'ltrequest = pylantorrent.request:main',
             'ltclient = pylantorrent.client:main',
+            'ltplan = pylantorrent.planner:main',
         ],
 
       },
@@ -0,0 +1,169 @@
+import os
+import json
+import unittest
+import tempfile
+import filecmp
+import StringIO
+import pylantorrent
+from pylantorrent.client import *
+from pylantorrent.server import *
+from pylantorrent.ltConnection import make_frame_header
+from pylantorrent.ltForward import LTFramedSource
+from forward_test import ThreadServer
+from resume_test import CountingClient
+
+#  keeps what the framed source says upstream
+class Printer(object):
+
+    def __init__(self):
+        self.lines = []
+        self.verified = None
+
+    def print_results(self, s):
+        self.lines.append(s)
+
+    def mark_verified(self, n):
+        self.verified = n
+
+
+class TestFramedSource(unittest.TestCase):
+
+    def _t_source(self, frames, length):
+        s = ""
+        for (offset, data, bad) in frames:
+            h = make_frame_header(offset, data)
+            if bad:
+                data = "x" + data[1:]
+            s = s + h + data
+        conn = LTSourceConnection(StringIO.StringIO(s))
+        conn.header = {'host' : "localhost", 'port' : 2893, 'requests' : []}
+        p = Printer()
+        return (LTFramedSource(conn, 0, length, p), p)
+
+    def test_resend(self):
+        (src, p) = self._t_source([(0, "aaaa", False), (4, "bbbb", True), (8, "cccc", False), (4, "bbbb", False)], 12)
+        self.assertEqual(src.next_block(4), (0, "aaaa"))
+        self.assertEqual(src.next_block(4), None)
+        self.assertEqual(p.lines, ["RESEND : 4 4\r\n"])
+        self.assertEqual(p.verified, 4)
+        self.assertEqual(src.next_block(4), (8, "cccc"))
+        self.assertFalse(src.done())
+        self.assertEqual(src.verified(), 4)
+        self.assertEqual(src.next_block(4), (4, "bbbb"))
+        self.assertTrue(src.done())
+        self.assertEqual(src.verified(), 12)
+
+    def test_gap(self):
+        # what the node above is still getting is waited for, not asked for
+        (src, p) = self._t_source([(0, "aaaa", False), (8, "cccc", False), (4, "bbbb", False)], 12)
+        src.next_block(4)
+        src.next_block(4)
+        self.assertEqual(p.lines, [])
+        self.assertEqual(src.verified(), 4)
+        self.assertEqual(src.next_block(4), (4, "bbbb"))
+        self.assertTrue(src.done())
+
+    def test_lost_frame(self):
+        (src, p) = self._t_source([(0, "aaaa", False)], 12)
+        src.conn.inf = StringIO.StringIO("nonsense" * 10)
+        self.assertRaises(LTException, src.next_block, 4)
+
+
+class TestChecksum(unittest.TestCase):
+
+    def setUp(self):
+        (osf, self.src_file) = tempfile.mkstemp()
+        os.write(osf, os.urandom(4*1024*1024 + 17))
+        os.close(osf)
+        self.src_size = os.path.getsize(self.src_file)
+        self.files = [self.src_file]
+
+    def tearDown(self):
+        for f in self.files:
+            for n in [f, f + ".lantorrent", f + ".lantorrent.state"]:
+                try:
+                    os.remove(n)
+                except:
+                    pass
+
+    def _t_new_dest(self, port):
+        (osf, fname) = tempfile.mkstemp()
+        os.close(osf)
+        self.files.append(fname)
+        return (fname, pylantorrent.create_endpoint_entry("localhost", [fname], self.src_size, port=port))
+
+    def _t_send(self, servers, framing):
+        dests = []
+        fnames = []
+        for s in servers:
+            (fname, ent) = self._t_new_dest(s.port)
+            dests.append(ent)
+            fnames.append(fname)
+        final = pylantorrent.create_endpoint_entry("localhost", ["/dev/null"], self.src_size, rename=False)
+        final['destinations'] = dests
+        c = CountingClient(self.src_file, final)
+        v = LTServer(c, c, framing=framing)
+        v.store_and_forward()
+        for s in servers:
+            s.join()
+        c.close()
+        c.check_sum()
+        self.assertEqual(len(c.get_incomplete()), 0)
+        for f in fnames:
+            self.assertTrue(filecmp.cmp(self.src_file, f, shallow=False))
+        return c
+
+    def test_framed_chain(self):
+        servers = [ThreadServer(), ThreadServer()]
+        self._t_send(servers, True)
+
+    def test_raw_chain(self):
+        servers = [ThreadServer(), ThreadServer()]
+        self._t_send(servers, False)
+
+    def test_old_hop(self):
+        # the old hop is sent the data raw and so is the one under it
+        servers = [ThreadServer(), ThreadServer(old=True), ThreadServer()]
+        old_timeout = pylantorrent.config.framing_timeout
+        pylantorrent.config.framing_timeout = 1
+        try:
+            self._t_send(servers, True)
+        finally:
+            pylantorrent.config.framing_timeout = old_timeout
+
+    def test_bad_block_first_hop(self):
+        # the block is sent again from what the root still holds, the
+        # source is read only once
+        servers = [ThreadServer(corrupt_at=300000), ThreadServer()]
+        c = self._t_send(servers, True)
+        self.assertTrue(servers[0].corrupted)
+        self.assertEqual(c.data_read, self.src_size)
+
+    def test_bad_block_middle_hop(self):
+        servers = [ThreadServer(), ThreadServer(corrupt_at=1000000), ThreadServer()]
+        c = self._t_send(servers, True)
+        self.assertTrue(servers[1].corrupted)
+        self.assertEqual(c.data_read, self.src_size)
+
+    def test_bad_old_block_middle_hop(self):
+        # the first hop has long sent the block on when it is asked for
+        # again, it is read back from its file
+        servers = [ThreadServer(), ThreadServer(delay=0.01, corrupt_at=1000000), ThreadServer()]
+        old_blocks = pylantorrent.config.buffer_blocks
+        pylantorrent.config.buffer_blocks = 1
+        try:
+            self._t_send(servers, True)
+        finally:
+            pylantorrent.config.buffer_blocks = old_blocks
+        self.assertTrue(servers[1].corrupted)
+
+    def test_resume_stops_at_hole(self):
+        (f1, e1) = self._t_new_dest(0)
+        rid = e1['requests'][0]['id']
+        f = open(f1 + ".lantorrent", "wb")
+        f.write("x" * 1000)
+        f.close()
+        f = open(f1 + ".lantorrent.state", "w")
+        f.write(json.dumps({'id' : rid, 'length' : self.src_size, 'verified' : 200}))
+        f.close()
+        self.assertEqual(get_resume_offset(f1 + ".lantorrent", rid, self.src_size), 200)
@@ -0,0 +1,203 @@
+import os
+import time
+import socket
+import threading
+import unittest
+import tempfile
+import filecmp
+import pylantorrent
+from pylantorrent.client import *
+from pylantorrent.server import *
+from pylantorrent.ltForward import LTRingBuffer
+
+#  a server from before resume and framing, it reads the header as if
+#  they were not there
+class OldServer(LTServer):
+
+    def _read_header(self):
+        header = self.source_conn.read_header()
+        header.pop('resume', None)
+        header.pop('framing', None)
+        LTServer._read_header(self)
+
+#  lantorrent servers run in threads of this process, each accepts count
+#  transfers one after the other on a port of its own.  fail_after makes
+#  the first one die once it has read that many bytes, corrupt_at flips a
+#  bit of the byte at that place in the data of the first one.  old ones
+#  are OldServers
+class ThreadServer(object):
+
+    def __init__(self, delay=0.0, drop=False, count=1, fail_after=None, corrupt_at=None, old=False):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("localhost", 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+        self.delay = delay
+        self.drop = drop
+        self.count = count
+        self.fail_after = fail_after
+        self.corrupt_at = corrupt_at
+        self.corrupted = False
+        self.old = old
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        for i in range(self.count):
+            (conn, addr) = self.sock.accept()
+            self.serve(conn)
+            self.fail_after = None
+            self.corrupt_at = None
+        self.sock.close()
+
+    def serve(self, conn):
+        if self.drop:
+            conn.close()
+            return
+        inf = SlowFile(conn.makefile("r"), self.delay, self.fail_after, self.corrupt_at)
+        outf = conn.makefile("w")
+        if self.old:
+            v = OldServer(inf, outf)
+        else:
+            v = LTServer(inf, outf)
+        try:
+            v.store_and_forward()
+        except LTException, ve:
+            v.print_results(ve.get_printable())
+            v.clean_up()
+        except Exception, ex:
+            v.print_results(LTException(500, str(ex)).get_printable())
+            v.clean_up()
+        if inf.corrupted:
+            self.corrupted = True
+        outf.close()
+        inf.close()
+        conn.shutdown(socket.SHUT_RDWR)
+        conn.close()
+
+    def join(self):
+        self.thread.join(30)
+
+
+class SlowFile(object):
+
+    def __init__(self, f, delay, fail_after=None, corrupt_at=None):
+        self.f = f
+        self.delay = delay
+        self.fail_after = fail_after
+        self.corrupt_at = corrupt_at
+        self.corrupted = False
+        self.count = 0
+
+    def readline(self):
+        return self.f.readline()
+
+    def read(self, bs=-1):
+        if self.delay > 0:
+            time.sleep(self.delay)
+        if self.fail_after != None:
+            if self.fail_after <= 0:
+                raise Exception("failing on purpose")
+            bs = min(bs, self.fail_after)
+            self.fail_after = self.fail_after - bs
+        d = self.f.read(bs)
+        n = self.count
+        self.count = self.count + len(d)
+        if self.corrupt_at != None and n <= self.corrupt_at < self.count:
+            i = self.corrupt_at - n
+            d = d[:i] + chr(ord(d[i]) ^ 0x10) + d[i + 1:]
+            self.corrupt_at = None
+            self.corrupted = True
+        return d
+
+    def close(self):
+        self.f.close()
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_ring(self):
+        r = LTRingBuffer(10)
+        self.assertTrue(r.has_room(100))
+        r.push("abcdef")
+        self.assertTrue(r.has_room(4))
+        self.assertFalse(r.has_room(5))
+        r.push("ghij")
+        self.assertEqual(len(r), 10)
+        r.consume(4)
+        self.assertEqual(str(r.peek()), "ef")
+        r.consume(2)
+        self.assertEqual(str(r.peek()), "ghij")
+        self.assertEqual(len(r), 4)
+        r.clear()
+        self.assertEqual(len(r), 0)
+
+
+class TestForward(unittest.TestCase):
+
+    def setUp(self):
+        # big enough to fill the socket buffers of a slow hop
+        (osf, self.src_file) = tempfile.mkstemp()
+        os.write(osf, os.urandom(4*1024*1024 + 17))
+        os.close(osf)
+        self.src_size = os.path.getsize(self.src_file)
+        self.files = [self.src_file]
+
+    def tearDown(self):
+        for f in self.files:
+            try:
+                os.remove(f)
+            except:
+                pass
+
+    def _t_new_dest(self, port, degree=1):
+        (osf, fname) = tempfile.mkstemp()
+        os.close(osf)
+        self.files.append(fname)
+        ent = pylantorrent.create_endpoint_entry("localhost", [fname], self.src_size, port=port, degree=degree)
+        return (fname, ent)
+
+    def _t_send(self, servers, degree=1):
+        (local, final) = self._t_new_dest(0, degree)
+        dests = []
+        fnames = []
+        for s in servers:
+            (fname, ent) = self._t_new_dest(s.port)
+            dests.append(ent)
+            fnames.append(fname)
+        final['destinations'] = dests
+        c = LTClient(self.src_file, final)
+        v = LTServer(c, c)
+        v.store_and_forward()
+        for s in servers:
+            s.join()
+        c.close()
+        self.assertTrue(filecmp.cmp(self.src_file, local, shallow=False))
+        return (c, fnames)
+
+    def test_chain(self):
+        servers = [ThreadServer(), ThreadServer(), ThreadServer()]
+        (c, fnames) = self._t_send(servers)
+        c.check_sum()
+        self.assertEqual(len(c.get_incomplete()), 0)
+        for f in fnames:
+            self.assertTrue(filecmp.cmp(self.src_file, f, shallow=False))
+
+    def test_slow_fanout(self):
+        # one slow hop does not lose data for the fast one
+        servers = [ThreadServer(delay=0.002), ThreadServer()]
+        (c, fnames) = self._t_send(servers, degree=2)
+        c.check_sum()
+        self.assertEqual(len(c.get_incomplete()), 0)
+        for f in fnames:
+            self.assertTrue(filecmp.cmp(self.src_file, f, shallow=False))
+
+    def test_dead_hop(self):
+        # a hop that goes away is reported, its sibling still gets the file
+        servers = [ThreadServer(drop=True), ThreadServer()]
+        (c, fnames) = self._t_send(servers, degree=2)
+        es = c.get_incomplete()
+        self.assertEqual(len(es), 1)
+        self.assertTrue(filecmp.cmp(self.src_file, fnames[1], shallow=False))
@@ -0,0 +1,139 @@
+import os
+import unittest
+import tempfile
+import filecmp
+import pylantorrent
+from pylantorrent.client import *
+from pylantorrent.server import *
+from pylantorrent.planner import *
+from pylantorrent.planner import _runs, _layout
+from forward_test import ThreadServer
+
+
+class TestPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self.size = 1024*1024*1024
+        (osf, self.links_file) = tempfile.mkstemp()
+        os.close(osf)
+
+    def tearDown(self):
+        os.remove(self.links_file)
+
+    def _t_links(self, lines, uplink_mbps=0.0):
+        f = open(self.links_file, "w")
+        f.write("# host mbps rack\n")
+        for l in lines:
+            f.write(l + "\n")
+        f.close()
+        return LTLinks(self.links_file, uplink_mbps=uplink_mbps)
+
+    def _t_dests(self, n):
+        dests = []
+        for i in range(n):
+            dests.append(pylantorrent.create_endpoint_entry("host%02d" % (i), ["/tmp/x"], self.size))
+        return dests
+
+    def _t_header(self):
+        return pylantorrent.create_endpoint_entry("localhost", ["/dev/null"], self.size, rename=False)
+
+    def _t_parents(self, header):
+        parents = {}
+        for n in decode_plan(header).walk():
+            for c in n.children:
+                parents[c.entry['host']] = n.entry['host']
+        return parents
+
+    def test_runs(self):
+        self.assertEqual(_runs(0, 2), [])
+        self.assertEqual(_runs(1, 2), [0])
+        self.assertEqual(_runs(7, 2), [3, 2])
+        self.assertEqual(_runs(9, 3), [2, 2, 2])
+
+    def test_round_trip(self):
+        links = self._t_links([])
+        root = _layout(self._t_dests(13), links, 2, 3, True)
+        header = self._t_header()
+        header['degree'] = 2
+        header['destinations'] = encode_plan(root)
+        self.assertEqual(len(header['destinations']), 13)
+        back = decode_plan(header)
+        a = [n.entry['host'] for n in list(root.walk())[1:]]
+        b = [n.entry['host'] for n in list(back.walk())[1:]]
+        self.assertEqual(a, b)
+
+    def test_slow_host_is_a_leaf(self):
+        links = self._t_links(["host03 100"])
+        (header, t) = plan(self._t_header(), self._t_dests(16), links)
+        parents = self._t_parents(header)
+        self.assertEqual(len(parents), 16)
+        self.assertTrue("host03" not in parents.values())
+        # better than the chain sorted by name
+        chain = self._t_header()
+        chain['destinations'] = self._t_dests(16)
+        (ct, times) = simulate(chain, links)
+        self.assertTrue(t < ct)
+
+    def test_all_fast_is_a_chain(self):
+        links = self._t_links([])
+        (header, t) = plan(self._t_header(), self._t_dests(8), links)
+        self.assertEqual(header['degree'], 1)
+        for d in header['destinations']:
+            self.assertEqual(d['degree'], 1)
+
+    def test_racks(self):
+        lines = []
+        for i in range(12):
+            lines.append("host%02d 1000 rack%d" % (i, i % 3))
+        links = self._t_links(lines, uplink_mbps=1000)
+        (header, t) = plan(self._t_header(), self._t_dests(12), links)
+        parents = self._t_parents(header)
+        cross = 0
+        for (c, p) in parents.items():
+            if p != "localhost" and links.rack(c) != links.rack(p):
+                cross = cross + 1
+        self.assertTrue(cross <= 2, "%d links leave their rack" % (cross))
+
+
+class TestPlannedXfer(unittest.TestCase):
+
+    def setUp(self):
+        self.src_file = "/etc/group"
+        self.src_size = os.path.getsize(self.src_file)
+        self.files = []
+
+    def tearDown(self):
+        for f in self.files:
+            os.remove(f)
+
+    def _t_new_dest(self, port):
+        (osf, fname) = tempfile.mkstemp()
+        os.close(osf)
+        self.files.append(fname)
+        return (fname, pylantorrent.create_endpoint_entry("localhost", [fname], self.src_size, port=port))
+
+    def test_tree(self):
+        # seven servers as a tree of degree 2 all get the file
+        servers = []
+        dests = []
+        fnames = []
+        for i in range(7):
+            s = ThreadServer()
+            (fname, ent) = self._t_new_dest(s.port)
+            ent['degree'] = 2
+            servers.append(s)
+            dests.append(ent)
+            fnames.append(fname)
+        (local, final) = self._t_new_dest(0)
+        final['degree'] = 2
+        final['destinations'] = dests
+        c = LTClient(self.src_file, final)
+        v = LTServer(c, c)
+        v.store_and_forward()
+        for s in servers:
+            s.join()
+        c.close()
+        c.check_sum()
+        self.assertEqual(len(c.get_incomplete()), 0)
+        for f in fnames:
+            self.assertTrue(filecmp.cmp(self.src_file, f, shallow=False))
@@ -0,0 +1,207 @@
+import os
+import time
+import uuid
+import threading
+import unittest
+import StringIO
+import sys
+import tempfile
+import filecmp
+import pylantorrent
+import pylantorrent.request
+from pylantorrent.ltQueue import *
+from pylantorrent.daemon import do_it_live
+from forward_test import ThreadServer
+
+
+class TestQueue(unittest.TestCase):
+
+    def setUp(self):
+        (osf, self.dbfile) = tempfile.mkstemp()
+        os.close(osf)
+        os.remove(self.dbfile)
+        self.src_file = "/etc/group"
+
+    def tearDown(self):
+        for n in [self.dbfile, self.dbfile + "-wal", self.dbfile + "-shm"]:
+            try:
+                os.remove(n)
+            except:
+                pass
+
+    def _t_queue(self, batch_min=0.2, batch_max=30.0, retry_delay=0.1):
+        return LTRequestQueue(open_journal(self.dbfile), batch_min, batch_max, retry_delay)
+
+    def _t_submit(self, q, n, group=None, src=None):
+        if src == None:
+            src = self.src_file
+        rids = []
+        for i in range(n):
+            rid = str(uuid.uuid1())
+            q.submit(LTRequest(rid, src, "/tmp/%s" % (rid), "localhost", 2893), group)
+            rids.append(rid)
+        return rids
+
+    def test_wal(self):
+        con = open_journal(self.dbfile)
+        self.assertEqual(con.execute("pragma journal_mode").fetchone()[0], "wal")
+
+    def test_full_group_closes_early(self):
+        q = self._t_queue(batch_min=10.0)
+        rids = self._t_submit(q, 3, group=3)
+        start = time.time()
+        rows = q.next_group(5)
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEqual(sorted([r[4] for r in rows]), sorted(rids))
+
+    def test_quiet_window(self):
+        q = self._t_queue(batch_min=0.3)
+        self._t_submit(q, 1)
+        self.assertEqual(q.next_group(0.1), None)
+        rows = q.next_group(5)
+        self.assertEqual(len(rows), 1)
+
+    def test_window_grows(self):
+        # requests that come in slowly are still one group
+        q = self._t_queue(batch_min=0.1)
+        def trickle():
+            for i in range(3):
+                time.sleep(0.15)
+                self._t_submit(q, 1)
+        self._t_submit(q, 1)
+        time.sleep(0.1)
+        self._t_submit(q, 1)
+        t = threading.Thread(target=trickle)
+        t.start()
+        rows = q.next_group(5)
+        t.join()
+        self.assertTrue(len(rows) >= 4, "%d in the group" % (len(rows)))
+
+    def test_retry(self):
+        q = self._t_queue()
+        (ok, bad) = self._t_submit(q, 2, group=2)
+        rows = q.next_group(5)
+        q.finish(rows, {bad : {'id' : bad, 'message' : "failed"}})
+        self.assertEqual(q.status(ok), (True, 0, "Success"))
+        self.assertFalse(q.status(bad)[0])
+        for i in range(2):
+            rows = q.next_group(5)
+            self.assertEqual([r[4] for r in rows], [bad])
+            self.assertEqual(rows[0][5], i + 1)
+            q.finish(rows, {bad : {'id' : bad, 'message' : "failed"}})
+        (done, rc, message) = q.status(bad)
+        self.assertTrue(done)
+        self.assertEqual(rc, 1)
+        self.assertEqual(q.next_group(0.3), None)
+
+    def test_journal(self):
+        q = self._t_queue()
+        rids = self._t_submit(q, 2)
+        # a daemon that starts again has them
+        q2 = self._t_queue()
+        rows = q2.next_group(5)
+        self.assertEqual(sorted([r[4] for r in rows]), sorted(rids))
+
+    def test_cancel(self):
+        q = self._t_queue()
+        (a, b) = self._t_submit(q, 2)
+        self.assertTrue(q.cancel(a))
+        self.assertEqual(q.status(a)[:2], (True, 1))
+        rows = q.next_group(5)
+        self.assertEqual([r[4] for r in rows], [b])
+        self.assertFalse(q.cancel(b))
+
+    def test_cancel_last(self):
+        # the batch goes with its last request, nothing is left to wake for
+        q = self._t_queue()
+        (a,) = self._t_submit(q, 1)
+        self.assertTrue(q.cancel(a))
+        self.assertEqual(q.batches, {})
+        self.assertEqual(q.next_group(0.1), None)
+
+
+class TestQueueXfer(unittest.TestCase):
+
+    def setUp(self):
+        (osf, self.dbfile) = tempfile.mkstemp()
+        os.close(osf)
+        os.remove(self.dbfile)
+        self.path = self.dbfile + ".sock"
+        self.queue = LTRequestQueue(open_journal(self.dbfile), 0.2, 30.0, 0.1)
+        self.listener = LTQueueServer(self.queue, self.path)
+        self.listener.start()
+        self.old_path = pylantorrent.config.queue_socket
+        pylantorrent.config.queue_socket = self.path
+        self.src_file = "/etc/group"
+        self.files = []
+
+    def tearDown(self):
+        pylantorrent.config.queue_socket = self.old_path
+        self.listener.stop()
+        for n in self.files + [self.dbfile, self.dbfile + "-wal", self.dbfile + "-shm"]:
+            try:
+                os.remove(n)
+            except:
+                pass
+
+    # one pass of the daemon loop
+    def _t_daemon(self, count=1):
+        con = open_journal(self.dbfile)
+        for i in range(count):
+            rows = self.queue.next_group(10)
+            es = do_it_live(con, rows)
+            self.queue.finish(rows, es)
+
+    def test_await(self):
+        servers = [ThreadServer(count=2)]
+        t = threading.Thread(target=self._t_daemon)
+        t.start()
+        c = LTQueueClient(self.path)
+        rids = []
+        for i in range(2):
+            (osf, fname) = tempfile.mkstemp()
+            os.close(osf)
+            self.files.append(fname)
+            rid = str(uuid.uuid1())
+            r = c.call({'cmd' : "submit", 'rid' : rid, 'src' : self.src_file, 'dst' : fname, 'host' : "localhost", 'port' : servers[0].port, 'group' : 2})
+            self.assertEqual(r['rc'], 0)
+            rids.append(rid)
+        for rid in rids:
+            r = c.call({'cmd' : "await", 'rid' : rid})
+            self.assertTrue(r['done'])
+            self.assertEqual(r['rc'], 0, r['message'])
+        c.close()
+        t.join()
+        for f in self.files:
+            self.assertTrue(filecmp.cmp(self.src_file, f, shallow=False))
+
+    def test_request_main(self):
+        servers = [ThreadServer()]
+        t = threading.Thread(target=self._t_daemon)
+        t.start()
+        (osf, fname) = tempfile.mkstemp()
+        os.close(osf)
+        self.files.append(fname)
+        rid = str(uuid.uuid1())
+        rc = pylantorrent.request.main(["-g", "1", self.src_file, fname, rid, "localhost:%d" % (servers[0].port)])
+        self.assertEqual(rc, 0)
+        t.join()
+        self.assertTrue(filecmp.cmp(self.src_file, fname, shallow=False))
+        # it is forgotten once the result is had
+        self.assertEqual(self.queue.status(rid)[:2], (True, 1))
+
+    def test_request_refused(self):
+        # the caller gets the error on stdout, the exit code is always 0
+        rid = str(uuid.uuid1())
+        args = ["-n", self.src_file, "/tmp/%s" % (rid), rid, "localhost:2893"]
+        self.assertEqual(pylantorrent.request.main(args), 0)
+        old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            rc = pylantorrent.request.main(args)
+            out = sys.stdout.getvalue()
+        finally:
+            sys.stdout = old_stdout
+        self.assertEqual(rc, 0)
+        self.assertEqual(out.split(",")[:2], ["1", "True"])
+        self.queue.cancel(rid)
@@ -0,0 +1,190 @@
+import os
+import json
+import unittest
+import tempfile
+import filecmp
+import pylantorrent
+from pylantorrent.client import *
+from pylantorrent.server import *
+from forward_test import ThreadServer
+
+#  counts what is read of the source file
+class CountingClient(LTClient):
+
+    def __init__(self, filename, json_header):
+        LTClient.__init__(self, filename, json_header)
+        self.data_read = 0
+
+    def read(self, blocksize=1):
+        d = LTClient.read(self, blocksize)
+        if self.file_data and d:
+            self.data_read = self.data_read + len(d)
+        return d
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        (osf, self.src_file) = tempfile.mkstemp()
+        os.write(osf, os.urandom(4*1024*1024 + 17))
+        os.close(osf)
+        self.src_size = os.path.getsize(self.src_file)
+        self.files = [self.src_file]
+
+    def tearDown(self):
+        for f in self.files:
+            for n in [f, f + ".lantorrent", f + ".lantorrent.state"]:
+                try:
+                    os.remove(n)
+                except:
+                    pass
+
+    def _t_new_dest(self, port):
+        (osf, fname) = tempfile.mkstemp()
+        os.close(osf)
+        os.remove(fname)
+        self.files.append(fname)
+        ent = pylantorrent.create_endpoint_entry("localhost", [fname], self.src_size, port=port)
+        return (fname, ent)
+
+    def _t_partial(self, ent, n, rid=None):
+        fname = ent['requests'][0]['filename'] + ".lantorrent"
+        src = open(self.src_file, "rb")
+        f = open(fname, "wb")
+        f.write(src.read(n))
+        f.close()
+        src.close()
+        if rid == None:
+            rid = ent['requests'][0]['id']
+        f = open(fname + ".state", "w")
+        f.write(json.dumps({'id' : rid, 'length' : self.src_size}))
+        f.close()
+
+    def _t_root(self):
+        final = pylantorrent.create_endpoint_entry("localhost", ["/dev/null"], self.src_size, rename=False)
+        return final
+
+    def test_offset(self):
+        (f1, e1) = self._t_new_dest(0)
+        self.assertEqual(get_resume_offset(f1 + ".lantorrent", e1['requests'][0]['id'], self.src_size), 0)
+        self._t_partial(e1, 1000)
+        self.assertEqual(get_resume_offset(f1 + ".lantorrent", e1['requests'][0]['id'], self.src_size), 1000)
+        self.assertEqual(get_resume_offset(f1 + ".lantorrent", "other", self.src_size), 0)
+        self.assertEqual(get_resume_offset(f1 + ".lantorrent", e1['requests'][0]['id'], self.src_size + 1), 0)
+
+    def test_split(self):
+        d = range(9)
+        self.assertEqual(split_destinations(d, 2), [(0, [2, 3, 4, 5]), (1, [6, 7, 8])])
+        self.assertEqual(split_destinations([0], 2), [(0, [])])
+
+    def test_resume_chain(self):
+        # the least any hop has is where the data starts
+        servers = [ThreadServer(), ThreadServer()]
+        (f1, e1) = self._t_new_dest(servers[0].port)
+        (f2, e2) = self._t_new_dest(servers[1].port)
+        self._t_partial(e1, 3*1024*1024)
+        self._t_partial(e2, 1024*1024 + 5)
+        final = self._t_root()
+        final['destinations'] = [e1, e2]
+        final['resume'] = True
+        c = CountingClient(self.src_file, final)
+        v = LTServer(c, c)
+        v.store_and_forward()
+        for s in servers:
+            s.join()
+        c.close()
+        c.check_sum()
+        self.assertEqual(len(c.get_incomplete()), 0)
+        self.assertEqual(c.data_read, self.src_size - (1024*1024 + 5))
+        for f in [f1, f2]:
+            self.assertTrue(filecmp.cmp(self.src_file, f, shallow=False))
+            self.assertFalse(os.path.exists(f + ".lantorrent.state"))
+
+    def test_old_hop(self):
+        # a hop that does not say where it is gets it all, the others
+        # still get the data
+        servers = [ThreadServer(old=True), ThreadServer()]
+        (f1, e1) = self._t_new_dest(servers[0].port)
+        (f2, e2) = self._t_new_dest(servers[1].port)
+        self._t_partial(e2, 1024*1024)
+        final = self._t_root()
+        final['destinations'] = [e1, e2]
+        final['resume'] = True
+        c = CountingClient(self.src_file, final)
+        old_timeout = pylantorrent.config.offset_timeout
+        pylantorrent.config.offset_timeout = 1
+        try:
+            v = LTServer(c, c, framing=False)
+            v.store_and_forward()
+        finally:
+            pylantorrent.config.offset_timeout = old_timeout
+        for s in servers:
+            s.join()
+        c.close()
+        c.check_sum()
+        self.assertEqual(len(c.get_incomplete()), 0)
+        self.assertEqual(c.data_read, self.src_size)
+        for f in [f1, f2]:
+            self.assertTrue(filecmp.cmp(self.src_file, f, shallow=False))
+
+    def test_failed_hop_is_kept(self):
+        # what a hop got before its source went away is there to resume
+        servers = [ThreadServer(fail_after=1024*1024)]
+        (f1, e1) = self._t_new_dest(servers[0].port)
+        final = self._t_root()
+        final['destinations'] = [e1]
+        c = LTClient(self.src_file, final)
+        v = LTServer(c, c)
+        v.store_and_forward()
+        servers[0].join()
+        c.close()
+        self.assertEqual(len(c.get_incomplete()), 1)
+        rid = e1['requests'][0]['id']
+        self.assertEqual(get_resume_offset(f1 + ".lantorrent", rid, self.src_size), 1024*1024)
+
+    def test_bad_sum_is_not_kept(self):
+        # data that failed its checksum is not resumed from, the next
+        # attempt starts over
+        servers = [ThreadServer(count=2, corrupt_at=1000)]
+        (f1, e1) = self._t_new_dest(servers[0].port)
+        rid = e1['requests'][0]['id']
+        for resume in [False, True]:
+            final = self._t_root()
+            final['destinations'] = [e1]
+            final['resume'] = resume
+            c = CountingClient(self.src_file, final)
+            v = LTServer(c, c, framing=False)
+            v.store_and_forward()
+            c.close()
+            if not resume:
+                self.assertEqual(c.get_incomplete().keys(), [rid])
+                self.assertEqual(get_resume_offset(f1 + ".lantorrent", rid, self.src_size), 0)
+                self.assertFalse(os.path.exists(f1 + ".lantorrent"))
+        servers[0].join()
+        self.assertTrue(servers[0].corrupted)
+        self.assertEqual(len(c.get_incomplete()), 0)
+        self.assertEqual(c.data_read, self.src_size)
+        self.assertTrue(filecmp.cmp(self.src_file, f1, shallow=False))
+
+    def test_reparent(self):
+        # the first hop dies part way, the two under it are sent the rest
+        # by the root from where they stopped
+        servers = [ThreadServer(fail_after=512*1024), ThreadServer(count=2), ThreadServer(count=2)]
+        ents = []
+        fnames = []
+        for s in servers:
+            (f, e) = self._t_new_dest(s.port)
+            ents.append(e)
+            fnames.append(f)
+        final = self._t_root()
+        final['destinations'] = ents
+        c = CountingClient(self.src_file, final)
+        v = LTServer(c, c, repair_path=self.src_file)
+        v.store_and_forward()
+        for s in servers:
+            s.join()
+        c.close()
+        es = c.get_incomplete()
+        self.assertEqual(es.keys(), [ents[0]['requests'][0]['id']])
+        for f in fnames[1:]:
+            self.assertTrue(filecmp.cmp(self.src_file, f, shallow=False))
@@ -19,5 +19,5 @@ ltd_pid=$!
 
 trap "kill $xinet_pid $ltd_pid; sleep 10; kill -9 $xinet_pid $ltd_pid" EXIT
 source $LANTORRENT_HOME/tests/ports_env.sh
-nosetests tests/xfer_test.py  tests/simple_test.py
+nosetests tests/xfer_test.py  tests/simple_test.py tests/forward_test.py tests/planner_test.py tests/resume_test.py tests/checksum_test.py tests/queue_test.py
 